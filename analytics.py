@@ -0,0 +1,351 @@
+import argparse
+import atexit
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+from dotenv import load_dotenv
+import database
+import logging_config
+
+logger = logging.getLogger(__name__)
+
+# Daily rollups behind /admin_stats, kept up to date as things happen instead of
+# being computed from the licenses and transactions tables on request:
+#
+#   sales_daily      licenses issued and revenue (USD / XLM at the tier's list
+#                    price) per day, product and pricing tier; trials are tier
+#                    'trial' and earn nothing
+#   usage_daily      validations and refusals per day and product, licenses that
+#                    expired that day and a snapshot of the active count
+#   active_licenses  licenses per product that are active and not expired
+#
+# A sale is recorded when its license is stored (telegram_bot.issue_license, or
+# the purchase queue once the database is back). Validations are counted in
+# memory by every process that answers /validate and added to usage_daily every
+# STATS_FLUSH_INTERVAL seconds. The expiry sweeper, run by the poller leader
+# every STATS_SWEEP_INTERVAL seconds, counts the licenses whose expiry passed
+# since its last run and takes them off the active counts; its first run counts
+# the active licenses once. An /admin_stats answer therefore reads a few hundred
+# rollup rows, whatever the number of licenses.
+#
+# The rollups start when this is deployed: earlier sales are not in them. After
+# licenses were changed in bulk (an import, a restore) recount the active
+# licenses with
+#
+#   python analytics.py rebuild
+
+STATS_FLUSH_INTERVAL = float(os.getenv('STATS_FLUSH_INTERVAL', '10'))  # seconds
+STATS_SWEEP_INTERVAL = float(os.getenv('STATS_SWEEP_INTERVAL', '3600'))  # seconds
+# License key -> product mappings remembered per process, for validations
+# answered without a database lookup (license index, degraded answers)
+STATS_PRODUCT_CACHE_SIZE = int(os.getenv('STATS_PRODUCT_CACHE_SIZE', '50000'))
+
+# Product of validations for keys that do not exist
+UNKNOWN_PRODUCT = ''
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+# (day, product) -> [validations, refused]
+_counts = {}
+# (day, license_key) -> [validations, refused] of keys whose product is not known yet
+_unresolved = {}
+# license_key -> product, least recently used first
+_products = OrderedDict()
+_flusher_pid = None
+
+def today():
+    return date.today().isoformat()
+
+# --- sales ---------------------------------------------------------------------
+
+# (day, product, tier, revenue_usd, revenue_xlm) of a license issued now
+def sale(product_info, tier):
+    if tier == 'trial':
+        return [today(), product_info['name'], 'trial', 0, 0]
+    tier_info = product_info['pricing_tiers'][tier]
+    return [today(), product_info['name'], str(tier), tier_info['price_usd'], tier_info['price_xlm']]
+
+# The license is stored by then, so a failure here only costs the rollups one sale
+def record_sale(sale):
+    try:
+        database.record_sale(*sale)
+    except Exception as e:
+        logger.error("Could not add the sale of a %s license to the rollups: %s", sale[1], e)
+
+# --- validations ---------------------------------------------------------------
+
+def _remember(license_key, product):
+    _products[license_key] = product
+    _products.move_to_end(license_key)
+    if len(_products) > STATS_PRODUCT_CACHE_SIZE:
+        _products.popitem(last=False)
+
+# Counts one /validate answer. `license` is what the answer was based on: a
+# database row, the license index's record (no product) or None.
+def count_validation(outcome, license_key, status, license=None):
+    day = today()
+    refused = 1 if 400 <= status < 500 else 0
+    product = license.get('product') if license else None
+    with _lock:
+        if product is not None:
+            _remember(license_key, product)
+        elif outcome == 'invalid_key':
+            product = UNKNOWN_PRODUCT
+        elif license_key in _products:
+            product = _products[license_key]
+            _products.move_to_end(license_key)
+        elif len(_unresolved) >= STATS_PRODUCT_CACHE_SIZE:
+            product = UNKNOWN_PRODUCT
+        if product is None:
+            counts = _unresolved.setdefault((day, license_key), [0, 0])
+        else:
+            counts = _counts.setdefault((day, product), [0, 0])
+        counts[0] += 1
+        counts[1] += refused
+    if _flusher_pid != os.getpid():
+        _start_flusher()
+
+def _merge(target, source):
+    for key, (validations, refused) in source.items():
+        counts = target.setdefault(key, [0, 0])
+        counts[0] += validations
+        counts[1] += refused
+
+# Adds the counts so far to usage_daily; on failure they are kept for the next flush
+def flush():
+    global _counts, _unresolved
+    with _flush_lock:
+        with _lock:
+            counts, _counts = _counts, {}
+            unresolved, _unresolved = _unresolved, {}
+        if unresolved:
+            try:
+                licenses = database.get_licenses(sorted({license_key for _, license_key in unresolved}))
+            except Exception as e:
+                logger.warning("Could not look up the products of %d validated keys: %s", len(unresolved), e)
+                with _lock:
+                    _merge(_unresolved, unresolved)
+            else:
+                with _lock:
+                    for license_key, license in licenses.items():
+                        _remember(license_key, license['product'])
+                for (day, license_key), values in unresolved.items():
+                    product = licenses[license_key]['product'] if license_key in licenses else UNKNOWN_PRODUCT
+                    _merge(counts, {(day, product): values})
+        if not counts:
+            return
+        try:
+            database.get_store().add_usage([(day, product, validations, refused)
+                                            for (day, product), (validations, refused) in sorted(counts.items())])
+        except Exception as e:
+            logger.warning("Could not add %d validation counts to the rollups: %s", len(counts), e)
+            with _lock:
+                _merge(_counts, counts)
+
+def _run_flusher():
+    while True:
+        time.sleep(STATS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception:
+            logger.exception("Flushing validation counts failed")
+
+# Started by the first count of each process, so forked workers get their own
+def _start_flusher():
+    global _flusher_pid
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        if _flusher_pid is None:
+            atexit.register(flush)
+        _flusher_pid = os.getpid()
+        threading.Thread(target=_run_flusher, name="stats-flusher", daemon=True).start()
+
+# --- expiry sweeper ------------------------------------------------------------
+
+def _count_licenses(store, where, key):
+    counts = {}
+    for row, _ in store.stream_rows('licenses', ('license_key', 'product', 'expiry'), where=where):
+        counts[key(row)] = counts.get(key(row), 0) + 1
+    return counts
+
+# Counts the active licenses from scratch and restarts the sweep from today;
+# returns their number
+def rebuild_active(store=None):
+    store = store or database.get_store()
+    active = store.rebuild_active_licenses(today())
+    logger.info("Counted %d active licenses of %d products", sum(active.values()), len(active))
+    return sum(active.values())
+
+# A license stops validating when its expiry date begins, so a sweep on day D
+# counts the licenses with an expiry after the last sweep's day and up to D.
+# Returns the number of licenses that expired.
+def sweep_expired(store=None):
+    store = store or database.get_store()
+    previous = store.expiry_swept_through()
+    if previous is None:
+        rebuild_active(store)
+        return 0
+    through = today()
+    if previous >= through:
+        return 0
+    # Both dates are ours, checked before they go into the SQL
+    where = f"active = TRUE AND expiry > '{date.fromisoformat(previous).isoformat()}' AND expiry <= '{through}'"
+    expired = _count_licenses(store, where, lambda row: (row[2], row[1]))
+    if not store.apply_expiry_sweep(previous, through, expired):
+        logger.info("Expired licenses were swept by another process")
+        return 0
+    logger.info("Swept %d licenses that expired after %s through %s", sum(expired.values()), previous, through)
+    return sum(expired.values())
+
+# --- /admin_stats ----------------------------------------------------------------
+
+RANGE_HELP = "today, 7d, 30d, month (this month so far), YYYY-MM, YYYY-MM-DD or YYYY-MM-DD..YYYY-MM-DD"
+
+# (first, last) days of a range (see RANGE_HELP); ValueError if it is not one
+def parse_range(text=None, now=None):
+    now = now or date.today()
+    text = (text or 'month').strip().lower()
+    if text == 'today':
+        return now, now
+    if text == 'month':
+        return now.replace(day=1), now
+    days = re.fullmatch(r'(\d+)d', text)
+    if days:
+        if not 1 <= int(days.group(1)) <= 3660:
+            raise ValueError(f"Invalid number of days in {text!r}")
+        return now - timedelta(days=int(days.group(1)) - 1), now
+    if re.fullmatch(r'\d{4}-\d{2}', text):
+        first = date.fromisoformat(f"{text}-01")
+        return first, (first + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    if '..' in text:
+        first, last = (date.fromisoformat(part.strip()) for part in text.split('..', 1))
+        if first > last:
+            raise ValueError(f"{first} is after {last}")
+        return first, last
+    day = date.fromisoformat(text)
+    return day, day
+
+# Rollup rows of a range, as read by /admin_stats
+def report(first, last):
+    return {
+        'first': first.isoformat(),
+        'last': last.isoformat(),
+        'sales': database.sales_rollup(first.isoformat(), last.isoformat()),
+        'usage': database.usage_rollup(first.isoformat(), last.isoformat()),
+        'active': database.active_license_counts(),
+    }
+
+def format_report(report):
+    products = {}
+
+    def totals(product):
+        return products.setdefault(product, {'sold': 0, 'trials': 0, 'usd': 0.0, 'xlm': 0.0, 'validations': 0, 'refused': 0, 'expired': 0})
+
+    for _, product, tier, licenses, usd, xlm in report['sales']:
+        entry = totals(product)
+        entry['trials' if tier == 'trial' else 'sold'] += licenses
+        entry['usd'] += usd
+        entry['xlm'] += xlm
+    for _, product, validations, refused, expired, _ in report['usage']:
+        entry = totals(product)
+        entry['validations'] += validations
+        entry['refused'] += refused
+        entry['expired'] += expired
+    for product in report['active']:
+        totals(product)
+    overall = {name: sum(entry[name] for entry in products.values())
+               for name in ('sold', 'trials', 'usd', 'xlm', 'validations', 'refused', 'expired')}
+
+    period = report['first'] if report['first'] == report['last'] else f"{report['first']} .. {report['last']}"
+    lines = [
+        f"Stats for {period}",
+        f"Licenses sold: {overall['sold']} (+{overall['trials']} trials)",
+        f"Revenue: ${overall['usd']:,.2f} / {overall['xlm']:,.2f} XLM",
+        f"Validations: {overall['validations']:,} ({overall['refused']:,} refused)",
+        f"Expired: {overall['expired']}",
+        f"Active now: {sum(report['active'].values())}",
+        "",
+        "By product:",
+    ]
+    for product, entry in sorted(products.items(), key=lambda item: (-item[1]['usd'], item[0])):
+        lines.append(
+            f"{product or '(unknown keys)'}: {entry['sold']} sold (+{entry['trials']} trials), "
+            f"${entry['usd']:,.2f} / {entry['xlm']:,.2f} XLM, {entry['validations']:,} validations "
+            f"({entry['refused']:,} refused), {entry['expired']} expired, {report['active'].get(product, 0)} active"
+        )
+    return "\n".join(lines)
+
+def _days(report):
+    first, last = date.fromisoformat(report['first']), date.fromisoformat(report['last'])
+    return [(first + timedelta(days=offset)).isoformat() for offset in range((last - first).days + 1)]
+
+def _bar_chart(pdf, x, y, width, height, title, days, values):
+    pdf.set_font('Arial', 'B', 11)
+    pdf.text(x, y - 3, title)
+    peak = max(values, default=0) or 1
+    pdf.set_font('Arial', '', 7)
+    pdf.text(x, y + 2, f"max {max(values, default=0):,.2f}".rstrip('0').rstrip('.'))
+    pdf.set_draw_color(150, 150, 150)
+    pdf.line(x, y + height, x + width, y + height)
+    pdf.set_fill_color(52, 101, 164)
+    bar = width / len(days)
+    for index, value in enumerate(values):
+        if value > 0:
+            bar_height = height * value / peak
+            pdf.rect(x + index * bar + bar * 0.1, y + height - bar_height, bar * 0.8, bar_height, 'F')
+    pdf.text(x, y + height + 4, days[0])
+    if len(days) > 1:
+        pdf.text(x + width - pdf.get_string_width(days[-1]), y + height + 4, days[-1])
+
+# One A4 page with a bar per day of licenses sold, revenue, validations and the
+# active licenses recorded by the sweeper. fpdf is imported here so processes
+# that only count validations never load it.
+def render_chart(report, path):
+    from fpdf import FPDF
+    days = _days(report)
+    index = {day: position for position, day in enumerate(days)}
+    sold, revenue, validations, active = ([0.0] * len(days) for _ in range(4))
+    for day, _, tier, licenses, usd, _ in report['sales']:
+        if tier != 'trial':
+            sold[index[day]] += licenses
+        revenue[index[day]] += usd
+    for day, _, day_validations, _, _, day_active in report['usage']:
+        validations[index[day]] += day_validations
+        active[index[day]] += day_active or 0
+
+    pdf = FPDF(orientation='L', unit='mm', format='A4')
+    pdf.add_page()
+    pdf.set_font('Arial', 'B', 14)
+    pdf.text(15, 15, f"License stats {report['first']} .. {report['last']}")
+    charts = (("Licenses sold", sold), ("Revenue (USD)", revenue),
+              ("Validations", validations), ("Active licenses", active))
+    for position, (title, values) in enumerate(charts):
+        _bar_chart(pdf, 15 + (position % 2) * 140, 32 + (position // 2) * 88, 125, 65, title, days, values)
+    pdf.output(path)
+    return path
+
+def main():
+    load_dotenv()
+    logging_config.setup_logging()
+    parser = argparse.ArgumentParser(description="Maintain and show the /admin_stats rollups.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('sweep', help="count the licenses that expired since the last sweep")
+    subparsers.add_parser('rebuild', help="recount the active licenses")
+    show_parser = subparsers.add_parser('show', help="print the stats of a range")
+    show_parser.add_argument('range', nargs='?', default='month', help=RANGE_HELP)
+    args = parser.parse_args()
+
+    if args.command == 'sweep':
+        print(f"{sweep_expired()} licenses expired since the last sweep")
+    elif args.command == 'rebuild':
+        print(f"{rebuild_active()} active licenses")
+    else:
+        print(format_report(report(*parse_range(args.range))))
+
+if __name__ == '__main__':
+    main()
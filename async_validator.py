@@ -0,0 +1,449 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import struct
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+from dotenv import load_dotenv
+import circuit_breaker
+import database
+import leases
+import license_index
+import logging_config
+import metrics
+import storage
+import validator
+
+# Asyncio validation server for clients that keep their connection open. It runs
+# alongside the Flask route (validator.py) and gives the same answers:
+#
+#   python async_validator.py --http-port 5001 --binary-port 5002
+#
+# HTTP: POST /validate (form-encoded, same bodies, status codes and X-License-*
+# headers as the Flask route, JSON on request) and GET /metrics over HTTP/1.1
+# keep-alive connections.
+#
+# Binary: frames of a 2-byte big-endian payload length followed by the payload,
+# on a persistent TCP connection:
+#   request   16-byte license key (the UUID's bytes) + 16-byte HWID (the 32 hex
+#             digits printed by get_hwid.py, as bytes)
+#   response  1-byte status (STATUS_CODES) + 4-byte lease + 4-byte next check,
+#             in seconds, big-endian (see leases.py; the lease is 0 unless valid)
+# Clients may send several requests without waiting; answers come back in
+# request order. Licenses bound to an HWID that is not 32 hex digits can only
+# use HTTP. Answers from the last known good state while the database is
+# unavailable (see validator.degraded_result) are valid (0) with a short lease,
+# or unavailable (9); over HTTP they carry X-License-Degraded.
+#
+# License lookups of all connections are batched: while lookups are running, new
+# ones queue up and go out together in the next query. With a PostgreSQL
+# DATABASE_URL and neither replicas nor shards they run on an asyncpg connection
+# pool, as do first HWID binds; otherwise on threads through
+# database.get_licenses, which routes them like every other read. Seat claims
+# (and, without the pool, binds) go through database.py on a thread. Licenses
+# the license index (LICENSE_INDEX_PATH) accepts are answered without a lookup.
+
+logger = logging.getLogger(__name__)
+
+STATUS_CODES = {
+    'valid': 0,
+    'invalid_key': 1,
+    'hwid_mismatch': 2,
+    'deactivated': 3,
+    'expired': 4,
+    'no_free_seat': 5,
+    'missing_params': 6,
+    'malformed': 7,
+    'error': 8,
+    'unavailable': 9,
+}
+REQUEST_FRAME_SIZE = 32
+RESPONSE_FRAME = struct.Struct('>HBII')
+ERROR = ('error', "Internal Server Error", 500)
+
+MAX_HEADER_BYTES = 8192
+MAX_BODY_BYTES = 4096
+# Keys per lookup query
+MAX_BATCH = 500
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 431: 'Request Header Fields Too Large', 500: 'Internal Server Error',
+                503: 'Service Unavailable'}
+
+# Collects the license lookups made during one pass of the event loop and
+# answers them with a single query; at most `concurrency` queries run at once,
+# and lookups made meanwhile wait for the next one. Lookups are answered by
+# calling back rather than through futures, which would cost a scheduled
+# callback per request.
+class LicenseBatcher:
+    def __init__(self, fetch, concurrency):
+        self._fetch = fetch
+        self._concurrency = concurrency
+        self._running = 0
+        self._pending = {}
+        self._scheduled = False
+
+    # callback(license, error) runs with the license (None if unknown) or the
+    # error of the query
+    def get(self, license_key, callback):
+        self._pending.setdefault(license_key, []).append(callback)
+        if not self._scheduled and self._running < self._concurrency:
+            self._scheduled = True
+            asyncio.get_running_loop().call_soon(self._dispatch)
+
+    def _dispatch(self):
+        self._scheduled = False
+        while self._pending and self._running < self._concurrency:
+            keys = list(itertools.islice(self._pending, MAX_BATCH))
+            batch = {key: self._pending.pop(key) for key in keys}
+            self._running += 1
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        licenses, error = {}, None
+        try:
+            licenses = await self._fetch(list(batch))
+        except Exception as e:
+            error = e
+        finally:
+            self._running -= 1
+        for license_key, callbacks in batch.items():
+            for callback in callbacks:
+                callback(licenses.get(license_key), error)
+        self._dispatch()
+
+def asyncpg_url(database_url):
+    # asyncpg only takes URLs, not libpq keyword strings
+    if database.replica_urls() or database.shard_urls():
+        return None
+    if urlsplit(database_url or '').scheme in ('postgres', 'postgresql'):
+        return database_url
+    return None
+
+class ValidationServer:
+    def __init__(self, pool_size):
+        self.pool_size = pool_size
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="validate-db")
+        self.pool = None
+        self.licenses = None
+
+    async def start(self):
+        url = asyncpg_url(os.getenv('DATABASE_URL'))
+        if url:
+            import asyncpg
+            self.pool = await asyncpg.create_pool(url, min_size=self.pool_size, max_size=self.pool_size,
+                                                  timeout=storage.DB_CONNECT_TIMEOUT,
+                                                  command_timeout=storage.DB_STATEMENT_TIMEOUT or None)
+            fetch = self._fetch_asyncpg
+        else:
+            fetch = self._fetch_threaded
+        self.licenses = LicenseBatcher(fetch, self.pool_size)
+        logger.info("License lookups on %s, %d connections", 'asyncpg' if self.pool else 'database.py threads', self.pool_size)
+
+    async def _fetch_asyncpg(self, license_keys):
+        return await database.breaker.call_async(self._query_licenses, license_keys)
+
+    async def _query_licenses(self, license_keys):
+        start = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                f"SELECT {', '.join(storage.LICENSE_COLUMNS)} FROM licenses WHERE license_key = ANY($1::text[])",
+                license_keys
+            )
+        metrics.DB_QUERY_LATENCY.labels('get_licenses').observe(time.perf_counter() - start)
+        return dict(storage.license_from_row(tuple(row)) for row in rows)
+
+    # storage.Storage.bind_hwid, then the check for a concurrent bind of
+    # validator.claim_machine
+    async def _bind_asyncpg(self, license_key, hwid):
+        start = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            bound = await conn.fetchval(
+                "UPDATE licenses SET hwid = $1, updated_at = NOW() "
+                "WHERE license_key = $2 AND (hwid IS NULL OR hwid = '') RETURNING TRUE",
+                hwid, license_key
+            )
+            current = None if bound else await conn.fetchval("SELECT hwid FROM licenses WHERE license_key = $1", license_key)
+        metrics.DB_QUERY_LATENCY.labels('bind_hwid').observe(time.perf_counter() - start)
+        if bound:
+            logger.info("Bound HWID to license %s", license_key)
+        elif current != hwid:
+            return validator.HWID_MISMATCH
+        return validator.VALID
+
+    async def _fetch_threaded(self, license_keys):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, database.get_licenses, license_keys)
+
+    # Validates as validator.validate does and calls reply((result, lease,
+    # next check)), right away or once the license has been looked up; ip is
+    # the client's, for the validation log
+    def validate(self, license_key, hwid, reply, ip=None):
+        start_time = time.perf_counter()
+        if not license_key or not hwid:
+            reply(self._answer(validator.MISSING_PARAMS, license_key, None, start_time, hwid, ip))
+            return
+        license = license_index.valid_license(license_key, hwid)
+        if license is not None:
+            reply(self._answer(validator.VALID, license_key, license, start_time, hwid, ip))
+            return
+
+        def looked_up(license, error):
+            if error is not None:
+                if circuit_breaker.is_outage(error):
+                    result, license = validator.degraded_result(license_key, hwid, error)
+                else:
+                    logger.error("License lookup for %s failed: %s", license_key, error)
+                    result = ERROR
+                reply(self._answer(result, license_key, license, start_time, hwid, ip))
+                return
+            try:
+                result = validator.check_license(license, hwid)
+            except Exception:
+                logger.exception("Validation of license %s failed", license_key)
+                result = ERROR
+            if result is None:
+                asyncio.ensure_future(self._claim(license_key, license, hwid, start_time, reply, ip))
+                return
+            if result is validator.VALID:
+                validator.remember_valid(license_key, hwid, license)
+            reply(self._answer(result, license_key, license, start_time, hwid, ip))
+        self.licenses.get(license_key, looked_up)
+
+    # Binds the HWID or claims a seat as validator.claim_machine does; first
+    # binds run on the pool when there is one, seat claims on a thread
+    async def _claim(self, license_key, license, hwid, start_time, reply, ip=None):
+        try:
+            if self.pool is not None and license['seats'] == 1:
+                result = await database.breaker.call_async(self._bind_asyncpg, license_key, hwid)
+            else:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, validator.claim_machine, license_key, license, hwid)
+        except Exception as e:
+            if circuit_breaker.is_outage(e):
+                result, license = validator.degraded_result(license_key, hwid, e)
+            else:
+                logger.exception("Validation of license %s failed", license_key)
+                result = ERROR
+        else:
+            if result is validator.VALID:
+                validator.remember_valid(license_key, hwid, license)
+        reply(self._answer(result, license_key, license, start_time, hwid, ip))
+
+    def _answer(self, result, license_key, license, start_time, hwid=None, ip=None):
+        lease, next_check = leases.grant(result[0], license_key, license if result[2] == 200 else None,
+                                         result in validator.DEGRADED_RESULTS)
+        validator.record_answer(result[0], license_key, result[2], start_time, lease, license, hwid, ip)
+        return result, lease, next_check
+
+# Answers of one connection, written in request order as they come in; the
+# answers that arrive during one pass of the event loop go out in one write
+class OrderedAnswers:
+    def __init__(self):
+        self.transport = None
+        self.ip = None
+        # [encoded answer or None while pending, close the connection after it]
+        self._queue = collections.deque()
+        self._flush_scheduled = False
+        # Set once an answer that closes the connection is queued; later
+        # requests on it are ignored
+        self.closing = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        peer = transport.get_extra_info('peername')
+        self.ip = peer[0] if isinstance(peer, tuple) else None
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self.closing = True
+
+    # Reserves the next place in the answer order; returns the function that
+    # fills it in with encode(answer)
+    def _expect(self, encode, close=False):
+        slot = [None, close]
+        self._queue.append(slot)
+        self.closing = self.closing or close
+
+        def reply(answer):
+            slot[0] = encode(answer)
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                asyncio.get_running_loop().call_soon(self._flush)
+        return reply
+
+    def _answer_now(self, data, close=False):
+        self._expect(lambda answer: answer, close)(data)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        chunks = []
+        close = False
+        while self._queue and self._queue[0][0] is not None and not close:
+            data, close = self._queue.popleft()
+            chunks.append(data)
+        if self.transport is None or not chunks:
+            return
+        self.transport.write(b''.join(chunks))
+        if close:
+            self.transport.close()
+            self.transport = None
+
+class BinaryProtocol(OrderedAnswers, asyncio.Protocol):
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+        self.buffer = bytearray()
+
+    def data_received(self, data):
+        self.buffer += data
+        while len(self.buffer) >= 2 and not self.closing:
+            length = int.from_bytes(self.buffer[:2], 'big')
+            if len(self.buffer) < 2 + length:
+                return
+            payload = bytes(self.buffer[2:2 + length])
+            del self.buffer[:2 + length]
+            if length != REQUEST_FRAME_SIZE:
+                self._answer_now(RESPONSE_FRAME.pack(9, STATUS_CODES['malformed'], 0, leases.next_check_seconds()), close=True)
+                return
+            key_bytes, hwid_bytes = payload[:16], payload[16:]
+            license_key = str(uuid.UUID(bytes=key_bytes)) if any(key_bytes) else None
+            hwid = hwid_bytes.hex() if any(hwid_bytes) else None
+            self.server.validate(license_key, hwid, self._expect(self._encode), self.ip)
+
+    @staticmethod
+    def _encode(answer):
+        result, lease, next_check = answer
+        outcome = 'valid' if result is validator.VALID_DEGRADED else result[0]
+        return RESPONSE_FRAME.pack(9, STATUS_CODES[outcome], lease or 0, next_check)
+
+class HTTPProtocol(OrderedAnswers, asyncio.Protocol):
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+        self.buffer = bytearray()
+
+    def data_received(self, data):
+        self.buffer += data
+        while not self.closing:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self.buffer) > MAX_HEADER_BYTES:
+                    self._error(431)
+                return
+            lines = bytes(self.buffer[:end]).decode('latin-1').split('\r\n')
+            try:
+                method, target, version = lines[0].split(' ')
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', '0'))
+            except ValueError:
+                self._error(400)
+                return
+            if 'transfer-encoding' in headers or length < 0:
+                self._error(400)
+                return
+            if length > MAX_BODY_BYTES:
+                self._error(413)
+                return
+            if len(self.buffer) < end + 4 + length:
+                return
+            body = bytes(self.buffer[end + 4:end + 4 + length])
+            del self.buffer[:end + 4 + length]
+            connection = headers.get('connection', '').lower()
+            keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+            self._request(method, target.split('?', 1)[0], headers, body, keep_alive)
+
+    def _request(self, method, path, headers, body, keep_alive):
+        if path == '/metrics' and method == 'GET':
+            content, content_type = metrics.render_metrics()
+            self._answer_now(http_response(200, content, content_type, {}, keep_alive), close=not keep_alive)
+        elif path == '/validate' and method == 'POST':
+            form = parse_qs(body.decode('utf-8', errors='replace'))
+            license_key = form.get('license_key', [None])[0]
+            hwid = form.get('hwid', [None])[0]
+            json_answer = wants_json(headers.get('accept', ''))
+            reply = self._expect(lambda answer: validate_http_response(answer, json_answer, keep_alive), close=not keep_alive)
+            self.server.validate(license_key, hwid, reply, self.ip)
+        elif path in ('/metrics', '/validate'):
+            self._answer_now(http_response(405, b"Method Not Allowed", 'text/plain', {}, keep_alive), close=not keep_alive)
+        else:
+            self._answer_now(http_response(404, b"Not Found", 'text/plain', {}, keep_alive), close=not keep_alive)
+
+    def _error(self, status):
+        self._answer_now(http_response(status, HTTP_REASONS[status].encode(), 'text/plain', {}, False), close=True)
+
+def http_response(status, body, content_type, headers, keep_alive):
+    lines = [f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Unknown')}",
+             f"Content-Type: {content_type}",
+             f"Content-Length: {len(body)}",
+             f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    lines.extend(f"{name}: {value}" for name, value in headers.items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body
+
+def validate_http_response(answer, json_answer, keep_alive):
+    result, lease, next_check = answer
+    headers = validator.lease_headers(lease, next_check, result in validator.DEGRADED_RESULTS)
+    if json_answer:
+        body = json.dumps(validator.answer_json(result, lease, next_check)).encode()
+        return http_response(result[2], body, 'application/json', headers, keep_alive)
+    return http_response(result[2], result[1].encode(), 'text/plain; charset=utf-8', headers, keep_alive)
+
+# Whether an Accept header prefers application/json over text/plain, as the
+# Flask route decides it
+def wants_json(accept):
+    quality = {}
+    for item in accept.split(','):
+        media_type, _, params = item.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality[media_type.strip().lower()] = q
+
+    def score(media_type):
+        for pattern in (media_type, media_type.split('/')[0] + '/*', '*/*'):
+            if pattern in quality:
+                return quality[pattern]
+        return 0.0
+    return score('application/json') > score('text/plain')
+
+async def serve(host, http_port, binary_port, pool_size):
+    server = ValidationServer(pool_size)
+    await server.start()
+    loop = asyncio.get_running_loop()
+    listeners = []
+    if http_port:
+        listeners.append(await loop.create_server(lambda: HTTPProtocol(server), host, http_port, reuse_address=True))
+        logger.info("Serving HTTP on %s:%d", host, http_port)
+    if binary_port:
+        listeners.append(await loop.create_server(lambda: BinaryProtocol(server), host, binary_port, reuse_address=True))
+        logger.info("Serving the binary protocol on %s:%d", host, binary_port)
+    await asyncio.gather(*(listener.serve_forever() for listener in listeners))
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Serve license validation over HTTP keep-alive and a binary protocol.")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--http-port', type=int, default=5001, help="0 disables HTTP")
+    parser.add_argument('--binary-port', type=int, default=5002, help="0 disables the binary protocol")
+    parser.add_argument('--pool-size', type=int, default=8, help="database connections (or lookup threads)")
+    args = parser.parse_args()
+    for url in [os.getenv('DATABASE_URL')] + database.replica_urls() + database.shard_urls():
+        if url:
+            logging_config.register_secret(urlsplit(url).password)
+    logging_config.setup_logging()
+    asyncio.run(serve(args.host, args.http_port, args.binary_port, args.pool_size))
+
+if __name__ == '__main__':
+    main()
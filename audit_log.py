@@ -0,0 +1,99 @@
+import json
+import logging
+import queue
+import threading
+import atexit
+import copy
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Admin actions are queued in memory and written to the admin_audit_log table
+# (created by storage.py) by a background thread.
+
+# Flush settings: events are written in one multi-row INSERT per batch
+AUDIT_FLUSH_INTERVAL = 2.0  # seconds
+AUDIT_BATCH_SIZE = 200
+AUDIT_MAX_PENDING = 10000  # events kept in memory while the database is unreachable
+
+_queue = queue.Queue()
+_store = None
+_flush_lock = threading.Lock()
+_flusher = None
+_stop = threading.Event()
+
+def product_entity(product_id):
+    return f"product:{product_id}"
+
+def license_entity(license_key):
+    return f"license:{license_key}"
+
+# Reduce two snapshots of a record to the keys that actually changed
+def diff(before, after):
+    before = before or {}
+    after = after or {}
+    changed = [key for key in set(before) | set(after) if before.get(key) != after.get(key)]
+    return ({key: before[key] for key in changed if key in before},
+            {key: after[key] for key in changed if key in after})
+
+# Queue an audit event; never blocks the caller on database I/O
+def record(actor, action, entity=None, before=None, after=None, message=None):
+    if _queue.qsize() >= AUDIT_MAX_PENDING:
+        logger.error("Audit queue full, dropping event %s on %s", action, entity)
+        return
+    _queue.put((datetime.now(), actor, action, entity, copy.deepcopy(before), copy.deepcopy(after), message, 'bot'))
+
+# Drain the queue into the database in batches; events are put back on failure
+def flush():
+    if _store is None:
+        return
+    with _flush_lock:
+        while True:
+            events = []
+            try:
+                while len(events) < AUDIT_BATCH_SIZE:
+                    events.append(_queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not events:
+                return
+            try:
+                _store.insert_audit_events(events)
+            except Exception as e:
+                logger.error("Failed to flush %d audit events: %s", len(events), e)
+                for event in events:
+                    _queue.put(event)
+                return
+
+def _run_flusher():
+    while not _stop.wait(AUDIT_FLUSH_INTERVAL):
+        flush()
+    flush()
+
+def start(store):
+    global _store, _flusher
+    _store = store
+    if _flusher is None:
+        _flusher = threading.Thread(target=_run_flusher, name="audit-log-flusher", daemon=True)
+        _flusher.start()
+        atexit.register(stop)
+
+def stop():
+    _stop.set()
+    if _flusher is not None and _flusher.is_alive():
+        _flusher.join(timeout=AUDIT_FLUSH_INTERVAL * 2)
+
+# Latest events, optionally for a single entity; pending events are flushed first
+def history(entity=None, limit=20):
+    flush()
+    return _store.audit_history(entity, limit)
+
+def format_event(event):
+    line = f"[{event['created_at'].strftime('%Y-%m-%d %H:%M:%S')}] User {event['actor']}: {event['action']}"
+    if event['entity']:
+        line += f" {event['entity']}"
+    if event['message']:
+        line += f" - {event['message']}"
+    if event['before'] or event['after']:
+        line += f"\n  {json.dumps(event['before'])} -> {json.dumps(event['after'])}"
+    return line
@@ -0,0 +1,82 @@
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime
+
+# Helpers shared by the benchmark scripts: latency summaries and JSON result files
+# that can be diffed between versions with `python -m benchmarks.common old.json new.json`.
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile
+    index = min(len(sorted_values), max(1, math.ceil(fraction * len(sorted_values)))) - 1
+    return sorted_values[index]
+
+def summarize(latencies, elapsed=None):
+    values = sorted(latencies)
+    summary = {
+        'count': len(values),
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else None,
+        'p50_ms': round(percentile(values, 0.50) * 1000, 3) if values else None,
+        'p95_ms': round(percentile(values, 0.95) * 1000, 3) if values else None,
+        'p99_ms': round(percentile(values, 0.99) * 1000, 3) if values else None,
+        'max_ms': round(values[-1] * 1000, 3) if values else None,
+    }
+    if elapsed:
+        summary['throughput_per_s'] = round(len(values) / elapsed, 1)
+    return summary
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return 'unknown'
+
+def write_results(name, config, results, output=None):
+    document = {
+        'benchmark': name,
+        'revision': git_revision(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'host': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'config': config,
+        'results': results,
+    }
+    text = json.dumps(document, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + "\n")
+        print(f"Results written to {output}")
+    else:
+        print(text)
+    return document
+
+# Print the relative change of every numeric leaf between two result files
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['benchmark']}: {old['revision']} -> {new['revision']}")
+
+    def walk(old_node, new_node, path):
+        if isinstance(old_node, dict) and isinstance(new_node, dict):
+            for key in sorted(set(old_node) & set(new_node)):
+                walk(old_node[key], new_node[key], f"{path}.{key}" if path else key)
+        elif isinstance(old_node, list) and isinstance(new_node, list):
+            for index, (old_item, new_item) in enumerate(zip(old_node, new_node)):
+                walk(old_item, new_item, f"{path}[{index}]")
+        elif isinstance(old_node, (int, float)) and isinstance(new_node, (int, float)) and not isinstance(old_node, bool):
+            change = f"{(new_node - old_node) / old_node * 100:+.1f}%" if old_node else "n/a"
+            print(f"  {path}: {old_node} -> {new_node} ({change})")
+
+    walk(old['results'], new['results'], '')
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: python -m benchmarks.common <old_results.json> <new_results.json>")
+        sys.exit(1)
+    compare(sys.argv[1], sys.argv[2])
@@ -0,0 +1,217 @@
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+import storage
+from benchmarks.common import summarize, write_results
+from benchmarks.validate_bench import category, hwid, license_key, seed
+
+# /validate and purchases through a PostgreSQL outage. The validators reach the
+# database through a TCP proxy started here, which can pass traffic, refuse
+# connections (--mode refuse: the server is down) or accept them and never
+# answer (--mode hang: the server or the network is stuck, so only the
+# timeouts end the calls). Phases:
+#
+#   healthy   --requests validations of bound licenses (and trials), which
+#             also fill the workers' last known good state
+#   outage    the same machines again, plus --unknown machines the validator has
+#             not seen; --purchases licenses are issued through the bot
+#   recovery  traffic passes again; validations continue until the circuit
+#             breaker has closed and the purchase queue is drained
+#
+# With --index, a license index is built before the outage; it answers the
+# healthy phase, so the per-worker state stays empty and the index, treated as
+# stale once the outage starts, has to carry the degraded answers on its own.
+#
+#   python -m benchmarks.db_outage --database-url postgresql://localhost/license_outage --mode hang
+#
+# Exits non-zero if a known machine is refused or errors during the outage, an
+# unknown one gets anything but 503, or a queued purchase is not stored after
+# recovery.
+
+class Proxy:
+    def __init__(self, target):
+        self.target = target
+        self.mode = 'up'
+        self.listener = socket.socket()
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(64)
+        self.port = self.listener.getsockname()[1]
+        self.connections = []
+        self.lock = threading.Lock()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    # Drops every open connection, as a crashed server or a cut network would
+    def set_mode(self, mode):
+        self.mode = mode
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for conn in connections:
+            conn.close()
+
+    def _accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            if self.mode == 'refuse':
+                client.close()
+                continue
+            with self.lock:
+                self.connections.append(client)
+            if self.mode == 'hang':
+                continue
+            if isinstance(self.target, str):
+                server = socket.socket(socket.AF_UNIX)
+            else:
+                server = socket.socket()
+            server.connect(self.target)
+            with self.lock:
+                self.connections.append(server)
+            for source, destination in ((client, server), (server, client)):
+                threading.Thread(target=self._pipe, args=(source, destination), daemon=True).start()
+
+    @staticmethod
+    def _pipe(source, destination):
+        try:
+            while True:
+                data = source.recv(65536)
+                if not data:
+                    break
+                destination.sendall(data)
+        except OSError:
+            pass
+        for conn in (source, destination):
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+def proxied_dsn(database_url):
+    from psycopg2.extensions import make_dsn, parse_dsn
+    params = parse_dsn(database_url)
+    host, port = params.get('host', 'localhost'), int(params.get('port', 5432))
+    target = f"{host}/.s.PGSQL.{port}" if host.startswith('/') else (host, port)
+    return target, lambda proxy_port: make_dsn(database_url, host='127.0.0.1', port=proxy_port)
+
+def run(client, machines, timings, outcomes):
+    for key, machine in machines:
+        start = time.perf_counter()
+        response = client.post('/validate', data={'license_key': key, 'hwid': machine})
+        timings.append(time.perf_counter() - start)
+        degraded = response.headers.get('X-License-Degraded') == '1'
+        outcomes[(response.status_code, response.get_data(as_text=True), degraded)] += 1
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate and sell through a simulated database outage.")
+    parser.add_argument('--database-url', required=True, help="scratch PostgreSQL database; licenses are replaced")
+    parser.add_argument('--licenses', type=int, default=10000)
+    parser.add_argument('--mode', choices=('refuse', 'hang'), default='hang')
+    parser.add_argument('--requests', type=int, default=500, help="validations per phase")
+    parser.add_argument('--unknown', type=int, default=50, help="machines validated for the first time during the outage")
+    parser.add_argument('--purchases', type=int, default=20, help="licenses issued during the outage")
+    parser.add_argument('--index', action='store_true', help="answer degraded validations from a license index")
+    parser.add_argument('--connect-timeout', type=int, default=2, help="DB_CONNECT_TIMEOUT for the validators")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    if not args.database_url.startswith('postgres'):
+        parser.error("the outage is simulated with a TCP proxy in front of PostgreSQL")
+    seed(args.database_url, args.licenses)
+    target, make_url = proxied_dsn(args.database_url)
+    proxy = Proxy(target)
+    workdir = tempfile.mkdtemp(prefix='db-outage-')
+    os.environ.update({'DATABASE_URL': make_url(proxy.port), 'LOG_LEVEL': os.getenv('LOG_LEVEL', 'ERROR'),
+                       'PURCHASE_QUEUE_PATH': os.path.join(workdir, 'pending_licenses.jsonl')})
+    storage.DB_CONNECT_TIMEOUT = args.connect_timeout
+    import circuit_breaker
+    import database
+    import license_index
+    import purchase_queue
+    import telegram_bot
+    import validator
+
+    if args.index:
+        license_index.LICENSE_INDEX_PATH = os.path.join(workdir, 'licenses.idx')
+        license_index.build(storage.open_storage(args.database_url), license_index.LICENSE_INDEX_PATH)
+    client = validator.create_app().test_client()
+    known = [(license_key(index), hwid(index)) for index in range(args.licenses)
+             if category(index) in ('bound', 'trial')][:args.requests]
+    unknown = [(license_key(index), hwid(index + 1)) for index in range(args.unknown)]
+    product = {'name': 'Outage EA', 'file': 'outage.ex5', 'expiry_days': 3,
+               'pricing_tiers': {'1': {'price_usd': 1, 'expiry_days': 30}}}
+    results = {}
+    violations = []
+
+    timings, outcomes = [], Counter()
+    run(client, known, timings, outcomes)
+    results['healthy'] = {'latency': summarize(timings), 'answers': {str(k): v for k, v in outcomes.items()}}
+
+    proxy.set_mode(args.mode)
+    # The index follower cannot refresh without the database either
+    license_index.LICENSE_INDEX_MAX_AGE = 0
+    outage_start = time.perf_counter()
+    timings, outcomes = [], Counter()
+    run(client, known, timings, outcomes)
+    for answer, count in outcomes.items():
+        if answer[:2] != (200, 'valid'):
+            violations.append(f"known machine during the outage: {answer} x{count}")
+    unknown_outcomes = Counter()
+    run(client, unknown, [], unknown_outcomes)
+    for answer, count in unknown_outcomes.items():
+        if answer[0] != 503:
+            violations.append(f"unknown machine during the outage: {answer} x{count}")
+    issued = []
+    purchase_timings = []
+    for n in range(args.purchases):
+        start = time.perf_counter()
+        issued.append(telegram_bot.issue_license(f"outage{n}", product, '1', f"outage-tx-{n}")[0])
+        purchase_timings.append(time.perf_counter() - start)
+    results['outage'] = {
+        'mode': args.mode,
+        'latency': summarize(timings),
+        'answers': {str(k): v for k, v in outcomes.items()},
+        'unknown_answers': {str(k): v for k, v in unknown_outcomes.items()},
+        'purchases': summarize(purchase_timings),
+        'queued': len(purchase_queue._read()),
+        'seconds': round(time.perf_counter() - outage_start, 1),
+    }
+
+    proxy.set_mode('up')
+    recovery_start = time.perf_counter()
+    timings, outcomes = [], Counter()
+    while database.breaker.state != circuit_breaker.CLOSED and time.perf_counter() - recovery_start < 60:
+        run(client, known[:10], timings, outcomes)
+        time.sleep(0.1)
+    closed_after = time.perf_counter() - recovery_start
+    stored = purchase_queue.drain()
+    missing = [key for key in issued if database.get_license(key) is None]
+    if missing:
+        violations.append(f"{len(missing)} queued purchases not stored after recovery")
+    run(client, known, timings, outcomes)
+    results['recovery'] = {
+        'breaker_closed_after_s': round(closed_after, 1),
+        'queued_stored': stored,
+        'latency': summarize(timings),
+        'answers': {str(k): v for k, v in outcomes.items()},
+    }
+    results['violations'] = violations[:20]
+    results['violation_count'] = len(violations)
+
+    write_results('db_outage', {
+        'licenses': args.licenses,
+        'mode': args.mode,
+        'index': args.index,
+        'requests': args.requests,
+        'connect_timeout': args.connect_timeout,
+        'breaker_failures': circuit_breaker.DB_BREAKER_FAILURES,
+        'breaker_reset': circuit_breaker.DB_BREAKER_RESET,
+    }, results, args.output)
+    if violations:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
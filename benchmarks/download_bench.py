@@ -0,0 +1,157 @@
+import argparse
+import hashlib
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+from benchmarks.common import summarize, write_results
+
+# Signed product downloads (file_store.py) served by gunicorn 'validator:create_app()',
+# once with sendfile(2) and once with --no-sendfile (the body copied through the
+# worker in chunks):
+#   full      --downloads downloads of a --size-mb file; throughput and the CPU
+#             time the workers spent per GB sent
+#   ranges    --ranges random single-range requests, checked byte for byte
+#   resume    a download cut off halfway and resumed with Range + If-Range
+#
+#   python -m benchmarks.download_bench --size-mb 64 --downloads 20
+#
+# Exits non-zero if any body differs from the stored file.
+
+# CPU seconds used so far by the children (workers) of `pid`
+def workers_cpu(pid):
+    ticks = 0
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            ticks += int(fields[11]) + int(fields[12])
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+def start_server(port, workers, sendfile, env):
+    command = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f"127.0.0.1:{port}", 'validator:create_app()']
+    if not sendfile:
+        command.insert(-1, '--no-sendfile')
+    process = subprocess.Popen(command, env=env)
+    for _ in range(120):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("Server did not come up within 60 seconds")
+
+def fetch(client, url, headers=None):
+    digest = hashlib.sha256()
+    size = 0
+    with client.stream('GET', url, headers=headers) as response:
+        for chunk in response.iter_bytes(1024 * 1024):
+            digest.update(chunk)
+            size += len(chunk)
+    return response, digest.hexdigest(), size
+
+def run(url, data, sha256, args, rng, violations, label):
+    results = {}
+    size = len(data)
+    with httpx.Client(timeout=60) as client:
+        fetch(client, url)
+        timings = []
+        cpu_start = workers_cpu(args.server_pid)
+        start = time.perf_counter()
+        for _ in range(args.downloads):
+            begin = time.perf_counter()
+            response, digest, received = fetch(client, url)
+            timings.append(time.perf_counter() - begin)
+            if response.status_code != 200 or digest != sha256:
+                violations.append(f"{label}: full download {response.status_code}, {received} bytes, sha256 {digest[:12]}")
+        elapsed = time.perf_counter() - start
+        cpu = workers_cpu(args.server_pid) - cpu_start
+        sent_gb = args.downloads * size / 1e9
+        results['full'] = dict(summarize(timings, elapsed), mb_per_s=round(args.downloads * size / 1e6 / elapsed, 1),
+                               worker_cpu_s_per_gb=round(cpu / sent_gb, 3))
+
+        timings = []
+        for _ in range(args.ranges):
+            first = rng.randrange(size)
+            last = min(size - 1, first + rng.randrange(1, 4 * 1024 * 1024))
+            begin = time.perf_counter()
+            response = client.get(url, headers={'Range': f"bytes={first}-{last}"})
+            timings.append(time.perf_counter() - begin)
+            if response.status_code != 206 or response.content != data[first:last + 1]:
+                violations.append(f"{label}: range {first}-{last} answered {response.status_code}")
+        results['ranges'] = summarize(timings)
+
+        # A client that lost the connection halfway resumes where it stopped
+        half = size // 2
+        first_part = client.get(url, headers={'Range': f"bytes=0-{half - 1}"})
+        etag = first_part.headers['ETag']
+        rest = client.get(url, headers={'Range': f"bytes={half}-", 'If-Range': etag})
+        resumed = hashlib.sha256(first_part.content + rest.content).hexdigest()
+        if rest.status_code != 206 or resumed != sha256:
+            violations.append(f"{label}: resumed download {rest.status_code}, sha256 {resumed[:12]}")
+        results['resume'] = {'status': rest.status_code, 'complete': resumed == sha256}
+        not_modified = client.get(url, headers={'If-None-Match': etag})
+        results['revalidate_status'] = not_modified.status_code
+        if not_modified.status_code != 304:
+            violations.append(f"{label}: If-None-Match answered {not_modified.status_code}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Time signed file downloads with and without sendfile.")
+    parser.add_argument('--size-mb', type=int, default=64, help="size of the stored file")
+    parser.add_argument('--downloads', type=int, default=20, help="full downloads per server")
+    parser.add_argument('--ranges', type=int, default=200, help="range requests per server")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers")
+    parser.add_argument('--port', type=int, default=5077)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='download-bench-')
+    env = dict(os.environ, FILE_STORE_DIR=os.path.join(work_dir, 'store'), DOWNLOAD_SECRET='bench-secret',
+               DOWNLOAD_BASE_URL=f"http://127.0.0.1:{args.port}", LOG_LEVEL=os.getenv('LOG_LEVEL', 'WARNING'),
+               DATABASE_URL=f"sqlite:///{os.path.join(work_dir, 'bench.db')}")
+    os.environ.update(env)
+    import file_store
+
+    rng = random.Random(args.seed)
+    data = rng.randbytes(args.size_mb * 1024 * 1024)
+    source = os.path.join(work_dir, 'Bench Expert Advisor.ex5')
+    with open(source, 'wb') as f:
+        f.write(data)
+    sha256 = file_store.add_file(source)
+    url = file_store.download_url(sha256, os.path.basename(source), ttl=3600)
+
+    violations = []
+    results = {}
+    for label, sendfile in (('sendfile', True), ('copy', False)):
+        server = start_server(args.port, args.workers, sendfile, env)
+        args.server_pid = server.pid
+        try:
+            results[label] = run(url, data, sha256, args, rng, violations, label)
+        finally:
+            server.terminate()
+            server.wait()
+    results['violations'] = violations[:20]
+    results['violation_count'] = len(violations)
+
+    write_results('download', {
+        'size_mb': args.size_mb,
+        'downloads': args.downloads,
+        'ranges': args.ranges,
+        'workers': args.workers,
+    }, results, args.output)
+    if violations:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
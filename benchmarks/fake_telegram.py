@@ -0,0 +1,269 @@
+import itertools
+import json
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# Local stand-in for the Telegram Bot API.
+#
+# Point the bot at it with TELEGRAM_API_URL=http://127.0.0.1:<port>. Scripted users
+# are simulated by queueing updates (inject_command / inject_text /
+# inject_callback) which the bot picks up through getUpdates; everything the bot
+# sends back is recorded per chat so a driver can wait for the expected reply.
+#
+# Like the real API, a getUpdates call terminates any getUpdates still waiting,
+# which then fails with 409 Conflict; `conflicts` counts these, so it keeps
+# growing while more than one process polls the same token.
+
+UPLOAD_METHODS = {'sendDocument', 'sendMediaGroup', 'sendPhoto', 'sendVideo', 'sendAudio'}
+
+class Conflict(Exception):
+    pass
+
+class ChatLog:
+    def __init__(self):
+        self.events = []
+        self.last_markup_message = None
+
+class FakeBotAPI:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.lock = threading.Condition()
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.callback_ids = itertools.count(1)
+        self.chats = {}
+        self.method_counts = {}
+        self.bytes_uploaded = 0
+        self.poll_generation = 0
+        self.polls_waiting = 0
+        self.conflicts = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-bot-api", daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # --- simulated users -------------------------------------------------
+
+    @staticmethod
+    def user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"Bench{user_id}"}
+
+    @staticmethod
+    def chat(user_id):
+        return {'id': user_id, 'type': 'private', 'first_name': f"Bench{user_id}"}
+
+    def _push(self, update):
+        with self.lock:
+            update['update_id'] = next(self.update_ids)
+            self.updates.append(update)
+            self.lock.notify_all()
+
+    def inject_text(self, user_id, text):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': self.chat(user_id),
+            'from': self.user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            command_length = len(text.split(' ', 1)[0])
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': command_length}]
+        self._push({'message': message})
+
+    inject_command = inject_text
+
+    def inject_callback(self, user_id, data):
+        with self.lock:
+            message = self.chats[user_id].last_markup_message
+        self._push({'callback_query': {
+            'id': str(next(self.callback_ids)),
+            'from': self.user(user_id),
+            'chat_instance': str(user_id),
+            'message': message,
+            'data': data,
+        }})
+
+    def last_keyboard(self, user_id):
+        with self.lock:
+            message = self.chats[user_id].last_markup_message
+        if not message:
+            return []
+        return [button for row in message['reply_markup']['inline_keyboard'] for button in row]
+
+    def mark(self, user_id):
+        with self.lock:
+            return len(self.chats.setdefault(user_id, ChatLog()).events)
+
+    # Wait until the bot sent something to the chat (after index `since`) that
+    # matches `predicate`; returns the matching event
+    def wait_for(self, user_id, predicate, since=0, timeout=30):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while True:
+                events = self.chats.setdefault(user_id, ChatLog()).events
+                for event in events[since:]:
+                    if predicate(event):
+                        return event
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"No matching reply for chat {user_id} within {timeout}s")
+                self.lock.wait(remaining)
+
+    def events(self, user_id, since=0):
+        with self.lock:
+            return list(self.chats.setdefault(user_id, ChatLog()).events[since:])
+
+    # --- Bot API ---------------------------------------------------------
+
+    def _record(self, chat_id, method, params, message):
+        with self.lock:
+            log = self.chats.setdefault(chat_id, ChatLog())
+            log.events.append({'method': method, 'text': params.get('text') or params.get('caption'), 'time': time.perf_counter(), 'message': message})
+            if message is not None and message.get('reply_markup'):
+                log.last_markup_message = message
+            self.lock.notify_all()
+
+    def _message(self, chat_id, params, message_id=None):
+        message = {
+            'message_id': message_id or next(self.message_ids),
+            'date': int(time.time()),
+            'chat': self.chat(chat_id),
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'LicenseBot', 'username': 'LicenseBot'},
+        }
+        if params.get('text'):
+            message['text'] = params['text']
+        if params.get('caption'):
+            message['caption'] = params['caption']
+        if params.get('reply_markup'):
+            message['reply_markup'] = json.loads(params['reply_markup'])
+        return message
+
+    def handle(self, method, params, body_size):
+        with self.lock:
+            self.method_counts[method] = self.method_counts.get(method, 0) + 1
+            if method in UPLOAD_METHODS:
+                self.bytes_uploaded += body_size
+
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'LicenseBot', 'username': 'LicenseBot',
+                    'can_join_groups': True, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        if method == 'getUpdates':
+            offset = int(params.get('offset') or 0)
+            timeout = float(params.get('timeout') or 0)
+            deadline = time.monotonic() + timeout
+            with self.lock:
+                if self.polls_waiting:
+                    self.conflicts += self.polls_waiting
+                self.poll_generation += 1
+                generation = self.poll_generation
+                self.lock.notify_all()
+                self.updates = [update for update in self.updates if update['update_id'] >= offset]
+                self.polls_waiting += 1
+                try:
+                    while not self.updates and time.monotonic() < deadline:
+                        self.lock.wait(deadline - time.monotonic())
+                        if generation != self.poll_generation:
+                            raise Conflict("terminated by other getUpdates request; make sure that only one bot instance is running")
+                finally:
+                    self.polls_waiting -= 1
+                limit = int(params.get('limit') or 100)
+                return self.updates[:limit]
+        if method in ('sendMessage', 'sendDocument', 'sendPhoto', 'sendVideo', 'sendAudio'):
+            chat_id = int(params['chat_id'])
+            message = self._message(chat_id, params)
+            if method == 'sendDocument':
+                message['document'] = {'file_id': f"doc{message['message_id']}", 'file_unique_id': f"u{message['message_id']}"}
+            self._record(chat_id, method, params, message)
+            return message
+        if method == 'sendMediaGroup':
+            chat_id = int(params['chat_id'])
+            media = json.loads(params.get('media') or '[]')
+            messages = []
+            for item in media:
+                message = self._message(chat_id, {'caption': item.get('caption')})
+                message['document'] = {'file_id': f"doc{message['message_id']}", 'file_unique_id': f"u{message['message_id']}"}
+                messages.append(message)
+            self._record(chat_id, method, params, None)
+            return messages
+        if method in ('editMessageText', 'editMessageReplyMarkup', 'editMessageCaption'):
+            chat_id = int(params['chat_id'])
+            message = self._message(chat_id, params, message_id=int(params['message_id']))
+            if method == 'editMessageReplyMarkup' or 'text' not in message:
+                with self.lock:
+                    previous = self.chats.setdefault(chat_id, ChatLog()).last_markup_message or {}
+                message.setdefault('text', previous.get('text', ''))
+            self._record(chat_id, method, params, message)
+            return message
+        # answerCallbackQuery, deleteWebhook, setMyCommands, ...
+        return True
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                method = self.path.rstrip('/').rsplit('/', 1)[-1]
+                try:
+                    params = parse_body(self.headers.get('Content-Type', ''), body)
+                    result = api.handle(method, params, length)
+                    payload = {'ok': True, 'result': result}
+                    status = 200
+                except Conflict as e:
+                    payload = {'ok': False, 'error_code': 409, 'description': f"Conflict: {e}"}
+                    status = 409
+                except Exception as e:
+                    payload = {'ok': False, 'error_code': 400, 'description': f"Bad Request: {e}"}
+                    status = 400
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client went away, e.g. a killed poller
+                    pass
+
+            do_GET = do_POST
+
+        return Handler
+
+def parse_body(content_type, body):
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename() is None:
+                params[name] = part.get_content() if isinstance(part.get_content(), str) else part.get_payload(decode=True).decode()
+        return params
+    if content_type.startswith('application/json'):
+        return {key: value if isinstance(value, str) else json.dumps(value) for key, value in json.loads(body or b'{}').items()}
+    return {key: values[0] for key, values in parse_qs(body.decode()).items()}
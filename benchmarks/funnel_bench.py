@@ -0,0 +1,185 @@
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from benchmarks.common import summarize, write_results
+from benchmarks.fake_telegram import FakeBotAPI
+
+# Purchase-funnel throughput benchmark against a local Bot API stand-in.
+#
+# Each simulated user runs /start -> name -> product -> tier -> payment and then
+# /resend <key> against the real handlers registered by setup_application(),
+# talking to benchmarks/fake_telegram.py instead of api.telegram.org.
+#
+#   python -m benchmarks.funnel_bench --database-url postgresql://localhost/license_bench \
+#       --sessions 500 --concurrency 50 --output funnel.json
+#
+# The products table of the given database is replaced by a benchmark catalog and
+# licenses/transactions are written to it, so the DSN must be passed explicitly.
+
+STEP_TIMEOUT = 60
+LICENSE_KEY_PATTERN = re.compile(r'License Key: ([0-9a-f-]{36})')
+PURCHASE_DONE = ("Thank you! Check your files above.", "An error occurred")
+TRIAL_DONE = ("Thank you for trying our product!", "An error occurred")
+
+def text_of(event):
+    return event['text'] or ''
+
+def text_contains(*fragments):
+    return lambda event: any(fragment in text_of(event) for fragment in fragments)
+
+class Session:
+    def __init__(self, api, user_id, test_address, trial):
+        self.api = api
+        self.user_id = user_id
+        self.test_address = test_address
+        self.trial = trial
+        self.steps = []
+        self.license_key = None
+
+    def step(self, name, send, predicate):
+        since = self.api.mark(self.user_id)
+        start = time.perf_counter()
+        send()
+        event = self.api.wait_for(self.user_id, predicate, since=since, timeout=STEP_TIMEOUT)
+        self.steps.append((name, event['time'] - start))
+        return since
+
+    def button(self, prefix):
+        return next(b['callback_data'] for b in self.api.last_keyboard(self.user_id) if b['callback_data'].startswith(prefix))
+
+    def run(self):
+        api, uid = self.api, self.user_id
+        self.step('start', lambda: api.inject_command(uid, '/start'), text_contains("What's your name?"))
+        self.step('name', lambda: api.inject_text(uid, f"bench{uid}"), text_contains("Please select a product"))
+        product_id = BENCH_TRIAL_ID if self.trial else BENCH_PRODUCT_ID
+        if self.trial:
+            since = self.step('product', lambda: api.inject_callback(uid, f"product:{product_id}"), text_contains(*TRIAL_DONE))
+        else:
+            self.step('product', lambda: api.inject_callback(uid, f"product:{product_id}"), text_contains("Please select a pricing tier"))
+            self.step('tier', lambda: api.inject_callback(uid, self.button('tier:')), text_contains("You selected the $"))
+            since = self.step('payment', lambda: api.inject_text(uid, self.test_address), text_contains(*PURCHASE_DONE))
+        for event in api.events(uid, since):
+            match = LICENSE_KEY_PATTERN.search(text_of(event))
+            if match:
+                self.license_key = match.group(1)
+        if self.license_key is None:
+            raise RuntimeError(f"No license key issued for chat {uid}")
+        self.step('resend', lambda: api.inject_command(uid, f"/resend {self.license_key}"),
+                  text_contains(*(TRIAL_DONE if self.trial else PURCHASE_DONE)))
+
+BENCH_PRODUCT_ID = '9001'
+BENCH_TRIAL_ID = '9002'
+
+def bench_catalog(product_file):
+    return {
+        BENCH_PRODUCT_ID: {
+            'name': 'Bench Expert Advisor',
+            'file': product_file,
+            'is_trial': False,
+            'expiry_days': None,
+            'pricing_tiers': {'1': {'price_usd': 10.0, 'price_xlm': 50.0, 'expiry_days': 30}},
+        },
+        BENCH_TRIAL_ID: {
+            'name': 'Bench Expert Advisor Trial',
+            'file': product_file,
+            'is_trial': True,
+            'expiry_days': 7,
+            'pricing_tiers': {},
+        },
+    }
+
+def run_sessions(api, sessions, concurrency, test_address, trial_every, first_user_id):
+    results = []
+    errors = []
+    next_index = iter(range(sessions))
+    index_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with index_lock:
+                index = next(next_index, None)
+            if index is None:
+                return
+            session = Session(api, first_user_id + index, test_address,
+                              trial=bool(trial_every) and index % trial_every == 0)
+            try:
+                session.run()
+                results.append(session)
+            except Exception as e:
+                errors.append(f"chat {session.user_id}: {e}")
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure purchase-funnel throughput against a fake Bot API.")
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help="DSN of a scratch database; its products table is replaced")
+    parser.add_argument('--sessions', type=int, default=200, help="simulated users")
+    parser.add_argument('--concurrency', type=int, default=20, help="users active at the same time")
+    parser.add_argument('--trial-every', type=int, default=0, help="every Nth user claims a trial instead of buying")
+    parser.add_argument('--product-size', type=int, default=256 * 1024, help="bytes of the delivered EA file")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("--database-url (or BENCH_DATABASE_URL) is required; the products table will be replaced")
+
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    work_dir = tempfile.mkdtemp(prefix='funnel-bench-')
+    shutil.copy(os.path.join(repo_dir, 'usage_guide.pdf'), work_dir)
+    product_file = os.path.join(work_dir, 'bench_expert_advisor.ex5')
+    with open(product_file, 'wb') as f:
+        f.write(os.urandom(args.product_size))
+
+    api = FakeBotAPI().start()
+    os.environ.update({
+        'TELEGRAM_API_URL': api.url,
+        'TELEGRAM_TOKEN': '123456:bench-token',
+        'DATABASE_URL': args.database_url,
+    })
+    os.chdir(work_dir)
+    sys.path.insert(0, repo_dir)
+    import telegram_bot
+    # Initializes the database and starts polling against the fake API
+    telegram_bot.start_bot()
+    telegram_bot.save_products(bench_catalog(product_file))
+
+    try:
+        sessions, errors, elapsed = run_sessions(api, args.sessions, args.concurrency, telegram_bot.TEST_ADDRESS,
+                                                 args.trial_every, first_user_id=10_000_000)
+    finally:
+        api.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    steps = {}
+    for session in sessions:
+        for name, latency in session.steps:
+            steps.setdefault(name, []).append(latency)
+    results = {
+        'completed': len(sessions),
+        'failed': len(errors),
+        'elapsed_s': round(elapsed, 2),
+        'purchases_per_s': round(len(sessions) / elapsed, 2) if elapsed else None,
+        'steps': {name: summarize(latencies) for name, latencies in steps.items()},
+        'bytes_uploaded': api.bytes_uploaded,
+        'bytes_uploaded_per_purchase': round(api.bytes_uploaded / len(sessions)) if sessions else None,
+        'bot_api_calls': dict(sorted(api.method_counts.items())),
+        'errors': errors[:20],
+    }
+    write_results('funnel', {
+        'sessions': args.sessions, 'concurrency': args.concurrency,
+        'trial_every': args.trial_every, 'product_size': args.product_size,
+    }, results, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import hashlib
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import get_hwid
+from benchmarks.common import summarize, write_results
+
+# Per-call cost of HWID generation (get_hwid.py).
+#
+#   legacy     the previous implementation: one shell command per call
+#              (wmic / system_profiler | grep / cat /proc/cpuinfo | grep Serial)
+#   collect    get_system_info() and hashing, no cache
+#   cached     generate_hwid() in a fresh process: reads and verifies the cache
+#              and re-collects the components to check that they still match
+#   memoized   generate_hwid() again in the same process
+#
+#   python -m benchmarks.hwid_bench --calls 200
+#
+# The cache is written to a temporary file. Also reports which identifiers were
+# found, and whether the legacy command fell back to its constant placeholder.
+
+# system -> (command, line index or None, placeholder) as in the old get_system_info()
+LEGACY_COMMANDS = {
+    'Windows': ("wmic diskdrive get serialnumber", 1, "unknown-windows-id"),
+    'Darwin': ("system_profiler SPHardwareDataType | grep Serial", None, "unknown-macos-id"),
+}
+LEGACY_DEFAULT = ("cat /proc/cpuinfo | grep Serial", None, "unknown-linux-id")
+
+def legacy_hwid():
+    command, line, placeholder = LEGACY_COMMANDS.get(platform.system(), LEGACY_DEFAULT)
+    try:
+        result = subprocess.check_output(command, shell=True, stderr=subprocess.DEVNULL).decode()
+        system_info = result.split("\n")[line].strip() if line is not None else result.split(":")[1].strip()
+    except Exception:
+        system_info = placeholder
+    unique_string = f"{system_info}-{platform.node()}-{platform.machine()}"
+    return hashlib.sha256(unique_string.encode()).hexdigest()[:32], system_info
+
+def time_calls(call, calls):
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        call()
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+def fresh_process_call():
+    get_hwid._hwid = None
+    return get_hwid.generate_hwid()
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the per-call cost of HWID generation.")
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['HWID_CACHE_PATH'] = os.path.join(directory, 'hwid.json')
+        hwid = get_hwid.generate_hwid(refresh=True)
+        results = {
+            'legacy': time_calls(legacy_hwid, args.calls),
+            'collect': time_calls(lambda: get_hwid._fingerprint(get_hwid.get_system_info()), args.calls),
+            'cached': time_calls(fresh_process_call, args.calls),
+            'memoized': time_calls(get_hwid.generate_hwid, args.calls),
+        }
+        stable = get_hwid.generate_hwid(refresh=True) == hwid
+    _, legacy_info = legacy_hwid()
+    results.update({
+        'components': sorted(get_hwid.get_system_info()),
+        'legacy_placeholder': legacy_info.startswith('unknown-') and legacy_info.endswith('-id'),
+        'stable_across_refresh': stable,
+    })
+    write_results('hwid_bench', {'calls': args.calls, 'system': platform.system()}, results, args.output)
+
+if __name__ == '__main__':
+    main()
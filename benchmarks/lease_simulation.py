@@ -0,0 +1,80 @@
+import argparse
+import random
+from collections import Counter
+from datetime import datetime, timedelta
+import leases
+from benchmarks.common import write_results
+
+# Simulated request rate at /validate for three client behaviours, starting the
+# moment an outage ends and every machine reconnects within --reconnect seconds:
+#
+#   tick    every machine checks every --tick-interval seconds (the behaviour of
+#           EAs that validate on every tick, throttled to that interval)
+#   fixed   every machine checks again after a fixed 0.625 * LEASE_MAX_SECONDS,
+#           the mean next check of a full lease, without jitter
+#   lease   every machine follows the lease and next check of leases.py
+#
+# Licenses have 1 to 365 days left, trials (--trial-share) 1 to 3 days; a
+# machine stops checking once its license has expired. No server is involved,
+# the lease policy is called directly.
+#
+#   python -m benchmarks.lease_simulation --machines 100000 --hours 24
+
+def simulate(machines, policy, args, start):
+    per_minute = Counter()
+    horizon = args.hours * 3600
+    for expiry, reconnect in machines:
+        license = {'expiry': expiry.strftime('%Y-%m-%d')}
+        t = reconnect
+        while t < horizon and start + timedelta(seconds=t) < expiry:
+            per_minute[int(t // 60)] += 1
+            if policy == 'fixed':
+                t += leases.LEASE_MAX_SECONDS * (leases.NEXT_CHECK_EARLIEST + leases.NEXT_CHECK_LATEST) / 2
+            else:
+                lease = leases.lease_seconds('simulated', license, start + timedelta(seconds=t))
+                t += leases.next_check_seconds(lease)
+    return per_minute
+
+def rates(per_minute, hours):
+    minutes = [per_minute.get(minute, 0) / 60 for minute in range(hours * 60)]
+    return {
+        'mean_qps': round(sum(minutes) / len(minutes), 2),
+        'peak_qps': round(max(minutes), 2),
+        # Largest one-minute rate once the reconnect itself is over: an echo of
+        # the outage shows up here
+        'peak_qps_after_first_hour': round(max(minutes[60:] or [0]), 2),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate /validate request rates with and without leases.")
+    parser.add_argument('--machines', type=int, default=100000)
+    parser.add_argument('--hours', type=int, default=24)
+    parser.add_argument('--tick-interval', type=float, default=60, help="seconds between checks of the tick policy")
+    parser.add_argument('--reconnect', type=float, default=10, help="seconds over which machines reconnect after the outage")
+    parser.add_argument('--trial-share', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    start = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+    machines = []
+    for _ in range(args.machines):
+        days = random.randint(1, 3) if random.random() < args.trial_share else random.randint(1, 365)
+        machines.append((start.replace(hour=0) + timedelta(days=days), random.uniform(0, args.reconnect)))
+
+    tick = args.machines / args.tick_interval
+    results = {'tick': {'mean_qps': round(tick, 2), 'peak_qps': round(tick, 2), 'peak_qps_after_first_hour': round(tick, 2)}}
+    for policy in ('fixed', 'lease'):
+        results[policy] = rates(simulate(machines, policy, args, start), args.hours)
+    write_results('lease_simulation', {
+        'machines': args.machines,
+        'hours': args.hours,
+        'tick_interval': args.tick_interval,
+        'reconnect': args.reconnect,
+        'lease_min_seconds': leases.LEASE_MIN_SECONDS,
+        'lease_max_seconds': leases.LEASE_MAX_SECONDS,
+    }, results, args.output)
+
+if __name__ == '__main__':
+    main()
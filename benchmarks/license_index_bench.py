@@ -0,0 +1,165 @@
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+import database
+import license_index
+import storage
+import validator
+from benchmarks.common import summarize, write_results
+from benchmarks.validate_bench import category, hwid, license_key, seed
+
+# The shared license index (license_index.py) on the synthetic licenses of
+# validate_bench:
+#   build     full build time and file size
+#   memory    --workers processes map the index and read all of it; their
+#             proportional set size (Pss) for the mapping adds up to one copy
+#   agreement every sampled license is checked with a matching and a foreign
+#             HWID against validator.check_license on the database; the index may
+#             only accept what the database accepts, and should answer every
+#             bound, valid license itself
+#   refresh   --changes licenses are deactivated, the change feed is merged in,
+#             and none of them may still be accepted
+#   lookups   /validate (through the validator blueprint) of bound, valid
+#             licenses with and without the index
+#
+#   python -m benchmarks.license_index_bench --database-url postgresql://localhost/license_index \
+#       --licenses 1000000
+#
+# Exits non-zero if the index accepts a license the database refuses.
+
+# Pss and Rss in kB of the mappings of `path` in this process
+def mapping_memory(path):
+    usage = {'Pss': 0, 'Rss': 0}
+    inside = False
+    with open('/proc/self/smaps') as f:
+        for line in f:
+            if re.match(r'^[0-9a-f]+-[0-9a-f]+ ', line):
+                inside = line.rstrip().endswith(path)
+            elif inside and line.split(':')[0] in usage:
+                usage[line.split(':')[0]] += int(line.split()[1])
+    return usage
+
+def map_and_read(path, ready, done, results):
+    index = license_index.LicenseIndex(path)
+    checksum = sum(index.map[offset] for offset in range(0, len(index.map), 4096))
+    ready.wait()
+    results.put((mapping_memory(path), checksum))
+    done.wait()
+
+def measure_workers(path, workers):
+    context = get_context('fork')
+    ready = context.Barrier(workers + 1)
+    done = context.Event()
+    results = context.Queue()
+    processes = [context.Process(target=map_and_read, args=(path, ready, done, results)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    ready.wait()
+    usages = [results.get()[0] for _ in processes]
+    done.set()
+    for process in processes:
+        process.join()
+    return {
+        'workers': workers,
+        'rss_kb_per_worker': max(usage['Rss'] for usage in usages),
+        'pss_kb_total': sum(usage['Pss'] for usage in usages),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Build, check and time the shared license index.")
+    parser.add_argument('--database-url', required=True, help="scratch database; licenses are replaced")
+    parser.add_argument('--licenses', type=int, default=100000)
+    parser.add_argument('--skip-seed', action='store_true', help="keep the licenses already in the database")
+    parser.add_argument('--workers', type=int, default=4, help="processes mapping the index for the memory check")
+    parser.add_argument('--sample', type=int, default=2000, help="licenses checked against the database")
+    parser.add_argument('--changes', type=int, default=1000, help="licenses deactivated before the refresh")
+    parser.add_argument('--lookups', type=int, default=5000, help="validations timed with and without the index")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix='license-index-'), 'licenses.idx')
+    os.environ.update({'DATABASE_URL': args.database_url, 'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING')})
+    license_index.LICENSE_INDEX_PATH = path
+
+    rng = random.Random(args.seed)
+    if not args.skip_seed:
+        seed(args.database_url, args.licenses)
+    store = storage.open_storage(args.database_url)
+    violations = []
+    results = {}
+
+    start = time.perf_counter()
+    count, _ = license_index.build(store, path)
+    results['build'] = {'seconds': round(time.perf_counter() - start, 2), 'licenses': count,
+                        'file_mb': round(os.path.getsize(path) / 1e6, 1)}
+    results['memory'] = measure_workers(path, args.workers)
+
+    # Index answers against the database
+    indexes = rng.sample(range(args.licenses), min(args.sample, args.licenses))
+    valid_count = answered = 0
+    for index in indexes:
+        key = license_key(index)
+        license = database.get_license(key)
+        for label, machine in (('bound', hwid(index)), ('foreign', hwid(index + 1))):
+            accepted = license_index.valid_license(key, machine) is not None
+            valid = validator.check_license(license, machine) == validator.VALID
+            if accepted and not valid:
+                violations.append(f"{key} ({category(index)}, {label} HWID): accepted by the index only")
+            valid_count += valid
+            answered += valid and accepted
+    results['agreement'] = {'sampled': len(indexes), 'valid_in_database': valid_count, 'answered_by_index': answered}
+
+    # Deactivations reach the index through the change feed
+    bound_valid = [index for index in indexes if category(index) in ('bound', 'trial')]
+    deactivated = bound_valid[:args.changes]
+    with store.transaction() as cur:
+        for index in deactivated:
+            cur.execute(store._sql(f"UPDATE licenses SET active = FALSE, updated_at = {store.now_sql} "
+                                   "WHERE license_key = %s"), (license_key(index),))
+    start = time.perf_counter()
+    changed, _ = license_index.refresh(store, path)
+    results['refresh'] = {'seconds': round(time.perf_counter() - start, 3), 'changed': changed,
+                          'deactivated': len(deactivated)}
+    license_index.REOPEN_INTERVAL = 0
+    for index in deactivated:
+        if license_index.valid_license(license_key(index), hwid(index)) is not None:
+            violations.append(f"{license_key(index)}: still accepted after deactivation and refresh")
+
+    # /validate of bound, valid licenses with and without the index
+    client = validator.create_app().test_client()
+    timed = bound_valid[len(deactivated):] or bound_valid
+    lookups = {}
+    for label, index_path in (('database', ''), ('index', path)):
+        license_index.LICENSE_INDEX_PATH = index_path
+        timings = []
+        for n in range(args.lookups):
+            index = timed[n % len(timed)]
+            start = time.perf_counter()
+            response = client.post('/validate', data={'license_key': license_key(index), 'hwid': hwid(index)})
+            timings.append(time.perf_counter() - start)
+            if response.get_data(as_text=True) != 'valid':
+                violations.append(f"{license_key(index)} via {label}: {response.get_data(as_text=True)!r}")
+                break
+        lookups[label] = summarize(timings, sum(timings))
+    results['validate'] = lookups
+    results['violations'] = violations[:20]
+    results['violation_count'] = len(violations)
+
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+    write_results('license_index', {
+        'backend': args.database_url.split(':', 1)[0],
+        'licenses': args.licenses,
+        'workers': args.workers,
+    }, results, args.output)
+    if violations:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
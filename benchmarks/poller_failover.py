@@ -0,0 +1,157 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from benchmarks.common import summarize, write_results
+from benchmarks.fake_telegram import FakeBotAPI
+
+# Failover test for the poller leader election (leader.py).
+#
+# Several bot processes are started against the fake Bot API and one database,
+# the way gunicorn workers or replicas of `python telegram_bot.py` would run.
+# The current leader is then killed with SIGKILL, round after round. Measured
+# per failover:
+#   - election: time until another process reports itself leader
+#   - polling: time until getUpdates reaches the fake API again
+#   - reply: time until a /start sent right after the kill is answered
+# and checked throughout:
+#   - never more than one live leader at a time
+#   - no getUpdates conflicts while the cluster is settled (the fake API counts
+#     a conflict whenever a poll is cut short by another process's poll)
+#
+#   python -m benchmarks.poller_failover --database-url postgresql://localhost/license_failover \
+#       --processes 4 --rounds 3
+#
+# Exits non-zero if an invariant is violated. A sqlite:///path URL elects via
+# flock() instead of a PostgreSQL advisory lock.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def candidate(database_url, api_url, check_interval, event_queue):
+    os.environ.update({'DATABASE_URL': database_url, 'TELEGRAM_TOKEN': '123456:failover-token',
+                       'TELEGRAM_API_URL': api_url, 'LEADER_CHECK_INTERVAL': str(check_interval),
+                       'LOG_LEVEL': 'WARNING'})
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    import leader
+    import telegram_bot
+    telegram_bot.start_bot()
+    was_leader = False
+    while True:
+        if leader.is_leader() != was_leader:
+            was_leader = not was_leader
+            event_queue.put((os.getpid(), was_leader, time.monotonic()))
+        time.sleep(0.01)
+
+def wait_for_leader(events, leaders, dead, timeout):
+    deadline = time.monotonic() + timeout
+    violations = []
+    while True:
+        try:
+            pid, is_leader, at = events.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            raise TimeoutError(f"No leader elected within {timeout}s")
+        if pid in dead:
+            continue
+        if is_leader:
+            leaders.add(pid)
+        else:
+            leaders.discard(pid)
+        if len(leaders) > 1:
+            violations.append(f"{len(leaders)} live leaders at once: {sorted(leaders)}")
+        if is_leader:
+            return pid, at, violations
+
+def wait_until(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Condition not met within {timeout}s")
+        time.sleep(0.005)
+    return time.monotonic()
+
+def main():
+    parser = argparse.ArgumentParser(description="Kill the elected Telegram poller repeatedly and measure failover.")
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help="database shared by the candidates (postgresql://... or sqlite:///path)")
+    parser.add_argument('--processes', type=int, default=4, help="competing bot processes")
+    parser.add_argument('--rounds', type=int, default=3, help="leaders to kill")
+    parser.add_argument('--check-interval', type=float, default=1.0, help="LEADER_CHECK_INTERVAL of the candidates")
+    parser.add_argument('--settle', type=float, default=5.0, help="seconds to watch for conflicts after each election")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("--database-url or BENCH_DATABASE_URL is required")
+    if args.rounds >= args.processes:
+        parser.error("--rounds must be smaller than --processes")
+
+    api = FakeBotAPI().start()
+    context = multiprocessing.get_context('spawn')
+    events = context.Queue()
+    processes = {}
+    for _ in range(args.processes):
+        process = context.Process(target=candidate, args=(args.database_url, api.url, args.check_interval, events), daemon=True)
+        process.start()
+        processes[process.pid] = process
+
+    leaders, dead = set(), set()
+    violations = []
+    election, polling, reply = [], [], []
+    settled_conflicts = 0
+    timeout = args.check_interval * 10 + 30
+    try:
+        pid, _, found = wait_for_leader(events, leaders, dead, timeout=120)
+        for round_number in range(args.rounds + 1):
+            # Let the cluster settle and make sure only one process is polling
+            conflicts_before = api.conflicts
+            time.sleep(args.settle)
+            settled_conflicts += api.conflicts - conflicts_before
+            if round_number == args.rounds:
+                break
+
+            polls_before = api.method_counts.get('getUpdates', 0)
+            user_id = 5000 + round_number
+            since = api.mark(user_id)
+            processes[pid].kill()
+            processes[pid].join()
+            killed_at = time.monotonic()
+            dead.add(pid)
+            leaders.discard(pid)
+            api.inject_command(user_id, '/start')
+
+            pid, elected_at, round_violations = wait_for_leader(events, leaders, dead, timeout)
+            violations.extend(round_violations)
+            election.append(elected_at - killed_at)
+            polled_at = wait_until(lambda: api.method_counts.get('getUpdates', 0) > polls_before, timeout)
+            polling.append(polled_at - killed_at)
+            api.wait_for(user_id, lambda event: event['method'] == 'sendMessage', since=since, timeout=timeout)
+            reply.append(time.monotonic() - killed_at)
+    finally:
+        for process in processes.values():
+            if process.is_alive():
+                process.kill()
+        api.stop()
+
+    if settled_conflicts:
+        violations.append(f"{settled_conflicts} getUpdates conflicts while the cluster was settled")
+    results = {
+        'election': summarize(election),
+        'polling_resumed': summarize(polling),
+        'first_reply': summarize(reply),
+        'conflicts_total': api.conflicts,
+        'conflicts_settled': settled_conflicts,
+        'violations': violations,
+    }
+    write_results('poller_failover', {
+        'backend': args.database_url.split(':', 1)[0],
+        'processes': args.processes,
+        'rounds': args.rounds,
+        'check_interval': args.check_interval,
+    }, results, args.output)
+    if violations:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
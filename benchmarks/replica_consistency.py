@@ -0,0 +1,124 @@
+import argparse
+import os
+import sys
+import time
+import uuid
+from datetime import date, timedelta
+import storage
+from benchmarks.common import summarize, write_results
+
+# Read-your-writes and routing check for read replicas (DATABASE_REPLICA_URLS).
+#
+# Needs a primary and at least one streaming replica of it, e.g. two local
+# PostgreSQL instances:
+#
+#   pg_basebackup -D /tmp/replica -R -h localhost -p 5432 -U postgres -X stream
+#   echo "port = 5433" >> /tmp/replica/postgresql.auto.conf
+#   echo "recovery_min_apply_delay = '500ms'" >> /tmp/replica/postgresql.auto.conf  # optional: exaggerate lag
+#   pg_ctl -D /tmp/replica start
+#   python -m benchmarks.replica_consistency --primary-url postgresql://localhost:5432/license_replica \
+#       --replica-url postgresql://localhost:5433/license_replica --licenses 200
+#
+# The check plays both sides: the bot issues each license through its own
+# ReplicatedStorage, and the validator blueprint (with a separate one, as in a
+# separate gunicorn worker) immediately validates it, re-validates it from the
+# same machine and from a second machine; the bot then looks the transaction up
+# as /resend would. Afterwards licenses older than READ_YOUR_WRITES_WINDOW are
+# validated to show how reads are spread. --dead-replica adds an unreachable
+# replica that has to be failed over. Exits non-zero on any wrong answer.
+#
+# The licenses and transactions tables of the primary are wiped first.
+
+EXPECTED = (
+    ('first validation', 'first', 'valid'),
+    ('same machine again', 'first', 'valid'),
+    ('other machine', 'second', 'HWID mismatch'),
+)
+
+def new_license(today):
+    license_key = str(uuid.uuid4())
+    license = {'username': 'replica-check', 'hwid': '', 'expiry': (today + timedelta(days=30)).strftime('%Y-%m-%d'),
+               'active': True, 'tx_hash': 'replica-tx', 'product': 'Replica EA', 'is_trial': False}
+    transaction = {'username': 'replica-check', 'product': 'Replica EA', 'product_file': 'replica.ex5',
+                   'pdf_file': f"license_{license_key}.pdf", 'is_trial': False}
+    return license_key, license, transaction
+
+def read_counts(metrics):
+    return {sample.labels['target']: sample.value
+            for metric in metrics.DB_READS.collect() for sample in metric.samples if sample.name.endswith('_total')}
+
+def main():
+    parser = argparse.ArgumentParser(description="Check read-your-writes and read routing with read replicas.")
+    parser.add_argument('--primary-url', required=True, help="primary DSN; its licenses and transactions are wiped")
+    parser.add_argument('--replica-url', action='append', required=True, help="replica DSN (repeatable)")
+    parser.add_argument('--licenses', type=int, default=200, help="licenses issued and validated right away")
+    parser.add_argument('--settled-requests', type=int, default=2000, help="validations of settled licenses")
+    parser.add_argument('--dead-replica', action='store_true', help="also route to an unreachable replica")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    replica_urls = list(args.replica_url)
+    if args.dead_replica:
+        replica_urls.append('postgresql://postgres@127.0.0.1:1/unreachable?connect_timeout=1')
+    os.environ.update({'DATABASE_URL': args.primary_url, 'DATABASE_REPLICA_URLS': ','.join(replica_urls),
+                       'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING')})
+    import metrics
+    import validator
+
+    primary = storage.open_storage(args.primary_url)
+    primary.init_schema()
+    with primary.transaction() as cur:
+        cur.execute("DELETE FROM transactions")
+        cur.execute("DELETE FROM licenses")
+    bot_store = storage.open_storage(args.primary_url, replica_urls)
+    client = validator.create_app().test_client()
+    today = date.today()
+
+    failures = []
+    latencies = []
+    issued = []
+    for _ in range(args.licenses):
+        license_key, license, transaction = new_license(today)
+        bot_store.add_license(license_key, license, transaction)
+        issued.append(license_key)
+        start = time.perf_counter()
+        for step, machine, expected in EXPECTED:
+            response = client.post('/validate', data={'license_key': license_key, 'hwid': f"{machine}-{license_key}"})
+            if response.get_data(as_text=True) != expected:
+                failures.append(f"{license_key} {step}: {response.get_data(as_text=True)!r}, expected {expected!r}")
+        latencies.append(time.perf_counter() - start)
+        if bot_store.get_transaction(license_key) is None:
+            failures.append(f"{license_key}: transaction not found right after issuing")
+    fresh_reads = read_counts(metrics)
+
+    # Let the replicas catch up and the read-your-writes windows expire
+    time.sleep(storage.READ_YOUR_WRITES_WINDOW + 1)
+    start = time.perf_counter()
+    for n in range(args.settled_requests):
+        license_key = issued[n % len(issued)]
+        response = client.post('/validate', data={'license_key': license_key, 'hwid': f"first-{license_key}"})
+        if response.get_data(as_text=True) != 'valid':
+            failures.append(f"{license_key} settled: {response.get_data(as_text=True)!r}")
+    settled_elapsed = time.perf_counter() - start
+    settled_reads = {target: count - fresh_reads.get(target, 0) for target, count in read_counts(metrics).items()}
+
+    results = {
+        'fresh_license_checks': summarize(latencies),
+        'reads_while_fresh': fresh_reads,
+        'reads_when_settled': settled_reads,
+        'settled_throughput_per_s': round(args.settled_requests / settled_elapsed, 1),
+        'failures': failures[:20],
+        'failure_count': len(failures),
+    }
+    write_results('replica_consistency', {
+        'replicas': len(args.replica_url),
+        'dead_replica': args.dead_replica,
+        'licenses': args.licenses,
+        'settled_requests': args.settled_requests,
+        'read_your_writes_window': storage.READ_YOUR_WRITES_WINDOW,
+    }, results, args.output)
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+import storage
+from benchmarks.common import summarize, write_results
+
+# Seat claims of multi-seat licenses (storage.Storage.claim_seat).
+#
+# Race: for each of --licenses licenses with --seats seats, --claimants threads
+# wait on a barrier and then claim a seat at the same moment, each for its own
+# machine, and again all for one machine on a fresh license. Checked:
+#   - exactly min(seats, claimants) distinct machines get a seat
+#   - the stored seats match the successful claims
+#   - concurrent claims for one machine all succeed and use a single seat
+#
+# Cost: for every --seat-counts entry a license with that many seats is filled,
+# then /validate (through the validator blueprint) is timed for a machine on an
+# extra seat and for the first machine, to show that validation does not slow
+# down as seats are added.
+#
+#   python -m benchmarks.seat_claims --database-url postgresql://localhost/license_seats \
+#       --licenses 50 --seats 3 --claimants 8
+#
+# Exits non-zero if a check fails. Licenses, transactions and seats are wiped.
+
+def new_license(seats, today):
+    license_key = str(uuid.uuid4())
+    license = {'username': 'seat-check', 'hwid': '', 'expiry': (today + timedelta(days=30)).strftime('%Y-%m-%d'),
+               'active': True, 'tx_hash': 'seat-tx', 'product': 'Seat EA', 'is_trial': False, 'seats': seats}
+    transaction = {'username': 'seat-check', 'product': 'Seat EA', 'product_file': 'seat.ex5',
+                   'pdf_file': f"license_{license_key}.pdf", 'is_trial': False}
+    return license_key, license, transaction
+
+def race(store, license_key, hwids):
+    barrier = threading.Barrier(len(hwids))
+    results = [None] * len(hwids)
+
+    def claim(index):
+        barrier.wait()
+        try:
+            results[index] = store.claim_seat(license_key, hwids[index])
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=claim, args=(index,)) for index in range(len(hwids))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Race seat claims and time validation against the seat count.")
+    parser.add_argument('--database-url', required=True, help="scratch database; licenses, transactions and seats are wiped")
+    parser.add_argument('--licenses', type=int, default=50, help="licenses raced for")
+    parser.add_argument('--seats', type=int, default=3, help="seats per raced license")
+    parser.add_argument('--claimants', type=int, default=8, help="machines racing for each license")
+    parser.add_argument('--seat-counts', default='1,10,100,1000', help="seat counts timed for validation")
+    parser.add_argument('--lookups', type=int, default=1000, help="validations timed per seat count and machine")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    os.environ.update({'DATABASE_URL': args.database_url, 'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING')})
+    import validator
+
+    store = storage.open_storage(args.database_url)
+    store.init_schema()
+    with store.transaction() as cur:
+        for table in ('license_seats', 'transactions', 'licenses'):
+            cur.execute(f"DELETE FROM {table}")
+    today = date.today()
+
+    violations = []
+    latencies = []
+    for _ in range(args.licenses):
+        license_key, license, transaction = new_license(args.seats, today)
+        store.add_license(license_key, license, transaction)
+        hwids = [f"machine-{n}-{license_key}" for n in range(args.claimants)]
+        start = time.perf_counter()
+        results = race(store, license_key, hwids)
+        latencies.append(time.perf_counter() - start)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            violations.append(f"{license_key}: {errors[0]!r}")
+        granted = sorted(hwid for hwid, result in zip(hwids, results) if result is True)
+        if len(granted) != min(args.seats, args.claimants):
+            violations.append(f"{license_key}: {len(granted)} seats granted, {args.seats} available")
+        if sorted(store.list_seats(license_key)) != granted:
+            violations.append(f"{license_key}: stored seats differ from the granted claims")
+
+        license_key, license, transaction = new_license(args.seats, today)
+        store.add_license(license_key, license, transaction)
+        results = race(store, license_key, ['one-machine'] * args.claimants)
+        if results != [True] * args.claimants or store.list_seats(license_key) != ['one-machine']:
+            violations.append(f"{license_key}: same-machine claims gave {results}, seats {store.list_seats(license_key)}")
+
+    client = validator.create_app().test_client()
+    lookups = {}
+    for seat_count in [int(count) for count in args.seat_counts.split(',')]:
+        license_key, license, transaction = new_license(seat_count, today)
+        store.add_license(license_key, license, transaction)
+        for n in range(seat_count):
+            store.claim_seat(license_key, f"machine-{n}")
+        for label, hwid in (('first_seat', 'machine-0'), ('last_seat', f"machine-{seat_count - 1}")):
+            timings = []
+            for _ in range(args.lookups):
+                start = time.perf_counter()
+                response = client.post('/validate', data={'license_key': license_key, 'hwid': hwid})
+                timings.append(time.perf_counter() - start)
+                if response.get_data(as_text=True) != 'valid':
+                    violations.append(f"{seat_count} seats, {label}: {response.get_data(as_text=True)!r}")
+                    break
+            lookups[f"{seat_count}_seats_{label}"] = summarize(timings)
+        # Single-seat licenses keep their old answer for a second machine
+        refused = 'No free seats' if seat_count > 1 else 'HWID mismatch'
+        response = client.post('/validate', data={'license_key': license_key, 'hwid': 'one-too-many'})
+        if response.get_data(as_text=True) != refused:
+            violations.append(f"{seat_count} seats, extra machine: {response.get_data(as_text=True)!r}")
+
+    results = {
+        'race_rounds': summarize(latencies),
+        'validate': lookups,
+        'violations': violations[:20],
+        'violation_count': len(violations),
+    }
+    write_results('seat_claims', {
+        'backend': args.database_url.split(':', 1)[0],
+        'licenses': args.licenses,
+        'seats': args.seats,
+        'claimants': args.claimants,
+        'lookups': args.lookups,
+    }, results, args.output)
+    if violations:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+import argparse
+import contextlib
+import sys
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+import rebalance_shards
+import sharding
+import storage
+from benchmarks.common import summarize, write_results
+
+# Online shard rebalancing under write load.
+#
+# Seeds licenses (with transactions) over the first --initial-shards shards,
+# then adds the remaining shards and runs rebalance_shards.rebalance() while
+# writer threads keep issuing licenses and binding HWIDs, each through its own
+# ShardedStorage (so with its own copy of the shard map, like separate workers).
+# Afterwards every license is looked up through a fresh ShardedStorage and the
+# shards are checked:
+#   - every seeded or issued license and its transaction is found
+#   - every HWID a writer was told it bound is the stored one
+#   - no license is stored on more than one shard, and none on a shard that
+#     does not own its bucket
+#   - the shards' owned buckets partition the keyspace exactly
+#
+#   python -m benchmarks.shard_rebalance --catalog-url postgresql://localhost/license_catalog \
+#       --shard-url postgresql://localhost/license_shard0 --shard-url postgresql://localhost/license_shard1 \
+#       --licenses 100000 --writers 4
+#
+# Exits non-zero if any check fails. The catalog's shard map and every shard's
+# licenses and transactions are wiped first. sqlite:///path URLs work as well.
+
+def reset(catalog_url, shard_urls):
+    catalog = storage.open_database(catalog_url)
+    catalog.init_schema()
+    with catalog.transaction() as cur:
+        cur.execute("DELETE FROM shard_map")
+    for url in shard_urls:
+        shard = storage.open_database(url)
+        shard.init_schema()
+        with shard.transaction() as cur:
+            for table in ('transactions', 'licenses', 'shard_buckets', 'shard_identity'):
+                cur.execute(f"DELETE FROM {table}")
+
+def open_sharded(catalog_url, shard_urls):
+    return sharding.ShardedStorage(storage.open_database(catalog_url), [storage.open_database(url) for url in shard_urls])
+
+def synthetic(index, today):
+    license_key = str(uuid.uuid5(uuid.NAMESPACE_OID, f"seed:{index}"))
+    license = {'username': f"user{index}", 'hwid': '' if index % 2 else f"seed-hwid-{index}",
+               'expiry': (today + timedelta(days=30)).strftime('%Y-%m-%d'), 'active': True,
+               'tx_hash': 'seed-tx', 'product': 'Shard EA', 'is_trial': False}
+    transaction = {'username': f"user{index}", 'product': 'Shard EA', 'product_file': 'shard.ex5',
+                   'pdf_file': f"license_{license_key}.pdf", 'is_trial': False}
+    return license_key, license, transaction
+
+def writer(catalog_url, shard_urls, unbound_keys, stop, result):
+    store = open_sharded(catalog_url, shard_urls)
+    today = date.today()
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            license_key, license, transaction = synthetic(uuid.uuid4().int, today)
+            license['hwid'] = ''
+            store.add_license(license_key, license, transaction)
+            result['issued'].append(license_key)
+            if store.get_license(license_key) is None:
+                result['errors'].append(f"{license_key}: not found right after issuing")
+            hwid = f"hwid-{license_key}"
+            if store.bind_hwid(license_key, hwid):
+                result['bound'][license_key] = hwid
+            else:
+                result['errors'].append(f"{license_key}: first bind refused")
+            if store.bind_hwid(license_key, 'another-machine'):
+                result['errors'].append(f"{license_key}: second bind accepted")
+            if unbound_keys:
+                seeded_key = unbound_keys.pop()
+                if store.bind_hwid(seeded_key, f"hwid-{seeded_key}"):
+                    result['bound'][seeded_key] = f"hwid-{seeded_key}"
+                else:
+                    result['errors'].append(f"{seeded_key}: bind of a seeded license refused")
+        except Exception as e:
+            result['errors'].append(f"{type(e).__name__}: {e}")
+        result['latencies'].append(time.perf_counter() - start)
+
+def verify(catalog_url, shard_urls, expected, bound):
+    violations = []
+    store = open_sharded(catalog_url, shard_urls)
+    for license_key in expected:
+        license = store.get_license(license_key)
+        if license is None:
+            violations.append(f"{license_key}: license missing")
+            continue
+        if license_key in bound and license['hwid'] != bound[license_key]:
+            violations.append(f"{license_key}: stored HWID {license['hwid']!r}, bound {bound[license_key]!r}")
+        if store.get_transaction(license_key) is None:
+            violations.append(f"{license_key}: transaction missing")
+
+    _, assignment = store.shard_map(force=True)
+    owners = {}
+    stored = 0
+    for index, shard in enumerate(store.shards):
+        owned = shard.owned_buckets()
+        for bucket in owned:
+            owners.setdefault(bucket, []).append(index)
+        for license_key in shard.load_licenses():
+            stored += 1
+            if sharding.shard_bucket(license_key) not in owned:
+                violations.append(f"{license_key}: stored on shard {index}, which does not own its bucket")
+    if stored != len(expected):
+        violations.append(f"{stored} licenses stored across shards, {len(expected)} expected")
+    for bucket in range(sharding.SHARD_BUCKETS):
+        if owners.get(bucket, []) != [assignment[bucket]]:
+            violations.append(f"bucket {bucket}: owned by {owners.get(bucket, [])}, map says {assignment[bucket]}")
+    return violations, [sum(1 for owner in assignment if owner == index) for index in range(len(shard_urls))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebalance license shards under write load and verify the result.")
+    parser.add_argument('--catalog-url', required=True, help="main database (shard map); wiped")
+    parser.add_argument('--shard-url', action='append', required=True, help="shard database (repeatable); wiped")
+    parser.add_argument('--initial-shards', type=int, default=1, help="shards the licenses are seeded over")
+    parser.add_argument('--licenses', type=int, default=20000)
+    parser.add_argument('--writers', type=int, default=4, help="threads issuing and binding during the rebalance")
+    parser.add_argument('--buckets-per-cutover', type=int, default=16)
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+    if not 0 < args.initial_shards < len(args.shard_url):
+        parser.error("--initial-shards must leave at least one --shard-url to add")
+
+    reset(args.catalog_url, args.shard_url)
+    initial = open_sharded(args.catalog_url, args.shard_url[:args.initial_shards])
+    initial.init_schema()
+    today = date.today()
+    seeded = [synthetic(index, today) for index in range(args.licenses)]
+    start = time.perf_counter()
+    initial.save_licenses({key: license for key, license, _ in seeded})
+    initial.save_transactions({key: transaction for key, _, transaction in seeded})
+    seed_seconds = time.perf_counter() - start
+    unbound_keys = [key for key, license, _ in seeded if not license['hwid']]
+    bound = {key: license['hwid'] for key, license, _ in seeded if license['hwid']}
+
+    store = open_sharded(args.catalog_url, args.shard_url)
+    store.init_schema()
+    stop = threading.Event()
+    results = [{'issued': [], 'bound': {}, 'errors': [], 'latencies': []} for _ in range(args.writers)]
+    writers = [threading.Thread(target=writer, args=(args.catalog_url, args.shard_url, unbound_keys, stop, result))
+               for result in results]
+    for thread in writers:
+        thread.start()
+    time.sleep(1)
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stderr):
+        rebalance_shards.rebalance(store, args.buckets_per_cutover)
+    rebalance_seconds = time.perf_counter() - start
+    time.sleep(1)
+    stop.set()
+    for thread in writers:
+        thread.join()
+
+    issued = [key for result in results for key in result['issued']]
+    for result in results:
+        bound.update(result['bound'])
+    errors = [error for result in results for error in result['errors']]
+    latencies = [latency for result in results for latency in result['latencies']]
+    violations, buckets_per_shard = verify(args.catalog_url, args.shard_url,
+                                           [key for key, _, _ in seeded] + issued, bound)
+    document = {
+        'seed_seconds': round(seed_seconds, 2),
+        'rebalance_seconds': round(rebalance_seconds, 2),
+        'map_version': store.shard_map(force=True)[0],
+        'buckets_per_shard': buckets_per_shard,
+        'writer_iterations': summarize(latencies, rebalance_seconds + 2),
+        'issued_during_rebalance': len(issued),
+        'errors': errors[:20],
+        'error_count': len(errors),
+        'violations': violations[:20],
+        'violation_count': len(violations),
+    }
+    write_results('shard_rebalance', {
+        'backend': args.catalog_url.split(':', 1)[0],
+        'shards': len(args.shard_url),
+        'initial_shards': args.initial_shards,
+        'licenses': args.licenses,
+        'writers': args.writers,
+        'buckets_per_cutover': args.buckets_per_cutover,
+    }, document, args.output)
+    if errors or violations:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
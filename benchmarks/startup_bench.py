@@ -0,0 +1,67 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+from benchmarks.common import summarize, write_results
+
+# Cold-start benchmark for the process entry points.
+#
+# Every sample is a fresh interpreter that loads one entry point the way a
+# gunicorn worker would and reports the time taken, its peak RSS and how many
+# modules it imported:
+#
+#   bot        import telegram_bot (python-telegram-bot, fpdf, the full bot)
+#   validator  validator.create_app() (Flask, the data layer and metrics only)
+#
+#   python -m benchmarks.startup_bench --runs 10 --output startup.json
+#
+# No database is touched; DATABASE_URL only has to be syntactically valid.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = {
+    'bot': "import telegram_bot",
+    'validator': "import validator; validator.create_app()",
+}
+
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'modules': len(sys.modules), 'telegram_loaded': 'telegram' in sys.modules,
+        'psycopg2_loaded': 'psycopg2' in sys.modules}}))
+"""
+
+def sample(entry_point, database_url):
+    env = dict(os.environ, DATABASE_URL=database_url, TELEGRAM_TOKEN='123456:startup-token', LOG_LEVEL='WARNING')
+    output = subprocess.check_output(
+        [sys.executable, '-c', PROBE.format(statement=ENTRY_POINTS[entry_point])],
+        cwd=REPO_DIR, env=env, stderr=subprocess.DEVNULL
+    )
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold start time and RSS of the bot and validator entry points.")
+    parser.add_argument('--runs', type=int, default=5, help="fresh interpreters per entry point")
+    parser.add_argument('--database-url', default='sqlite:///startup-bench.db',
+                        help="DATABASE_URL given to the entry points (never connected to)")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    results = {}
+    for entry_point in ENTRY_POINTS:
+        samples = [sample(entry_point, args.database_url) for _ in range(args.runs)]
+        results[entry_point] = {
+            'startup': summarize([s['seconds'] for s in samples]),
+            'max_rss_mb': round(max(s['max_rss_kb'] for s in samples) / 1024, 1),
+            'modules': samples[-1]['modules'],
+            'telegram_loaded': samples[-1]['telegram_loaded'],
+            'psycopg2_loaded': samples[-1]['psycopg2_loaded'],
+        }
+    write_results('startup', {'runs': args.runs, 'database_url': args.database_url.split(':', 1)[0]}, results, args.output)
+
+if __name__ == '__main__':
+    main()
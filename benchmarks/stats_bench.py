@@ -0,0 +1,144 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from benchmarks.common import summarize, write_results
+from benchmarks.validate_bench import seed
+
+# /admin_stats from the daily rollups of analytics.py against a table of
+# --size licenses and a year of rollup history:
+#
+#   sweep     the expiry sweeper's first run (counts the active licenses) and a
+#             daily run (the licenses of one expiry day), both checked against
+#             COUNT(*) over the licenses table
+#   report    analytics.report() for today / 30d / 365d, next to the GROUP BY
+#             over the licenses table that the same active and expiry numbers
+#             would otherwise take
+#   chart     rendering the 365 day chart
+#   count     the cost of analytics.count_validation on the /validate path
+#
+#   python -m benchmarks.stats_bench --database-url postgresql://localhost/license_bench --size 1000000
+#
+# Exits non-zero if a rollup differs from the licenses table.
+
+TIERS = ('1', '2', '3', 'trial')
+
+def seed_history(store, products, today, days, rng):
+    sales = []
+    usage = []
+    for offset in range(days):
+        day = (today - timedelta(days=offset)).isoformat()
+        for product in products:
+            for tier in TIERS:
+                licenses = rng.randrange(1, 50)
+                price = 0 if tier == 'trial' else 10 * int(tier)
+                sales.append((day, product, tier, licenses, licenses * price, licenses * price * 9.5))
+            usage.append((day, product, rng.randrange(10**5, 10**6), rng.randrange(10**3), 0, None))
+    with store.transaction() as cur:
+        cur.execute("DELETE FROM sales_daily")
+        cur.execute("DELETE FROM usage_daily")
+        store._insert_many(cur, 'sales_daily', ('day', 'product', 'tier', 'licenses', 'revenue_usd', 'revenue_xlm'), sales)
+        store._insert_many(cur, 'usage_daily', ('day', 'product', 'validations', 'refused', 'expired', 'active'), usage)
+
+def count_by_product(store, where):
+    with store.transaction(write=False) as cur:
+        cur.execute(f"SELECT product, COUNT(*) FROM licenses WHERE {where} GROUP BY product")
+        return dict(cur.fetchall())
+
+def timed(call, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    return summarize(timings)
+
+def main():
+    parser = argparse.ArgumentParser(description="Time /admin_stats answered from the analytics rollups.")
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help="database to seed (default: a temporary SQLite file)")
+    parser.add_argument('--size', type=int, default=100000, help="licenses in the table")
+    parser.add_argument('--days', type=int, default=365, help="days of rollup history")
+    parser.add_argument('--repeat', type=int, default=50, help="timed runs per report")
+    parser.add_argument('--counts', type=int, default=200000, help="count_validation calls timed")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='stats-bench-'), 'bench.db')}"
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    import analytics
+    import database
+
+    rng = random.Random(args.seed)
+    today = date.today()
+    seed(database_url, args.size)
+    store = database.get_store()
+    with store.transaction() as cur:
+        cur.execute("DELETE FROM analytics_state")
+    products = sorted(count_by_product(store, "TRUE"))
+    seed_history(store, products, today, args.days, rng)
+
+    violations = []
+    results = {}
+    start = time.perf_counter()
+    analytics.sweep_expired(store)
+    results['sweep'] = {'first_run_ms': round((time.perf_counter() - start) * 1000, 1)}
+    active = count_by_product(store, f"active = TRUE AND expiry > '{today.isoformat()}'")
+    if store.active_license_counts() != active:
+        violations.append(f"active counts {store.active_license_counts()} != {active}")
+
+    # A day passes: the licenses expiring tomorrow are the ones the next run counts
+    tomorrow = (today + timedelta(days=1)).isoformat()
+    expiring = count_by_product(store, f"active = TRUE AND expiry = '{tomorrow}'")
+    real_today, analytics.today = analytics.today, lambda: tomorrow
+    start = time.perf_counter()
+    swept = analytics.sweep_expired(store)
+    results['sweep']['daily_run_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    results['sweep']['expired_in_one_day'] = swept
+    if swept != sum(expiring.values()):
+        violations.append(f"daily sweep counted {swept} expired licenses, the table has {sum(expiring.values())}")
+    remaining = {product: count - expiring.get(product, 0) for product, count in active.items()}
+    if store.active_license_counts() != remaining:
+        violations.append(f"active counts after the sweep {store.active_license_counts()} != {remaining}")
+    analytics.today = real_today
+
+    results['report'] = {}
+    for name in ('today', '30d', '365d'):
+        first, last = analytics.parse_range(name)
+        results['report'][name] = timed(lambda: analytics.format_report(analytics.report(first, last)), args.repeat)
+    first = (today - timedelta(days=29)).isoformat()
+    results['report']['table_scan_30d'] = timed(lambda: (
+        count_by_product(store, f"active = TRUE AND expiry > '{today.isoformat()}'"),
+        count_by_product(store, f"active = TRUE AND expiry >= '{first}' AND expiry <= '{today.isoformat()}'"),
+    ), max(1, args.repeat // 10))
+
+    report = analytics.report(*analytics.parse_range('365d'))
+    path = os.path.join(tempfile.mkdtemp(prefix='stats-chart-'), 'chart.pdf')
+    results['chart_365d'] = timed(lambda: analytics.render_chart(report, path), max(1, args.repeat // 10))
+    results['chart_365d']['bytes'] = os.path.getsize(path)
+
+    keys = [f"key-{index}" for index in range(1000)]
+    license = {'product': products[0]}
+    start = time.perf_counter()
+    for index in range(args.counts):
+        analytics.count_validation('valid', keys[index % len(keys)], 200, license)
+    results['count_validation_us'] = round((time.perf_counter() - start) / args.counts * 1e6, 3)
+
+    results['violations'] = violations
+    write_results('stats', {
+        'database': database_url.split(':', 1)[0],
+        'size': args.size,
+        'days': args.days,
+        'products': len(products),
+        'repeat': args.repeat,
+    }, results, args.output)
+    if violations:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
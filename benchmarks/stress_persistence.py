@@ -0,0 +1,185 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+import storage
+from benchmarks.common import write_results
+
+# Concurrency stress test for the persistence layer.
+#
+# Worker processes fire simultaneous purchases, trial claims and first-time
+# /validate calls (several workers race to bind each unbound license with
+# different HWIDs) through the same code paths the bot and the Flask app use.
+# Afterwards the database is checked for lost writes:
+#   - every issued license key exists in licenses
+#   - every issued key has exactly one transaction, and no transaction is orphaned
+#   - each contended license accepted at most one HWID, and the stored HWID is
+#     the one that was accepted
+#
+#   python -m benchmarks.stress_persistence --database-url postgresql://localhost/license_stress \
+#       --processes 8 --purchases 2000 --trials 1000 --bind-keys 500 --binders 4
+#
+# Exits non-zero if any invariant is violated. The licenses, transactions and
+# products tables of the given database are wiped first; a sqlite:///path URL
+# stresses the embedded SQLite backend instead of PostgreSQL.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STRESS_PRODUCT = {
+    'name': 'Stress Expert Advisor',
+    'file': 'stress_expert_advisor.ex5',
+    'is_trial': False,
+    'expiry_days': 7,
+    'pricing_tiers': {'1': {'price_usd': 10.0, 'price_xlm': 50.0, 'expiry_days': 30}},
+}
+
+def load_bot(database_url):
+    os.environ.update({'DATABASE_URL': database_url, 'TELEGRAM_TOKEN': '123456:stress-token'})
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    import telegram_bot
+    return telegram_bot
+
+def worker(worker_id, database_url, operations, barrier, result_queue):
+    telegram_bot = load_bot(database_url)
+    client = telegram_bot.app.test_client()
+    barrier.wait(timeout=300)
+    issued, binds, errors, timings = [], [], [], {}
+    start = time.perf_counter()
+    for kind, argument in operations:
+        op_start = time.perf_counter()
+        try:
+            if kind == 'purchase':
+                license_key, _ = telegram_bot.issue_license(f"stress{worker_id}", STRESS_PRODUCT, '1', 'stress-tx')
+                issued.append(license_key)
+            elif kind == 'trial':
+                license_key, _ = telegram_bot.issue_license(f"stress{worker_id}", STRESS_PRODUCT, 'trial', 'trial-no-payment')
+                issued.append(license_key)
+            else:
+                license_key, hwid = argument
+                response = client.post('/validate', data={'license_key': license_key, 'hwid': hwid})
+                binds.append((license_key, hwid, response.get_data(as_text=True)))
+        except Exception as e:
+            errors.append(f"{kind}: {e!r}")
+        timings.setdefault(kind, []).append(time.perf_counter() - op_start)
+    result_queue.put({
+        'issued': issued, 'binds': binds, 'errors': errors,
+        'elapsed': time.perf_counter() - start, 'timings': timings,
+    })
+
+def reset_database(database_url, bind_keys):
+    store = storage.open_storage(database_url)
+    store.save_transactions({})
+    store.replace_licenses(
+        (license_key, 'stress-binder', '', '2099-12-31', True, 'stress-tx', STRESS_PRODUCT['name'], False, 1, None)
+        for license_key in bind_keys
+    )
+
+def check_invariants(database_url, issued, binds, bind_keys):
+    store = storage.open_storage(database_url)
+    licenses = {license_key: info['hwid'] for license_key, info in store.load_licenses().items()}
+    with store.transaction(write=False) as cur:
+        cur.execute("SELECT license_key, COUNT(*) FROM transactions GROUP BY license_key")
+        transaction_counts = dict(cur.fetchall())
+
+    violations = {
+        'missing_license': [key for key in issued if key not in licenses],
+        'missing_transaction': [key for key in issued if transaction_counts.get(key, 0) == 0],
+        'duplicate_transaction': [key for key, count in transaction_counts.items() if count > 1],
+        'orphan_transaction': [key for key in transaction_counts if key not in licenses],
+        'bind_key_lost': [key for key in bind_keys if key not in licenses],
+        'multiple_hwids_accepted': [],
+        'accepted_hwid_not_stored': [],
+    }
+    accepted = {}
+    for license_key, hwid, outcome in binds:
+        if outcome == 'valid':
+            accepted.setdefault(license_key, set()).add(hwid)
+    for license_key, hwids in accepted.items():
+        if len(hwids) > 1:
+            violations['multiple_hwids_accepted'].append(license_key)
+        elif licenses.get(license_key) not in hwids:
+            violations['accepted_hwid_not_stored'].append(license_key)
+    return violations
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress the persistence layer and check for lost writes.")
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help="DSN of a scratch database; licenses, transactions and products are wiped")
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--purchases', type=int, default=1000)
+    parser.add_argument('--trials', type=int, default=500)
+    parser.add_argument('--bind-keys', type=int, default=200, help="unbound licenses raced for first-time validation")
+    parser.add_argument('--binders', type=int, default=4, help="competing HWIDs per unbound license")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("--database-url (or BENCH_DATABASE_URL) is required; its tables will be wiped")
+
+    telegram_bot = load_bot(args.database_url)
+    telegram_bot.init_db()
+    telegram_bot.save_products({'1': STRESS_PRODUCT})
+
+    rng = random.Random(args.seed)
+    bind_keys = [str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(args.bind_keys)]
+    reset_database(args.database_url, bind_keys)
+
+    operations = [('purchase', None)] * args.purchases + [('trial', None)] * args.trials
+    operations += [('validate', (key, f"stress-hwid-{key[:8]}-{n}")) for key in bind_keys for n in range(args.binders)]
+    rng.shuffle(operations)
+    shares = [operations[n::args.processes] for n in range(args.processes)]
+
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(args.processes)
+    result_queue = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(n, args.database_url, shares[n], barrier, result_queue))
+        for n in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    worker_results = []
+    while len(worker_results) < len(processes):
+        try:
+            worker_results.append(result_queue.get(timeout=1))
+        except queue.Empty:
+            crashed = [process.pid for process in processes if process.exitcode not in (None, 0)]
+            if crashed:
+                for process in processes:
+                    process.terminate()
+                sys.exit(f"Worker processes {crashed} crashed before reporting results")
+    for process in processes:
+        process.join()
+
+    issued = [key for result in worker_results for key in result['issued']]
+    binds = [bind for result in worker_results for bind in result['binds']]
+    errors = [error for result in worker_results for error in result['errors']]
+    elapsed = max(result['elapsed'] for result in worker_results)
+    violations = check_invariants(args.database_url, issued, binds, bind_keys)
+
+    counts = {}
+    for result in worker_results:
+        for kind, latencies in result['timings'].items():
+            counts[kind] = counts.get(kind, 0) + len(latencies)
+    results = {
+        'elapsed_s': round(elapsed, 2),
+        'operations': counts,
+        'throughput_per_s': {kind: round(count / elapsed, 1) for kind, count in counts.items()},
+        'errors': len(errors),
+        'error_samples': errors[:10],
+        'violations': {name: len(keys) for name, keys in violations.items()},
+        'violation_samples': {name: keys[:5] for name, keys in violations.items() if keys},
+    }
+    write_results('stress_persistence', {
+        'processes': args.processes, 'purchases': args.purchases, 'trials': args.trials,
+        'bind_keys': args.bind_keys, 'binders': args.binders, 'seed': args.seed,
+    }, results, args.output)
+    if any(violations.values()) or errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+import argparse
+import hashlib
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+import httpx
+import async_validator
+import storage
+from benchmarks.common import summarize, write_results
+
+# Load test for the /validate endpoint.
+#
+# For every table size the licenses table is truncated and re-seeded with
+# synthetic rows, then a pool of client processes/threads drives /validate with a
+# configurable scenario mix. Latency percentiles and throughput are reported per
+# outcome as JSON.
+#
+#   python -m benchmarks.validate_bench --database-url postgresql://localhost/license_bench \
+#       --start-server --sizes 1000,100000,1000000 --duration 30 --output validate.json
+#
+# The seeded database is wiped, so the DSN has to be given explicitly (or via
+# BENCH_DATABASE_URL) and never defaults to DATABASE_URL. A sqlite:///path URL
+# runs the whole benchmark without a database server. --replica-url (repeatable)
+# hands streaming replicas of the database to the server as DATABASE_REPLICA_URLS;
+# each run then waits until the replicas have the seeded rows.
+#
+# --server async launches async_validator.py instead of gunicorn (HTTP on
+# --port, the binary protocol on --port + 1), and --protocol binary drives it
+# over the binary protocol, --pipeline requests at a time per connection; the
+# latency of each request is then the round trip of its whole batch. Compare
+# runs with `python -m benchmarks.common`.
+
+# Every block of 20 consecutive synthetic licenses has the same layout, so the row
+# for any index can be regenerated on the client without keeping the keys in memory.
+BLOCK_SIZE = 20
+CATEGORY_OFFSETS = {
+    'bound': range(0, 12),        # active, HWID bound (60%)
+    'unbound': range(12, 16),     # active, HWID not bound yet (20%)
+    'expired': range(16, 18),     # expired (10%)
+    'deactivated': range(18, 19), # deactivated (5%)
+    'trial': range(19, 20),       # active trial, HWID bound (5%)
+}
+
+# Request scenarios: (license category or None for unknown keys, send the matching HWID)
+SCENARIOS = {
+    'valid': ('bound', True),
+    'first_bind': ('unbound', True),
+    'trial': ('trial', True),
+    'hwid_mismatch': ('bound', False),
+    'expired': ('expired', True),
+    'deactivated': ('deactivated', True),
+    'invalid_key': (None, True),
+}
+DEFAULT_MIX = 'valid=70,first_bind=5,trial=5,hwid_mismatch=5,expired=5,deactivated=2,invalid_key=8'
+
+RESPONSE_OUTCOMES = {
+    'valid': 'valid',
+    'Invalid license key': 'invalid_key',
+    'HWID mismatch': 'hwid_mismatch',
+    'License deactivated': 'deactivated',
+    'License expired': 'expired',
+    'No free seats': 'no_free_seat',
+    'Missing license_key or hwid': 'missing_params',
+}
+
+BINARY_OUTCOMES = {code: outcome for outcome, code in async_validator.STATUS_CODES.items()}
+FRAME_HEADER = async_validator.REQUEST_FRAME_SIZE.to_bytes(2, 'big')
+
+def license_key(index):
+    return str(uuid.UUID(bytes=hashlib.md5(f"license:{index}".encode()).digest(), version=4))
+
+def hwid(index):
+    return hashlib.sha256(f"hwid:{index}".encode()).hexdigest()[:32]
+
+def category(index):
+    offset = index % BLOCK_SIZE
+    return next(name for name, offsets in CATEGORY_OFFSETS.items() if offset in offsets)
+
+def synthetic_license(index, today):
+    kind = category(index)
+    expiry = today - timedelta(days=1 + index % 300) if kind == 'expired' else today + timedelta(days=1 + index % 365)
+    return (
+        license_key(index),
+        f"user{index}",
+        '' if kind == 'unbound' else hwid(index),
+        expiry.strftime('%Y-%m-%d'),
+        kind != 'deactivated',
+        'bench-tx' if kind != 'trial' else 'trial-no-payment',
+        'MT5 Expert Advisor' if index % 2 else 'MT4 Expert Advisor',
+        kind == 'trial',
+        1,
+        # Four licenses per buyer
+        10**9 + index // 4,
+    )
+
+def seed(database_url, size):
+    store = storage.open_storage(database_url)
+    store.init_schema()
+    today = date.today()
+    store.replace_licenses(synthetic_license(index, today) for index in range(size))
+
+def wait_for_replicas(replica_urls, size, timeout=600):
+    deadline = time.monotonic() + timeout
+    for replica_url in replica_urls:
+        replica = storage.open_storage(replica_url)
+        while True:
+            with replica.transaction(write=False) as cur:
+                cur.execute("SELECT COUNT(*) FROM licenses")
+                if cur.fetchone()[0] == size:
+                    break
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Replica did not catch up with {size} licenses within {timeout}s")
+            time.sleep(0.5)
+
+def pick_index(rng, kind, size):
+    offsets = CATEGORY_OFFSETS[kind]
+    blocks = max(1, size // BLOCK_SIZE)
+    return rng.randrange(blocks) * BLOCK_SIZE + rng.choice(offsets)
+
+def build_request(rng, scenario, size):
+    kind, matching_hwid = SCENARIOS[scenario]
+    if kind is None:
+        return str(uuid.UUID(int=rng.getrandbits(128), version=4)), hwid(0)
+    index = pick_index(rng, kind, size)
+    return license_key(index), hwid(index) if matching_hwid else hwid(index + 1)
+
+def parse_mix(spec):
+    mix = {}
+    for item in spec.split(','):
+        name, weight = item.split('=')
+        if name not in SCENARIOS:
+            raise ValueError(f"Unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight)
+    return mix
+
+def client_thread(url, size, mix, deadline, seed_value, samples):
+    rng = random.Random(seed_value)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    with httpx.Client(timeout=30) as client:
+        while time.perf_counter() < deadline:
+            scenario = rng.choices(names, weights)[0]
+            key, request_hwid = build_request(rng, scenario, size)
+            start = time.perf_counter()
+            try:
+                response = client.post(url, data={'license_key': key, 'hwid': request_hwid})
+                outcome = RESPONSE_OUTCOMES.get(response.text, f"http_{response.status_code}")
+            except httpx.HTTPError:
+                outcome = 'transport_error'
+            samples.append((outcome, time.perf_counter() - start))
+
+def read_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed by the server")
+        data += chunk
+    return data
+
+def binary_client_thread(address, size, mix, deadline, seed_value, samples, pipeline):
+    rng = random.Random(seed_value)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    host, port = address.rsplit(':', 1)
+    frame_size = async_validator.RESPONSE_FRAME.size
+    with socket.create_connection((host, int(port))) as sock:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        while time.perf_counter() < deadline:
+            frames = []
+            for _ in range(pipeline):
+                key, request_hwid = build_request(rng, rng.choices(names, weights)[0], size)
+                frames.append(FRAME_HEADER + uuid.UUID(key).bytes + bytes.fromhex(request_hwid))
+            start = time.perf_counter()
+            try:
+                sock.sendall(b''.join(frames))
+                data = read_exactly(sock, frame_size * pipeline)
+            except OSError:
+                samples.append(('transport_error', time.perf_counter() - start))
+                return
+            latency = time.perf_counter() - start
+            for offset in range(0, len(data), frame_size):
+                _, status, _, _ = async_validator.RESPONSE_FRAME.unpack_from(data, offset)
+                samples.append((BINARY_OUTCOMES.get(status, f"status_{status}"), latency))
+
+def client_process(target, size, mix, duration, threads, seed_value, protocol='http', pipeline=1):
+    samples = []
+    deadline = time.perf_counter() + duration
+    if protocol == 'binary':
+        def run(n):
+            binary_client_thread(target, size, mix, deadline, seed_value * 1000 + n, samples, pipeline)
+    else:
+        def run(n):
+            client_thread(target, size, mix, deadline, seed_value * 1000 + n, samples)
+    workers = [threading.Thread(target=run, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return samples
+
+def run_load(target, size, mix, duration, processes, threads, protocol='http', pipeline=1):
+    with multiprocessing.Pool(processes) as pool:
+        start = time.perf_counter()
+        batches = pool.starmap(client_process, [(target, size, mix, duration, threads, n + 1, protocol, pipeline)
+                                                for n in range(processes)])
+        elapsed = time.perf_counter() - start
+    samples = [sample for batch in batches for sample in batch]
+    by_outcome = {}
+    for outcome, latency in samples:
+        by_outcome.setdefault(outcome, []).append(latency)
+    return {
+        'overall': summarize([latency for _, latency in samples], elapsed),
+        'outcomes': {outcome: summarize(latencies, elapsed) for outcome, latencies in sorted(by_outcome.items())},
+    }
+
+def start_server(database_url, port, workers, replica_urls=(), kind='gunicorn'):
+    env = dict(os.environ, DATABASE_URL=database_url, DATABASE_REPLICA_URLS=','.join(replica_urls))
+    if kind == 'async':
+        command = [sys.executable, 'async_validator.py', '--host', '127.0.0.1',
+                   '--http-port', str(port), '--binary-port', str(port + 1)]
+    else:
+        command = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '-b', f"127.0.0.1:{port}", 'validator:create_app()']
+    process = subprocess.Popen(command, env=env)
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(120):
+        try:
+            httpx.get(f"{base}/metrics", timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("Server did not come up within 60 seconds")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the /validate endpoint across license table sizes.")
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help="DSN of the database the server under test uses; its licenses table is wiped")
+    parser.add_argument('--url', default='http://127.0.0.1:5000/validate', help="/validate URL of the server under test")
+    parser.add_argument('--start-server', action='store_true', help="launch gunicorn 'validator:create_app()' against --database-url")
+    parser.add_argument('--server', choices=('gunicorn', 'async'), default='gunicorn',
+                        help="what --start-server launches: gunicorn workers or async_validator.py")
+    parser.add_argument('--server-workers', type=int, default=4, help="gunicorn workers")
+    parser.add_argument('--protocol', choices=('http', 'binary'), default='http')
+    parser.add_argument('--binary-address', default='127.0.0.1:5002', help="host:port of the binary protocol")
+    parser.add_argument('--pipeline', type=int, default=1, help="binary requests in flight per connection")
+    parser.add_argument('--replica-url', action='append', default=[],
+                        help="read replica of --database-url for the launched server (repeatable)")
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--sizes', default='1000,100000,1000000', help="comma-separated license table sizes")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="scenario weights, e.g. valid=90,invalid_key=10")
+    parser.add_argument('--duration', type=float, default=20.0, help="seconds of load per table size")
+    parser.add_argument('--warmup', type=float, default=2.0, help="seconds of unrecorded load before each run")
+    parser.add_argument('--processes', type=int, default=2, help="client processes")
+    parser.add_argument('--threads', type=int, default=8, help="client threads per process")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("--database-url (or BENCH_DATABASE_URL) is required; the licenses table will be wiped")
+    mix = parse_mix(args.mix)
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    server = None
+    url = args.url
+    binary_address = args.binary_address
+    if args.start_server:
+        server = start_server(args.database_url, args.port, args.server_workers, args.replica_url, args.server)
+        url = f"http://127.0.0.1:{args.port}/validate"
+        binary_address = f"127.0.0.1:{args.port + 1}"
+    target = binary_address if args.protocol == 'binary' else url
+    results = []
+    try:
+        for size in sizes:
+            print(f"Seeding {size} licenses...", file=sys.stderr)
+            seed_start = time.perf_counter()
+            seed(args.database_url, size)
+            wait_for_replicas(args.replica_url, size)
+            seed_seconds = time.perf_counter() - seed_start
+            if args.warmup:
+                run_load(target, size, mix, args.warmup, args.processes, args.threads, args.protocol, args.pipeline)
+            print(f"Running {args.duration}s of load against {size} licenses...", file=sys.stderr)
+            result = run_load(target, size, mix, args.duration, args.processes, args.threads, args.protocol, args.pipeline)
+            result.update({'size': size, 'seed_seconds': round(seed_seconds, 2)})
+            results.append(result)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    write_results('validate', {
+        'url': target, 'sizes': sizes, 'mix': mix, 'duration': args.duration,
+        'processes': args.processes, 'threads': args.threads,
+        'server': args.server if args.start_server else None,
+        'server_workers': args.server_workers if args.start_server and args.server == 'gunicorn' else None,
+        'protocol': args.protocol, 'pipeline': args.pipeline,
+        'replicas': len(args.replica_url),
+    }, results, args.output)
+
+if __name__ == '__main__':
+    main()
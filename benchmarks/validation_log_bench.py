@@ -0,0 +1,141 @@
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from benchmarks.common import summarize, write_results
+
+# Validation event ingestion (validation_log.py):
+#
+#   record     cost of validation_log.record() on the /validate path, from
+#              --threads threads at once
+#   batched    --events events written by the flusher (COPY on PostgreSQL,
+#              multi-row INSERT on SQLite), in events per second
+#   per_row    the same events written one INSERT and commit each, as logging
+#              synchronously from /validate would
+#   retention  events spread over --months months: every month gets its
+#              partition, and pruning keeps exactly the months inside the
+#              retention period
+#
+#   python -m benchmarks.validation_log_bench --database-url postgresql://localhost/license_bench
+#
+# Exits non-zero if an event is lost or pruning keeps the wrong rows.
+
+def count_events(store, since=None):
+    with store.transaction(write=False) as cur:
+        if since is None:
+            cur.execute("SELECT COUNT(*) FROM validation_events")
+        else:
+            cur.execute(store._sql("SELECT COUNT(*) FROM validation_events WHERE created_at >= %s"), (store._timestamp(since),))
+        return cur.fetchone()[0]
+
+def clear(store):
+    with store.transaction() as cur:
+        cur.execute("DELETE FROM validation_events")
+
+def main():
+    parser = argparse.ArgumentParser(description="Time batched validation event ingestion.")
+    parser.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                        help="database to write to (default: a temporary SQLite file)")
+    parser.add_argument('--events', type=int, default=200000, help="events written by the flusher")
+    parser.add_argument('--per-row-events', type=int, default=5000, help="events written one INSERT each")
+    parser.add_argument('--threads', type=int, default=8, help="threads calling record()")
+    parser.add_argument('--months', type=int, default=6, help="months of events for the retention check")
+    parser.add_argument('--output', help="write JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    database_url = args.database_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='validation-log-bench-'), 'bench.db')}"
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['VALIDATION_LOG_BUFFER_SIZE'] = str(args.events)
+    import database
+    import storage
+    import validation_log
+
+    store = database.get_store()
+    store.init_schema()
+    clear(store)
+    # No flusher thread: the flushes below are timed and write everything themselves
+    validation_log._flusher_pid = os.getpid()
+    keys = [str(uuid.uuid4()) for _ in range(1000)]
+    violations = []
+    results = {}
+
+    per_thread = args.events // args.threads
+
+    def produce(offset):
+        for index in range(per_thread):
+            validation_log.record(keys[(offset + index) % len(keys)], f"hwid-{index % 50}", '203.0.113.7', 'valid', 0.0021)
+
+    threads = [threading.Thread(target=produce, args=(offset,)) for offset in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    recorded = per_thread * args.threads
+    results['record'] = {'us_per_event': round(elapsed / recorded * 1e6, 3), 'events': recorded}
+
+    start = time.perf_counter()
+    validation_log.flush(store)
+    elapsed = time.perf_counter() - start
+    results['batched'] = {'events_per_s': round(recorded / elapsed), 'seconds': round(elapsed, 3)}
+    if count_events(store) != recorded:
+        violations.append(f"batched: {count_events(store)} of {recorded} events stored")
+
+    clear(store)
+    now = datetime.now()
+    row_timings = []
+    sql = store._sql(f"INSERT INTO validation_events ({', '.join(storage.VALIDATION_EVENT_COLUMNS)}) "
+                     f"VALUES ({', '.join(['%s'] * len(storage.VALIDATION_EVENT_COLUMNS))})")
+    start = time.perf_counter()
+    for index in range(args.per_row_events):
+        begin = time.perf_counter()
+        with store.transaction() as cur:
+            cur.execute(sql, (store._timestamp(now), keys[index % len(keys)], 'ab' * 16, '203.0.113.7', 'valid', 2.1))
+        row_timings.append(time.perf_counter() - begin)
+    elapsed = time.perf_counter() - start
+    results['per_row'] = dict(summarize(row_timings), events_per_s=round(args.per_row_events / elapsed))
+    results['batched_speedup'] = round(results['batched']['events_per_s'] / results['per_row']['events_per_s'], 1)
+
+    clear(store)
+    per_month = 1000
+    for month in range(args.months):
+        created_at = (now.replace(day=15) - timedelta(days=30 * month)).replace(day=15)
+        for index in range(per_month):
+            validation_log._buffer.append((created_at, keys[index % len(keys)], 'cd' * 16, '198.51.100.1', 'valid', 1.5))
+    validation_log.flush(store)
+    if count_events(store) != per_month * args.months:
+        violations.append(f"retention: {count_events(store)} of {per_month * args.months} events stored")
+    cutoff = now - timedelta(days=validation_log.VALIDATION_LOG_RETENTION_DAYS)
+    recent = count_events(store, cutoff)
+    start = time.perf_counter()
+    validation_log.prune(store)
+    results['retention'] = {'prune_ms': round((time.perf_counter() - start) * 1000, 1), 'kept': count_events(store)}
+    # Partitions go whole, so events up to a month older than the cutoff may stay
+    if isinstance(store, storage.PostgresStorage):
+        oldest_kept = datetime(cutoff.year, cutoff.month, 1)
+    else:
+        oldest_kept = cutoff
+    if count_events(store) != count_events(store, oldest_kept):
+        violations.append("retention: events older than the retention period were kept")
+    if count_events(store, cutoff) != recent:
+        violations.append("retention: events inside the retention period were dropped")
+
+    results['violations'] = violations
+    write_results('validation_log', {
+        'database': database_url.split(':', 1)[0],
+        'events': args.events,
+        'per_row_events': args.per_row_events,
+        'threads': args.threads,
+        'batch_size': validation_log.VALIDATION_LOG_BATCH_SIZE,
+    }, results, args.output)
+    if violations:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker for the data layer. While the database keeps failing, callers
+# get CircuitOpen right away instead of each waiting for their own timeout:
+#
+#   closed     calls go through; DB_BREAKER_FAILURES failures in a row open it.
+#              Only errors that mean the database is unreachable or overloaded
+#              (see is_outage) are failures; a rejected statement or a bug in
+#              the caller is re-raised without counting.
+#              A call that takes longer than DB_BREAKER_SLOW_CALL seconds counts
+#              as a failure, so an overloaded database trips it as well (except
+#              for bulk reads and writes, guarded with timed=False).
+#   open       calls fail with CircuitOpen for DB_BREAKER_RESET seconds
+#   half-open  one call goes through as a probe; its success closes the
+#              circuit, its failure opens it for another DB_BREAKER_RESET seconds
+#
+# Every process has its own breaker. db_circuit_state shows the worst state of
+# the live processes and db_circuit_transitions_total every state change.
+
+DB_BREAKER_FAILURES = int(os.getenv('DB_BREAKER_FAILURES', '5'))
+DB_BREAKER_SLOW_CALL = float(os.getenv('DB_BREAKER_SLOW_CALL', '2'))
+DB_BREAKER_RESET = float(os.getenv('DB_BREAKER_RESET', '10'))
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+class CircuitOpen(Exception):
+    pass
+
+# Whether `error` means the database could not answer: no connection, a lost
+# connection, a timeout, or the circuit already open. IntegrityError, WrongShard
+# and programming errors mean it answered. The drivers are only checked once
+# something has imported them, so this module imports neither.
+def is_outage(error):
+    if isinstance(error, (CircuitOpen, OSError, asyncio.TimeoutError, sqlite3.OperationalError)):
+        return True
+    psycopg2 = sys.modules.get('psycopg2')
+    if psycopg2 is not None and isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+        return True
+    asyncpg = sys.modules.get('asyncpg')
+    return asyncpg is not None and isinstance(error, (
+        asyncpg.PostgresConnectionError, asyncpg.exceptions.OperatorInterventionError,
+        asyncpg.exceptions.TooManyConnectionsError, asyncpg.exceptions.QueryCanceledError))
+
+# `limit` is entered around every timed call, e.g. to give the request path a
+# statement timeout that bulk work does not get
+class CircuitBreaker:
+    def __init__(self, name, failures=DB_BREAKER_FAILURES, slow_call=DB_BREAKER_SLOW_CALL, reset=DB_BREAKER_RESET,
+                 limit=contextlib.nullcontext):
+        self.name = name
+        self.limit = limit
+        self.failures = failures
+        self.slow_call = slow_call
+        self.reset = reset
+        self.state = CLOSED
+        self._failed = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        metrics.DB_CIRCUIT_STATE.set(STATE_VALUES[CLOSED])
+
+    def _enter(self, state):
+        logger.log(logging.INFO if state == CLOSED else logging.WARNING, "Circuit %s %s -> %s",
+                   self.name, self.state, state)
+        self.state = state
+        metrics.DB_CIRCUIT_STATE.set(STATE_VALUES[state])
+        metrics.DB_CIRCUIT_TRANSITIONS.labels(state).inc()
+
+    # Raises CircuitOpen unless a call may go through now; returns whether the
+    # call is the half-open probe
+    def before_call(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return False
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset:
+                self._enter(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+        raise CircuitOpen(f"{self.name} unavailable, retrying in at most {self.reset:.0f}s")
+
+    def after_call(self, probe, duration, error=None, timed=True):
+        with self._lock:
+            if probe:
+                self._probing = False
+            if error is not None and not is_outage(error):
+                # Neither a success nor a failure; a probe leaves the circuit
+                # half-open for the next call to try
+                return
+            failed = error is not None or (timed and duration > self.slow_call)
+            if not failed:
+                self._failed = 0
+                if self.state == HALF_OPEN:
+                    self._enter(CLOSED)
+                return
+            self._failed += 1
+            if probe or (self.state == CLOSED and self._failed >= self.failures):
+                self._opened_at = time.monotonic()
+                self._enter(OPEN)
+
+    # Every call ends with after_call, so an interrupted probe (e.g. a cancelled
+    # task) still lets the next call probe
+    def call(self, func, *args, **kwargs):
+        return self._call(func, args, kwargs, True)
+
+    def _call(self, func, args, kwargs, timed):
+        probe = self.before_call()
+        start = time.perf_counter()
+        error = None
+        try:
+            if not timed:
+                return func(*args, **kwargs)
+            with self.limit():
+                return func(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.after_call(probe, time.perf_counter() - start, error, timed)
+
+    async def call_async(self, func, *args, **kwargs):
+        probe = self.before_call()
+        start = time.perf_counter()
+        error = None
+        try:
+            return await func(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.after_call(probe, time.perf_counter() - start, error)
+
+    # Decorator form of call(); timed=False for calls that may take long
+    def guard(self, func=None, *, timed=True):
+        if func is None:
+            return functools.partial(self.guard, timed=timed)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self._call(func, args, kwargs, timed)
+        return wrapper
@@ -0,0 +1,213 @@
+import logging
+import os
+import circuit_breaker
+import metrics
+import sharding
+import storage
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Instrumented data layer shared by the bot and the validator service. Every call
+# is timed (db_query_duration_seconds) and traced as a db.* span. The storage
+# backend is opened on first use, so importing this module does no I/O.
+#
+# DATABASE_REPLICA_URLS (comma-separated DSNs of streaming replicas of
+# DATABASE_URL) moves license lookups, catalog loads and other reads off the
+# primary; see storage.ReplicatedStorage for routing and read-your-writes.
+# DATABASE_SHARD_URLS spreads licenses and transactions over several databases
+# by a hash of the license key; see sharding.py.
+#
+# Every call also goes through one circuit breaker (see circuit_breaker.py):
+# while the database is down or too slow, calls fail at once with
+# circuit_breaker.CircuitOpen, and /validate answers from its snapshot instead
+# (validator.degraded_result). Timed calls also run under the statement timeout
+# of storage.statement_timeout; bulk ones (timed=False) do not.
+
+_store = None
+breaker = circuit_breaker.CircuitBreaker('database', limit=storage.statement_timeout)
+
+def url_list(name):
+    return [url.strip() for url in os.getenv(name, '').split(',') if url.strip()]
+
+def replica_urls():
+    return url_list('DATABASE_REPLICA_URLS')
+
+def shard_urls():
+    return url_list('DATABASE_SHARD_URLS')
+
+def get_store():
+    global _store
+    if _store is None:
+        store = storage.open_storage(os.getenv('DATABASE_URL'), replica_urls())
+        if shard_urls():
+            store = sharding.ShardedStorage(store, [storage.open_database(url) for url in shard_urls()])
+        _store = store
+    return _store
+
+# Initialize database tables
+def init_db():
+    get_store().init_schema()
+
+# Load products from the database
+@metrics.timed_db
+@tracing.traced('db.load_products')
+@breaker.guard
+def load_products():
+    logger.debug("Loading products from database")
+    return get_store().load_products()
+
+@metrics.timed_db
+@tracing.traced('db.catalog_version')
+@breaker.guard
+def catalog_version():
+    return get_store().catalog_version()
+
+@metrics.timed_db
+@tracing.traced('db.load_catalog')
+@breaker.guard
+def load_catalog():
+    logger.debug("Loading the catalog from database")
+    return get_store().load_catalog()
+
+@metrics.timed_db
+@tracing.traced('db.save_products')
+@breaker.guard
+def save_products(products):
+    logger.debug("Saving products to database")
+    get_store().save_products(products)
+
+@metrics.timed_db
+@tracing.traced('db.delete_product')
+@breaker.guard
+def delete_product(product_id):
+    logger.debug("Deleting product %s from database", product_id)
+    get_store().delete_product(product_id)
+
+@metrics.timed_db
+@tracing.traced('db.load_licenses')
+@breaker.guard(timed=False)
+def load_licenses():
+    logger.debug("Loading licenses from database")
+    return get_store().load_licenses()
+
+@metrics.timed_db
+@tracing.traced('db.get_license')
+@breaker.guard
+def get_license(license_key):
+    return get_store().get_license(license_key)
+
+# {license_key: license} of the given keys that exist, in one round trip per
+# database (used by the batched lookups of async_validator.py)
+@metrics.timed_db
+@tracing.traced('db.get_licenses')
+@breaker.guard
+def get_licenses(license_keys):
+    return get_store().get_licenses(license_keys)
+
+# Licenses by key prefix or exact username, searched on every shard
+@metrics.timed_db
+@tracing.traced('db.search_licenses')
+@breaker.guard
+def search_licenses(term, limit=20):
+    return get_store().search_licenses(term, limit)
+
+# A page of the licenses bought by a Telegram user, latest expiry first; pass
+# the (expiry, license_key) of the previous page's last license as `after`
+@metrics.timed_db
+@tracing.traced('db.licenses_of_user')
+@breaker.guard
+def licenses_of_user(telegram_id, after=None, limit=10):
+    return get_store().licenses_of_user(telegram_id, after, limit)
+
+@metrics.timed_db
+@tracing.traced('db.save_licenses')
+@breaker.guard(timed=False)
+def save_licenses(licenses):
+    logger.debug("Saving licenses to database")
+    get_store().save_licenses(licenses)
+
+# Stores a new license and its transaction record in one database transaction
+@metrics.timed_db
+@tracing.traced('db.add_license')
+@breaker.guard
+def add_license(license_key, license, transaction):
+    get_store().add_license(license_key, license, transaction)
+
+# Binds the HWID only if the license has none yet; False if another request won
+@metrics.timed_db
+@tracing.traced('db.bind_hwid')
+@breaker.guard
+def bind_hwid(license_key, hwid):
+    return get_store().bind_hwid(license_key, hwid)
+
+# Seats of multi-seat licenses (see storage.Storage.claim_seat)
+@metrics.timed_db
+@tracing.traced('db.has_seat')
+@breaker.guard
+def has_seat(license_key, hwid):
+    return get_store().has_seat(license_key, hwid)
+
+# True if the HWID holds a seat afterwards; False when every seat is taken
+@metrics.timed_db
+@tracing.traced('db.claim_seat')
+@breaker.guard
+def claim_seat(license_key, hwid):
+    return get_store().claim_seat(license_key, hwid)
+
+@metrics.timed_db
+@tracing.traced('db.release_seats')
+@breaker.guard
+def release_seats(license_key, hwid=None):
+    return get_store().release_seats(license_key, hwid)
+
+@metrics.timed_db
+@tracing.traced('db.list_seats')
+@breaker.guard
+def list_seats(license_key):
+    return get_store().list_seats(license_key)
+
+@metrics.timed_db
+@tracing.traced('db.load_transactions')
+@breaker.guard(timed=False)
+def load_transactions():
+    logger.debug("Loading transactions from database")
+    return get_store().load_transactions()
+
+@metrics.timed_db
+@tracing.traced('db.get_transaction')
+@breaker.guard
+def get_transaction(license_key):
+    return get_store().get_transaction(license_key)
+
+@metrics.timed_db
+@tracing.traced('db.save_transactions')
+@breaker.guard(timed=False)
+def save_transactions(transactions):
+    logger.debug("Saving transactions to database")
+    get_store().save_transactions(transactions)
+
+# Analytics rollups (see analytics.py)
+@metrics.timed_db
+@tracing.traced('db.record_sale')
+@breaker.guard
+def record_sale(day, product, tier, revenue_usd, revenue_xlm):
+    get_store().record_sale(day, product, tier, revenue_usd, revenue_xlm)
+
+@metrics.timed_db
+@tracing.traced('db.sales_rollup')
+@breaker.guard
+def sales_rollup(first, last):
+    return get_store().sales_rollup(first, last)
+
+@metrics.timed_db
+@tracing.traced('db.usage_rollup')
+@breaker.guard
+def usage_rollup(first, last):
+    return get_store().usage_rollup(first, last)
+
+@metrics.timed_db
+@tracing.traced('db.active_license_counts')
+@breaker.guard
+def active_license_counts():
+    return get_store().active_license_counts()
@@ -0,0 +1,115 @@
+import argparse
+import csv
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+import database
+import storage
+
+# Load environment variables
+load_dotenv()
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+# Streaming export of licenses, transactions and payments to gzipped CSV or NDJSON.
+#
+# Rows are read through a server-side cursor (PostgreSQL) or an incrementally
+# fetched SQLite cursor and written straight into the gzip stream, so memory use
+# does not depend on the table size. Every row carries its updated_at stamp; the
+# newest one is reported as the watermark, and passing it back as --since (or
+# keeping it in a --state file) exports only what changed afterwards. With
+# DATABASE_SHARD_URLS set, every shard is read concurrently and the watermark is
+# the newest stamp across them, so keep the shard servers' clocks in sync.
+#
+# A row is stamped when its transaction starts but only becomes visible when it
+# commits, so a write in progress during an export can land below the saved
+# watermark. Incremental exports therefore look back EXPORT_MARGIN before it
+# (as license_index.py and rebalance_shards.py do) and repeat the rows changed
+# in that window: load them by primary key (license_key), keeping the copy with
+# the newest updated_at.
+#
+#   python export_data.py licenses --format csv --output licenses.csv.gz
+#   python export_data.py transactions --format ndjson --state export_state.json
+#
+# The same export is available to the admin as /admin_export in the bot.
+
+# name: (table, columns, row filter)
+EXPORTS = {
+    'licenses': ('licenses', storage.LICENSE_COLUMNS, None),
+    'transactions': ('transactions', storage.TRANSACTION_COLUMNS, None),
+    # There is no separate payments table: a payment is the transaction hash
+    # recorded on a paid (non-trial) license
+    'payments': ('licenses', ('license_key', 'username', 'product', 'tx_hash', 'expiry'), "is_trial = FALSE"),
+}
+FORMATS = ('csv', 'ndjson')
+EXPORT_MARGIN = timedelta(minutes=5)
+BOOLEAN_COLUMNS = {'active', 'is_trial'}
+
+# Write one export to `path`; returns the number of rows and the new watermark
+def export(store, name, path, fmt='csv', since=None):
+    table, columns, where = EXPORTS[name]
+    header = tuple(columns) + ('updated_at',)
+    booleans = [index for index, column in enumerate(columns) if column in BOOLEAN_COLUMNS]
+    count = 0
+    watermark = since
+    with gzip.open(path, 'wt', compresslevel=6, encoding='utf-8', newline='') as f:
+        writer = csv.writer(f) if fmt == 'csv' else None
+        if writer:
+            writer.writerow(header)
+        for row, updated_at in store.stream_rows(table, columns, where=where,
+                                                 since=since - EXPORT_MARGIN if since else None):
+            values = list(row)
+            # SQLite hands booleans back as 0/1
+            for index in booleans:
+                values[index] = bool(values[index])
+            values.append(updated_at.isoformat() if updated_at else None)
+            if writer:
+                writer.writerow(values)
+            else:
+                f.write(json.dumps(dict(zip(header, values))) + "\n")
+            if updated_at is not None and (watermark is None or updated_at > watermark):
+                watermark = updated_at
+            count += 1
+    return count, watermark
+
+def read_state(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def write_state(path, state):
+    temporary = f"{path}.tmp"
+    with open(temporary, 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(temporary, path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Export licenses, transactions or payments as gzipped CSV/NDJSON.")
+    parser.add_argument('name', choices=sorted(EXPORTS))
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--output', help="output file (default: <name>-<timestamp>.<format>.gz)")
+    parser.add_argument('--since', type=datetime.fromisoformat, help="only rows changed after this watermark")
+    parser.add_argument('--state', help="JSON file remembering the watermark of each export between runs")
+    args = parser.parse_args()
+    if not DATABASE_URL:
+        parser.error("DATABASE_URL is not set")
+
+    state = read_state(args.state)
+    since = args.since
+    if since is None and args.name in state:
+        since = datetime.fromisoformat(state[args.name])
+    output = args.output or f"{args.name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{args.format}.gz"
+
+    # Reads from replicas and every shard when DATABASE_REPLICA_URLS / DATABASE_SHARD_URLS are set
+    count, watermark = export(database.get_store(), args.name, output, args.format, since)
+    print(f"Exported {count} {args.name} rows to {output}" + (f" (changed after {since.isoformat()})" if since else "") + ".")
+    if watermark is not None:
+        print(f"Watermark: {watermark.isoformat()}")
+        if args.state:
+            state[args.name] = watermark.isoformat()
+            write_state(args.state, state)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+import argparse
+import hashlib
+import hmac
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+from dotenv import load_dotenv
+from flask import Blueprint, Response, request
+import database
+import logging_config
+import metrics
+
+# Content-addressed store for the EA files the bot sells. A file lives at
+# FILE_STORE_DIR/<first 2 hex digits>/<SHA-256 of its content>, and products and
+# transactions reference it by that hash (file_sha256) plus the name it is
+# delivered under ('file' / 'product_file'). Uploading the same content twice
+# stores it once; uploading a different file under a used name no longer
+# overwrites what earlier buyers received, so /resend sends the version that was
+# sold. Files are written to a temporary file in the store, fsynced and renamed
+# into place, so readers never see a partial file.
+#
+# With DOWNLOAD_SECRET and DOWNLOAD_BASE_URL set, the bot delivers product files
+# as signed links that expire after DOWNLOAD_URL_TTL seconds instead of
+# uploading them through the Bot API (limited to 50 MB per file). The links are
+# served by the blueprint below, registered by validator.create_app() and the
+# bot's Flask app:
+#
+#   GET /download/<sha256>/<name>?expires=<unix time>&signature=<HMAC-SHA256>
+#
+# The ETag is the content hash, so conditional requests (If-None-Match,
+# If-Range) need no extra state. A single byte range is answered with 206, so
+# interrupted downloads resume. Under gunicorn the body is sent with sendfile(2)
+# from the file's page cache, without passing through the worker.
+#
+# Products created before the store reference a plain path; they keep working
+# and are moved into the store with
+#
+#   python file_store.py import-products
+
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger(logging_config.ACCESS_LOGGER_NAME)
+
+FILE_STORE_DIR = os.getenv('FILE_STORE_DIR', os.path.join('ea_files', 'store'))
+DOWNLOAD_SECRET = os.getenv('DOWNLOAD_SECRET', '')
+# Public URL of the processes serving /download, e.g. https://licenses.example.com
+DOWNLOAD_BASE_URL = os.getenv('DOWNLOAD_BASE_URL', '')
+DOWNLOAD_URL_TTL = float(os.getenv('DOWNLOAD_URL_TTL', '900'))
+
+CHUNK_SIZE = 1024 * 1024
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+blueprint = Blueprint('file_store', __name__)
+
+def path(sha256):
+    return os.path.join(FILE_STORE_DIR, sha256[:2], sha256)
+
+# The file to deliver: the stored content when there is a hash, else the legacy path
+def resolve(file, file_sha256=None):
+    return path(file_sha256) if file_sha256 else file
+
+# A temporary file inside the store, for downloads that add_file(move=True)
+# then renames into place
+def incoming_path():
+    os.makedirs(FILE_STORE_DIR, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(prefix='.incoming-', dir=FILE_STORE_DIR)
+    os.close(fd)
+    return temporary
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# Store the file at `source` and return its SHA-256. With move=True `source` must
+# come from incoming_path() and is consumed; otherwise it is copied.
+def add_file(source, move=False):
+    if not move:
+        temporary = incoming_path()
+        try:
+            shutil.copyfile(source, temporary)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        source = temporary
+    try:
+        digest = hashlib.sha256()
+        with open(source, 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                digest.update(chunk)
+            os.fsync(f.fileno())
+        sha256 = digest.hexdigest()
+        target = path(sha256)
+        if os.path.exists(target):
+            os.remove(source)
+            logger.info("File %s is already stored", sha256)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.chmod(source, 0o444)
+            os.replace(source, target)
+            _fsync_directory(os.path.dirname(target))
+            logger.info("Stored file %s (%d bytes)", sha256, os.path.getsize(target))
+    except BaseException:
+        if os.path.exists(source):
+            os.remove(source)
+        raise
+    return sha256
+
+# --- signed download links ---------------------------------------------------
+
+def downloads_enabled():
+    return bool(DOWNLOAD_SECRET and DOWNLOAD_BASE_URL)
+
+def _signature(sha256, name, expires):
+    message = f"{sha256}/{name}/{expires}".encode()
+    return hmac.new(DOWNLOAD_SECRET.encode(), message, hashlib.sha256).hexdigest()
+
+# URL of a stored file, downloaded as `name`, valid for `ttl` seconds
+def download_url(sha256, name, ttl=None):
+    expires = int(time.time() + (DOWNLOAD_URL_TTL if ttl is None else ttl))
+    return (f"{DOWNLOAD_BASE_URL.rstrip('/')}/download/{sha256}/{quote(name)}"
+            f"?expires={expires}&signature={_signature(sha256, name, expires)}")
+
+def _content_disposition(name):
+    fallback = name.encode('ascii', 'ignore').decode().replace('"', '').replace('\\', '') or 'download'
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(name)}"
+
+# gunicorn sends a wsgi.file_wrapper with sendfile(2): Content-Length bytes from
+# the file's current offset. Other servers iterate the range.
+def _file_body(f, length):
+    if 'gunicorn.socket' in request.environ and 'wsgi.file_wrapper' in request.environ:
+        return request.environ['wsgi.file_wrapper'](f, CHUNK_SIZE)
+    return _read_range(f, length)
+
+def _read_range(f, length):
+    try:
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+def _answer(result, sha256, status, body=(), headers=None, length=0):
+    metrics.FILE_DOWNLOADS.labels(result).inc()
+    access_logger.info("download result=%s sha256=%s status=%d bytes=%d", result, sha256, status, length)
+    if isinstance(body, str):
+        return body, status, headers or {}
+    return Response(body, status=status, headers=headers, direct_passthrough=True)
+
+@blueprint.route('/download/<sha256>/<name>', methods=['GET'])
+def download(sha256, name):
+    expires = request.args.get('expires', '')
+    signature = request.args.get('signature', '')
+    if (not DOWNLOAD_SECRET or not SHA256_PATTERN.match(sha256) or not expires.isdigit()
+            or not hmac.compare_digest(signature, _signature(sha256, name, int(expires)))):
+        return _answer('forbidden', sha256, 403, "Invalid download link")
+    remaining = int(expires) - int(time.time())
+    if remaining <= 0:
+        return _answer('expired', sha256, 410, "Download link expired, use /resend in the bot for a new one")
+    try:
+        f = open(path(sha256), 'rb')
+    except FileNotFoundError:
+        return _answer('missing', sha256, 404, "File not found")
+
+    size = os.fstat(f.fileno()).st_size
+    headers = {
+        'ETag': f'"{sha256}"',
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': f"private, max-age={remaining}, immutable",
+        'Content-Type': 'application/octet-stream',
+        'Content-Disposition': _content_disposition(name),
+    }
+    if request.if_none_match.contains(sha256):
+        f.close()
+        return _answer('not_modified', sha256, 304, headers=headers)
+
+    start, end, result, status = 0, size, 'full', 200
+    # A range is only served if the client's copy (If-Range) is this content;
+    # several ranges are answered with the whole file
+    byte_range = request.range
+    if byte_range is not None and (request.headers.get('If-Range') is None or request.if_range.etag == sha256):
+        bounds = byte_range.range_for_length(size)
+        if bounds is not None:
+            start, end, result, status = bounds[0], bounds[1], 'partial', 206
+            headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+        elif len(byte_range.ranges) == 1:
+            f.close()
+            headers['Content-Range'] = f"bytes */{size}"
+            return _answer('unsatisfiable', sha256, 416, headers=headers)
+    headers['Content-Length'] = str(end - start)
+    if request.method == 'HEAD':
+        f.close()
+        return _answer(result, sha256, status, headers=headers)
+    f.seek(start)
+    return _answer(result, sha256, status, _file_body(f, end - start), headers, end - start)
+
+# --- products created before the store -----------------------------------------
+
+# Move the files of products that reference a plain path into the store;
+# returns the number of products changed
+def import_products():
+    products = database.load_products()
+    imported = 0
+    for product_id, info in products.items():
+        if info.get('file_sha256'):
+            continue
+        if not os.path.isfile(info['file']):
+            logger.warning("Product %s: %s not found, left as it is", product_id, info['file'])
+            continue
+        info['file_sha256'] = add_file(info['file'])
+        info['file'] = os.path.basename(info['file'])
+        imported += 1
+        logger.info("Product %s: %s stored as %s", product_id, info['file'], info['file_sha256'])
+    if imported:
+        database.save_products(products)
+    return imported
+
+def main():
+    load_dotenv()
+    logging_config.setup_logging()
+    parser = argparse.ArgumentParser(description="Manage the content-addressed EA file store.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    add_parser = subparsers.add_parser('add', help="store a file and print its SHA-256")
+    add_parser.add_argument('file')
+    subparsers.add_parser('import-products', help="move the files of existing products into the store")
+    url_parser = subparsers.add_parser('url', help="print a signed download URL")
+    url_parser.add_argument('sha256')
+    url_parser.add_argument('name', help="file name the download is saved under")
+    url_parser.add_argument('--ttl', type=float, default=DOWNLOAD_URL_TTL, help="seconds the URL stays valid")
+    args = parser.parse_args()
+
+    if args.command == 'add':
+        print(add_file(args.file))
+    elif args.command == 'import-products':
+        print(f"Moved the files of {import_products()} products into {FILE_STORE_DIR}")
+    else:
+        if not downloads_enabled():
+            sys.exit("DOWNLOAD_SECRET and DOWNLOAD_BASE_URL must be set")
+        if not os.path.exists(path(args.sha256)):
+            sys.exit(f"{args.sha256} is not stored in {FILE_STORE_DIR}")
+        print(download_url(args.sha256, args.name, args.ttl))
+
+if __name__ == '__main__':
+    main()
@@ -1,54 +1,252 @@
+import argparse
+import ctypes
 import hashlib
-import subprocess
+import json
+import os
 import platform
 import sys
+import uuid
+
+# Machine fingerprint for license binding, collected without running any
+# commands: machine IDs and serials are read straight from the OS (files under
+# /etc, /sys and /proc on Linux, the registry and kernel32 on Windows, IOKit on
+# macOS) along with the MAC addresses of physical network cards. Every readable
+# source becomes a named component, and the HWID hashes all of them, so two
+# machines only collide if every identifier matches.
+#
+# The HWID is cached (see cache_path()) together with hashes of its components
+# and a checksum. Later runs reuse it as long as the cache is intact and most of
+# the components still match, so replacing a network card or a BIOS update does
+# not change a machine's HWID; a cache copied from another machine does not match.
+#
+#   import get_hwid
+#   hwid = get_hwid.generate_hwid()
+
+CACHE_VERSION = 1
+# Components that many machines share; they only count towards a cache match
+# alongside a unique identifier
+WEAK_COMPONENTS = {'architecture', 'sys_vendor', 'product_name', 'board_vendor', 'board_name'}
+
+DMI_DIR = '/sys/class/dmi/id'
+NET_DIR = '/sys/class/net'
+
+_hwid = None
+
+def cache_path():
+    """Location of the HWID cache; HWID_CACHE_PATH overrides it."""
+    if os.getenv('HWID_CACHE_PATH'):
+        return os.getenv('HWID_CACHE_PATH')
+    if platform.system() == "Windows":
+        base = os.getenv('LOCALAPPDATA') or os.path.expanduser('~')
+    elif platform.system() == "Darwin":
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'license-hwid', 'hwid.json')
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            value = f.read().replace(b'\x00', b'').decode(errors='replace').strip()
+    except OSError:
+        return None
+    # Placeholders that firmware vendors leave in place of real serials
+    if not value or value.lower() in ('none', 'default string', 'to be filled by o.e.m.', 'not specified', '0'):
+        return None
+    return value
+
+def _linux_components():
+    components = {
+        'machine_id': _read('/etc/machine-id') or _read('/var/lib/dbus/machine-id'),
+        # Serial numbers of ARM boards such as the Raspberry Pi
+        'device_serial': _read('/proc/device-tree/serial-number'),
+    }
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('Serial'):
+                    components['cpu_serial'] = line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    # product_uuid and the serials are readable by root only
+    for name in ('product_uuid', 'product_serial', 'board_serial', 'chassis_serial',
+                 'sys_vendor', 'product_name', 'board_vendor', 'board_name'):
+        components[name] = _read(os.path.join(DMI_DIR, name))
+    components.update(_linux_macs())
+    return components
+
+def _linux_macs():
+    """Permanent MAC addresses of hardware network interfaces."""
+    macs = {}
+    try:
+        interfaces = os.listdir(NET_DIR)
+    except OSError:
+        return macs
+    for interface in interfaces:
+        path = os.path.join(NET_DIR, interface)
+        # Virtual interfaces (bridges, VPNs, containers) have no device, and
+        # random or user-set addresses have an addr_assign_type other than 0
+        try:
+            with open(os.path.join(path, 'addr_assign_type')) as f:
+                permanent = f.read().strip() == '0'
+        except OSError:
+            permanent = False
+        if not permanent or not os.path.exists(os.path.join(path, 'device')):
+            continue
+        address = _read(os.path.join(path, 'address'))
+        if address and address != '00:00:00:00:00:00':
+            macs[f"mac:{address}"] = address
+    return macs
+
+def _windows_components():
+    import winreg
+    components = {}
+    try:
+        with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"SOFTWARE\Microsoft\Cryptography",
+                            0, winreg.KEY_READ | winreg.KEY_WOW64_64KEY) as key:
+            components['machine_guid'] = winreg.QueryValueEx(key, 'MachineGuid')[0]
+    except OSError:
+        pass
+    serial = ctypes.c_uint32()
+    root = os.getenv('SystemDrive', 'C:') + '\\'
+    if ctypes.windll.kernel32.GetVolumeInformationW(root, None, 0, ctypes.byref(serial), None, None, None, 0):
+        components['volume_serial'] = f"{serial.value:08X}"
+    try:
+        with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, r"HARDWARE\DESCRIPTION\System\BIOS") as key:
+            for name, value_name in (('sys_vendor', 'SystemManufacturer'), ('product_name', 'SystemProductName'),
+                                     ('board_name', 'BaseBoardProduct')):
+                try:
+                    components[name] = winreg.QueryValueEx(key, value_name)[0]
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return components
+
+def _macos_components():
+    utf8 = 0x08000100  # kCFStringEncodingUTF8
+    iokit = ctypes.CDLL('/System/Library/Frameworks/IOKit.framework/IOKit')
+    cf = ctypes.CDLL('/System/Library/Frameworks/CoreFoundation.framework/CoreFoundation')
+    iokit.IOServiceMatching.restype = ctypes.c_void_p
+    iokit.IOServiceMatching.argtypes = [ctypes.c_char_p]
+    iokit.IOServiceGetMatchingService.restype = ctypes.c_uint32
+    iokit.IOServiceGetMatchingService.argtypes = [ctypes.c_uint32, ctypes.c_void_p]
+    iokit.IORegistryEntryCreateCFProperty.restype = ctypes.c_void_p
+    iokit.IORegistryEntryCreateCFProperty.argtypes = [ctypes.c_uint32, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint32]
+    iokit.IOObjectRelease.argtypes = [ctypes.c_uint32]
+    cf.CFStringCreateWithCString.restype = ctypes.c_void_p
+    cf.CFStringCreateWithCString.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint32]
+    cf.CFStringGetCString.restype = ctypes.c_bool
+    cf.CFStringGetCString.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_long, ctypes.c_uint32]
+    cf.CFRelease.argtypes = [ctypes.c_void_p]
+
+    components = {}
+    service = iokit.IOServiceGetMatchingService(0, iokit.IOServiceMatching(b"IOPlatformExpertDevice"))
+    if not service:
+        return components
+    try:
+        for name, property_name in (('platform_uuid', b"IOPlatformUUID"), ('product_serial', b"IOPlatformSerialNumber")):
+            key = cf.CFStringCreateWithCString(None, property_name, utf8)
+            value = iokit.IORegistryEntryCreateCFProperty(service, key, None, 0)
+            cf.CFRelease(key)
+            if value:
+                buffer = ctypes.create_string_buffer(256)
+                if cf.CFStringGetCString(value, buffer, len(buffer), utf8):
+                    components[name] = buffer.value.decode()
+                cf.CFRelease(value)
+    finally:
+        iokit.IOObjectRelease(service)
+    return components
 
 def get_system_info():
-    """Retrieve system identifiers based on the operating system."""
+    """Retrieve the machine's identifiers as a dict of component name to value."""
     os_name = platform.system()
-    if os_name == "Windows":
-        # Get disk serial number on Windows
-        try:
-            result = subprocess.check_output("wmic diskdrive get serialnumber", shell=True).decode()
-            serial = result.split("\n")[1].strip()
-            return serial
-        except Exception as e:
-            print(f"Error fetching disk serial: {e}")
-            return "unknown-windows-id"
-    elif os_name == "Darwin":  # macOS
-        try:
-            result = subprocess.check_output("system_profiler SPHardwareDataType | grep Serial", shell=True).decode()
-            serial = result.split(":")[1].strip()
-            return serial
-        except Exception as e:
-            print(f"Error fetching macOS serial: {e}")
-            return "unknown-macos-id"
-    else:  # Linux or other
-        try:
-            result = subprocess.check_output("cat /proc/cpuinfo | grep Serial", shell=True).decode()
-            serial = result.split(":")[1].strip()
-            return serial
-        except Exception as e:
-            print(f"Error fetching Linux serial: {e}")
-            return "unknown-linux-id"
-
-def generate_hwid():
-    """Generate a hashed HWID from system identifiers."""
-    system_info = get_system_info()
-    # Combine system info with platform details for uniqueness
-    unique_string = f"{system_info}-{platform.node()}-{platform.machine()}"
-    # Hash the string using SHA-256
-    hwid_hash = hashlib.sha256(unique_string.encode()).hexdigest()
+    try:
+        if os_name == "Windows":
+            components = _windows_components()
+        elif os_name == "Darwin":
+            components = _macos_components()
+        else:
+            components = _linux_components()
+    except Exception as e:
+        print(f"Error reading system identifiers: {e}", file=sys.stderr)
+        components = {}
+    components['architecture'] = platform.machine()
+    return {name: str(value).strip() for name, value in components.items() if value and str(value).strip()}
+
+def _fingerprint(components):
+    unique_string = "\n".join(f"{name}={components[name]}" for name in sorted(components))
     # Shorten the hash to 32 characters for usability
-    return hwid_hash[:32]
+    return hashlib.sha256(unique_string.encode()).hexdigest()[:32]
+
+def _component_hashes(components):
+    return {name: hashlib.sha256(f"{name}={value}".encode()).hexdigest() for name, value in components.items()}
+
+def _checksum(entry):
+    payload = {name: entry[name] for name in ('version', 'hwid', 'components', 'install_id')}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+def _load_cache(path):
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+        if entry.get('version') != CACHE_VERSION or entry.get('checksum') != _checksum(entry):
+            return None
+        return entry
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+def _save_cache(path, entry):
+    entry = dict(entry, checksum=_checksum(entry))
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temporary, 'w') as f:
+            json.dump(entry, f, sort_keys=True)
+        os.replace(temporary, path)
+    except OSError as e:
+        print(f"Could not cache the HWID in {path}: {e}", file=sys.stderr)
+
+def _matches(cached, current):
+    """Whether most of the cached components, including a unique one, are unchanged."""
+    unchanged = {name for name, digest in cached.items() if current.get(name) == digest}
+    return bool(unchanged - WEAK_COMPONENTS) and len(unchanged) * 2 > len(cached)
+
+def generate_hwid(refresh=False):
+    """Generate a hashed HWID from system identifiers, reusing the cached one if it still matches."""
+    global _hwid
+    if _hwid is not None and not refresh:
+        return _hwid
+    path = cache_path()
+    cached = None if refresh else _load_cache(path)
+    components = get_system_info()
+    if not set(components) - WEAK_COMPONENTS:
+        # Nothing unique is readable (e.g. a minimal container): identify this
+        # installation by a random ID that lives in the cache
+        components['install_id'] = (cached or {}).get('install_id') or str(uuid.uuid4())
+    hashes = _component_hashes(components)
+    if cached is not None and _matches(cached['components'], hashes):
+        if cached['components'] != hashes:
+            _save_cache(path, dict(cached, components=hashes))
+        _hwid = cached['hwid']
+        return _hwid
+    _hwid = _fingerprint(components)
+    _save_cache(path, {'version': CACHE_VERSION, 'hwid': _hwid, 'components': hashes,
+                       'install_id': components.get('install_id')})
+    return _hwid
 
 def main():
+    parser = argparse.ArgumentParser(description="Print this machine's HWID for license binding.")
+    parser.add_argument('--refresh', action='store_true', help="ignore the cached HWID and fingerprint the machine again")
+    parser.add_argument('--no-wait', action='store_true', help="exit without waiting for Enter")
+    args = parser.parse_args()
     print("Generating your HWID...")
-    hwid = generate_hwid()
+    hwid = generate_hwid(refresh=args.refresh)
     print(f"Your HWID is: {hwid}")
     print("Please copy this HWID and paste it into the Telegram bot when prompted.")
-    print("Press Enter to exit...")
-    input()
+    if not args.no_wait:
+        print("Press Enter to exit...")
+        input()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,11 @@
+import metrics
+
+# Drop a finished worker's multiprocess metric files (see PROMETHEUS_MULTIPROC_DIR in metrics.py)
+def child_exit(server, worker):
+    metrics.mark_process_dead(worker.pid)
+
+# Serve only the validator; the bot runs separately as `python telegram_bot.py`.
+# To run the bot inside the workers instead, pass 'telegram_bot:create_app()' on
+# the command line (without --preload): every worker then serves /validate and
+# the poller leader election picks the one that polls Telegram.
+wsgi_app = 'validator:create_app()'
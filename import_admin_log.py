@@ -0,0 +1,77 @@
+import os
+import re
+import sys
+from datetime import datetime
+from dotenv import load_dotenv
+import audit_log
+import storage
+
+# Load environment variables
+load_dotenv()
+DATABASE_URL = os.getenv('DATABASE_URL')
+
+# Lines written by the old file-based log_admin_action look like:
+# [2025-04-27 10:10:02] User 359966763: Added product ID 5: GoldScalper
+LINE_PATTERN = re.compile(r'^\[(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})\] User (\d+): (.*)$')
+PRODUCT_PATTERN = re.compile(r'product ID (\d+)')
+FIELD_EDIT_PATTERN = re.compile(r'^Edited (name|file|expiry_days) of product ID \d+ to (.*)$')
+
+# Map the free-text messages onto the structured action names used by the bot
+ACTION_PATTERNS = [
+    (re.compile(r'^Listed products$'), 'product.list'),
+    (re.compile(r'^Started adding a new product$'), 'product.add_started'),
+    (re.compile(r'^Added product ID '), 'product.add'),
+    (re.compile(r'^Uploaded EA file: '), 'product.file_upload'),
+    (re.compile(r'^Started editing product ID '), 'product.edit_started'),
+    (re.compile(r'^Finished editing product ID '), 'product.edit'),
+    (re.compile(r'^Edited (name|file|expiry_days) of product ID '), 'product.field_edit'),
+    (re.compile(r'^Edited tier '), 'product.tier_edit'),
+    (re.compile(r'^Added tier '), 'product.tier_add'),
+    (re.compile(r'^Deleted tier '), 'product.tier_delete'),
+    (re.compile(r'^Deleted product ID '), 'product.delete'),
+]
+
+def parse_line(line):
+    match = LINE_PATTERN.match(line.rstrip('\n'))
+    if not match:
+        return None
+    timestamp, actor, message = match.groups()
+    action = next((name for pattern, name in ACTION_PATTERNS if pattern.match(message)), 'legacy')
+    product_match = PRODUCT_PATTERN.search(message)
+    entity = audit_log.product_entity(product_match.group(1)) if product_match else None
+    after = None
+    field_match = FIELD_EDIT_PATTERN.match(message)
+    if field_match:
+        after = {field_match.group(1): field_match.group(2)}
+    return (datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S'), int(actor), action, entity, None, after, message, 'admin_log.txt')
+
+def import_admin_log(path, force=False):
+    store = storage.open_storage(DATABASE_URL)
+    store.init_schema()
+    already_imported = store.count_audit_events('admin_log.txt')
+    if already_imported and not force:
+        print(f"{already_imported} events were already imported from admin_log.txt; pass --force to import again.")
+        return
+
+    imported = skipped = 0
+    batch = []
+    with open(path, 'r') as f:
+        for line in f:
+            event = parse_line(line)
+            if event is None:
+                if line.strip():
+                    skipped += 1
+                continue
+            batch.append(event)
+            if len(batch) >= audit_log.AUDIT_BATCH_SIZE:
+                store.insert_audit_events(batch)
+                imported += len(batch)
+                batch = []
+    if batch:
+        store.insert_audit_events(batch)
+        imported += len(batch)
+    print(f"Imported {imported} admin log events ({skipped} unparseable lines skipped).")
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if arg != '--force']
+    import_admin_log(args[0] if args else 'admin_log.txt', force='--force' in sys.argv[1:])
@@ -0,0 +1,84 @@
+import atexit
+import logging
+import os
+import threading
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Leader election for work that must run in exactly one process of the cluster:
+# Telegram allows a single getUpdates consumer per bot token, and the job queue
+# must not fire once per worker.
+#
+# Every process started with start() competes for a lock from the storage
+# backend (storage.leader_lock: a PostgreSQL advisory lock, or flock() next to a
+# SQLite file). The winner runs on_elected() and keeps checking that it still
+# holds the lock; the others retry every LEADER_CHECK_INTERVAL seconds, so when
+# the leader dies a follower takes over within about one interval. A leader that
+# loses its lock (e.g. its database connection dropped) runs on_demoted() and
+# goes back to competing; it only notices at its next check, so after a dropped
+# connection two processes may poll for up to one interval.
+
+LEADER_CHECK_INTERVAL = float(os.getenv('LEADER_CHECK_INTERVAL', '2'))  # seconds
+
+# Advisory lock key of the Telegram poller (SCHEMA_LOCK_ID in storage.py is 7427000)
+POLLER_LOCK_ID = 7427001
+
+_lock = None
+_elector = None
+_stop = threading.Event()
+_leader = threading.Event()
+
+def is_leader():
+    return _leader.is_set()
+
+def _demote(on_demoted, reason):
+    _leader.clear()
+    metrics.POLLER_LEADER.set(0)
+    metrics.LEADER_TRANSITIONS.labels('lost').inc()
+    logger.warning("Lost poller leadership (%s), pid %d", reason, os.getpid())
+    try:
+        on_demoted()
+    except Exception as e:
+        logger.error("Failed to stop leader work: %s", e)
+    _lock.release()
+
+def _run_elector(on_elected, on_demoted):
+    while True:
+        try:
+            if not _leader.is_set():
+                if _lock.acquire():
+                    _leader.set()
+                    metrics.POLLER_LEADER.set(1)
+                    metrics.LEADER_TRANSITIONS.labels('gained').inc()
+                    logger.info("Elected poller leader, pid %d", os.getpid())
+                    on_elected()
+            elif not _lock.held():
+                _demote(on_demoted, "lock lost")
+        except Exception as e:
+            logger.error("Leader election failed: %s", e)
+            if _leader.is_set():
+                # Never keep the lock without doing the leader's work
+                _demote(on_demoted, "error")
+            else:
+                _lock.release()
+        if _stop.wait(LEADER_CHECK_INTERVAL):
+            break
+    if _leader.is_set():
+        _demote(on_demoted, "shutdown")
+
+# Start competing for leadership; on_elected/on_demoted run on the elector thread
+def start(lock, on_elected, on_demoted):
+    global _lock, _elector
+    if _elector is not None:
+        return
+    _lock = lock
+    _elector = threading.Thread(target=_run_elector, args=(on_elected, on_demoted), name="leader-elector", daemon=True)
+    _elector.start()
+    atexit.register(stop)
+
+# Stop the leader's work and release the lock on shutdown so a follower takes over at once
+def stop():
+    _stop.set()
+    if _elector is not None and _elector.is_alive():
+        _elector.join(timeout=LEADER_CHECK_INTERVAL * 5)
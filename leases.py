@@ -0,0 +1,89 @@
+import functools
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+# Validation leases: how long a client may keep running on a successful
+# /validate before it has to check again, and when it should check.
+#
+# The server picks the lease per license: up to LEASE_MAX_SECONDS while the
+# license is far from expiry, shrinking with the time left (a lease never
+# outlives the license), and LEASE_MIN_SECONDS while the license key has recently
+# been refused for another machine. The next check is due at a random point in
+# the second half of the lease, so a client whose check fails still has time to
+# retry, and clients that all reconnect after an outage spread their following
+# checks out instead of returning together.
+#
+# Raising LEASE_MAX_SECONDS lowers the aggregate request rate without new client
+# builds; deactivating a license takes effect on its clients within one lease.
+# Answers given from a snapshot while the database is unavailable (degraded, see
+# validator.degraded_result) never get more than LEASE_MIN_SECONDS, so clients
+# are checked properly soon after it is back.
+
+LEASE_MIN_SECONDS = float(os.getenv('LEASE_MIN_SECONDS', '300'))
+LEASE_MAX_SECONDS = float(os.getenv('LEASE_MAX_SECONDS', '21600'))
+# Share of the time left until expiry that a lease may cover
+LEASE_EXPIRY_SHARE = 0.25
+# The next check falls between these fractions of the lease
+NEXT_CHECK_EARLIEST = 0.5
+NEXT_CHECK_LATEST = 0.75
+# Refusals that mean a license key is being tried on more machines than it may
+# run on; the key gets the shortest lease for SUSPICIOUS_WINDOW seconds
+SUSPICIOUS_OUTCOMES = ('hwid_mismatch', 'no_free_seat')
+SUSPICIOUS_WINDOW = float(os.getenv('LEASE_SUSPICIOUS_WINDOW', '3600'))
+SUSPICIOUS_TRACKED = 10000
+
+# license_key -> time.monotonic() of its last refusal, oldest first. Each worker
+# only sees the refusals it answered itself, which is enough to shorten the
+# leases of a key that is being shared around.
+_refusals = OrderedDict()
+_refusals_lock = threading.Lock()
+
+def record_refusal(license_key):
+    with _refusals_lock:
+        _refusals[license_key] = time.monotonic()
+        _refusals.move_to_end(license_key)
+        while len(_refusals) > SUSPICIOUS_TRACKED:
+            _refusals.popitem(last=False)
+
+def is_suspicious(license_key):
+    with _refusals_lock:
+        refused_at = _refusals.get(license_key)
+    return refused_at is not None and time.monotonic() - refused_at < SUSPICIOUS_WINDOW
+
+# Licenses run out at the start of their expiry date; most licenses share a
+# few hundred dates, so parsed dates are cached
+@functools.lru_cache(maxsize=4096)
+def expiry_time(expiry):
+    return datetime.strptime(expiry, '%Y-%m-%d')
+
+# Lease in seconds for a license that just validated
+def lease_seconds(license_key, license, now=None):
+    now = now or datetime.now()
+    remaining = (expiry_time(license['expiry']) - now).total_seconds()
+    if is_suspicious(license_key):
+        lease = LEASE_MIN_SECONDS
+    else:
+        lease = min(max(remaining * LEASE_EXPIRY_SHARE, LEASE_MIN_SECONDS), LEASE_MAX_SECONDS)
+    return max(1, int(min(lease, remaining)))
+
+# Seconds until the next check for a lease; refusals are retried as if after the
+# shortest lease. So are the last leases of a license, which end at its expiry:
+# checking ever sooner before expiry would bring all the licenses that expire at
+# midnight back at the same moment
+def next_check_seconds(lease=None):
+    lease = max(lease or 0, LEASE_MIN_SECONDS)
+    return max(1, int(lease * random.uniform(NEXT_CHECK_EARLIEST, NEXT_CHECK_LATEST)))
+
+# (lease, next check) for a /validate answer; the lease is None unless the
+# license (given for valid answers only) was accepted
+def grant(outcome, license_key, license=None, degraded=False):
+    if outcome in SUSPICIOUS_OUTCOMES:
+        record_refusal(license_key)
+    lease = lease_seconds(license_key, license) if license is not None else None
+    if degraded and lease is not None:
+        lease = min(lease, int(LEASE_MIN_SECONDS))
+    return lease, next_check_seconds(lease)
@@ -0,0 +1,350 @@
+import argparse
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from dotenv import load_dotenv
+import database
+import leases
+import logging_config
+import metrics
+
+# Compact on-disk index of the licenses for /validate. Every validator worker
+# maps the same file read-only, so the page cache holds one copy however many
+# workers there are (about 41 MB for 1M licenses), and a validation that the
+# index can answer costs no database round trip.
+#
+# One process keeps the file current from the licenses' updated_at change feed:
+#
+#   python license_index.py follow --path /var/lib/license-index/licenses.idx
+#   python license_index.py build --path ...    # one full build, then exit
+#
+# and the workers get the same path in LICENSE_INDEX_PATH. A new version is
+# written next to the old one and renamed over it; workers notice the new file
+# within a second and map it, requests in flight finish on the old mapping.
+#
+# The index only ever says "valid": a license that is active, unexpired and bound
+# to the requesting machine. Everything else (unknown keys, first binds, other
+# seats of multi-seat licenses, refusals) is checked against the database as
+# before, so a stale index can never refuse a license that was just bought,
+# renewed or moved to another machine. What it can do is accept a license for up
+# to one refresh (a few seconds) after it was deactivated or re-bound, which is
+# well within the lease the client already holds (leases.py). Licenses deleted
+# outright leave no trace in the change feed and stay in the index until the
+# next full rebuild (LICENSE_INDEX_FULL_REBUILD). If the follower stops, workers
+# stop using the index once it is LICENSE_INDEX_MAX_AGE seconds old, unless the
+# database is unavailable too (see validator.degraded_result).
+#
+# File layout, all integers big-endian:
+#   header     64 bytes: magic, record count, build time, change feed watermark
+#   directory  65537 x 4-byte record numbers: the records whose keys start with
+#              the 2 bytes p are records directory[p] to directory[p + 1] - 1
+#   records    40 bytes each, sorted by key: 16-byte license key (the UUID's
+#              bytes), 16-byte BLAKE2b hash of the HWID, expiry as a day number
+#              (date.toordinal()), flag bits, padding
+# License keys are random UUIDs, so a directory slot holds about count / 65536
+# records and a lookup is a binary search over a handful of them.
+
+logger = logging.getLogger(__name__)
+
+LICENSE_INDEX_PATH = os.getenv('LICENSE_INDEX_PATH', '')
+# Workers ignore an index that has not been refreshed for this long
+LICENSE_INDEX_MAX_AGE = float(os.getenv('LICENSE_INDEX_MAX_AGE', '120'))
+# Seconds between change feed reads of the follower
+LICENSE_INDEX_INTERVAL = float(os.getenv('LICENSE_INDEX_INTERVAL', '5'))
+# Seconds between full rebuilds of the follower, which drop deleted licenses
+LICENSE_INDEX_FULL_REBUILD = float(os.getenv('LICENSE_INDEX_FULL_REBUILD', '900'))
+# Rows of write transactions that began shortly before a change feed read carry
+# slightly older updated_at stamps, so every read looks back this far (as the
+# catch-up copy of rebalance_shards.py does)
+CHANGE_MARGIN = timedelta(minutes=5)
+# Seconds between the workers' checks for a new file
+REOPEN_INTERVAL = 1.0
+
+MAGIC = b'LICIDX01'
+HEADER = struct.Struct('>8sId32s')
+HEADER_SIZE = 64
+PREFIXES = 1 << 16
+DIRECTORY = struct.Struct(f'>{PREFIXES + 1}I')
+BOUNDS = struct.Struct('>II')
+RECORD = struct.Struct('>16s16sIB3x')
+RECORDS_OFFSET = HEADER_SIZE + DIRECTORY.size
+KEY_SIZE = 16
+
+FLAG_ACTIVE = 1
+FLAG_TRIAL = 2
+FLAG_BOUND = 4
+FLAG_MULTI_SEAT = 8
+
+INDEX_COLUMNS = ('license_key', 'hwid', 'expiry', 'active', 'is_trial', 'seats')
+
+# 16-byte key of a license key in canonical UUID form, None for any other key
+# (uuid.UUID also takes braces, uppercase and missing dashes, which the
+# database would not match)
+def key_bytes(license_key):
+    try:
+        key = uuid.UUID(license_key)
+    except (ValueError, TypeError, AttributeError):
+        return None
+    return key.bytes if str(key) == license_key else None
+
+def hwid_hash(hwid):
+    return hashlib.blake2b(hwid.encode(), digest_size=16).digest()
+
+# (key, record) for a row in INDEX_COLUMNS order, None if the license cannot be
+# indexed and is always looked up in the database
+def encode_row(row):
+    license_key, hwid, expiry, active, is_trial, seats = row
+    key = key_bytes(license_key)
+    if key is None:
+        return None
+    try:
+        expiry_day = leases.expiry_time(expiry).toordinal()
+    except (ValueError, TypeError):
+        return None
+    flags = ((FLAG_ACTIVE if active else 0) | (FLAG_TRIAL if is_trial else 0) |
+             (FLAG_BOUND if hwid else 0) | (FLAG_MULTI_SEAT if seats > 1 else 0))
+    return key, RECORD.pack(key, hwid_hash(hwid) if hwid else bytes(16), expiry_day, flags)
+
+# A read-only mapping of one index file
+class LicenseIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.built_at, watermark = HEADER.unpack_from(self.map)
+        if magic != MAGIC or len(self.map) != RECORDS_OFFSET + self.count * RECORD.size:
+            raise ValueError(f"{path} is not a complete license index")
+        watermark = watermark.rstrip(b'\0').decode()
+        self.watermark = datetime.fromisoformat(watermark) if watermark else None
+        self.refreshed_at = self.built_at
+
+    # Record number of `key`, or of the first record after it
+    def position(self, key):
+        lo, hi = BOUNDS.unpack_from(self.map, HEADER_SIZE + (key[0] << 8 | key[1]) * 4)
+        records = self.map
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = RECORDS_OFFSET + mid * RECORD.size
+            if records[offset:offset + KEY_SIZE] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def key_at(self, position):
+        offset = RECORDS_OFFSET + position * RECORD.size
+        return self.map[offset:offset + KEY_SIZE]
+
+    # (key, hwid hash, expiry day, flags) of `key`, None if it is not indexed
+    def find(self, key):
+        position = self.position(key)
+        if position < self.count and self.key_at(position) == key:
+            return RECORD.unpack_from(self.map, RECORDS_OFFSET + position * RECORD.size)
+        return None
+
+    def records(self, start, end):
+        return memoryview(self.map)[RECORDS_OFFSET + start * RECORD.size:RECORDS_OFFSET + end * RECORD.size]
+
+    def counts(self):
+        bounds = DIRECTORY.unpack_from(self.map, HEADER_SIZE)
+        return [bounds[prefix + 1] - bounds[prefix] for prefix in range(PREFIXES)]
+
+# --- lookups (validator workers) ---------------------------------------------
+
+_index = None
+_checked_at = float('-inf')
+_reopen_lock = threading.Lock()
+
+# The index of LICENSE_INDEX_PATH, mapped again when the file was replaced; None
+# if there is none or it is older than max_age seconds
+def current(max_age=None):
+    global _index, _checked_at
+    if not LICENSE_INDEX_PATH:
+        return None
+    if time.monotonic() - _checked_at >= REOPEN_INTERVAL and _reopen_lock.acquire(blocking=False):
+        try:
+            _checked_at = time.monotonic()
+            _index = reopen(_index, LICENSE_INDEX_PATH)
+        finally:
+            _reopen_lock.release()
+    index = _index
+    if index is None or time.time() - index.refreshed_at > (LICENSE_INDEX_MAX_AGE if max_age is None else max_age):
+        return None
+    return index
+
+def reopen(index, path):
+    try:
+        stat = os.stat(path)
+        if index is None or stat.st_ino != index.inode:
+            index = LicenseIndex(path)
+            logger.info("Mapped license index %s: %d licenses, watermark %s", path, index.count, index.watermark)
+        # The follower touches the file when nothing changed
+        index.refreshed_at = stat.st_mtime
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning("Cannot map license index %s: %s", path, e)
+    return index
+
+# The license as far as /validate needs it ({'expiry': ...}) if the index alone
+# shows that `hwid` may use it, otherwise None and the caller asks the database.
+# While the database is unavailable, validator.degraded_result accepts an older
+# index (max_age).
+def valid_license(license_key, hwid, max_age=None):
+    index = current(max_age)
+    if index is None:
+        if LICENSE_INDEX_PATH:
+            metrics.LICENSE_INDEX_LOOKUPS.labels('unavailable').inc()
+        return None
+    key = key_bytes(license_key)
+    record = index.find(key) if key is not None else None
+    if record is None or not accepts(record, hwid):
+        metrics.LICENSE_INDEX_LOOKUPS.labels('database').inc()
+        return None
+    metrics.LICENSE_INDEX_LOOKUPS.labels('hit').inc()
+    return {'expiry': date.fromordinal(record[2]).isoformat()}
+
+# Same rules as validator.check_license for a machine that is already bound;
+# licenses run out at the start of their expiry date
+def accepts(record, hwid):
+    _, bound_hwid, expiry_day, flags = record
+    return (flags & FLAG_ACTIVE and flags & FLAG_BOUND and bound_hwid == hwid_hash(hwid)
+            and date.today().toordinal() < expiry_day)
+
+# --- building (follower) -------------------------------------------------------
+
+# Write an index of `count` records (`chunks` of record bytes in key order) and
+# move it over `path` in one rename
+def write_index(path, chunks, counts, watermark):
+    bounds = [0]
+    for count in counts:
+        bounds.append(bounds[-1] + count)
+    header = HEADER.pack(MAGIC, bounds[-1], time.time(), watermark.isoformat().encode() if watermark else b'')
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(header.ljust(HEADER_SIZE, b'\0'))
+            f.write(DIRECTORY.pack(*bounds))
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+    return bounds[-1]
+
+def newest(watermark, updated_at):
+    return updated_at if updated_at is not None and (watermark is None or updated_at > watermark) else watermark
+
+# Index every license; returns (licenses indexed, watermark)
+def build(store, path):
+    records = []
+    watermark = None
+    for row, updated_at in store.stream_rows('licenses', INDEX_COLUMNS):
+        encoded = encode_row(row)
+        if encoded is not None:
+            records.append(encoded)
+        watermark = newest(watermark, updated_at)
+    records.sort()
+    counts = [0] * PREFIXES
+    for key, _ in records:
+        counts[key[0] << 8 | key[1]] += 1
+    count = write_index(path, (record for _, record in records), counts, watermark)
+    return count, watermark
+
+# Merge the licenses changed since the index at `path` was built into a new
+# version of it; returns (licenses changed, watermark). Unchanged records are
+# copied over in runs straight from the old mapping.
+def refresh(store, path):
+    index = LicenseIndex(path)
+    since = index.watermark - CHANGE_MARGIN if index.watermark else None
+    changes = {}
+    watermark = index.watermark
+    for row, updated_at in store.stream_rows('licenses', INDEX_COLUMNS, since=since):
+        key = key_bytes(row[0])
+        if key is not None:
+            encoded = encode_row(row)
+            changes[key] = encoded[1] if encoded else None
+        watermark = newest(watermark, updated_at)
+
+    counts = index.counts()
+    chunks = []
+    copied = 0
+    changed = 0
+    for key in sorted(changes):
+        position = index.position(key)
+        found = position < index.count and index.key_at(position) == key
+        record = changes[key]
+        if (record is None and not found) or (found and index.records(position, position + 1) == record):
+            continue
+        chunks.append(index.records(copied, position))
+        if record is not None:
+            chunks.append(record)
+        copied = position + 1 if found else position
+        counts[key[0] << 8 | key[1]] += (record is not None) - found
+        changed += 1
+    if not changed:
+        # Nothing to write; the new modification time tells the workers the
+        # index is still current
+        os.utime(path)
+        return 0, watermark
+    chunks.append(index.records(copied, index.count))
+    write_index(path, chunks, counts, watermark)
+    return changed, watermark
+
+def follow(store, path, interval, full_interval):
+    built_at = float('-inf')
+    while True:
+        started = time.monotonic()
+        try:
+            if started - built_at >= full_interval or not os.path.exists(path):
+                count, watermark = build(store, path)
+                built_at = started
+                logger.info("Built license index %s: %d licenses in %.1fs, watermark %s",
+                            path, count, time.monotonic() - started, watermark)
+            else:
+                changed, watermark = refresh(store, path)
+                if changed:
+                    logger.info("Refreshed license index %s: %d licenses changed, watermark %s",
+                                path, changed, watermark)
+        except Exception:
+            logger.exception("Updating license index %s failed", path)
+        time.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+def main():
+    load_dotenv()
+    logging_config.setup_logging()
+    parser = argparse.ArgumentParser(description="Build and refresh the license index used by the validator workers.")
+    parser.add_argument('command', choices=('build', 'refresh', 'follow'))
+    parser.add_argument('--path', default=LICENSE_INDEX_PATH or None, help="index file (default: LICENSE_INDEX_PATH)")
+    parser.add_argument('--interval', type=float, default=LICENSE_INDEX_INTERVAL, help="seconds between refreshes")
+    parser.add_argument('--full-interval', type=float, default=LICENSE_INDEX_FULL_REBUILD,
+                        help="seconds between full rebuilds")
+    args = parser.parse_args()
+    if not args.path:
+        parser.error("--path or LICENSE_INDEX_PATH is required")
+
+    store = database.get_store()
+    if args.command == 'build':
+        count, watermark = build(store, args.path)
+        print(f"Indexed {count} licenses, watermark {watermark}")
+    elif args.command == 'refresh':
+        if not os.path.exists(args.path):
+            sys.exit(f"{args.path} does not exist; run build first")
+        changed, watermark = refresh(store, args.path)
+        print(f"{changed} licenses changed, watermark {watermark}")
+    else:
+        follow(store, args.path, args.interval, args.full_interval)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+# Logging configuration (all optional):
+#   LOG_LEVEL               root level, e.g. INFO (default) or DEBUG
+#   LOG_LEVELS              per-logger overrides, e.g. "httpx=WARNING,telegram.ext=INFO"
+#   LOG_ACCESS_SAMPLE_RATE  fraction of hot-path access log lines kept (0.0 - 1.0)
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+DEFAULT_LOG_LEVELS = 'httpx=WARNING,httpcore=WARNING,telegram=INFO,apscheduler=WARNING'
+ACCESS_LOGGER_NAME = 'access'
+
+_secrets = set()
+_listener = None
+
+# Values that must never reach a log sink (tokens, keys, DSN passwords)
+def register_secret(value):
+    if value and len(value) >= 8:
+        _secrets.add(value)
+
+class RedactingFormatter(logging.Formatter):
+    def format(self, record):
+        message = super().format(record)
+        for secret in _secrets:
+            if secret in message:
+                message = message.replace(secret, '***')
+        return message
+
+# Unlike the stock QueueHandler this does not pre-format the record, so the
+# calling thread only pays for an enqueue; %-formatting, redaction and the
+# stream write all happen on the listener thread.
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+# Keeps a random fraction of records; used for per-request access logs
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+def parse_log_levels(spec):
+    levels = {}
+    for item in (spec or '').split(','):
+        if '=' not in item:
+            continue
+        name, level = item.split('=', 1)
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+def setup_logging():
+    global _listener
+    if _listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(RedactingFormatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(NonBlockingQueueHandler(log_queue))
+    root.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+
+    levels = parse_log_levels(DEFAULT_LOG_LEVELS)
+    levels.update(parse_log_levels(os.getenv('LOG_LEVELS')))
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+
+    access_logger = logging.getLogger(ACCESS_LOGGER_NAME)
+    access_logger.addFilter(SamplingFilter(float(os.getenv('LOG_ACCESS_SAMPLE_RATE', '0.01'))))
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
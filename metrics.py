@@ -0,0 +1,121 @@
+import functools
+import os
+import time
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess, REGISTRY
+
+# Prometheus metrics for the bot and the /validate endpoint.
+#
+# Under gunicorn set PROMETHEUS_MULTIPROC_DIR to an empty, writable directory
+# before the workers start: every worker then records into its own mmap-backed
+# files and /metrics aggregates all of them, whichever worker serves the scrape.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HANDLER_LATENCY = Histogram(
+    'bot_handler_duration_seconds', 'Time spent in Telegram update handlers', ['handler'],
+    buckets=LATENCY_BUCKETS
+)
+VALIDATE_LATENCY = Histogram(
+    'license_validate_duration_seconds', 'Time spent answering /validate, by outcome', ['outcome'],
+    buckets=LATENCY_BUCKETS
+)
+# Requests per second from clients that follow their leases is roughly the
+# number of active machines divided by the mean next check (about 0.6 leases)
+VALIDATE_LEASE = Histogram(
+    'license_validate_lease_seconds', 'Leases granted by /validate',
+    buckets=(60, 300, 900, 1800, 3600, 7200, 14400, 21600, 43200, 86400)
+)
+LICENSE_INDEX_LOOKUPS = Counter(
+    'license_index_lookups_total', 'Validations answered by the license index (hit), passed on to the database '
+    '(database), or made while there was no current index (unavailable)', ['result']
+)
+DB_QUERY_LATENCY = Histogram(
+    'db_query_duration_seconds', 'Time spent in data layer calls', ['operation'],
+    buckets=LATENCY_BUCKETS
+)
+PDF_RENDER_LATENCY = Histogram(
+    'pdf_render_duration_seconds', 'Time spent rendering license certificates',
+    buckets=LATENCY_BUCKETS
+)
+TELEGRAM_REQUEST_LATENCY = Histogram(
+    'telegram_request_duration_seconds', 'Bot API request latency', ['method'],
+    buckets=LATENCY_BUCKETS
+)
+TELEGRAM_RATE_LIMITED = Counter(
+    'telegram_rate_limited_total', 'Bot API requests rejected with 429 Too Many Requests', ['method']
+)
+LICENSES_ISSUED = Counter(
+    'licenses_issued_total', 'Licenses issued', ['product', 'tier']
+)
+DB_READS = Counter(
+    'db_reads_total', 'Reads by where they were served when read replicas are configured '
+    '(replica, primary, or primary after a replica miss/failure)', ['target']
+)
+# 0 closed, 1 half-open, 2 open (see circuit_breaker.py)
+DB_CIRCUIT_STATE = Gauge(
+    'db_circuit_state', 'State of the database circuit breaker', multiprocess_mode='livemax'
+)
+DB_CIRCUIT_TRANSITIONS = Counter(
+    'db_circuit_transitions_total', 'Database circuit breaker state changes, by the state entered', ['state']
+)
+PURCHASES_QUEUED = Counter(
+    'purchases_queued_total', 'Licenses queued because the database could not store them when issued'
+)
+PURCHASE_QUEUE_PENDING = Gauge(
+    'purchase_queue_pending', 'Queued licenses not yet stored in the database', multiprocess_mode='livesum'
+)
+FILE_DOWNLOADS = Counter(
+    'file_downloads_total', 'Signed product file downloads (see file_store.py), by result '
+    '(full, partial, not_modified, unsatisfiable, forbidden, expired, missing)', ['result']
+)
+VALIDATION_EVENTS = Counter(
+    'validation_events_total', 'Validation events written to validation_events (stored) or lost because the '
+    'buffer was full (dropped), see validation_log.py', ['result']
+)
+# Summed over live processes this should always be exactly 1
+POLLER_LEADER = Gauge(
+    'bot_poller_leader', 'Whether this process holds the Telegram poller leadership',
+    multiprocess_mode='livesum'
+)
+LEADER_TRANSITIONS = Counter(
+    'bot_poller_leader_transitions_total', 'Poller leadership gained or lost by this process', ['event']
+)
+
+# Decorator for async Telegram handlers
+def timed_handler(func):
+    histogram = HANDLER_LATENCY.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+# Decorator for synchronous data layer functions
+def timed_db(func):
+    histogram = DB_QUERY_LATENCY.labels(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+def render_metrics():
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+# Called from gunicorn's child_exit hook so a dead worker's live gauges are dropped
+def mark_process_dead(pid):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
@@ -1,84 +1,258 @@
+import argparse
+import io
 import json
 import os
+import sys
+import time
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2.extensions import make_dsn
 from dotenv import load_dotenv
+import storage
 
 # Load environment variables
 load_dotenv()
 DATABASE_URL = os.getenv('DATABASE_URL')
 
-# Database connection
-def get_db_connection():
-    return psycopg2.connect(DATABASE_URL, sslmode='require')
+# Migrates the legacy products.json / licenses.json / transactions.json files into
+# the typed tables the bot uses (see storage.py).
+#
+# The files are stream-parsed one record at a time, so memory stays flat however
+# large they are. Records are bulk-loaded with COPY in chunks through a staging
+# table, and after every chunk the number of migrated records is checkpointed in
+# the same transaction. An interrupted run picks up after the last committed
+# chunk. Rows whose key already exists are left alone, so re-running is safe.
+#
+#   python migrate_to_postgres.py --dir /path/to/json --chunk-size 50000
+#   python migrate_to_postgres.py --restart   # ignore checkpoints and start over
 
-# Initialize database tables
-def init_db():
-    conn = get_db_connection()
+READ_SIZE = 1024 * 1024
+DEFAULT_CHUNK_SIZE = 50000
+
+CHECKPOINT_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS migration_checkpoints (
+        source TEXT PRIMARY KEY,
+        records BIGINT NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+    )
+"""
+
+# Yield the (key, value) pairs of a file holding one top-level JSON object
+# without loading the whole file
+def iter_json_object(path):
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ''
+        position = 0
+        eof = False
+
+        def fill():
+            nonlocal buffer, position, eof
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                eof = True
+            buffer = buffer[position:] + chunk
+            position = 0
+
+        def skip_whitespace():
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n':
+                    position += 1
+                if position < len(buffer) or eof:
+                    return
+                fill()
+
+        # Decode one value; retried with more data while it runs into the end of
+        # the buffer (a number cut in half would otherwise decode "successfully")
+        def decode():
+            nonlocal position
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                    if end < len(buffer) or eof:
+                        position = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                fill()
+
+        def expect(character):
+            nonlocal position
+            skip_whitespace()
+            if position >= len(buffer) or buffer[position] != character:
+                raise ValueError(f"{path}: expected {character!r}, found {buffer[position:position + 20]!r}")
+            position += 1
+
+        fill()
+        expect('{')
+        skip_whitespace()
+        if buffer[position:position + 1] == '}':
+            return
+        while True:
+            skip_whitespace()
+            key = decode()
+            expect(':')
+            skip_whitespace()
+            yield key, decode()
+            skip_whitespace()
+            if buffer[position:position + 1] == ',':
+                position += 1
+                continue
+            expect('}')
+            return
+
+# Map legacy records onto the live columns. Fields missing from older files get
+# the same defaults the bot uses; licenses.json predates is_trial, so trials are
+# recognized by the placeholder transaction hash the bot writes for them.
+def product_row(product_id, info):
+    return (int(product_id), info['name'], info['file'], info.get('is_trial', False),
+            info.get('expiry_days'), json.dumps(info.get('pricing_tiers') or {}), info.get('file_sha256'))
+
+def license_row(license_key, info):
+    tx_hash = info.get('tx_hash')
+    return (license_key, info['username'], info.get('hwid') or '', info['expiry'], info.get('active', True),
+            tx_hash, info['product'], info.get('is_trial', tx_hash == 'trial-no-payment'), info.get('seats', 1),
+            info.get('telegram_id'))
+
+def transaction_row(license_key, info):
+    return (license_key, info['username'], info['product'], info['product_file'],
+            info.get('pdf_file') or f"license_{license_key}.pdf", info.get('is_trial', False), info.get('telegram_id'),
+            info.get('file_sha256'))
+
+# (source file, target table, conflict key, row builder, columns)
+SOURCES = [
+    ('products.json', 'products', 'id', product_row, storage.PRODUCT_COLUMNS),
+    ('licenses.json', 'licenses', 'license_key', license_row, storage.LICENSE_COLUMNS),
+    ('transactions.json', 'transactions', 'license_key', transaction_row, storage.TRANSACTION_COLUMNS),
+]
+
+def load_checkpoint(conn, source):
     cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS products (
-            id TEXT PRIMARY KEY,
-            data JSONB NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS licenses (
-            license_key TEXT PRIMARY KEY,
-            data JSONB NOT NULL
-        );
-        CREATE TABLE IF NOT EXISTS transactions (
-            license_key TEXT PRIMARY KEY,
-            data JSONB NOT NULL
-        );
-    """)
+    cur.execute("SELECT records FROM migration_checkpoints WHERE source = %s", (source,))
+    row = cur.fetchone()
+    cur.close()
+    return row[0] if row else 0
+
+# COPY one chunk into the staging table, move it into the live table and advance
+# the checkpoint, all in one transaction; returns the number of new rows
+def load_chunk(conn, table, key, columns, rows, source, records):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(storage.copy_value(value) for value in row) + "\n")
+    buffer.seek(0)
+    cur = conn.cursor()
+    cur.copy_expert(f"COPY {table}_stage ({', '.join(columns)}) FROM STDIN", buffer)
+    cur.execute(
+        f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join(columns)} FROM {table}_stage "
+        f"ON CONFLICT ({key}) DO NOTHING"
+    )
+    inserted = cur.rowcount
+    cur.execute(
+        """
+        INSERT INTO migration_checkpoints (source, records, updated_at) VALUES (%s, %s, NOW())
+        ON CONFLICT (source) DO UPDATE SET records = EXCLUDED.records, updated_at = EXCLUDED.updated_at
+        """,
+        (source, records)
+    )
     conn.commit()
     cur.close()
-    conn.close()
+    return inserted
 
-# Migrate JSON files to PostgreSQL
-def migrate_products():
-    with open('products.json', 'r') as f:
-        products = json.load(f)
-    
-    conn = get_db_connection()
+def migrate_source(conn, directory, source, table, key, build_row, columns, chunk_size):
+    path = os.path.join(directory, source)
+    if not os.path.exists(path):
+        print(f"{source}: not found, skipped.")
+        return None
+    done = load_checkpoint(conn, source)
     cur = conn.cursor()
-    for product_id, data in products.items():
-        cur.execute("INSERT INTO products (id, data) VALUES (%s, %s) ON CONFLICT (id) DO UPDATE SET data = %s",
-                    (product_id, Json(data), Json(data)))
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table}_stage (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS")
     conn.commit()
     cur.close()
-    conn.close()
-    print("Products migrated successfully.")
 
-def migrate_licenses():
-    with open('licenses.json', 'r') as f:
-        licenses = json.load(f)
-    
-    conn = get_db_connection()
+    start = time.perf_counter()
+    records = inserted = 0
+    rows = []
+    for record_key, info in iter_json_object(path):
+        records += 1
+        if records <= done:
+            continue
+        rows.append(build_row(record_key, info))
+        if len(rows) >= chunk_size:
+            inserted += load_chunk(conn, table, key, columns, rows, source, records)
+            rows = []
+            print(f"{source}: {records} records migrated...")
+    if rows:
+        inserted += load_chunk(conn, table, key, columns, rows, source, records)
+    elapsed = time.perf_counter() - start
+    resumed = f", resumed after {done}" if done else ""
+    print(f"{source}: {records} records, {inserted} new rows in {elapsed:.1f}s{resumed}.")
+    return records
+
+# Every source record has to be present in its table afterwards
+def verify(conn, table, records):
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM {table}")
+    count = cur.fetchone()[0]
+    cur.close()
+    if count < records:
+        print(f"{table}: only {count} rows for {records} source records!")
+        return False
+    print(f"{table}: {count} rows for {records} source records, OK.")
+    return True
+
+# Older versions of this script created (id, data JSONB) tables; those have to be
+# renamed or dropped before the typed tables can be created
+def check_legacy_layout(conn):
     cur = conn.cursor()
-    for license_key, data in licenses.items():
-        cur.execute("INSERT INTO licenses (license_key, data) VALUES (%s, %s) ON CONFLICT (license_key) DO UPDATE SET data = %s",
-                    (license_key, Json(data), Json(data)))
+    cur.execute(
+        """
+        SELECT table_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND column_name = 'data'
+          AND table_name IN ('products', 'licenses', 'transactions')
+        """
+    )
+    legacy = [row[0] for row in cur.fetchall()]
+    cur.close()
+    if legacy:
+        sys.exit(f"Tables {', '.join(legacy)} use the old (key, data JSONB) layout; rename or drop them first.")
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate the legacy JSON files into PostgreSQL.")
+    parser.add_argument('--dir', default='.', help="directory holding products.json, licenses.json and transactions.json")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help="records per COPY and checkpoint")
+    parser.add_argument('--sslmode', default='require', help="libpq sslmode for the connection")
+    parser.add_argument('--restart', action='store_true', help="discard checkpoints from an earlier run")
+    args = parser.parse_args()
+    if not DATABASE_URL:
+        parser.error("DATABASE_URL is not set")
+
+    dsn = make_dsn(DATABASE_URL, sslmode=args.sslmode)
+    conn = psycopg2.connect(dsn)
+    check_legacy_layout(conn)
+    storage.PostgresStorage(dsn).init_schema()
+    cur = conn.cursor()
+    cur.execute(CHECKPOINT_SCHEMA)
+    if args.restart:
+        cur.execute("DELETE FROM migration_checkpoints")
     conn.commit()
     cur.close()
-    conn.close()
-    print("Licenses migrated successfully.")
 
-def migrate_transactions():
-    with open('transactions.json', 'r') as f:
-        transactions = json.load(f)
-    
-    conn = get_db_connection()
+    ok = True
+    for source, table, key, build_row, columns in SOURCES:
+        records = migrate_source(conn, args.dir, source, table, key, build_row, columns, args.chunk_size)
+        if records is not None:
+            ok = verify(conn, table, records) and ok
+
+    # Explicit ids bypass the SERIAL sequence; move it past the migrated products
     cur = conn.cursor()
-    for license_key, data in transactions.items():
-        cur.execute("INSERT INTO transactions (license_key, data) VALUES (%s, %s) ON CONFLICT (license_key) DO UPDATE SET data = %s",
-                    (license_key, Json(data), Json(data)))
+    cur.execute("SELECT setval(pg_get_serial_sequence('products', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM products")
     conn.commit()
     cur.close()
     conn.close()
-    print("Transactions migrated successfully.")
+    if not ok:
+        sys.exit(1)
+    print("Migration complete.")
 
 if __name__ == "__main__":
-    init_db()
-    migrate_products()
-    migrate_licenses()
-    migrate_transactions()
\ No newline at end of file
+    main()
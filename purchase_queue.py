@@ -0,0 +1,135 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+import analytics
+import circuit_breaker
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Licenses the bot issued while the database could not store them. The customer
+# still gets the license key and files; the license and its transaction are
+# appended to PURCHASE_QUEUE_PATH (one JSON object per line, fsynced before the
+# bot answers) and a background thread stores them once the database is back,
+# then rewrites the file without them. A flock() on PURCHASE_QUEUE_PATH.lock
+# keeps processes on the same host that share the file from losing entries; it
+# is only held for file operations, never across a database call, so enqueue()
+# does not wait for a drain. Drains themselves take PURCHASE_QUEUE_PATH.drain.lock.
+#
+# Until its license is stored, a queued key is unknown to /validate, so the
+# queue is retried every PURCHASE_RETRY_INTERVAL seconds. An entry the database
+# rejects for another reason than an outage (circuit_breaker.is_outage) would
+# never be stored: it is moved to PURCHASE_DEAD_LETTER_PATH with its error, to
+# be fixed by hand, and the entries after it are stored as usual.
+
+PURCHASE_QUEUE_PATH = os.getenv('PURCHASE_QUEUE_PATH', 'pending_licenses.jsonl')
+PURCHASE_RETRY_INTERVAL = float(os.getenv('PURCHASE_RETRY_INTERVAL', '5'))
+PURCHASE_DEAD_LETTER_PATH = os.getenv('PURCHASE_DEAD_LETTER_PATH', 'failed_licenses.jsonl')
+
+_drainer = None
+_stop = threading.Event()
+
+@contextmanager
+def _locked(suffix='.lock'):
+    with open(f"{PURCHASE_QUEUE_PATH}{suffix}", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def _read():
+    entries = []
+    try:
+        with open(PURCHASE_QUEUE_PATH) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Only the last line can be torn, by a crash before the
+                    # fsync, and that customer never got an answer
+                    if line.strip():
+                        logger.error("Skipping unreadable queued purchase: %r", line)
+    except FileNotFoundError:
+        pass
+    return entries
+
+# Queue a license that add_license could not store; its sale (analytics.sale)
+# is added to the rollups once it is stored
+def enqueue(license_key, license, transaction, sale=None):
+    entry = json.dumps({'license_key': license_key, 'license': license, 'transaction': transaction, 'sale': sale})
+    with _locked():
+        _append(PURCHASE_QUEUE_PATH, [entry])
+        pending = len(_read())
+    metrics.PURCHASES_QUEUED.inc()
+    metrics.PURCHASE_QUEUE_PENDING.set(pending)
+    logger.warning("Queued license %s until the database is available (%d pending)", license_key, pending)
+
+def _append(path, lines):
+    with open(path, 'a') as f:
+        f.writelines(line + '\n' for line in lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+# Store queued licenses in order until the database fails again; returns the
+# number stored
+def drain():
+    with _locked('.drain.lock'):
+        with _locked():
+            entries = _read()
+        done = set()
+        failed = []
+        for entry in entries:
+            license_key = entry['license_key']
+            try:
+                try:
+                    database.add_license(license_key, entry['license'], entry['transaction'])
+                except Exception:
+                    # An earlier attempt may have been committed without its answer arriving
+                    if database.get_license(license_key) is None:
+                        raise
+            except Exception as e:
+                if circuit_breaker.is_outage(e):
+                    logger.warning("Storing queued license %s failed, %d still queued: %s",
+                                   license_key, len(entries) - len(done), e)
+                    break
+                logger.error("Queued license %s was rejected, moving it to %s: %s", license_key, PURCHASE_DEAD_LETTER_PATH, e)
+                failed.append(dict(entry, error=str(e)))
+                done.add(license_key)
+                continue
+            done.add(license_key)
+            logger.info("Stored queued license %s", license_key)
+            if entry.get('sale'):
+                analytics.record_sale(entry['sale'])
+        with _locked():
+            if failed:
+                _append(PURCHASE_DEAD_LETTER_PATH, [json.dumps(entry) for entry in failed])
+            # Re-read: entries may have been queued while the lock was released
+            remaining = [entry for entry in _read() if entry['license_key'] not in done]
+            if done:
+                temporary = f"{PURCHASE_QUEUE_PATH}.tmp"
+                with open(temporary, 'w') as f:
+                    f.writelines(json.dumps(entry) + '\n' for entry in remaining)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temporary, PURCHASE_QUEUE_PATH)
+        metrics.PURCHASE_QUEUE_PENDING.set(len(remaining))
+    return len(done) - len(failed)
+
+def _run_drainer():
+    while not _stop.wait(PURCHASE_RETRY_INTERVAL):
+        try:
+            if _read():
+                drain()
+        except Exception:
+            logger.exception("Draining the purchase queue failed")
+
+def start():
+    global _drainer
+    if _drainer is None:
+        _drainer = threading.Thread(target=_run_drainer, name="purchase-queue", daemon=True)
+        _drainer.start()
+
+def stop():
+    _stop.set()
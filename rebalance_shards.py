@@ -0,0 +1,226 @@
+import argparse
+import sys
+import time
+from datetime import timedelta
+from dotenv import load_dotenv
+import database
+import sharding
+import storage
+
+# Online rebalancing of the license shards (see sharding.py).
+#
+# After adding a database to the end of DATABASE_SHARD_URLS (in every worker's
+# environment), run
+#
+#   python rebalance_shards.py status
+#   python rebalance_shards.py rebalance
+#
+# to move buckets onto it until every shard owns an even share. The bot and the
+# validators keep running meanwhile:
+#   1. copy: the moving buckets' licenses, transactions and seats are copied to
+#      their new shards while the old shards keep taking writes
+#   2. cut over, a few buckets at a time: lock the buckets on the old shard
+#      (waits for running writes, blocks new ones), copy what changed since
+#      step 1, let the new shard claim the buckets, publish the next shard map
+#      version, then release the buckets on the old shard. Writers blocked
+#      meanwhile are refused, reload the map and retry on the new shard.
+#   3. clean up: delete the moved rows from the old shards
+# An interrupted run is finished by running it again: each run starts by
+# reconciling bucket ownership and stray rows with the latest map.
+#
+# With SQLite shards, keep DATABASE_URL in a file of its own: the cut-over
+# writes the map while it holds the old shard's write lock.
+
+# Copied rows are compared with updated_at stamps from the source's clock; rows
+# of write transactions that began shortly before the copy started carry
+# slightly older stamps, so the catch-up copy looks back this far
+COPY_MARGIN = timedelta(minutes=5)
+COPY_BATCH_SIZE = 5000
+# Pause between cut-overs so writes queued behind one get through before the
+# next takes the lock (SQLite's busy handler would otherwise keep losing the race)
+CUTOVER_PAUSE = 0.2  # seconds
+# Advisory lock key that keeps two rebalances from running at once
+# (storage.SCHEMA_LOCK_ID is 7427000, leader.POLLER_LOCK_ID 7427001)
+REBALANCE_LOCK_ID = 7427002
+
+# (table, columns, primary key) of everything stored per license
+TABLES = (
+    ('licenses', storage.LICENSE_COLUMNS, ('license_key',)),
+    ('transactions', storage.TRANSACTION_COLUMNS, ('license_key',)),
+    ('license_seats', storage.SEAT_COLUMNS, ('license_key', 'hwid')),
+)
+SEAT_KEYS = TABLES[2][2]
+
+def rows_in_buckets(rows, buckets):
+    return [(row, updated_at) for row, updated_at in rows if sharding.shard_bucket(row[0]) in buckets]
+
+# Copy rows of `buckets` (bucket -> destination shard index) from `source`
+def copy_rows(store, source, buckets, since=None):
+    copied = 0
+    for table, columns, keys in TABLES:
+        batches = {}
+        for row, updated_at in source.stream_rows(table, columns, since=since):
+            destination = buckets.get(sharding.shard_bucket(row[0]))
+            if destination is None:
+                continue
+            batch = batches.setdefault(destination, [])
+            batch.append((row, updated_at))
+            if len(batch) >= COPY_BATCH_SIZE:
+                store.shards[destination].upsert_rows(table, columns, batch, keys)
+                copied += len(batch)
+                batch.clear()
+        for destination, batch in batches.items():
+            if batch:
+                store.shards[destination].upsert_rows(table, columns, batch, keys)
+                copied += len(batch)
+    return copied
+
+# Delete every row of `index` whose bucket the map assigns elsewhere
+def remove_stray_rows(store, index, assignment):
+    shard = store.shards[index]
+    removed = 0
+    for table, _, _ in TABLES:
+        stray = {row[0] for row, _ in shard.stream_rows(table, ('license_key',))
+                 if assignment[sharding.shard_bucket(row[0])] != index}
+        shard.delete_rows(table, stray)
+        removed += len(stray)
+    return removed
+
+# Make bucket ownership and rows match the latest map
+def reconcile(store):
+    version, assignment = store.shard_map(force=True)
+    for index, shard in enumerate(store.shards):
+        assigned = {bucket for bucket, owner in enumerate(assignment) if owner == index}
+        owned = shard.owned_buckets()
+        if owned - assigned:
+            with shard.transaction() as cur:
+                shard.lock_buckets(cur, sorted(owned - assigned))
+                shard.release_buckets(cur, sorted(owned - assigned))
+            print(f"Shard {index}: released {len(owned - assigned)} buckets that map version {version} assigns elsewhere.")
+        if assigned - owned:
+            shard.claim_buckets(sorted(assigned - owned))
+            print(f"Shard {index}: claimed {len(assigned - owned)} buckets that map version {version} assigns to it.")
+        removed = remove_stray_rows(store, index, assignment)
+        if removed:
+            print(f"Shard {index}: removed {removed} rows of buckets it does not own.")
+
+# Fewest moves that leave every shard with an even share: buckets leave the
+# most loaded shards for the least loaded ones
+def plan_moves(assignment, shard_count):
+    owned = {index: [] for index in range(shard_count)}
+    for bucket, owner in enumerate(assignment):
+        owned[owner].append(bucket)
+    quota = {index: len(assignment) // shard_count + (1 if index < len(assignment) % shard_count else 0)
+             for index in range(shard_count)}
+    surplus = [bucket for index in owned for bucket in owned[index][quota[index]:]]
+    moves = {}
+    for index in range(shard_count):
+        while len(owned[index]) < quota[index]:
+            bucket = surplus.pop()
+            moves[bucket] = (assignment[bucket], index)
+            owned[index].append(bucket)
+    return moves
+
+def cut_over(store, source_index, buckets, since):
+    source = store.shards[source_index]
+    with source.transaction() as cur:
+        source.lock_buckets(cur, sorted(buckets))
+        changed_licenses = set()
+        for table, columns, keys in TABLES:
+            if table == 'license_seats':
+                continue
+            changed = rows_in_buckets(source.changed_rows(cur, table, columns, since), buckets)
+            if table == 'licenses':
+                changed_licenses = {row[0] for row, _ in changed}
+            for destination in set(buckets.values()):
+                rows = [(row, updated_at) for row, updated_at in changed if buckets[sharding.shard_bucket(row[0])] == destination]
+                if rows:
+                    store.shards[destination].upsert_rows(table, columns, rows, keys)
+        # Claiming or releasing a seat stamps its license: replace the seats of
+        # every changed license, which also drops seats released since the copy
+        seats = source.rows_for_keys(cur, 'license_seats', storage.SEAT_COLUMNS, changed_licenses)
+        for destination in set(buckets.values()):
+            moved = [key for key in changed_licenses if buckets[sharding.shard_bucket(key)] == destination]
+            rows = [(row, updated_at) for row, updated_at in seats if buckets[sharding.shard_bucket(row[0])] == destination]
+            store.shards[destination].delete_rows('license_seats', moved)
+            if rows:
+                store.shards[destination].upsert_rows('license_seats', storage.SEAT_COLUMNS, rows, SEAT_KEYS)
+        for destination in set(buckets.values()):
+            store.shards[destination].claim_buckets(sorted(b for b, d in buckets.items() if d == destination))
+        version, assignment = store.shard_map(force=True)
+        assignment = list(assignment)
+        for bucket, destination in buckets.items():
+            assignment[bucket] = destination
+        store.catalog.save_shard_map(version + 1, max(assignment) + 1, assignment)
+        source.release_buckets(cur, sorted(buckets))
+    return version + 1
+
+def rebalance(store, buckets_per_cutover, dry_run=False):
+    reconcile(store)
+    version, assignment = store.shard_map(force=True)
+    moves = plan_moves(assignment, len(store.shards))
+    if not moves:
+        print(f"Shard map version {version} is already balanced over {len(store.shards)} shards.")
+        return
+    by_source = {}
+    for bucket, (source, destination) in moves.items():
+        by_source.setdefault(source, {})[bucket] = destination
+    for source, buckets in sorted(by_source.items()):
+        targets = ', '.join(f"{sum(1 for d in buckets.values() if d == t)} to shard {t}" for t in sorted(set(buckets.values())))
+        print(f"Shard {source}: moving {len(buckets)} buckets ({targets}).")
+    if dry_run:
+        return
+
+    start = time.perf_counter()
+    for source, buckets in sorted(by_source.items()):
+        since = store.shards[source].now() - COPY_MARGIN
+        copied = copy_rows(store, store.shards[source], buckets)
+        print(f"Shard {source}: copied {copied} rows in {time.perf_counter() - start:.1f}s; cutting over...")
+        ordered = sorted(buckets)
+        for offset in range(0, len(ordered), buckets_per_cutover):
+            group = {bucket: buckets[bucket] for bucket in ordered[offset:offset + buckets_per_cutover]}
+            version = cut_over(store, source, group, since)
+            time.sleep(CUTOVER_PAUSE)
+        print(f"Shard {source}: cut over, shard map is at version {version}.")
+        _, assignment = store.shard_map(force=True)
+        removed = remove_stray_rows(store, source, assignment)
+        print(f"Shard {source}: removed {removed} moved rows.")
+    print(f"Rebalanced {len(moves)} buckets in {time.perf_counter() - start:.1f}s.")
+
+def status(store):
+    version, assignment = store.shard_map(force=True)
+    print(f"Shard map version {version}, {sharding.SHARD_BUCKETS} buckets over {len(store.shards)} configured shards:")
+    for index, shard in enumerate(store.shards):
+        assigned = sum(1 for owner in assignment if owner == index)
+        with shard.transaction(write=False) as cur:
+            cur.execute("SELECT COUNT(*) FROM licenses")
+            licenses = cur.fetchone()[0]
+        print(f"  shard {index}: {assigned} buckets assigned, {len(shard.owned_buckets())} owned, {licenses} licenses")
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Show or rebalance the license shards.")
+    parser.add_argument('command', choices=('status', 'rebalance'))
+    parser.add_argument('--buckets-per-cutover', type=int, default=16,
+                        help="buckets moved per cut-over; writes to them wait while it runs")
+    parser.add_argument('--dry-run', action='store_true', help="print the planned moves only")
+    args = parser.parse_args()
+    if not database.shard_urls():
+        parser.error("DATABASE_SHARD_URLS is not set")
+
+    store = database.get_store()
+    store.init_schema()
+    if args.command == 'status':
+        status(store)
+        return
+    lock = store.catalog.leader_lock(REBALANCE_LOCK_ID)
+    if not lock.acquire():
+        print("Another rebalance is running.")
+        sys.exit(1)
+    try:
+        rebalance(store, args.buckets_per_cutover, args.dry_run)
+    finally:
+        lock.release()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Hash sharding of licenses and transactions across several databases.
+#
+# DATABASE_SHARD_URLS lists the shard databases (comma-separated DSNs; the order
+# matters and is checked against each shard's recorded position). Every license
+# key hashes (CRC-32) into one of SHARD_BUCKETS buckets, and a versioned shard
+# map in the main database (DATABASE_URL, which keeps products, the audit log and
+# the map itself) assigns each bucket to a shard. A license, its transaction
+# and its seats live on the same shard, so issuing, HWID binds, seat claims,
+# /validate and /resend touch a single database; whole-table loads, searches and
+# exports query every shard concurrently and merge the results.
+#
+# Each shard also records which buckets it owns. Writes check ownership in the
+# same transaction under a share lock, so a worker holding an outdated map is
+# refused (storage.WrongShard), reloads the map and retries; rebalance_shards.py
+# takes the exclusive lock while it hands a bucket to another shard. Workers
+# reload the map every SHARD_MAP_REFRESH seconds and after a lookup misses, so
+# they all follow a new version within seconds.
+
+SHARD_BUCKETS = 1024
+SHARD_MAP_REFRESH = float(os.getenv('SHARD_MAP_REFRESH', '5'))  # seconds
+SHARD_MAP_MISS_REFRESH = 1.0  # at most one reload per second for keys that are not found
+WRONG_SHARD_RETRIES = 6
+FANOUT_QUEUE_SIZE = 4  # batches buffered per shard while streaming
+
+def shard_bucket(license_key):
+    return zlib.crc32(license_key.encode()) % SHARD_BUCKETS
+
+def even_assignment(shard_count):
+    return [bucket % shard_count for bucket in range(SHARD_BUCKETS)]
+
+def has_licenses(store):
+    with store.transaction(write=False) as cur:
+        cur.execute("SELECT 1 FROM licenses LIMIT 1")
+        return cur.fetchone() is not None
+
+class ShardedStorage:
+    def __init__(self, catalog, shards):
+        self.catalog = catalog
+        self.shards = list(shards)
+        self._map = None
+        self._loaded_at = float('-inf')
+        self._map_lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix="shard-fanout")
+
+    # Products, the audit log, leader locks and the shard map stay in the main database
+    def __getattr__(self, name):
+        return getattr(self.catalog, name)
+
+    # Creates the tables everywhere and, on first start, the first shard map.
+    # Empty shards get the buckets spread evenly; if shard 0 already holds
+    # licenses (an existing single database being sharded) it keeps every
+    # bucket until rebalance_shards.py moves some.
+    def init_schema(self):
+        self.catalog.init_schema()
+        for shard in self.shards:
+            shard.init_schema()
+        if self.catalog.load_shard_map() is not None:
+            return
+        if any(has_licenses(shard) for shard in self.shards[1:]):
+            raise RuntimeError("Shards other than the first already hold licenses but there is no shard map")
+        if has_licenses(self.shards[0]):
+            assignment = even_assignment(1)
+            logger.warning("Shard 0 already holds licenses: assigning it every bucket; run rebalance_shards.py to spread them")
+        else:
+            assignment = even_assignment(len(self.shards))
+        for index, shard in enumerate(self.shards):
+            if shard.shard_identity() is None:
+                shard.set_shard_identity(index)
+            shard.claim_buckets([bucket for bucket, owner in enumerate(assignment) if owner == index])
+        try:
+            self.catalog.save_shard_map(1, max(assignment) + 1, assignment)
+            logger.info("Created shard map version 1 over %d shards", max(assignment) + 1)
+        except Exception:
+            # Another worker published it first
+            if self.catalog.load_shard_map() is None:
+                raise
+
+    # Latest (version, assignment), reloaded every SHARD_MAP_REFRESH seconds or when forced
+    def shard_map(self, force=False):
+        if not force and self._map is not None and time.monotonic() - self._loaded_at < SHARD_MAP_REFRESH:
+            return self._map
+        with self._map_lock:
+            loaded = self.catalog.load_shard_map()
+            if loaded is None:
+                raise RuntimeError("No shard map yet: initialize the database (init_db) first")
+            version, shard_count, assignment = loaded
+            if shard_count > len(self.shards):
+                raise RuntimeError(f"Shard map version {version} uses {shard_count} shards but "
+                                   f"DATABASE_SHARD_URLS lists {len(self.shards)}")
+            if self._map is None:
+                self._check_identities()
+            elif version != self._map[0]:
+                logger.info("Shard map updated from version %d to %d", self._map[0], version)
+            self._map = (version, assignment)
+            self._loaded_at = time.monotonic()
+            return self._map
+
+    def _check_identities(self):
+        for index, shard in enumerate(self.shards):
+            identity = shard.shard_identity()
+            if identity is None:
+                shard.set_shard_identity(index)
+            elif identity != index:
+                raise RuntimeError(f"DATABASE_SHARD_URLS entry {index} is shard {identity}; keep the original order")
+
+    def _owner(self, license_key, force=False):
+        version, assignment = self.shard_map(force)
+        bucket = shard_bucket(license_key)
+        return self.shards[assignment[bucket]], bucket, version
+
+    # A refused write means the bucket moved: reload the map and retry, backing
+    # off while a rebalance is publishing the new version
+    def _write(self, license_key, write):
+        for attempt in range(WRONG_SHARD_RETRIES):
+            shard, bucket, version = self._owner(license_key, force=attempt > 0)
+            try:
+                return write(shard, bucket)
+            except storage.WrongShard:
+                logger.info("Bucket %d is not on its shard in map version %d, reloading the map", bucket, version)
+                time.sleep(0.05 * 2 ** attempt)
+        raise storage.WrongShard(bucket)
+
+    # A miss may mean the bucket moved since the map was loaded
+    def _read(self, license_key, read):
+        shard, _, version = self._owner(license_key)
+        result = read(shard)
+        if result is None and time.monotonic() - self._loaded_at > SHARD_MAP_MISS_REFRESH:
+            current, _, current_version = self._owner(license_key, force=True)
+            if current_version != version and current is not shard:
+                result = read(current)
+        return result
+
+    def _fan_out(self, call):
+        return list(self._pool.map(call, self.shards))
+
+    # Rows of buckets a shard does not own (left behind by a rebalance that
+    # has not cleaned up yet) are skipped
+    def _owned(self, assignment, index, license_key):
+        return assignment[shard_bucket(license_key)] == index
+
+    def _partition(self, items):
+        _, assignment = self.shard_map()
+        parts = [{} for _ in self.shards]
+        for license_key, value in items.items():
+            parts[assignment[shard_bucket(license_key)]][license_key] = value
+        return parts
+
+    # --- single-key operations ----------------------------------------------
+
+    def get_license(self, license_key):
+        return self._read(license_key, lambda shard: shard.get_license(license_key))
+
+    def get_transaction(self, license_key):
+        return self._read(license_key, lambda shard: shard.get_transaction(license_key))
+
+    # Every shard is asked for its keys concurrently; keys that are not found
+    # are asked again where a reloaded map puts them, as in _read
+    def get_licenses(self, license_keys):
+        license_keys = list(license_keys)
+        _, assignment = self.shard_map()
+        licenses = self._get_licenses(assignment, license_keys)
+        missing = [key for key in license_keys if key not in licenses]
+        if missing and time.monotonic() - self._loaded_at > SHARD_MAP_MISS_REFRESH:
+            _, current = self.shard_map(force=True)
+            moved = [key for key in missing if current[shard_bucket(key)] != assignment[shard_bucket(key)]]
+            if moved:
+                licenses.update(self._get_licenses(current, moved))
+        return licenses
+
+    def _get_licenses(self, assignment, license_keys):
+        parts = [[] for _ in self.shards]
+        for license_key in license_keys:
+            parts[assignment[shard_bucket(license_key)]].append(license_key)
+        jobs = [(self.shards[index], part) for index, part in enumerate(parts) if part]
+        licenses = {}
+        for found in self._pool.map(lambda job: job[0].get_licenses(job[1]), jobs):
+            licenses.update(found)
+        return licenses
+
+    def add_license(self, license_key, license, transaction):
+        self._write(license_key, lambda shard, bucket: shard.add_license(license_key, license, transaction, bucket=bucket))
+
+    def bind_hwid(self, license_key, hwid):
+        return self._write(license_key, lambda shard, bucket: shard.bind_hwid(license_key, hwid, bucket=bucket))
+
+    # A stale map answers False; the claim that follows checks ownership
+    def has_seat(self, license_key, hwid):
+        shard, _, _ = self._owner(license_key)
+        return shard.has_seat(license_key, hwid)
+
+    def list_seats(self, license_key):
+        return self._read(license_key, lambda shard: shard.list_seats(license_key))
+
+    def claim_seat(self, license_key, hwid):
+        return self._write(license_key, lambda shard, bucket: shard.claim_seat(license_key, hwid, bucket=bucket))
+
+    def release_seats(self, license_key, hwid=None):
+        return self._write(license_key, lambda shard, bucket: shard.release_seats(license_key, hwid, bucket=bucket))
+
+    # --- fan-out operations ----------------------------------------------------
+
+    def load_licenses(self):
+        _, assignment = self.shard_map()
+        licenses = {}
+        for index, rows in enumerate(self._fan_out(lambda shard: shard.load_licenses())):
+            licenses.update((key, info) for key, info in rows.items() if self._owned(assignment, index, key))
+        return licenses
+
+    def load_transactions(self):
+        _, assignment = self.shard_map()
+        transactions = {}
+        for index, rows in enumerate(self._fan_out(lambda shard: shard.load_transactions())):
+            transactions.update((key, info) for key, info in rows.items() if self._owned(assignment, index, key))
+        return transactions
+
+    def search_licenses(self, term, limit=20):
+        _, assignment = self.shard_map()
+        matches = [
+            (key, info)
+            for index, rows in enumerate(self._fan_out(lambda shard: shard.search_licenses(term, limit)))
+            for key, info in rows if self._owned(assignment, index, key)
+        ]
+        matches.sort(key=lambda match: match[0])
+        matches.sort(key=lambda match: match[1]['expiry'], reverse=True)
+        return matches[:limit]
+
+    # Each shard returns its own first `limit` after the cursor; the merged page
+    # is the first `limit` of those, in the same (expiry, key) descending order
+    def licenses_of_user(self, telegram_id, after=None, limit=10):
+        _, assignment = self.shard_map()
+        matches = [
+            (key, info)
+            for index, rows in enumerate(self._fan_out(lambda shard: shard.licenses_of_user(telegram_id, after, limit)))
+            for key, info in rows if self._owned(assignment, index, key)
+        ]
+        matches.sort(key=lambda match: (match[1]['expiry'], match[0]), reverse=True)
+        return matches[:limit]
+
+    # The rollups are in the main database and the licenses on the shards, so
+    # they are counted across the shards while the main database's transaction
+    # holds off concurrent increments
+    def rebuild_active_licenses(self, through):
+        def count():
+            active = {}
+            for row, _ in self.stream_rows('licenses', ('license_key', 'product'),
+                                           where=f"active = TRUE AND expiry > '{date.fromisoformat(through).isoformat()}'"):
+                active[row[1]] = active.get(row[1], 0) + 1
+            return active
+        return self.catalog.rebuild_active_licenses(through, count)
+
+    # Every shard streams on its own thread into a bounded queue; rows come out
+    # in arrival order. Exports pass license_key among the columns.
+    def stream_rows(self, table, columns, where=None, since=None):
+        _, assignment = self.shard_map()
+        key_index = list(columns).index('license_key')
+        batches = queue.Queue(maxsize=FANOUT_QUEUE_SIZE * len(self.shards))
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce(index, shard):
+            try:
+                batch = []
+                for row, updated_at in shard.stream_rows(table, columns, where, since):
+                    if self._owned(assignment, index, row[key_index]):
+                        batch.append((row, updated_at))
+                        if len(batch) >= storage.STREAM_BATCH_SIZE:
+                            put(batch)
+                            batch = []
+                        if stop.is_set():
+                            return
+                if batch:
+                    put(batch)
+                put(done)
+            except Exception as e:
+                put(e)
+
+        producers = [threading.Thread(target=produce, args=(index, shard), name=f"shard-stream-{index}", daemon=True)
+                     for index, shard in enumerate(self.shards)]
+        for producer in producers:
+            producer.start()
+        try:
+            finished = 0
+            while finished < len(producers):
+                item = batches.get()
+                if item is done:
+                    finished += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield from item
+        finally:
+            stop.set()
+
+    # Whole-table replacements go to every shard with its part of the rows.
+    # They are admin and seeding operations and skip the ownership check.
+
+    def save_licenses(self, licenses):
+        parts = self._partition(licenses)
+        list(self._pool.map(lambda shard, part: shard.save_licenses(part), self.shards, parts))
+
+    def save_transactions(self, transactions):
+        parts = self._partition(transactions)
+        list(self._pool.map(lambda shard, part: shard.save_transactions(part), self.shards, parts))
+
+    def replace_licenses(self, rows):
+        _, assignment = self.shard_map()
+        parts = [[] for _ in self.shards]
+        for row in rows:
+            parts[assignment[shard_bucket(row[0])]].append(row)
+        list(self._pool.map(lambda shard, part: shard.replace_licenses(part), self.shards, parts))
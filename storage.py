@@ -0,0 +1,1615 @@
+import fcntl
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Storage backends behind the bot's load_* / save_* functions.
+#
+# DATABASE_URL picks the backend: sqlite:///path/to/licenses.db opens an embedded
+# SQLite database in WAL mode (no server needed, which suits single-node
+# deployments and the benchmark suites); anything else is handed to libpq as a
+# PostgreSQL DSN. Both backends create the same tables and indexes and run the
+# same SQL; the subclasses only supply connections and type conversions.
+#
+# psycopg2 is imported on first use, so SQLite-only processes never load it.
+#
+# Besides the whole-table load_* / save_* calls, the backends offer row-level
+# operations (get_license, add_license, bind_hwid, ...) that only touch the rows
+# involved, so concurrent purchases and HWID binds cannot overwrite each other.
+#
+# Licenses with several seats keep their first HWID in licenses.hwid and the
+# others in license_seats; see claim_seat().
+#
+# leader_lock() hands out the cluster-wide lock used by leader.py to elect the
+# single process that polls Telegram.
+#
+# validation_events (see validation_log.py) is partitioned by month on
+# PostgreSQL; SQLite keeps it in one table.
+#
+# open_storage() also accepts read replicas; see ReplicatedStorage.
+
+LICENSE_COLUMNS = ('license_key', 'username', 'hwid', 'expiry', 'active', 'tx_hash', 'product', 'is_trial', 'seats',
+                   'telegram_id')
+TRANSACTION_COLUMNS = ('license_key', 'username', 'product', 'product_file', 'pdf_file', 'is_trial', 'telegram_id',
+                       'file_sha256')
+PRODUCT_COLUMNS = ('id', 'name', 'file', 'is_trial', 'expiry_days', 'pricing_tiers', 'file_sha256')
+SEAT_COLUMNS = ('license_key', 'hwid')
+AUDIT_COLUMNS = ('created_at', 'actor', 'action', 'entity', 'before', 'after', 'message', 'source')
+VALIDATION_EVENT_COLUMNS = ('created_at', 'license_key', 'hwid_hash', 'ip', 'outcome', 'latency_ms')
+
+# Rows per round trip for bulk inserts
+BULK_CHUNK_SIZE = 50000
+# Rows fetched per round trip when streaming a table
+STREAM_BATCH_SIZE = 5000
+
+# Read replica routing (ReplicatedStorage)
+REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL', '5'))  # seconds between health checks
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', '10'))  # seconds of replay lag before a replica is skipped
+READ_YOUR_WRITES_WINDOW = float(os.getenv('READ_YOUR_WRITES_WINDOW', '5'))  # seconds reads stay on the primary after a write
+
+# PostgreSQL timeouts, so an unreachable or stuck server fails calls instead of
+# holding them (and the circuit breaker in database.py can open). The statement
+# timeout only applies inside statement_timeout(), which database.py enters for
+# the short calls of the request path: exports, bulk saves, schema changes,
+# rebalances and migrations run as long as they need.
+DB_CONNECT_TIMEOUT = int(os.getenv('DB_CONNECT_TIMEOUT', '5'))  # seconds
+DB_STATEMENT_TIMEOUT = float(os.getenv('DB_STATEMENT_TIMEOUT', '30'))  # seconds per statement, 0 for none
+
+_limits = threading.local()
+
+# Transactions begun on this thread inside the block cancel statements that run
+# longer than `seconds`
+@contextmanager
+def statement_timeout(seconds=DB_STATEMENT_TIMEOUT):
+    previous = getattr(_limits, 'statement_timeout', None)
+    _limits.statement_timeout = seconds
+    try:
+        yield
+    finally:
+        _limits.statement_timeout = previous
+
+def license_from_row(row):
+    license_key, username, hwid, expiry, active, tx_hash, product, is_trial, seats, telegram_id = row
+    return license_key, {
+        'username': username,
+        'hwid': hwid,
+        'expiry': expiry,
+        'active': bool(active),
+        'tx_hash': tx_hash,
+        'product': product,
+        'is_trial': bool(is_trial),
+        'seats': seats,
+        'telegram_id': telegram_id
+    }
+
+# telegram_id is the buyer's Telegram user id; licenses issued before it was
+# recorded have none
+def license_to_row(license_key, info):
+    return (license_key, info['username'], info['hwid'], info['expiry'], info['active'], info['tx_hash'], info['product'], info['is_trial'],
+            info.get('seats', 1), info.get('telegram_id'))
+
+def transaction_from_row(row):
+    license_key, username, product, product_file, pdf_file, is_trial, telegram_id, file_sha256 = row
+    return license_key, {
+        'username': username,
+        'product': product,
+        'product_file': product_file,
+        'pdf_file': pdf_file,
+        'is_trial': bool(is_trial),
+        'telegram_id': telegram_id,
+        'file_sha256': file_sha256
+    }
+
+# file_sha256 is the product file as sold (see file_store.py); product_file then
+# is only its name
+def transaction_to_row(license_key, info):
+    return (license_key, info['username'], info['product'], info['product_file'], info['pdf_file'], info['is_trial'],
+            info.get('telegram_id'), info.get('file_sha256'))
+
+# Raised by a shard asked to write a license whose bucket it does not own (any
+# more): the caller's shard map is stale
+class WrongShard(Exception):
+    pass
+
+class Storage:
+    placeholder = '%s'
+    # DDL run by init_schema(), one statement per entry
+    schema = ()
+    # Columns added after a table was first released, as (table, column, definition);
+    # init_schema() adds them to databases created by older versions
+    upgrades = ()
+    # DDL that depends on upgraded columns, run after them
+    indexes = ()
+    # SQL expression for the current time, used to stamp updated_at
+    now_sql = 'NOW()'
+    # Row locks on shard_buckets: shared by writers into a bucket, exclusive
+    # while a rebalance moves it
+    share_lock_sql = ' FOR SHARE'
+    update_lock_sql = ' FOR UPDATE'
+    # Taken by rebuild_active_licenses: blocks the increments of record_sale and
+    # the expiry sweeper, and other rebuilds
+    analytics_lock_sql = 'LOCK TABLE active_licenses IN SHARE ROW EXCLUSIVE MODE'
+
+    # --- connections (provided by the backends) ---------------------------
+
+    def _acquire(self):
+        raise NotImplementedError
+
+    def _release(self, conn):
+        pass
+
+    def _cursor(self, conn, stream):
+        return conn.cursor()
+
+    def _add_column(self, cur, table, column, definition):
+        raise NotImplementedError
+
+    def _begin(self, conn, write):
+        pass
+
+    def _json(self, value):
+        raise NotImplementedError
+
+    def _from_json(self, value):
+        raise NotImplementedError
+
+    def _timestamp(self, value):
+        return value
+
+    def _from_timestamp(self, value):
+        return value
+
+    def _insert_many(self, cur, table, columns, rows, suffix=''):
+        cur.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join([self.placeholder] * len(columns))}){suffix}",
+            rows
+        )
+
+    def _sql(self, query):
+        return query if self.placeholder == '%s' else query.replace('%s', self.placeholder)
+
+    # Yields a cursor inside a transaction that is committed on success and
+    # rolled back on error; pass write=False for read-only work and stream=True
+    # for a cursor that fetches large results incrementally
+    @contextmanager
+    def transaction(self, write=True, stream=False):
+        conn = self._acquire()
+        try:
+            cur = self._cursor(conn, stream)
+            self._begin(conn, write)
+            yield cur
+            cur.close()
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    def init_schema(self):
+        with self.transaction() as cur:
+            for statement in self.schema:
+                cur.execute(statement)
+            for table, column, definition in self.upgrades:
+                self._add_column(cur, table, column, definition)
+            for statement in self.indexes:
+                cur.execute(statement)
+            # Rows from before updated_at was added (SQLite adds it without a
+            # default) would never be picked up by an incremental export
+            for table, column, _ in self.upgrades:
+                if column == 'updated_at':
+                    cur.execute(f"UPDATE {table} SET updated_at = {self.now_sql} WHERE updated_at IS NULL")
+
+    # --- products -----------------------------------------------------------
+
+    def load_products(self):
+        with self.transaction(write=False) as cur:
+            return self._load_products(cur)
+
+    def _load_products(self, cur):
+        cur.execute(f"SELECT {', '.join(PRODUCT_COLUMNS)} FROM products")
+        products = {}
+        for product_id, name, file, is_trial, expiry_days, pricing_tiers, file_sha256 in cur.fetchall():
+            products[str(product_id)] = {
+                'name': name,
+                'file': file,
+                'is_trial': bool(is_trial),
+                'expiry_days': expiry_days,
+                'pricing_tiers': self._from_json(pricing_tiers) or {},
+                'file_sha256': file_sha256
+            }
+        return products
+
+    def save_products(self, products):
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM products")
+            self._insert_many(cur, 'products', PRODUCT_COLUMNS, [
+                (int(product_id), info['name'], info['file'], info.get('is_trial', False), info.get('expiry_days'),
+                 self._json(info.get('pricing_tiers') or {}), info.get('file_sha256'))
+                for product_id, info in products.items()
+            ])
+            self._bump_catalog_version(cur)
+
+    def delete_product(self, product_id):
+        with self.transaction() as cur:
+            cur.execute(self._sql("DELETE FROM products WHERE id = %s"), (int(product_id),))
+            self._bump_catalog_version(cur)
+
+    def _bump_catalog_version(self, cur):
+        cur.execute("INSERT INTO catalog_version (id, version) VALUES (1, 1) "
+                    "ON CONFLICT (id) DO UPDATE SET version = catalog_version.version + 1")
+
+    # 0 until the products are first written
+    def catalog_version(self):
+        with self.transaction(write=False) as cur:
+            return self._catalog_version(cur)
+
+    def _catalog_version(self, cur):
+        cur.execute("SELECT version FROM catalog_version")
+        row = cur.fetchone()
+        return row[0] if row else 0
+
+    # (version, products) read together, so the version always matches the products
+    def load_catalog(self):
+        with self.transaction(write=False) as cur:
+            return self._catalog_version(cur), self._load_products(cur)
+
+    # --- licenses -----------------------------------------------------------
+
+    def load_licenses(self):
+        with self.transaction(write=False) as cur:
+            cur.execute(f"SELECT {', '.join(LICENSE_COLUMNS)} FROM licenses")
+            rows = cur.fetchall()
+        return dict(license_from_row(row) for row in rows)
+
+    def get_license(self, license_key):
+        with self.transaction(write=False) as cur:
+            cur.execute(self._sql(f"SELECT {', '.join(LICENSE_COLUMNS)} FROM licenses WHERE license_key = %s"), (license_key,))
+            row = cur.fetchone()
+        return license_from_row(row)[1] if row else None
+
+    # get_license for many keys in few round trips: {license_key: license} of
+    # the keys that exist
+    def get_licenses(self, license_keys):
+        license_keys = list(license_keys)
+        licenses = {}
+        with self.transaction(write=False) as cur:
+            for start in range(0, len(license_keys), 500):
+                chunk = license_keys[start:start + 500]
+                cur.execute(self._sql(f"SELECT {', '.join(LICENSE_COLUMNS)} FROM licenses "
+                                      f"WHERE license_key IN ({', '.join(['%s'] * len(chunk))})"), tuple(chunk))
+                licenses.update(license_from_row(row) for row in cur.fetchall())
+        return licenses
+
+    # Licenses whose key starts with `term` or whose username is `term`,
+    # latest expiry first, as (license_key, license) pairs
+    def search_licenses(self, term, limit=20):
+        prefix = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        with self.transaction(write=False) as cur:
+            cur.execute(
+                self._sql(f"SELECT {', '.join(LICENSE_COLUMNS)} FROM licenses "
+                          "WHERE license_key LIKE %s ESCAPE '\\' OR username = %s "
+                          "ORDER BY expiry DESC, license_key LIMIT %s"),
+                (prefix, term, limit)
+            )
+            return [license_from_row(row) for row in cur.fetchall()]
+
+    # One page of a Telegram user's licenses, latest expiry first. `after` is the
+    # (expiry, license_key) of the last license of the previous page.
+    def licenses_of_user(self, telegram_id, after=None, limit=10):
+        query = f"SELECT {', '.join(LICENSE_COLUMNS)} FROM licenses WHERE telegram_id = %s"
+        params = (telegram_id,)
+        if after is not None:
+            query += " AND (expiry, license_key) < (%s, %s)"
+            params += tuple(after)
+        with self.transaction(write=False) as cur:
+            cur.execute(self._sql(query + " ORDER BY expiry DESC, license_key DESC LIMIT %s"), params + (limit,))
+            return [license_from_row(row) for row in cur.fetchall()]
+
+    def save_licenses(self, licenses):
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM licenses")
+            self._insert_many(cur, 'licenses', LICENSE_COLUMNS,
+                              [license_to_row(license_key, info) for license_key, info in licenses.items()])
+
+    # Insert a new license together with its transaction record; `bucket` makes
+    # a shard refuse the write unless it owns that bucket (see sharding.py)
+    def add_license(self, license_key, license, transaction, bucket=None):
+        with self.transaction() as cur:
+            if bucket is not None:
+                self._check_bucket(cur, bucket)
+            self._insert_many(cur, 'licenses', LICENSE_COLUMNS, [license_to_row(license_key, license)])
+            self._insert_many(cur, 'transactions', TRANSACTION_COLUMNS, [transaction_to_row(license_key, transaction)])
+
+    # Bind a HWID to a license that has none yet; returns False if the license
+    # is unknown or was already bound (possibly by a concurrent request)
+    def bind_hwid(self, license_key, hwid, bucket=None):
+        with self.transaction() as cur:
+            if bucket is not None:
+                self._check_bucket(cur, bucket)
+            cur.execute(
+                self._sql(f"UPDATE licenses SET hwid = %s, updated_at = {self.now_sql} "
+                          "WHERE license_key = %s AND (hwid IS NULL OR hwid = '')"),
+                (hwid, license_key)
+            )
+            return cur.rowcount == 1
+
+    # --- seats ----------------------------------------------------------------
+
+    # Whether `hwid` holds one of the extra seats of a license: a primary key
+    # probe, answered from the index alone however many seats the license has
+    def has_seat(self, license_key, hwid):
+        with self.transaction(write=False) as cur:
+            cur.execute(self._sql("SELECT 1 FROM license_seats WHERE license_key = %s AND hwid = %s"), (license_key, hwid))
+            return cur.fetchone() is not None
+
+    # Give `hwid` a seat of a license; True if it holds one afterwards. The
+    # first seat is licenses.hwid, the other seats - 1 are license_seats rows.
+    # Claims on one license queue on the lock of its row, so the conditional
+    # insert counts every seat committed before it and cannot overshoot.
+    def claim_seat(self, license_key, hwid, bucket=None):
+        with self.transaction() as cur:
+            if bucket is not None:
+                self._check_bucket(cur, bucket)
+            cur.execute(self._sql(f"SELECT hwid, seats FROM licenses WHERE license_key = %s{self.update_lock_sql}"),
+                        (license_key,))
+            row = cur.fetchone()
+            if row is None:
+                return False
+            first, seats = row
+            if first == hwid:
+                return True
+            if not first:
+                # The first seat was released: move the machine there
+                cur.execute(self._sql("DELETE FROM license_seats WHERE license_key = %s AND hwid = %s"), (license_key, hwid))
+                cur.execute(self._sql(f"UPDATE licenses SET hwid = %s, updated_at = {self.now_sql} WHERE license_key = %s"),
+                            (hwid, license_key))
+                return True
+            cur.execute(
+                self._sql("INSERT INTO license_seats (license_key, hwid) SELECT %s, %s "
+                          "WHERE (SELECT COUNT(*) FROM license_seats WHERE license_key = %s) < %s "
+                          "ON CONFLICT DO NOTHING"),
+                (license_key, hwid, license_key, seats - 1)
+            )
+            if cur.rowcount == 1:
+                # Seat changes stamp the license, which moves its seats in a rebalance
+                cur.execute(self._sql(f"UPDATE licenses SET updated_at = {self.now_sql} WHERE license_key = %s"), (license_key,))
+                return True
+            cur.execute(self._sql("SELECT 1 FROM license_seats WHERE license_key = %s AND hwid = %s"), (license_key, hwid))
+            return cur.fetchone() is not None
+
+    # Free the seat of `hwid`, or every seat when hwid is None; returns how
+    # many were freed
+    def release_seats(self, license_key, hwid=None, bucket=None):
+        with self.transaction() as cur:
+            if bucket is not None:
+                self._check_bucket(cur, bucket)
+            cur.execute(self._sql(f"SELECT hwid FROM licenses WHERE license_key = %s{self.update_lock_sql}"), (license_key,))
+            row = cur.fetchone()
+            if row is None:
+                return 0
+            first = row[0]
+            released = 0
+            if first and hwid in (None, first):
+                cur.execute(self._sql("UPDATE licenses SET hwid = '' WHERE license_key = %s"), (license_key,))
+                released += 1
+            if hwid is None:
+                cur.execute(self._sql("DELETE FROM license_seats WHERE license_key = %s"), (license_key,))
+            else:
+                cur.execute(self._sql("DELETE FROM license_seats WHERE license_key = %s AND hwid = %s"), (license_key, hwid))
+            released += max(cur.rowcount, 0)
+            if released:
+                cur.execute(self._sql(f"UPDATE licenses SET updated_at = {self.now_sql} WHERE license_key = %s"), (license_key,))
+            return released
+
+    # HWIDs holding seats of a license, the first seat first; None for an unknown license
+    def list_seats(self, license_key):
+        with self.transaction(write=False) as cur:
+            cur.execute(self._sql("SELECT hwid FROM licenses WHERE license_key = %s"), (license_key,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            cur.execute(self._sql("SELECT hwid FROM license_seats WHERE license_key = %s ORDER BY updated_at, hwid"), (license_key,))
+            return ([row[0]] if row[0] else []) + [hwid for hwid, in cur.fetchall()]
+
+    # Replace every license with `rows` (tuples in LICENSE_COLUMNS order) through
+    # the backend's fastest bulk path; used to seed benchmark databases
+    def replace_licenses(self, rows):
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM licenses")
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) >= BULK_CHUNK_SIZE:
+                    self._insert_many(cur, 'licenses', LICENSE_COLUMNS, chunk)
+                    chunk = []
+            if chunk:
+                self._insert_many(cur, 'licenses', LICENSE_COLUMNS, chunk)
+        with self.transaction() as cur:
+            cur.execute("ANALYZE licenses")
+
+    # --- transactions ---------------------------------------------------------
+
+    def load_transactions(self):
+        with self.transaction(write=False) as cur:
+            cur.execute(f"SELECT {', '.join(TRANSACTION_COLUMNS)} FROM transactions")
+            rows = cur.fetchall()
+        return dict(transaction_from_row(row) for row in rows)
+
+    def get_transaction(self, license_key):
+        with self.transaction(write=False) as cur:
+            cur.execute(self._sql(f"SELECT {', '.join(TRANSACTION_COLUMNS)} FROM transactions WHERE license_key = %s"), (license_key,))
+            row = cur.fetchone()
+        return transaction_from_row(row)[1] if row else None
+
+    def save_transactions(self, transactions):
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM transactions")
+            self._insert_many(cur, 'transactions', TRANSACTION_COLUMNS,
+                              [transaction_to_row(license_key, info) for license_key, info in transactions.items()])
+
+    # --- export -------------------------------------------------------------
+
+    # Yield (row, updated_at) for every row of `table` matching `where`, or only
+    # rows changed after `since`, without holding the result set in memory
+    def stream_rows(self, table, columns, where=None, since=None):
+        conditions = [where] if where else []
+        params = ()
+        if since is not None:
+            conditions.append("updated_at > %s")
+            params = (self._timestamp(since),)
+        query = f"SELECT {', '.join(columns)}, updated_at FROM {table}"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with self.transaction(write=False, stream=True) as cur:
+            cur.execute(self._sql(query), params)
+            while True:
+                rows = cur.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    return
+                for row in rows:
+                    yield row[:-1], self._from_timestamp(row[-1])
+
+    # --- admin audit log (see audit_log.py) -----------------------------------
+
+    def insert_audit_events(self, events):
+        with self.transaction() as cur:
+            self._insert_many(cur, 'admin_audit_log', AUDIT_COLUMNS, [
+                (self._timestamp(created_at), actor, action, entity,
+                 self._json(before) if before is not None else None,
+                 self._json(after) if after is not None else None,
+                 message, source)
+                for created_at, actor, action, entity, before, after, message, source in events
+            ])
+
+    def audit_history(self, entity=None, limit=20):
+        with self.transaction(write=False) as cur:
+            if entity:
+                cur.execute(
+                    self._sql("""
+                    SELECT created_at, actor, action, entity, before, after, message FROM admin_audit_log
+                    WHERE entity = %s ORDER BY id DESC LIMIT %s
+                    """),
+                    (entity, limit)
+                )
+            else:
+                cur.execute(
+                    self._sql("""
+                    SELECT created_at, actor, action, entity, before, after, message FROM admin_audit_log
+                    ORDER BY id DESC LIMIT %s
+                    """),
+                    (limit,)
+                )
+            rows = cur.fetchall()
+        return [
+            {'created_at': self._from_timestamp(created_at), 'actor': actor, 'action': action, 'entity': entity,
+             'before': self._from_json(before), 'after': self._from_json(after), 'message': message}
+            for created_at, actor, action, entity, before, after, message in rows
+        ]
+
+    def count_audit_events(self, source):
+        with self.transaction(write=False) as cur:
+            cur.execute(self._sql("SELECT COUNT(*) FROM admin_audit_log WHERE source = %s"), (source,))
+            return cur.fetchone()[0]
+
+    # --- analytics rollups (see analytics.py) ---------------------------------
+
+    # One license sold (or trial claimed) on `day`; also counts it as active
+    def record_sale(self, day, product, tier, revenue_usd, revenue_xlm):
+        with self.transaction() as cur:
+            cur.execute(
+                self._sql("""
+                INSERT INTO sales_daily (day, product, tier, licenses, revenue_usd, revenue_xlm) VALUES (%s, %s, %s, 1, %s, %s)
+                ON CONFLICT (day, product, tier) DO UPDATE SET licenses = sales_daily.licenses + 1,
+                    revenue_usd = sales_daily.revenue_usd + EXCLUDED.revenue_usd,
+                    revenue_xlm = sales_daily.revenue_xlm + EXCLUDED.revenue_xlm
+                """),
+                (day, product, tier, revenue_usd, revenue_xlm)
+            )
+            cur.execute(
+                self._sql("""
+                INSERT INTO active_licenses (product, licenses) VALUES (%s, 1)
+                ON CONFLICT (product) DO UPDATE SET licenses = active_licenses.licenses + 1
+                """),
+                (product,)
+            )
+
+    # Adds (day, product, validations, refused) counts
+    def add_usage(self, rows):
+        with self.transaction() as cur:
+            self._insert_many(cur, 'usage_daily', ('day', 'product', 'validations', 'refused'), rows,
+                              suffix=" ON CONFLICT (day, product) DO UPDATE SET "
+                                     "validations = usage_daily.validations + EXCLUDED.validations, "
+                                     "refused = usage_daily.refused + EXCLUDED.refused")
+
+    # Last expiry date the sweeper has counted, or None before the first sweep
+    def expiry_swept_through(self):
+        with self.transaction(write=False) as cur:
+            cur.execute("SELECT value FROM analytics_state WHERE name = 'expiry_swept_through'")
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    # Moves the sweep watermark from `previous` to `through` and counts the
+    # licenses that expired in between ({(day, product): count}), then snapshots
+    # the active counts for `through`. False (and nothing written) if another
+    # sweeper moved the watermark first.
+    def apply_expiry_sweep(self, previous, through, expired):
+        with self.transaction() as cur:
+            cur.execute(self._sql("UPDATE analytics_state SET value = %s WHERE name = 'expiry_swept_through' AND value = %s"),
+                        (through, previous))
+            if cur.rowcount != 1:
+                return False
+            self._insert_many(cur, 'usage_daily', ('day', 'product', 'expired'),
+                              [(day, product, count) for (day, product), count in sorted(expired.items())],
+                              suffix=" ON CONFLICT (day, product) DO UPDATE SET expired = usage_daily.expired + EXCLUDED.expired")
+            removed = {}
+            for (_, product), count in expired.items():
+                removed[product] = removed.get(product, 0) + count
+            self._insert_many(cur, 'active_licenses', ('product', 'licenses'),
+                              [(product, -count) for product, count in sorted(removed.items())],
+                              suffix=" ON CONFLICT (product) DO UPDATE SET licenses = active_licenses.licenses + EXCLUDED.licenses")
+            self._snapshot_active(cur, through)
+        return True
+
+    # Recounts the active licenses (valid after `through`) and restarts the sweep
+    # from `through`, all in one transaction that holds off record_sale and
+    # sweeps until it commits; returns {product: count}. The licenses are
+    # counted with INSERT ... SELECT, or by `count()` when they live in other
+    # databases (ShardedStorage).
+    def rebuild_active_licenses(self, through, count=None):
+        with self.transaction() as cur:
+            if self.analytics_lock_sql:
+                cur.execute(self.analytics_lock_sql)
+            cur.execute("DELETE FROM active_licenses")
+            if count is None:
+                cur.execute(
+                    self._sql("INSERT INTO active_licenses (product, licenses) SELECT product, COUNT(*) FROM licenses "
+                              "WHERE active = TRUE AND expiry > %s GROUP BY product"),
+                    (through,)
+                )
+            else:
+                self._insert_many(cur, 'active_licenses', ('product', 'licenses'), sorted(count().items()))
+            cur.execute("DELETE FROM analytics_state WHERE name = 'expiry_swept_through'")
+            cur.execute(self._sql("INSERT INTO analytics_state (name, value) VALUES ('expiry_swept_through', %s)"), (through,))
+            self._snapshot_active(cur, through)
+            cur.execute("SELECT product, licenses FROM active_licenses")
+            return dict(cur.fetchall())
+
+    def _snapshot_active(self, cur, day):
+        cur.execute(
+            self._sql("""
+            INSERT INTO usage_daily (day, product, active) SELECT %s, product, licenses FROM active_licenses WHERE TRUE
+            ON CONFLICT (day, product) DO UPDATE SET active = EXCLUDED.active
+            """),
+            (day,)
+        )
+
+    # Rollup rows of the days first..last (inclusive); revenue comes back as float
+    def sales_rollup(self, first, last):
+        with self.transaction(write=False) as cur:
+            cur.execute(
+                self._sql("SELECT day, product, tier, licenses, revenue_usd, revenue_xlm FROM sales_daily "
+                          "WHERE day >= %s AND day <= %s ORDER BY day, product, tier"),
+                (first, last)
+            )
+            return [(day, product, tier, licenses, float(usd), float(xlm))
+                    for day, product, tier, licenses, usd, xlm in cur.fetchall()]
+
+    def usage_rollup(self, first, last):
+        with self.transaction(write=False) as cur:
+            cur.execute(
+                self._sql("SELECT day, product, validations, refused, expired, active FROM usage_daily "
+                          "WHERE day >= %s AND day <= %s ORDER BY day, product"),
+                (first, last)
+            )
+            return cur.fetchall()
+
+    def active_license_counts(self):
+        with self.transaction(write=False) as cur:
+            cur.execute("SELECT product, licenses FROM active_licenses")
+            return dict(cur.fetchall())
+
+    # --- validation events (see validation_log.py) ---------------------------
+
+    # Creates the partitions of the given months (dates of their first day);
+    # only PostgreSQL partitions the table
+    def ensure_validation_partitions(self, months):
+        pass
+
+    def insert_validation_events(self, events):
+        with self.transaction() as cur:
+            self._insert_many(cur, 'validation_events', VALIDATION_EVENT_COLUMNS,
+                              [(self._timestamp(created_at),) + tuple(rest) for created_at, *rest in events])
+
+    # Removes the events recorded before `cutoff`
+    def drop_validation_events(self, cutoff):
+        with self.transaction() as cur:
+            cur.execute(self._sql("DELETE FROM validation_events WHERE created_at < %s"), (self._timestamp(cutoff),))
+            if cur.rowcount > 0:
+                logger.info("Deleted %d validation events recorded before %s", cur.rowcount, cutoff)
+
+    # Latest validations of a license, newest first
+    def validation_events(self, license_key, limit=20):
+        with self.transaction(write=False) as cur:
+            cur.execute(
+                self._sql("SELECT created_at, hwid_hash, ip, outcome, latency_ms FROM validation_events "
+                          "WHERE license_key = %s ORDER BY created_at DESC LIMIT %s"),
+                (license_key, limit)
+            )
+            rows = cur.fetchall()
+        return [{'created_at': self._from_timestamp(created_at), 'hwid_hash': hwid_hash, 'ip': ip, 'outcome': outcome,
+                 'latency_ms': latency_ms}
+                for created_at, hwid_hash, ip, outcome, latency_ms in rows]
+
+    # Validations of a license since `since`: their number per outcome and the
+    # distinct machines and addresses they came from
+    def validation_summary(self, license_key, since):
+        with self.transaction(write=False) as cur:
+            cur.execute(
+                self._sql("SELECT outcome, COUNT(*) FROM validation_events WHERE license_key = %s AND created_at >= %s "
+                          "GROUP BY outcome"),
+                (license_key, self._timestamp(since))
+            )
+            outcomes = dict(cur.fetchall())
+            cur.execute(
+                self._sql("SELECT COUNT(DISTINCT hwid_hash), COUNT(DISTINCT ip) FROM validation_events "
+                          "WHERE license_key = %s AND created_at >= %s"),
+                (license_key, self._timestamp(since))
+            )
+            hwids, ips = cur.fetchone()
+        return {'outcomes': outcomes, 'hwids': hwids, 'ips': ips}
+
+    # (license_key, machines, addresses, validations) of the licenses validated
+    # from at least `min_hwids` machines since `since`, most machines first
+    def shared_licenses(self, since, min_hwids=2, limit=50):
+        with self.transaction(write=False) as cur:
+            cur.execute(
+                self._sql("""
+                SELECT license_key, COUNT(DISTINCT hwid_hash), COUNT(DISTINCT ip), COUNT(*) FROM validation_events
+                WHERE created_at >= %s AND license_key IS NOT NULL GROUP BY license_key
+                HAVING COUNT(DISTINCT hwid_hash) >= %s ORDER BY 2 DESC, 3 DESC, 1 LIMIT %s
+                """),
+                (self._timestamp(since), min_hwids, limit)
+            )
+            return cur.fetchall()
+
+    # Seconds this database lags behind its primary (0 for a primary); raises if
+    # the database cannot be reached
+    def replication_lag(self):
+        with self.transaction(write=False) as cur:
+            cur.execute("SELECT 1")
+        return 0.0
+
+    # --- sharding (see sharding.py) -----------------------------------------
+
+    # Latest (version, shard_count, assignment) of the shard map, or None
+    def load_shard_map(self):
+        with self.transaction(write=False) as cur:
+            cur.execute("SELECT version, shard_count, assignment FROM shard_map ORDER BY version DESC LIMIT 1")
+            row = cur.fetchone()
+        return (row[0], row[1], json.loads(row[2])) if row else None
+
+    # Versions are unique, so of two rebalancers publishing at once one fails
+    def save_shard_map(self, version, shard_count, assignment):
+        with self.transaction() as cur:
+            cur.execute(self._sql("INSERT INTO shard_map (version, shard_count, assignment) VALUES (%s, %s, %s)"),
+                        (version, shard_count, json.dumps(assignment)))
+
+    # Position of this database in DATABASE_SHARD_URLS, recorded when the shard
+    # was first used so a reordered list is caught instead of misrouting keys
+    def shard_identity(self):
+        with self.transaction(write=False) as cur:
+            cur.execute("SELECT shard FROM shard_identity")
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    def set_shard_identity(self, shard):
+        with self.transaction() as cur:
+            cur.execute("DELETE FROM shard_identity")
+            cur.execute(self._sql("INSERT INTO shard_identity (shard) VALUES (%s)"), (shard,))
+
+    def owned_buckets(self):
+        with self.transaction(write=False) as cur:
+            cur.execute("SELECT bucket FROM shard_buckets")
+            return {row[0] for row in cur.fetchall()}
+
+    def claim_buckets(self, buckets):
+        with self.transaction() as cur:
+            self._insert_many(cur, 'shard_buckets', ('bucket',), [(bucket,) for bucket in buckets],
+                              suffix=" ON CONFLICT DO NOTHING")
+
+    # Blocks writes into `buckets` until the caller's transaction ends (writers
+    # hold share locks on the same rows, see _check_bucket)
+    def lock_buckets(self, cur, buckets):
+        cur.execute(self._sql(f"SELECT bucket FROM shard_buckets WHERE bucket IN ({', '.join(['%s'] * len(buckets))})"
+                              f"{self.update_lock_sql}"), tuple(buckets))
+
+    def release_buckets(self, cur, buckets):
+        cur.execute(self._sql(f"DELETE FROM shard_buckets WHERE bucket IN ({', '.join(['%s'] * len(buckets))})"),
+                    tuple(buckets))
+
+    def _check_bucket(self, cur, bucket):
+        cur.execute(self._sql(f"SELECT bucket FROM shard_buckets WHERE bucket = %s{self.share_lock_sql}"), (bucket,))
+        if cur.fetchone() is None:
+            raise WrongShard(bucket)
+
+    # Insert or overwrite (row, updated_at) pairs from stream_rows() of another
+    # shard, keeping their updated_at; `keys` is the table's primary key
+    def upsert_rows(self, table, columns, rows, keys=('license_key',)):
+        columns = tuple(columns) + ('updated_at',)
+        updates = ', '.join(f"{column} = excluded.{column}" for column in columns if column not in keys)
+        with self.transaction() as cur:
+            self._insert_many(cur, table, columns,
+                              [tuple(row) + (self._timestamp(updated_at),) for row, updated_at in rows],
+                              suffix=f" ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {updates}")
+
+    # (row, updated_at) of rows changed after `since`, read on the caller's
+    # cursor so a rebalance sees them while it holds the bucket locks
+    def changed_rows(self, cur, table, columns, since):
+        cur.execute(self._sql(f"SELECT {', '.join(columns)}, updated_at FROM {table} WHERE updated_at > %s"),
+                    (self._timestamp(since),))
+        return [(row[:-1], self._from_timestamp(row[-1])) for row in cur.fetchall()]
+
+    # (row, updated_at) of every row of the given licenses, read on the caller's cursor
+    def rows_for_keys(self, cur, table, columns, license_keys):
+        license_keys = list(license_keys)
+        rows = []
+        for start in range(0, len(license_keys), 500):
+            chunk = license_keys[start:start + 500]
+            cur.execute(self._sql(f"SELECT {', '.join(columns)}, updated_at FROM {table} "
+                                  f"WHERE license_key IN ({', '.join(['%s'] * len(chunk))})"), tuple(chunk))
+            rows.extend((row[:-1], self._from_timestamp(row[-1])) for row in cur.fetchall())
+        return rows
+
+    def delete_rows(self, table, license_keys):
+        license_keys = list(license_keys)
+        with self.transaction() as cur:
+            for start in range(0, len(license_keys), 500):
+                chunk = license_keys[start:start + 500]
+                cur.execute(self._sql(f"DELETE FROM {table} WHERE license_key IN ({', '.join(['%s'] * len(chunk))})"),
+                            tuple(chunk))
+
+    # Current time on this database's clock, for watermarks compared with updated_at
+    def now(self):
+        with self.transaction(write=False) as cur:
+            cur.execute(f"SELECT {self.now_sql}")
+            return self._from_timestamp(cur.fetchone()[0])
+
+    # --- leader election -------------------------------------------------
+
+    # A non-blocking lock shared by every process using this database, released
+    # by the database or the OS as soon as its holder dies
+    def leader_lock(self, lock_id):
+        raise NotImplementedError
+
+# Advisory lock key held while creating the schema, so workers starting at the
+# same time do not deadlock on the DDL
+SCHEMA_LOCK_ID = 7427000
+# Held while validation_events partitions are created or dropped (leader.py and
+# rebalance_shards.py use 7427001 and 7427002)
+PARTITION_LOCK_ID = 7427003
+
+# Session-level advisory lock on a dedicated autocommit connection. PostgreSQL
+# drops it when that connection ends, so a crashed leader frees it at once; TCP
+# keepalives bound how long a vanished host can keep it. Needs a direct or
+# session-pooled connection: a transaction-pooling proxy would hand the session
+# (and the lock) to someone else.
+class PostgresLeaderLock:
+    def __init__(self, dsn, lock_id):
+        self.dsn = dsn
+        self.lock_id = lock_id
+        self._conn = None
+
+    def acquire(self):
+        import psycopg2
+        if self._conn is None:
+            self._conn = psycopg2.connect(self.dsn, connect_timeout=5, keepalives=1,
+                                          keepalives_idle=5, keepalives_interval=2, keepalives_count=3)
+            self._conn.autocommit = True
+        try:
+            with self._conn.cursor() as cur:
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (self.lock_id,))
+                return cur.fetchone()[0]
+        except psycopg2.Error:
+            self.release()
+            raise
+
+    # False once the session holding the lock is gone
+    def held(self):
+        import psycopg2
+        if self._conn is None:
+            return False
+        try:
+            with self._conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            self.release()
+            return False
+
+    def release(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            finally:
+                self._conn = None
+
+# A value in COPY's text format; None is NULL
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+class PostgresStorage(Storage):
+    schema = (
+        f"SELECT pg_advisory_xact_lock({SCHEMA_LOCK_ID})",
+        """
+        CREATE TABLE IF NOT EXISTS products (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL,
+            file TEXT NOT NULL,
+            is_trial BOOLEAN DEFAULT FALSE,
+            expiry_days INTEGER,
+            pricing_tiers JSONB,
+            file_sha256 TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS licenses (
+            license_key TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            hwid TEXT,
+            expiry TEXT NOT NULL,
+            active BOOLEAN DEFAULT TRUE,
+            tx_hash TEXT,
+            product TEXT NOT NULL,
+            is_trial BOOLEAN DEFAULT FALSE,
+            updated_at TIMESTAMP DEFAULT NOW(),
+            seats INTEGER NOT NULL DEFAULT 1,
+            telegram_id BIGINT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            license_key TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            product TEXT NOT NULL,
+            product_file TEXT NOT NULL,
+            pdf_file TEXT NOT NULL,
+            is_trial BOOLEAN DEFAULT FALSE,
+            updated_at TIMESTAMP DEFAULT NOW(),
+            telegram_id BIGINT,
+            file_sha256 TEXT
+        )
+        """,
+        # Extra seats of multi-seat licenses; the primary key answers seat lookups
+        """
+        CREATE TABLE IF NOT EXISTS license_seats (
+            license_key TEXT NOT NULL,
+            hwid TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (license_key, hwid)
+        )
+        """,
+        # Append-only audit table. UPDATE and DELETE are rejected by a trigger so
+        # rows can only ever be added; history lookups use the (entity, id) index.
+        """
+        CREATE TABLE IF NOT EXISTS admin_audit_log (
+            id BIGSERIAL PRIMARY KEY,
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            actor BIGINT NOT NULL,
+            action TEXT NOT NULL,
+            entity TEXT,
+            before JSONB,
+            after JSONB,
+            message TEXT,
+            source TEXT NOT NULL DEFAULT 'bot'
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS admin_audit_log_entity_idx ON admin_audit_log (entity, id DESC)",
+        """
+        CREATE OR REPLACE FUNCTION admin_audit_log_append_only() RETURNS trigger AS $$
+        BEGIN
+            RAISE EXCEPTION 'admin_audit_log is append-only';
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'admin_audit_log_append_only') THEN
+                CREATE TRIGGER admin_audit_log_append_only BEFORE UPDATE OR DELETE ON admin_audit_log
+                    FOR EACH ROW EXECUTE PROCEDURE admin_audit_log_append_only();
+            END IF;
+        END;
+        $$
+        """,
+        # Sharding bookkeeping (see sharding.py): the versioned bucket -> shard map
+        # lives in the main database, bucket ownership in every shard
+        """
+        CREATE TABLE IF NOT EXISTS shard_map (
+            version INTEGER PRIMARY KEY,
+            shard_count INTEGER NOT NULL,
+            assignment TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE TABLE IF NOT EXISTS shard_buckets (bucket INTEGER PRIMARY KEY)",
+        "CREATE TABLE IF NOT EXISTS shard_identity (shard INTEGER NOT NULL)",
+        # Bumped by every products write, so bots notice catalog changes made elsewhere
+        "CREATE TABLE IF NOT EXISTS catalog_version (id INTEGER PRIMARY KEY CHECK (id = 1), version BIGINT NOT NULL)",
+        # Rollups for /admin_stats (see analytics.py), one row per day (YYYY-MM-DD)
+        # and product; the expiry index serves the expiry sweeper's range scans
+        """
+        CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT NOT NULL,
+            product TEXT NOT NULL,
+            tier TEXT NOT NULL,
+            licenses INTEGER NOT NULL DEFAULT 0,
+            revenue_usd NUMERIC NOT NULL DEFAULT 0,
+            revenue_xlm NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product, tier)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            day TEXT NOT NULL,
+            product TEXT NOT NULL,
+            validations INTEGER NOT NULL DEFAULT 0,
+            refused INTEGER NOT NULL DEFAULT 0,
+            expired INTEGER NOT NULL DEFAULT 0,
+            active INTEGER,
+            PRIMARY KEY (day, product)
+        )
+        """,
+        "CREATE TABLE IF NOT EXISTS active_licenses (product TEXT PRIMARY KEY, licenses INTEGER NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS analytics_state (name TEXT PRIMARY KEY, value TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS licenses_expiry_idx ON licenses (expiry)",
+        # Validation events (see validation_log.py), one partition per month
+        # (validation_events_YYYY_MM), created as events arrive and dropped whole
+        # after the retention period. Rows are appended in time order, so a BRIN
+        # index covers time ranges at a fraction of a B-tree's size.
+        """
+        CREATE TABLE IF NOT EXISTS validation_events (
+            created_at TIMESTAMP NOT NULL,
+            license_key TEXT,
+            hwid_hash TEXT,
+            ip TEXT,
+            outcome TEXT NOT NULL,
+            latency_ms REAL
+        ) PARTITION BY RANGE (created_at)
+        """,
+        "CREATE INDEX IF NOT EXISTS validation_events_license_key_idx ON validation_events (license_key, created_at)",
+        "CREATE INDEX IF NOT EXISTS validation_events_created_at_idx ON validation_events USING BRIN (created_at)",
+    )
+    # updated_at is the watermark for incremental exports; seats the number of
+    # machines a license may run on; telegram_id the buyer, for /mylicenses;
+    # file_sha256 the product file in the content-addressed file store
+    upgrades = (
+        ('licenses', 'updated_at', 'TIMESTAMP DEFAULT NOW()'),
+        ('transactions', 'updated_at', 'TIMESTAMP DEFAULT NOW()'),
+        ('licenses', 'seats', 'INTEGER NOT NULL DEFAULT 1'),
+        ('licenses', 'telegram_id', 'BIGINT'),
+        ('transactions', 'telegram_id', 'BIGINT'),
+        ('products', 'file_sha256', 'TEXT'),
+        ('transactions', 'file_sha256', 'TEXT'),
+    )
+    # The (telegram_id, expiry, license_key) index serves a page of
+    # licenses_of_user() in key order, without a sort
+    indexes = (
+        "CREATE INDEX IF NOT EXISTS licenses_updated_at_idx ON licenses (updated_at)",
+        "CREATE INDEX IF NOT EXISTS transactions_updated_at_idx ON transactions (updated_at)",
+        "CREATE INDEX IF NOT EXISTS licenses_telegram_id_idx ON licenses (telegram_id, expiry, license_key)",
+        "CREATE INDEX IF NOT EXISTS transactions_telegram_id_idx ON transactions (telegram_id)",
+    )
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.connect_args = {'connect_timeout': DB_CONNECT_TIMEOUT}
+        from psycopg2.extensions import parse_dsn
+        # A DSN that sets its own statement_timeout keeps it on the request path too
+        self.own_statement_timeout = 'statement_timeout' in parse_dsn(dsn or '').get('options', '')
+
+    def _acquire(self):
+        import psycopg2
+        return psycopg2.connect(self.dsn, **self.connect_args)
+
+    def _release(self, conn):
+        conn.close()
+
+    # SET LOCAL ends with the transaction, so the connection carries no limit
+    # into work outside statement_timeout()
+    def _begin(self, conn, write):
+        timeout = getattr(_limits, 'statement_timeout', None)
+        if timeout and not self.own_statement_timeout:
+            with conn.cursor() as cur:
+                cur.execute("SET LOCAL statement_timeout = %s", (int(timeout * 1000),))
+
+    # Named cursors are server-side: rows arrive in batches of itersize
+    def _cursor(self, conn, stream):
+        if not stream:
+            return conn.cursor()
+        cur = conn.cursor(name=f"stream_{os.getpid()}_{threading.get_ident()}")
+        cur.itersize = STREAM_BATCH_SIZE
+        return cur
+
+    def _add_column(self, cur, table, column, definition):
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}")
+
+    def _json(self, value):
+        from psycopg2.extras import Json
+        return Json(value)
+
+    def _from_json(self, value):
+        return value
+
+    def leader_lock(self, lock_id):
+        return PostgresLeaderLock(self.dsn, lock_id)
+
+    # NOW() is a timestamptz; updated_at holds local time without a zone
+    def now(self):
+        with self.transaction(write=False) as cur:
+            cur.execute("SELECT LOCALTIMESTAMP")
+            return cur.fetchone()[0]
+
+    # Zero when everything received has been replayed, so an idle primary does
+    # not make its standbys look stale
+    def replication_lag(self):
+        with self.transaction(write=False) as cur:
+            cur.execute(
+                "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                "ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0) END"
+            )
+            return float(cur.fetchone()[0])
+
+    def _insert_many(self, cur, table, columns, rows, suffix=''):
+        from psycopg2.extras import execute_values
+        execute_values(cur, f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s{suffix}", rows, page_size=1000)
+
+    # Partitions are named after their month and created under an advisory lock,
+    # as concurrent CREATE TABLE ... PARTITION OF statements can fail each other
+    def ensure_validation_partitions(self, months):
+        with self.transaction() as cur:
+            cur.execute(f"SELECT pg_advisory_xact_lock({PARTITION_LOCK_ID})")
+            for month in sorted(set(months)):
+                following = (month + timedelta(days=32)).replace(day=1)
+                cur.execute(f"CREATE TABLE IF NOT EXISTS validation_events_{month:%Y_%m} PARTITION OF validation_events "
+                            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')")
+
+    def insert_validation_events(self, events):
+        buffer = io.StringIO()
+        for event in events:
+            buffer.write("\t".join(copy_value(value) for value in event) + "\n")
+        buffer.seek(0)
+        with self.transaction() as cur:
+            cur.copy_expert(f"COPY validation_events ({', '.join(VALIDATION_EVENT_COLUMNS)}) FROM STDIN", buffer)
+
+    # Drops the monthly partitions that end at or before `cutoff`
+    def drop_validation_events(self, cutoff):
+        with self.transaction() as cur:
+            cur.execute(f"SELECT pg_advisory_xact_lock({PARTITION_LOCK_ID})")
+            cur.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                        "WHERE i.inhparent = 'validation_events'::regclass")
+            for (name,) in cur.fetchall():
+                month = re.fullmatch(r'validation_events_(\d{4})_(\d{2})', name)
+                if month is None:
+                    continue
+                first = datetime(int(month.group(1)), int(month.group(2)), 1)
+                if (first + timedelta(days=32)).replace(day=1) <= cutoff:
+                    cur.execute(f"DROP TABLE {name}")
+                    logger.info("Dropped validation event partition %s", name)
+
+    # COPY is an order of magnitude faster than INSERT for large seeds
+    def replace_licenses(self, rows):
+        with self.transaction() as cur:
+            cur.execute("TRUNCATE licenses")
+            buffer = io.StringIO()
+            for count, row in enumerate(rows, 1):
+                buffer.write("\t".join(copy_value(value) for value in row) + "\n")
+                if count % BULK_CHUNK_SIZE == 0:
+                    buffer.seek(0)
+                    cur.copy_expert(f"COPY licenses ({', '.join(LICENSE_COLUMNS)}) FROM STDIN", buffer)
+                    buffer = io.StringIO()
+            buffer.seek(0)
+            cur.copy_expert(f"COPY licenses ({', '.join(LICENSE_COLUMNS)}) FROM STDIN", buffer)
+        with self.transaction() as cur:
+            cur.execute("ANALYZE licenses")
+
+# flock() on a file next to the database; the kernel releases it when the holding
+# process exits, however it exits. Only processes on the same host can compete,
+# which is all an embedded database supports anyway.
+class FileLeaderLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def held(self):
+        return self._file is not None
+
+    def release(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            finally:
+                self._file = None
+
+class SQLiteStorage(Storage):
+    placeholder = '?'
+    schema = (
+        """
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            file TEXT NOT NULL,
+            is_trial BOOLEAN DEFAULT FALSE,
+            expiry_days INTEGER,
+            pricing_tiers TEXT,
+            file_sha256 TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS licenses (
+            license_key TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            hwid TEXT,
+            expiry TEXT NOT NULL,
+            active BOOLEAN DEFAULT TRUE,
+            tx_hash TEXT,
+            product TEXT NOT NULL,
+            is_trial BOOLEAN DEFAULT FALSE,
+            updated_at TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+            seats INTEGER NOT NULL DEFAULT 1,
+            telegram_id INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            license_key TEXT PRIMARY KEY,
+            username TEXT NOT NULL,
+            product TEXT NOT NULL,
+            product_file TEXT NOT NULL,
+            pdf_file TEXT NOT NULL,
+            is_trial BOOLEAN DEFAULT FALSE,
+            updated_at TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+            telegram_id INTEGER,
+            file_sha256 TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS license_seats (
+            license_key TEXT NOT NULL,
+            hwid TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+            PRIMARY KEY (license_key, hwid)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS admin_audit_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            actor INTEGER NOT NULL,
+            action TEXT NOT NULL,
+            entity TEXT,
+            before TEXT,
+            after TEXT,
+            message TEXT,
+            source TEXT NOT NULL DEFAULT 'bot'
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS admin_audit_log_entity_idx ON admin_audit_log (entity, id DESC)",
+        """
+        CREATE TRIGGER IF NOT EXISTS admin_audit_log_no_update BEFORE UPDATE ON admin_audit_log
+        BEGIN SELECT RAISE(ABORT, 'admin_audit_log is append-only'); END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS admin_audit_log_no_delete BEFORE DELETE ON admin_audit_log
+        BEGIN SELECT RAISE(ABORT, 'admin_audit_log is append-only'); END
+        """,
+        # Sharding bookkeeping (see sharding.py): the versioned bucket -> shard map
+        # lives in the main database, bucket ownership in every shard
+        """
+        CREATE TABLE IF NOT EXISTS shard_map (
+            version INTEGER PRIMARY KEY,
+            shard_count INTEGER NOT NULL,
+            assignment TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE TABLE IF NOT EXISTS shard_buckets (bucket INTEGER PRIMARY KEY)",
+        "CREATE TABLE IF NOT EXISTS shard_identity (shard INTEGER NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS catalog_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)",
+        # Rollups for /admin_stats (see analytics.py), one row per day (YYYY-MM-DD)
+        # and product; the expiry index serves the expiry sweeper's range scans
+        """
+        CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT NOT NULL,
+            product TEXT NOT NULL,
+            tier TEXT NOT NULL,
+            licenses INTEGER NOT NULL DEFAULT 0,
+            revenue_usd NUMERIC NOT NULL DEFAULT 0,
+            revenue_xlm NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product, tier)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS usage_daily (
+            day TEXT NOT NULL,
+            product TEXT NOT NULL,
+            validations INTEGER NOT NULL DEFAULT 0,
+            refused INTEGER NOT NULL DEFAULT 0,
+            expired INTEGER NOT NULL DEFAULT 0,
+            active INTEGER,
+            PRIMARY KEY (day, product)
+        )
+        """,
+        "CREATE TABLE IF NOT EXISTS active_licenses (product TEXT PRIMARY KEY, licenses INTEGER NOT NULL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS analytics_state (name TEXT PRIMARY KEY, value TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS licenses_expiry_idx ON licenses (expiry)",
+        """
+        CREATE TABLE IF NOT EXISTS validation_events (
+            created_at TIMESTAMP NOT NULL,
+            license_key TEXT,
+            hwid_hash TEXT,
+            ip TEXT,
+            outcome TEXT NOT NULL,
+            latency_ms REAL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS validation_events_license_key_idx ON validation_events (license_key, created_at)",
+        "CREATE INDEX IF NOT EXISTS validation_events_created_at_idx ON validation_events (created_at)",
+    )
+    # SQLite cannot add a column with a non-constant default, so upgraded tables
+    # get their updated_at stamped by a trigger instead
+    upgrades = (
+        ('licenses', 'updated_at', 'TIMESTAMP'),
+        ('transactions', 'updated_at', 'TIMESTAMP'),
+        ('licenses', 'seats', 'INTEGER NOT NULL DEFAULT 1'),
+        ('licenses', 'telegram_id', 'INTEGER'),
+        ('transactions', 'telegram_id', 'INTEGER'),
+        ('products', 'file_sha256', 'TEXT'),
+        ('transactions', 'file_sha256', 'TEXT'),
+    )
+    indexes = (
+        "CREATE INDEX IF NOT EXISTS licenses_updated_at_idx ON licenses (updated_at)",
+        "CREATE INDEX IF NOT EXISTS transactions_updated_at_idx ON transactions (updated_at)",
+        "CREATE INDEX IF NOT EXISTS licenses_telegram_id_idx ON licenses (telegram_id, expiry, license_key)",
+        "CREATE INDEX IF NOT EXISTS transactions_telegram_id_idx ON transactions (telegram_id)",
+        """
+        CREATE TRIGGER IF NOT EXISTS licenses_stamp_updated_at AFTER INSERT ON licenses WHEN NEW.updated_at IS NULL
+        BEGIN UPDATE licenses SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE rowid = NEW.rowid; END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS transactions_stamp_updated_at AFTER INSERT ON transactions WHEN NEW.updated_at IS NULL
+        BEGIN UPDATE transactions SET updated_at = strftime('%Y-%m-%d %H:%M:%f', 'now') WHERE rowid = NEW.rowid; END
+        """,
+    )
+    now_sql = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+    # Write transactions already hold the database lock (BEGIN IMMEDIATE)
+    share_lock_sql = ''
+    update_lock_sql = ''
+    analytics_lock_sql = ''
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    # One connection per thread and process, kept open so SQLite's per-connection
+    # statement cache turns the fixed queries above into prepared statements
+    def _acquire(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    # Writers take the database lock up front instead of upgrading a read lock,
+    # which would fail with "database is locked" under concurrency
+    def _begin(self, conn, write):
+        conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+
+    def _add_column(self, cur, table, column, definition):
+        cur.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in cur.fetchall()]:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+    def _json(self, value):
+        return json.dumps(value)
+
+    def _from_json(self, value):
+        return json.loads(value) if value is not None else None
+
+    def _timestamp(self, value):
+        return value.isoformat(sep=' ', timespec='microseconds')
+
+    def _from_timestamp(self, value):
+        return datetime.fromisoformat(value) if value is not None else None
+
+    def leader_lock(self, lock_id):
+        return FileLeaderLock(f"{self.path}.lock-{lock_id}")
+
+# Sends read-only queries to read replicas and everything else to the primary.
+#
+# Reads rotate round-robin over the replicas that passed the last health check
+# (reachable and at most REPLICA_MAX_LAG seconds behind); a background thread
+# re-checks them every REPLICA_CHECK_INTERVAL seconds, and a replica that fails
+# a query is skipped at once, the query being retried on the primary. With no
+# healthy replica every read goes to the primary.
+#
+# Read-your-writes: replicas lag, so
+#   - after a write, reads from this process stay on the primary for
+#     READ_YOUR_WRITES_WINDOW seconds (only reads of that license for
+#     add_license/bind_hwid, so binds in a validator worker do not pin it,
+#     and the buyer's licenses_of_user for add_license)
+#   - a license or transaction a replica does not have yet is looked up on the
+#     primary, so a key issued by the bot process validates immediately (this
+#     also sends lookups of unknown keys to the primary)
+# Changes made by other processes to rows a replica already has (e.g. an HWID
+# bound by another worker) can be seen up to REPLICA_MAX_LAG seconds late; the
+# conditional bind_hwid on the primary keeps those races safe.
+class ReplicatedStorage:
+    def __init__(self, primary, replicas):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self._healthy = [True] * len(self.replicas)
+        self._next = itertools.count()
+        self._last_write = float('-inf')
+        self._written_keys = {}
+        self._checker = threading.Thread(target=self._run_health_checks, name="replica-health-check", daemon=True)
+        self._checker.start()
+
+    # Everything not routed below (init_schema, transaction, leader_lock, ...) runs on the primary.
+    # That includes the analytics rollup writes and validation events, which leave
+    # license reads on the replicas since they change no license.
+    def __getattr__(self, name):
+        return getattr(self.primary, name)
+
+    def _run_health_checks(self):
+        while True:
+            time.sleep(REPLICA_CHECK_INTERVAL)
+            for index, replica in enumerate(self.replicas):
+                try:
+                    lag = replica.replication_lag()
+                    healthy = lag <= REPLICA_MAX_LAG
+                    reason = f"replication lag {lag:.1f}s"
+                except Exception as e:
+                    healthy = False
+                    reason = str(e).strip()
+                if healthy != self._healthy[index]:
+                    if healthy:
+                        logger.info("Replica %d back in rotation (%s)", index + 1, reason)
+                    else:
+                        logger.warning("Replica %d taken out of rotation: %s", index + 1, reason)
+                self._healthy[index] = healthy
+
+    def _pick(self):
+        start = next(self._next)
+        for offset in range(len(self.replicas)):
+            index = (start + offset) % len(self.replicas)
+            if self._healthy[index]:
+                return index
+        return None
+
+    def _recently_written(self, license_key=None):
+        now = time.monotonic()
+        if now - self._last_write < READ_YOUR_WRITES_WINDOW:
+            return True
+        return license_key is not None and now - self._written_keys.get(license_key, float('-inf')) < READ_YOUR_WRITES_WINDOW
+
+    def _mark_written(self, license_key=None):
+        now = time.monotonic()
+        if license_key is None:
+            self._last_write = now
+            return
+        if len(self._written_keys) > 10000:
+            self._written_keys = {key: at for key, at in self._written_keys.items() if now - at < READ_YOUR_WRITES_WINDOW}
+        self._written_keys[license_key] = now
+
+    def _read(self, name, *args, license_key=None, missing_on_primary=False):
+        index = None if self._recently_written(license_key) else self._pick()
+        if index is not None:
+            try:
+                result = getattr(self.replicas[index], name)(*args)
+            except Exception as e:
+                self._healthy[index] = False
+                logger.warning("Replica %d failed %s, retrying on the primary: %s", index + 1, name, e)
+                metrics.DB_READS.labels('failover').inc()
+            else:
+                if result is not None or not missing_on_primary:
+                    metrics.DB_READS.labels('replica').inc()
+                    return result
+                metrics.DB_READS.labels('miss').inc()
+        else:
+            metrics.DB_READS.labels('primary').inc()
+        return getattr(self.primary, name)(*args)
+
+    # --- reads -----------------------------------------------------------
+
+    def load_products(self):
+        return self._read('load_products')
+
+    def catalog_version(self):
+        return self._read('catalog_version')
+
+    def load_catalog(self):
+        return self._read('load_catalog')
+
+    def load_licenses(self):
+        return self._read('load_licenses')
+
+    def get_license(self, license_key):
+        return self._read('get_license', license_key, license_key=license_key, missing_on_primary=True)
+
+    # Keys written recently, and keys the replica does not have, are read from
+    # the primary, as in get_license
+    def get_licenses(self, license_keys):
+        license_keys = list(license_keys)
+        index = None if self._recently_written() else self._pick()
+        licenses = {}
+        missing = license_keys
+        if index is not None:
+            try:
+                licenses = self.replicas[index].get_licenses([key for key in license_keys if not self._recently_written(key)])
+            except Exception as e:
+                self._healthy[index] = False
+                logger.warning("Replica %d failed get_licenses, retrying on the primary: %s", index + 1, e)
+                metrics.DB_READS.labels('failover').inc()
+            else:
+                metrics.DB_READS.labels('replica').inc()
+                missing = [key for key in license_keys if key not in licenses]
+                if missing:
+                    metrics.DB_READS.labels('miss').inc()
+        else:
+            metrics.DB_READS.labels('primary').inc()
+        if missing:
+            licenses.update(self.primary.get_licenses(missing))
+        return licenses
+
+    def search_licenses(self, term, limit=20):
+        return self._read('search_licenses', term, limit)
+
+    def licenses_of_user(self, telegram_id, after=None, limit=10):
+        return self._read('licenses_of_user', telegram_id, after, limit, license_key=('telegram_id', telegram_id))
+
+    def load_transactions(self):
+        return self._read('load_transactions')
+
+    def get_transaction(self, license_key):
+        return self._read('get_transaction', license_key, license_key=license_key, missing_on_primary=True)
+
+    def has_seat(self, license_key, hwid):
+        return self._read('has_seat', license_key, hwid, license_key=license_key)
+
+    def list_seats(self, license_key):
+        return self._read('list_seats', license_key, license_key=license_key, missing_on_primary=True)
+
+    def audit_history(self, entity=None, limit=20):
+        return self._read('audit_history', entity, limit)
+
+    def sales_rollup(self, first, last):
+        return self._read('sales_rollup', first, last)
+
+    def usage_rollup(self, first, last):
+        return self._read('usage_rollup', first, last)
+
+    def active_license_counts(self):
+        return self._read('active_license_counts')
+
+    def validation_events(self, license_key, limit=20):
+        return self._read('validation_events', license_key, limit)
+
+    def validation_summary(self, license_key, since):
+        return self._read('validation_summary', license_key, since)
+
+    def shared_licenses(self, since, min_hwids=2, limit=50):
+        return self._read('shared_licenses', since, min_hwids, limit)
+
+    # Generators fail while being consumed, too late to retry elsewhere
+    def stream_rows(self, table, columns, where=None, since=None):
+        index = None if self._recently_written() else self._pick()
+        store = self.primary if index is None else self.replicas[index]
+        return store.stream_rows(table, columns, where, since)
+
+    # --- writes ----------------------------------------------------------
+
+    def save_products(self, products):
+        self._mark_written()
+        self.primary.save_products(products)
+
+    def delete_product(self, product_id):
+        self._mark_written()
+        self.primary.delete_product(product_id)
+
+    def save_licenses(self, licenses):
+        self._mark_written()
+        self.primary.save_licenses(licenses)
+
+    # The buyer is marked too, so their /mylicenses right after paying reads
+    # the primary
+    def add_license(self, license_key, license, transaction):
+        self._mark_written(license_key)
+        if license.get('telegram_id') is not None:
+            self._mark_written(('telegram_id', license['telegram_id']))
+        self.primary.add_license(license_key, license, transaction)
+
+    # Marked even when another request bound the license first, so the re-read
+    # that follows a lost race sees the primary's HWID
+    def bind_hwid(self, license_key, hwid):
+        self._mark_written(license_key)
+        return self.primary.bind_hwid(license_key, hwid)
+
+    def claim_seat(self, license_key, hwid):
+        self._mark_written(license_key)
+        return self.primary.claim_seat(license_key, hwid)
+
+    def release_seats(self, license_key, hwid=None):
+        self._mark_written(license_key)
+        return self.primary.release_seats(license_key, hwid)
+
+    def replace_licenses(self, rows):
+        self._mark_written()
+        self.primary.replace_licenses(rows)
+
+    def save_transactions(self, transactions):
+        self._mark_written()
+        self.primary.save_transactions(transactions)
+
+    def insert_audit_events(self, events):
+        self._mark_written()
+        self.primary.insert_audit_events(events)
+
+def open_database(url):
+    if url and url.startswith('sqlite:///'):
+        return SQLiteStorage(url[len('sqlite:///'):])
+    return PostgresStorage(url)
+
+# replica_urls: read-only copies of `url` (streaming replicas) for ReplicatedStorage
+def open_storage(url, replica_urls=()):
+    primary = open_database(url)
+    if not replica_urls:
+        return primary
+    return ReplicatedStorage(primary, [open_database(replica_url) for replica_url in replica_urls])
@@ -1,5 +1,6 @@
 import telegram
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, ContextTypes
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ConversationHandler, ContextTypes
 import json
 import uuid
 import os
@@ -7,8 +8,6 @@ import re
 from datetime import datetime, timedelta
 from fpdf import FPDF
 from dotenv import load_dotenv
-import psycopg2
-from psycopg2 import sql
 from flask import Flask, request
 import signal
 import sys
@@ -16,227 +15,174 @@ import asyncio
 import logging
 import httpx
 import threading
-
-# Set up logging with DEBUG level
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
+import tempfile
+import time
+from urllib.parse import urlsplit
+from telegram.request import HTTPXRequest
+import analytics
+import audit_log
+import circuit_breaker
+import database
+import export_data
+import file_store
+import leader
+import logging_config
+import metrics
+import purchase_queue
+import tracing
+import validation_log
+import validator
+from database import (init_db, load_products, get_license, add_license, get_transaction, search_licenses, licenses_of_user,
+                      list_seats, release_seats)
 
 # Load environment variables
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
-logger.info(f"Loaded TELEGRAM_TOKEN: {TELEGRAM_TOKEN}")
+# Bot API server; point this at a local stand-in (see benchmarks/fake_telegram.py) for load tests
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
 STELLAR_PUBLIC_KEY = os.getenv('STELLAR_PUBLIC_KEY')
 STELLAR_SECRET_KEY = os.getenv('STELLAR_SECRET_KEY')
-logger.info(f"Loaded STELLAR_PUBLIC_KEY: {STELLAR_PUBLIC_KEY}")
-logger.info(f"Loaded STELLAR_SECRET_KEY: {STELLAR_SECRET_KEY}")
 DATABASE_URL = os.getenv('DATABASE_URL')
-logger.info(f"Loaded DATABASE_URL: {DATABASE_URL}")
+
+# Set up logging (level and per-logger overrides come from LOG_LEVEL / LOG_LEVELS).
+# Secrets are registered first so they are redacted from every log line, including
+# the Bot API URLs logged by httpx.
+logging_config.register_secret(TELEGRAM_TOKEN)
+logging_config.register_secret(STELLAR_SECRET_KEY)
+if DATABASE_URL:
+    logging_config.register_secret(urlsplit(DATABASE_URL).password)
+for url in database.replica_urls() + database.shard_urls():
+    logging_config.register_secret(urlsplit(url).password)
+logging_config.setup_logging()
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger(logging_config.ACCESS_LOGGER_NAME)
+logger.info("Loaded configuration: STELLAR_PUBLIC_KEY=%s, TELEGRAM_TOKEN set=%s, DATABASE_URL set=%s",
+            STELLAR_PUBLIC_KEY, bool(TELEGRAM_TOKEN), bool(DATABASE_URL))
 
 # Admin settings
 ADMIN_USER_ID = 359966763  # Replace with your actual Telegram user ID
-ADMIN_LOG_FILE = 'admin_log.txt'
-
-# Directory to store EA files
-EA_FILES_DIR = 'ea_files'
-if not os.path.exists(EA_FILES_DIR):
-    os.makedirs(EA_FILES_DIR)
 
 # Bot link for trial version redirection
 BOT_LINK = "https://t.me/YourLicenseBot"  # Replace with your actual bot link
 
+# Largest file the Bot API accepts for upload; bigger exports need export_data.py
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+
+# Number of products shown per page of the inline catalog menu
+CATALOG_PAGE_SIZE = 8
+# Seconds between checks of the database's catalog version, for product changes
+# made by other processes (an earlier leader, file_store.py import-products)
+CATALOG_CHECK_INTERVAL = float(os.getenv('CATALOG_CHECK_INTERVAL', '2'))
+
+# Number of licenses shown per page of /mylicenses
+MY_LICENSES_PAGE_SIZE = 5
+
 # States for conversation
 NAME, PRODUCT, PRICING_TIER, PAYMENT, ADMIN_ADD_PRODUCT, ADMIN_ADD_PRODUCT_FILE, ADMIN_EDIT_PRODUCT, ADMIN_EDIT_PRODUCT_ID, ADMIN_EDIT_PRODUCT_FIELD = range(9)
 
-# Initialize Flask app
+# Initialize Flask app; /validate and /metrics come from the validator blueprint,
+# signed product downloads from the file store's
 app = Flask(__name__)
+app.register_blueprint(validator.blueprint)
+app.register_blueprint(file_store.blueprint)
 
-# Database connection
-def get_db_connection():
-    return psycopg2.connect(DATABASE_URL)
-
-# Initialize database tables
-def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS products (
-            id SERIAL PRIMARY KEY,
-            name TEXT NOT NULL,
-            file TEXT NOT NULL,
-            is_trial BOOLEAN DEFAULT FALSE,
-            expiry_days INTEGER,
-            pricing_tiers JSONB
-        );
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS licenses (
-            license_key TEXT PRIMARY KEY,
-            username TEXT NOT NULL,
-            hwid TEXT,
-            expiry TEXT NOT NULL,
-            active BOOLEAN DEFAULT TRUE,
-            tx_hash TEXT,
-            product TEXT NOT NULL,
-            is_trial BOOLEAN DEFAULT FALSE
-        );
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS transactions (
-            license_key TEXT PRIMARY KEY,
-            username TEXT NOT NULL,
-            product TEXT NOT NULL,
-            product_file TEXT NOT NULL,
-            pdf_file TEXT NOT NULL,
-            is_trial BOOLEAN DEFAULT FALSE
-        );
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
-
-# Load products from PostgreSQL
-def load_products():
-    start_time = datetime.now()
-    logger.info("Loading products from database")
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, file, is_trial, expiry_days, pricing_tiers FROM products")
-    rows = cur.fetchall()
-    products = {}
-    for row in rows:
-        product_id, name, file, is_trial, expiry_days, pricing_tiers = row
-        products[str(product_id)] = {
-            'name': name,
-            'file': file,
-            'is_trial': is_trial,
-            'expiry_days': expiry_days,
-            'pricing_tiers': pricing_tiers or {}
-        }
-    cur.close()
-    conn.close()
-    end_time = datetime.now()
-    logger.info(f"Loaded products in {(end_time - start_time).total_seconds()} seconds")
-    return products
-
+# Product writes also drop the cached catalog menus below
 def save_products(products):
-    start_time = datetime.now()
-    logger.info("Saving products to database")
-    conn = get_db_connection()
-    cur = conn.cursor()
-    # Clear existing products
-    cur.execute("DELETE FROM products")
-    # Insert updated products
-    for product_id, info in products.items():
-        cur.execute(
-            """
-            INSERT INTO products (id, name, file, is_trial, expiry_days, pricing_tiers)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            """,
-            (int(product_id), info['name'], info['file'], info.get('is_trial', False), info.get('expiry_days'), info.get('pricing_tiers'))
-        )
-    conn.commit()
-    cur.close()
-    conn.close()
-    end_time = datetime.now()
-    logger.info(f"Saved products in {(end_time - start_time).total_seconds()} seconds")
-
-def load_licenses():
-    start_time = datetime.now()
-    logger.info("Loading licenses from database")
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT license_key, username, hwid, expiry, active, tx_hash, product, is_trial FROM licenses")
-    rows = cur.fetchall()
-    licenses = {}
-    for row in rows:
-        license_key, username, hwid, expiry, active, tx_hash, product, is_trial = row
-        licenses[license_key] = {
-            'username': username,
-            'hwid': hwid,
-            'expiry': expiry,
-            'active': active,
-            'tx_hash': tx_hash,
-            'product': product,
-            'is_trial': is_trial
-        }
-    cur.close()
-    conn.close()
-    end_time = datetime.now()
-    logger.info(f"Loaded licenses in {(end_time - start_time).total_seconds()} seconds")
-    return licenses
-
-def save_licenses(licenses):
-    start_time = datetime.now()
-    logger.info("Saving licenses to database")
-    conn = get_db_connection()
-    cur = conn.cursor()
-    # Clear existing licenses
-    cur.execute("DELETE FROM licenses")
-    # Insert updated licenses
-    for license_key, info in licenses.items():
-        cur.execute(
-            """
-            INSERT INTO licenses (license_key, username, hwid, expiry, active, tx_hash, product, is_trial)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            """,
-            (license_key, info['username'], info['hwid'], info['expiry'], info['active'], info['tx_hash'], info['product'], info['is_trial'])
-        )
-    conn.commit()
-    cur.close()
-    conn.close()
-    end_time = datetime.now()
-    logger.info(f"Saved licenses in {(end_time - start_time).total_seconds()} seconds")
-
-def load_transactions():
-    start_time = datetime.now()
-    logger.info("Loading transactions from database")
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT license_key, username, product, product_file, pdf_file, is_trial FROM transactions")
-    rows = cur.fetchall()
-    transactions = {}
-    for row in rows:
-        license_key, username, product, product_file, pdf_file, is_trial = row
-        transactions[license_key] = {
-            'username': username,
-            'product': product,
-            'product_file': product_file,
-            'pdf_file': pdf_file,
-            'is_trial': is_trial
-        }
-    cur.close()
-    conn.close()
-    end_time = datetime.now()
-    logger.info(f"Loaded transactions in {(end_time - start_time).total_seconds()} seconds")
-    return transactions
-
-def save_transactions(transactions):
-    start_time = datetime.now()
-    logger.info("Saving transactions to database")
-    conn = get_db_connection()
-    cur = conn.cursor()
-    # Clear existing transactions
-    cur.execute("DELETE FROM transactions")
-    # Insert updated transactions
-    for license_key, info in transactions.items():
-        cur.execute(
-            """
-            INSERT INTO transactions (license_key, username, product, product_file, pdf_file, is_trial)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            """,
-            (license_key, info['username'], info['product'], info['product_file'], info['pdf_file'], info['is_trial'])
-        )
-    conn.commit()
-    cur.close()
-    conn.close()
-    end_time = datetime.now()
-    logger.info(f"Saved transactions in {(end_time - start_time).total_seconds()} seconds")
-
-# Log admin actions
-def log_admin_action(user_id, action):
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    with open(ADMIN_LOG_FILE, 'a') as f:
-        f.write(f"[{timestamp}] User {user_id}: {action}\n")
+    database.save_products(products)
+    invalidate_catalog()
+
+def delete_product(product_id):
+    database.delete_product(product_id)
+    invalidate_catalog()
+
+# In-process catalog cache. The version is bumped on every reload so the
+# pre-rendered menus below are rebuilt exactly once per catalog change; the
+# database's catalog version (bumped by every products write, wherever it comes
+# from) tells when to reload. fresh=True checks it now, for payments; otherwise
+# at most every CATALOG_CHECK_INTERVAL seconds. While the database is
+# unavailable the cached catalog is served.
+_catalog = {'version': 0, 'products': None, 'db_version': None, 'checked_at': float('-inf')}
+_menu_cache = {}
+
+def get_catalog(fresh=False):
+    now = time.monotonic()
+    if _catalog['products'] is not None and (fresh or now - _catalog['checked_at'] >= CATALOG_CHECK_INTERVAL):
+        try:
+            if database.catalog_version() != _catalog['db_version']:
+                invalidate_catalog()
+        except Exception as e:
+            if not circuit_breaker.is_outage(e):
+                raise
+            logger.warning("Could not check the catalog version, serving the cached catalog: %s", e)
+        _catalog['checked_at'] = now
+    if _catalog['products'] is None:
+        _catalog['db_version'], _catalog['products'] = database.load_catalog()
+        _catalog['checked_at'] = now
+    return _catalog['version'], _catalog['products']
+
+def invalidate_catalog():
+    _catalog['version'] += 1
+    _catalog['products'] = None
+    _menu_cache.clear()
+
+def get_product_menu(page=0):
+    version, products = get_catalog()
+    page_count = max(1, -(-len(products) // CATALOG_PAGE_SIZE))
+    page = min(max(page, 0), page_count - 1)
+    cache_key = ('products', version, page)
+    if cache_key not in _menu_cache:
+        product_ids = sorted(products.keys(), key=int)
+        page_ids = product_ids[page * CATALOG_PAGE_SIZE:(page + 1) * CATALOG_PAGE_SIZE]
+        keyboard = [
+            [InlineKeyboardButton(
+                f"{products[key]['name']} (Trial)" if products[key].get('is_trial') else products[key]['name'],
+                callback_data=f"product:{key}"
+            )]
+            for key in page_ids
+        ]
+        if page_count > 1:
+            nav = []
+            if page > 0:
+                nav.append(InlineKeyboardButton("« Prev", callback_data=f"products_page:{page - 1}"))
+            nav.append(InlineKeyboardButton(f"{page + 1}/{page_count}", callback_data=f"products_page:{page}"))
+            if page < page_count - 1:
+                nav.append(InlineKeyboardButton("Next »", callback_data=f"products_page:{page + 1}"))
+            keyboard.append(nav)
+        _menu_cache[cache_key] = InlineKeyboardMarkup(keyboard)
+    return _menu_cache[cache_key]
+
+# Pricing tier fields "price_usd,price_xlm,expiry_days[,seats]"; a tier sold
+# with several seats lets each license run on that many machines
+def parse_tier(fields):
+    price_usd, price_xlm, expiry_days, *seats = [field.strip() for field in fields]
+    if len(seats) > 1:
+        raise ValueError("too many values")
+    tier = {'price_usd': float(price_usd), 'price_xlm': float(price_xlm), 'expiry_days': int(expiry_days)}
+    if seats:
+        if int(seats[0]) < 1:
+            raise ValueError("seats must be at least 1")
+        tier['seats'] = int(seats[0])
+    return tier
+
+def tier_seats_text(tier):
+    return f", {tier['seats']} machines" if tier.get('seats', 1) > 1 else ""
+
+def get_tier_menu(product_id):
+    version, products = get_catalog()
+    cache_key = ('tiers', version, product_id)
+    if cache_key not in _menu_cache:
+        pricing_tiers = products[product_id]['pricing_tiers']
+        keyboard = [
+            [InlineKeyboardButton(f"${info['price_usd']} ({info['expiry_days']} days{tier_seats_text(info)})", callback_data=f"tier:{product_id}:{key}")]
+            for key, info in sorted(pricing_tiers.items(), key=lambda item: (len(item[0]), item[0]))
+        ]
+        keyboard.append([InlineKeyboardButton("« Back to products", callback_data="products_page:0")])
+        _menu_cache[cache_key] = InlineKeyboardMarkup(keyboard)
+    return _menu_cache[cache_key]
+
+# Log admin actions to the audit table (queued and flushed in batches by audit_log)
+def log_admin_action(user_id, action, message=None, entity=None, before=None, after=None):
+    audit_log.record(user_id, action, entity=entity, before=before, after=after, message=message)
 
 # Test address for simulation
 TEST_ADDRESS = "GABCDEFGHIJKLMNOPQRSTUVWXYZ234567ABCDEFGHIJKLMNOPQRSTUVW"
@@ -244,9 +190,10 @@ TEST_ADDRESS = "GABCDEFGHIJKLMNOPQRSTUVWXYZ234567ABCDEFGHIJKLMNOPQRSTUVW"
 def generate_license_key():
     return str(uuid.uuid4())
 
+@metrics.PDF_RENDER_LATENCY.time()
+@tracing.traced('pdf.render')
 def create_pdf_license(license_key, username, expiry, product_name, is_trial=False):
-    start_time = datetime.now()
-    logger.info("Creating PDF license")
+    logger.debug("Creating PDF license")
     pdf = FPDF()
     pdf.add_page()
     pdf.set_font("Arial", size=12)
@@ -259,87 +206,117 @@ def create_pdf_license(license_key, username, expiry, product_name, is_trial=Fal
         pdf.cell(200, 10, txt=f"Trial Version - Purchase the full version at {BOT_LINK}", ln=True)
     pdf_file = f"license_{license_key}.pdf"
     pdf.output(pdf_file)
-    end_time = datetime.now()
-    logger.info(f"Created PDF license in {(end_time - start_time).total_seconds()} seconds")
     return pdf_file
 
+# Create the license and transaction records for a purchase (tier = pricing tier key)
+# or a trial claim (tier = 'trial'); returns the new key and its expiry date.
+# telegram_id is the buyer, whose /mylicenses lists the license.
+def issue_license(username, product_info, tier, tx_hash, telegram_id=None):
+    is_trial = tier == 'trial'
+    expiry_days = product_info['expiry_days'] if is_trial else product_info['pricing_tiers'][tier]['expiry_days']
+    seats = 1 if is_trial else product_info['pricing_tiers'][tier].get('seats', 1)
+    expiry = (datetime.now() + timedelta(days=expiry_days)).strftime('%Y-%m-%d')
+    license_key = generate_license_key()
+    product_name = product_info['name']
+
+    license = {
+        'username': username,
+        'hwid': '',
+        'expiry': expiry,
+        'active': True,
+        'tx_hash': tx_hash,
+        'product': product_name,
+        'is_trial': is_trial,
+        'seats': seats,
+        'telegram_id': telegram_id
+    }
+    transaction = {
+        'username': username,
+        'product': product_name,
+        'product_file': product_info['file'],
+        'pdf_file': f"license_{license_key}.pdf",
+        'is_trial': is_trial,
+        'telegram_id': telegram_id,
+        'file_sha256': product_info.get('file_sha256')
+    }
+    sale = analytics.sale(product_info, tier)
+    try:
+        add_license(license_key, license, transaction)
+    except Exception as e:
+        # The customer has paid (or claimed the trial); store it once the
+        # database is back rather than failing the purchase. Anything but an
+        # outage would fail again from the queue, so it fails the purchase now.
+        if not circuit_breaker.is_outage(e):
+            raise
+        logger.warning("Could not store license %s, queueing it: %s", license_key, e)
+        purchase_queue.enqueue(license_key, license, transaction, sale)
+    else:
+        analytics.record_sale(sale)
+
+    metrics.LICENSES_ISSUED.labels(product_name, tier).inc()
+    return license_key, expiry
+
 def check_payment(sender_address):
-    logger.info(f"check_payment: Comparing sender_address='{sender_address}' with TEST_ADDRESS='{TEST_ADDRESS}'")
+    logger.debug("check_payment: Comparing sender_address='%s' with TEST_ADDRESS='%s'", sender_address, TEST_ADDRESS)
     if sender_address == TEST_ADDRESS:
         return True, "simulated-tx-hash-1234567890"
     return False, None
 
+# Bot API client that records per-method latency, 429 responses and a trace span per call
+class MetricsHTTPXRequest(HTTPXRequest):
+    async def do_request(self, url, method, request_data=None, read_timeout=HTTPXRequest.DEFAULT_NONE,
+                         write_timeout=HTTPXRequest.DEFAULT_NONE, connect_timeout=HTTPXRequest.DEFAULT_NONE,
+                         pool_timeout=HTTPXRequest.DEFAULT_NONE):
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            with tracing.span(f"telegram.{api_method}") as api_span:
+                status_code, payload = await super().do_request(
+                    url, method, request_data=request_data, read_timeout=read_timeout,
+                    write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout
+                )
+                if api_span is not None:
+                    api_span.set_attribute('status_code', status_code)
+        finally:
+            metrics.TELEGRAM_REQUEST_LATENCY.labels(api_method).observe(time.perf_counter() - start)
+        if status_code == 429:
+            metrics.TELEGRAM_RATE_LIMITED.labels(api_method).inc()
+        return status_code, payload
+
 # Initialize Telegram bot application
-application = Application.builder().token(TELEGRAM_TOKEN).build()
+application = (
+    Application.builder()
+    .token(TELEGRAM_TOKEN)
+    .base_url(f"{TELEGRAM_API_URL}/bot")
+    .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    .request(MetricsHTTPXRequest(connection_pool_size=256))
+    .build()
+)
 
 # Flask endpoint for Telegram webhook (kept for reference, but not used with polling)
 @app.route('/webhook', methods=['POST'])
 def webhook():
     update = telegram.Update.de_json(request.get_json(force=True), application.bot)
-    logger.info("Received webhook update")
-    logger.debug(f"Webhook update data: {request.get_json(force=True)}")
+    logger.debug("Received webhook update %s", update.update_id)
     # Process the update in the background without blocking
     future = asyncio.run_coroutine_threadsafe(application.process_update(update), asyncio.get_event_loop())
     try:
         result = future.result(timeout=5)  # Wait up to 5 seconds for the update to process
-        logger.info("Webhook update processed successfully")
+        logger.debug("Webhook update processed successfully")
     except Exception as e:
-        logger.error(f"Failed to process webhook update: {str(e)}")
-    logger.info("Webhook update scheduled for processing")
+        logger.error("Failed to process webhook update: %s", e)
     return 'OK', 200
 
-# Flask endpoint for license validation
-@app.route('/validate', methods=['POST'])
-def validate():
-    start_time = datetime.now()
-    logger.info("Validating license via /validate endpoint")
-    data = request.form
-    license_key = data.get('license_key')
-    hwid = data.get('hwid')
-
-    if not license_key or not hwid:
-        logger.error("Missing license_key or hwid")
-        return "Missing license_key or hwid", 400
-
-    licenses = load_licenses()
-    if license_key not in licenses:
-        logger.error(f"Invalid license key: {license_key}")
-        return "Invalid license key", 404
-
-    license = licenses[license_key]
-    expiry_date = datetime.strptime(license['expiry'], '%Y-%m-%d')
-    current_date = datetime.now()
-
-    if license['hwid'] and license['hwid'] != hwid:
-        logger.error(f"HWID mismatch for license {license_key}")
-        return "HWID mismatch", 403
-    if not license['active']:
-        logger.error(f"License deactivated: {license_key}")
-        return "License deactivated", 403
-    if current_date > expiry_date:
-        logger.error(f"License expired: {license_key}")
-        return "License expired", 403
-
-    # If HWID is not set, bind it to the license
-    if not license['hwid']:
-        license['hwid'] = hwid
-        licenses[license_key] = license
-        save_licenses(licenses)
-        logger.info(f"Bound HWID to license {license_key}")
-
-    end_time = datetime.now()
-    logger.info(f"Validated license in {(end_time - start_time).total_seconds()} seconds")
-    return "valid", 200
-
 # Admin commands
+@metrics.timed_handler
+@tracing.traced_handler
 async def admin_list_products(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    start_time = datetime.now()
-    logger.info("Listing products via /admin_list_products")
+    logger.debug("Listing products via /admin_list_products")
     if update.effective_user.id != ADMIN_USER_ID:
         await update.message.reply_text("You are not authorized to use this command.")
         return
     
-    log_admin_action(update.effective_user.id, "Listed products")
+    log_admin_action(update.effective_user.id, "product.list", "Listed products")
     products = load_products()
     if not products:
         await update.message.reply_text("No products available.")
@@ -347,16 +324,15 @@ async def admin_list_products(update: telegram.Update, context: ContextTypes.DEF
     
     product_list = "\n".join([f"ID: {key}\nName: {info['name']}\nFile: {info['file']}\n" +
                               (f"Is Trial: {info['is_trial']}\nExpiry Days: {info['expiry_days']}\n" if info.get('is_trial') else
-                               "Pricing Tiers:\n" + "\n".join([f"  Tier {t_key}: ${t_info['price_usd']} ({t_info['price_xlm']} XLM, {t_info['expiry_days']} days)"
+                               "Pricing Tiers:\n" + "\n".join([f"  Tier {t_key}: ${t_info['price_usd']} ({t_info['price_xlm']} XLM, {t_info['expiry_days']} days{tier_seats_text(t_info)})"
                                                               for t_key, t_info in info['pricing_tiers'].items()]) + "\n")
                               for key, info in products.items()])
     await update.message.reply_text(f"Products:\n{product_list}")
-    end_time = datetime.now()
-    logger.info(f"Listed products in {(end_time - start_time).total_seconds()} seconds")
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def admin_add_product(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Starting /admin_add_product")
+    logger.debug("Starting /admin_add_product")
     if update.effective_user.id != ADMIN_USER_ID:
         await update.message.reply_text("You are not authorized to use this command.")
         return ConversationHandler.END
@@ -364,25 +340,22 @@ async def admin_add_product(update: telegram.Update, context: ContextTypes.DEFAU
     # Clear any ongoing conversation
     context.user_data.clear()
     
-    log_admin_action(update.effective_user.id, "Started adding a new product")
+    log_admin_action(update.effective_user.id, "product.add_started", "Started adding a new product")
     await update.message.reply_text(
         "Let's add a new product.\n"
         "Please provide the product name (e.g., 'MT6 Expert Advisor')."
     )
     context.user_data['admin_product'] = {}
-    end_time = datetime.now()
-    logger.info(f"Finished /admin_add_product setup in {(end_time - start_time).total_seconds()} seconds")
     return ADMIN_ADD_PRODUCT
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def admin_add_product_details(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Processing admin_add_product_details")
+    logger.debug("Processing admin_add_product_details")
     text = update.message.text.strip()
     if 'name' not in context.user_data['admin_product']:
         context.user_data['admin_product']['name'] = text
         await update.message.reply_text("Please upload the EA file for this product (e.g., 'expert_advisor.ex5').")
-        end_time = datetime.now()
-        logger.info(f"Set product name in {(end_time - start_time).total_seconds()} seconds")
         return ADMIN_ADD_PRODUCT_FILE
     
     if 'is_trial' not in context.user_data['admin_product']:
@@ -393,12 +366,10 @@ async def admin_add_product_details(update: telegram.Update, context: ContextTyp
         else:
             await update.message.reply_text(
                 "Please provide pricing tiers in the format:\n"
-                "tier_number,price_usd,price_xlm,expiry_days\n"
-                "For example: 1,10,50,30\n"
+                "tier_number,price_usd,price_xlm,expiry_days[,seats]\n"
+                "For example: 1,10,50,30 or 2,25,125,30,3 for a license usable on 3 machines\n"
                 "Enter one tier per message. Type 'done' when finished."
             )
-        end_time = datetime.now()
-        logger.info(f"Set trial status in {(end_time - start_time).total_seconds()} seconds")
         return ADMIN_ADD_PRODUCT
     
     if context.user_data['admin_product']['is_trial']:
@@ -409,15 +380,15 @@ async def admin_add_product_details(update: telegram.Update, context: ContextTyp
         products[new_id] = {
             'name': product['name'],
             'file': product['file'],
+            'file_sha256': product.get('file_sha256'),
             'is_trial': True,
             'expiry_days': product['expiry_days']
         }
         save_products(products)
-        log_admin_action(update.effective_user.id, f"Added product ID {new_id}: {product['name']}")
+        log_admin_action(update.effective_user.id, "product.add", f"Added product ID {new_id}: {product['name']}",
+                         entity=audit_log.product_entity(new_id), after=products[new_id])
         await update.message.reply_text(f"Product added successfully! ID: {new_id}")
         context.user_data.pop('admin_product', None)
-        end_time = datetime.now()
-        logger.info(f"Added trial product in {(end_time - start_time).total_seconds()} seconds")
         return ConversationHandler.END
     
     if text.lower() == 'done':
@@ -426,42 +397,33 @@ async def admin_add_product_details(update: telegram.Update, context: ContextTyp
         products[new_id] = {
             'name': context.user_data['admin_product']['name'],
             'file': context.user_data['admin_product']['file'],
+            'file_sha256': context.user_data['admin_product'].get('file_sha256'),
             'pricing_tiers': context.user_data['admin_product'].get('pricing_tiers', {})
         }
         save_products(products)
-        log_admin_action(update.effective_user.id, f"Added product ID {new_id}: {context.user_data['admin_product']['name']}")
+        log_admin_action(update.effective_user.id, "product.add", f"Added product ID {new_id}: {context.user_data['admin_product']['name']}",
+                         entity=audit_log.product_entity(new_id), after=products[new_id])
         await update.message.reply_text(f"Product added successfully! ID: {new_id}")
         context.user_data.pop('admin_product', None)
-        end_time = datetime.now()
-        logger.info(f"Added paid product in {(end_time - start_time).total_seconds()} seconds")
         return ConversationHandler.END
     
     try:
-        tier_number, price_usd, price_xlm, expiry_days = text.split(',')
+        tier_number, *fields = text.split(',')
         tier_number = tier_number.strip()
-        price_usd = float(price_usd.strip())
-        price_xlm = float(price_xlm.strip())
-        expiry_days = int(expiry_days.strip())
+        tier = parse_tier(fields)
         if 'pricing_tiers' not in context.user_data['admin_product']:
             context.user_data['admin_product']['pricing_tiers'] = {}
-        context.user_data['admin_product']['pricing_tiers'][tier_number] = {
-            'price_usd': price_usd,
-            'price_xlm': price_xlm,
-            'expiry_days': expiry_days
-        }
+        context.user_data['admin_product']['pricing_tiers'][tier_number] = tier
         await update.message.reply_text("Tier added. Add another tier or type 'done' to finish.")
-        end_time = datetime.now()
-        logger.info(f"Added pricing tier in {(end_time - start_time).total_seconds()} seconds")
         return ADMIN_ADD_PRODUCT
     except Exception as e:
-        await update.message.reply_text(f"Invalid format: {str(e)}. Please use: tier_number,price_usd,price_xlm,expiry_days (e.g., 1,10,50,30)")
-        end_time = datetime.now()
-        logger.info(f"Failed to add pricing tier in {(end_time - start_time).total_seconds()} seconds")
+        await update.message.reply_text(f"Invalid format: {str(e)}. Please use: tier_number,price_usd,price_xlm,expiry_days[,seats] (e.g., 1,10,50,30)")
         return ADMIN_ADD_PRODUCT
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def admin_add_product_file(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Processing admin_add_product_file")
+    logger.debug("Processing admin_add_product_file")
     if not update.message.document:
         await update.message.reply_text("Please upload a file (e.g., an .ex4 or .ex5 file).")
         return ADMIN_ADD_PRODUCT_FILE
@@ -472,23 +434,28 @@ async def admin_add_product_file(update: telegram.Update, context: ContextTypes.
         await update.message.reply_text("Please upload a valid EA file (.ex4 or .ex5).")
         return ADMIN_ADD_PRODUCT_FILE
     
-    # Download the file
+    # Download into the file store; the product references the content by hash
     file = await document.get_file()
-    file_path = os.path.join(EA_FILES_DIR, file_name)
-    await file.download_to_drive(file_path)
+    incoming = file_store.incoming_path()
+    try:
+        await file.download_to_drive(incoming)
+    except Exception:
+        os.remove(incoming)
+        raise
+    file_sha256 = await asyncio.to_thread(file_store.add_file, incoming, True)
     
-    # Store the file path in user data
-    context.user_data['admin_product']['file'] = file_path
-    log_admin_action(update.effective_user.id, f"Uploaded EA file: {file_path}")
+    context.user_data['admin_product']['file'] = file_name
+    context.user_data['admin_product']['file_sha256'] = file_sha256
+    log_admin_action(update.effective_user.id, "product.file_upload", f"Uploaded EA file: {file_name} ({file_sha256})",
+                     after={'file': file_name, 'file_sha256': file_sha256})
     
     await update.message.reply_text("File uploaded successfully! Is this a trial product? (yes/no)")
-    end_time = datetime.now()
-    logger.info(f"Uploaded product file in {(end_time - start_time).total_seconds()} seconds")
     return ADMIN_ADD_PRODUCT
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def admin_edit_product(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Starting /admin_edit_product")
+    logger.debug("Starting /admin_edit_product")
     if update.effective_user.id != ADMIN_USER_ID:
         await update.message.reply_text("You are not authorized to use this command.")
         return ConversationHandler.END
@@ -512,7 +479,8 @@ async def admin_edit_product(update: telegram.Update, context: ContextTypes.DEFA
         
         context.user_data['admin_edit_product_id'] = product_id
         context.user_data['admin_edit_product'] = products[product_id].copy()
-        log_admin_action(update.effective_user.id, f"Started editing product ID {product_id}")
+        log_admin_action(update.effective_user.id, "product.edit_started", f"Started editing product ID {product_id}",
+                     entity=audit_log.product_entity(product_id))
         await update.message.reply_text(
             f"Editing product ID {product_id}: {context.user_data['admin_edit_product']['name']}\n"
             "What would you like to edit?\n"
@@ -522,18 +490,15 @@ async def admin_edit_product(update: telegram.Update, context: ContextTypes.DEFA
             "4. Pricing tiers (if not trial)\n"
             "5. Done"
         )
-        end_time = datetime.now()
-        logger.info(f"Set up product editing in {(end_time - start_time).total_seconds()} seconds")
         return ADMIN_EDIT_PRODUCT
     else:
         await update.message.reply_text("Please provide the product ID to edit (e.g., 1).")
-        end_time = datetime.now()
-        logger.info(f"Requested product ID in {(end_time - start_time).total_seconds()} seconds")
         return ADMIN_EDIT_PRODUCT_ID
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def admin_edit_product_id(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Processing admin_edit_product_id")
+    logger.debug("Processing admin_edit_product_id")
     product_id = update.message.text.strip()
     # Remove any "ID: " prefix if present
     product_id = product_id.replace("ID: ", "").strip()
@@ -545,7 +510,8 @@ async def admin_edit_product_id(update: telegram.Update, context: ContextTypes.D
     
     context.user_data['admin_edit_product_id'] = product_id
     context.user_data['admin_edit_product'] = products[product_id].copy()
-    log_admin_action(update.effective_user.id, f"Started editing product ID {product_id}")
+    log_admin_action(update.effective_user.id, "product.edit_started", f"Started editing product ID {product_id}",
+                     entity=audit_log.product_entity(product_id))
     await update.message.reply_text(
         f"Editing product ID {product_id}: {context.user_data['admin_edit_product']['name']}\n"
         "What would you like to edit?\n"
@@ -555,13 +521,12 @@ async def admin_edit_product_id(update: telegram.Update, context: ContextTypes.D
         "4. Pricing tiers (if not trial)\n"
         "5. Done"
     )
-    end_time = datetime.now()
-    logger.info(f"Set up product editing in {(end_time - start_time).total_seconds()} seconds")
     return ADMIN_EDIT_PRODUCT
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def admin_edit_product_details(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Processing admin_edit_product_details")
+    logger.debug("Processing admin_edit_product_details")
     choice = update.message.text.strip()
     product_id = context.user_data.get('admin_edit_product_id')
     product = context.user_data.get('admin_edit_product')
@@ -570,14 +535,16 @@ async def admin_edit_product_details(update: telegram.Update, context: ContextTy
         await update.message.reply_text("Invalid state. Please start the edit process again with /admin_edit_product.")
         return ConversationHandler.END
     
-    logger.info(f"admin_edit_product_details: choice={choice}")
+    logger.debug("admin_edit_product_details: choice=%s", choice)
     
     if choice == '1':
         await update.message.reply_text("Please provide the new product name.")
         context.user_data['admin_edit_field'] = 'name'
         return ADMIN_EDIT_PRODUCT_FIELD
     elif choice == '2':
-        await update.message.reply_text("Please provide the new file name.")
+        await update.message.reply_text(
+            "Please provide the new file name, or the path of a file on the server to store and deliver instead."
+        )
         context.user_data['admin_edit_field'] = 'file'
         return ADMIN_EDIT_PRODUCT_FIELD
     elif choice == '3' and product.get('is_trial', False):
@@ -587,7 +554,7 @@ async def admin_edit_product_details(update: telegram.Update, context: ContextTy
     elif choice == '4' and not product.get('is_trial', False):
         await update.message.reply_text(
             "Current pricing tiers:\n" +
-            "\n".join([f"Tier {t_key}: ${t_info['price_usd']} ({t_info['price_xlm']} XLM, {t_info['expiry_days']} days)"
+            "\n".join([f"Tier {t_key}: ${t_info['price_usd']} ({t_info['price_xlm']} XLM, {t_info['expiry_days']} days{tier_seats_text(t_info)})"
                        for t_key, t_info in product['pricing_tiers'].items()]) + "\n" +
             "Please provide the tier to edit (e.g., 1) or 'add' to add a new tier, or 'delete <tier_number>' to remove a tier."
         )
@@ -595,23 +562,22 @@ async def admin_edit_product_details(update: telegram.Update, context: ContextTy
         return ADMIN_EDIT_PRODUCT_FIELD
     elif choice == '5':
         products = load_products()
+        before, after = audit_log.diff(products.get(product_id), product)
         products[product_id] = product
         save_products(products)
-        log_admin_action(update.effective_user.id, f"Finished editing product ID {product_id}")
+        log_admin_action(update.effective_user.id, "product.edit", f"Finished editing product ID {product_id}",
+                         entity=audit_log.product_entity(product_id), before=before, after=after)
         await update.message.reply_text("Product updated successfully!")
         context.user_data.clear()
-        end_time = datetime.now()
-        logger.info(f"Finished editing product in {(end_time - start_time).total_seconds()} seconds")
         return ConversationHandler.END
     else:
         await update.message.reply_text("Invalid choice. Please select an option (1-5).")
-        end_time = datetime.now()
-        logger.info(f"Invalid choice in {(end_time - start_time).total_seconds()} seconds")
         return ADMIN_EDIT_PRODUCT
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def admin_edit_product_field(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Processing admin_edit_product_field")
+    logger.debug("Processing admin_edit_product_field")
     text = update.message.text.strip()
     product = context.user_data.get('admin_edit_product')
     field = context.user_data.get('admin_edit_field')
@@ -621,55 +587,68 @@ async def admin_edit_product_field(update: telegram.Update, context: ContextType
         await update.message.reply_text("Invalid state. Please start the edit process again with /admin_edit_product.")
         return ConversationHandler.END
     
-    logger.info(f"admin_edit_product_field: field={field}, subfield={subfield}, text={text}")
+    logger.debug("admin_edit_product_field: field=%s, subfield=%s, text=%s", field, subfield, text)
 
     if subfield == 'edit_tier':
         try:
-            price_usd, price_xlm, expiry_days = text.split(',')
+            tier = parse_tier(text.split(','))
             tier_number = context.user_data['admin_edit_tier']
-            product['pricing_tiers'][tier_number] = {
-                'price_usd': float(price_usd.strip()),
-                'price_xlm': float(price_xlm.strip()),
-                'expiry_days': int(expiry_days.strip())
-            }
-            log_admin_action(update.effective_user.id, f"Edited tier {tier_number} of product ID {context.user_data['admin_edit_product_id']}")
+            old_tier = product['pricing_tiers'].get(tier_number)
+            product['pricing_tiers'][tier_number] = tier
+            log_admin_action(update.effective_user.id, "product.tier_edit", f"Edited tier {tier_number} of product ID {context.user_data['admin_edit_product_id']}",
+                             entity=audit_log.product_entity(context.user_data['admin_edit_product_id']),
+                             before={'pricing_tiers': {tier_number: old_tier}},
+                             after={'pricing_tiers': {tier_number: product['pricing_tiers'][tier_number]}})
             context.user_data.pop('admin_edit_subfield', None)
             context.user_data.pop('admin_edit_tier', None)
             context.user_data.pop('admin_edit_field', None)
         except Exception as e:
-            await update.message.reply_text(f"Invalid format: {str(e)}. Please use: price_usd,price_xlm,expiry_days (e.g., 10,50,30)")
+            await update.message.reply_text(f"Invalid format: {str(e)}. Please use: price_usd,price_xlm,expiry_days[,seats] (e.g., 10,50,30)")
             return ADMIN_EDIT_PRODUCT_FIELD
     elif subfield == 'add_tier':
         try:
-            tier_number, price_usd, price_xlm, expiry_days = text.split(',')
-            product['pricing_tiers'][tier_number.strip()] = {
-                'price_usd': float(price_usd.strip()),
-                'price_xlm': float(price_xlm.strip()),
-                'expiry_days': int(expiry_days.strip())
-            }
-            log_admin_action(update.effective_user.id, f"Added tier {tier_number} to product ID {context.user_data['admin_edit_product_id']}")
+            tier_number, *fields = text.split(',')
+            product['pricing_tiers'][tier_number.strip()] = parse_tier(fields)
+            log_admin_action(update.effective_user.id, "product.tier_add", f"Added tier {tier_number} to product ID {context.user_data['admin_edit_product_id']}",
+                             entity=audit_log.product_entity(context.user_data['admin_edit_product_id']),
+                             after={'pricing_tiers': {tier_number.strip(): product['pricing_tiers'][tier_number.strip()]}})
             context.user_data.pop('admin_edit_subfield', None)
             context.user_data.pop('admin_edit_field', None)
         except Exception as e:
-            await update.message.reply_text(f"Invalid format: {str(e)}. Please use: tier_number,price_usd,price_xlm,expiry_days (e.g., 1,10,50,30)")
+            await update.message.reply_text(f"Invalid format: {str(e)}. Please use: tier_number,price_usd,price_xlm,expiry_days[,seats] (e.g., 1,10,50,30)")
             return ADMIN_EDIT_PRODUCT_FIELD
     elif field == 'name':
+        old_value = product['name']
         product['name'] = text
-        log_admin_action(update.effective_user.id, f"Edited name of product ID {context.user_data['admin_edit_product_id']} to {text}")
+        log_admin_action(update.effective_user.id, "product.field_edit", f"Edited name of product ID {context.user_data['admin_edit_product_id']} to {text}",
+                         entity=audit_log.product_entity(context.user_data['admin_edit_product_id']),
+                         before={'name': old_value}, after={'name': text})
         context.user_data.pop('admin_edit_field', None)
     elif field == 'file':
-        product['file'] = text
-        log_admin_action(update.effective_user.id, f"Edited file of product ID {context.user_data['admin_edit_product_id']} to {text}")
+        # A name only renames the delivered file; a path stores new content
+        before = {'file': product['file'], 'file_sha256': product.get('file_sha256')}
+        if os.path.isfile(text):
+            product['file_sha256'] = await asyncio.to_thread(file_store.add_file, text)
+            product['file'] = os.path.basename(text)
+        else:
+            product['file'] = text
+        after = {'file': product['file'], 'file_sha256': product.get('file_sha256')}
+        log_admin_action(update.effective_user.id, "product.field_edit", f"Edited file of product ID {context.user_data['admin_edit_product_id']} to {product['file']}",
+                         entity=audit_log.product_entity(context.user_data['admin_edit_product_id']),
+                         before=before, after=after)
         context.user_data.pop('admin_edit_field', None)
     elif field == 'expiry_days':
+        old_value = product.get('expiry_days')
         product['expiry_days'] = int(text)
-        log_admin_action(update.effective_user.id, f"Edited expiry_days of product ID {context.user_data['admin_edit_product_id']} to {text}")
+        log_admin_action(update.effective_user.id, "product.field_edit", f"Edited expiry_days of product ID {context.user_data['admin_edit_product_id']} to {text}",
+                         entity=audit_log.product_entity(context.user_data['admin_edit_product_id']),
+                         before={'expiry_days': old_value}, after={'expiry_days': product['expiry_days']})
         context.user_data.pop('admin_edit_field', None)
     elif field == 'pricing_tiers':
         if text.lower() == 'add':
             await update.message.reply_text(
                 "Please provide the new tier in the format:\n"
-                "tier_number,price_usd,price_xlm,expiry_days\n"
+                "tier_number,price_usd,price_xlm,expiry_days[,seats]\n"
                 "For example: 1,10,50,30"
             )
             context.user_data['admin_edit_subfield'] = 'add_tier'
@@ -681,8 +660,10 @@ async def admin_edit_product_field(update: telegram.Update, context: ContextType
                 return ADMIN_EDIT_PRODUCT_FIELD
             tier_number = parts[1]
             if tier_number in product['pricing_tiers']:
-                del product['pricing_tiers'][tier_number]
-                log_admin_action(update.effective_user.id, f"Deleted tier {tier_number} from product ID {context.user_data['admin_edit_product_id']}")
+                old_tier = product['pricing_tiers'].pop(tier_number)
+                log_admin_action(update.effective_user.id, "product.tier_delete", f"Deleted tier {tier_number} from product ID {context.user_data['admin_edit_product_id']}",
+                                 entity=audit_log.product_entity(context.user_data['admin_edit_product_id']),
+                                 before={'pricing_tiers': {tier_number: old_tier}})
                 context.user_data.pop('admin_edit_field', None)
             else:
                 await update.message.reply_text("Tier not found.")
@@ -692,7 +673,7 @@ async def admin_edit_product_field(update: telegram.Update, context: ContextType
             context.user_data['admin_edit_subfield'] = 'edit_tier'
             await update.message.reply_text(
                 "Please provide the updated tier details in the format:\n"
-                "price_usd,price_xlm,expiry_days\n"
+                "price_usd,price_xlm,expiry_days[,seats]\n"
                 "For example: 10,50,30"
             )
             return ADMIN_EDIT_PRODUCT_FIELD
@@ -711,13 +692,12 @@ async def admin_edit_product_field(update: telegram.Update, context: ContextType
         "4. Pricing tiers (if not trial)\n"
         "5. Done"
     )
-    end_time = datetime.now()
-    logger.info(f"Updated product field in {(end_time - start_time).total_seconds()} seconds")
     return ADMIN_EDIT_PRODUCT
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def admin_delete_product(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    start_time = datetime.now()
-    logger.info("Processing /admin_delete_product")
+    logger.debug("Processing /admin_delete_product")
     if update.effective_user.id != ADMIN_USER_ID:
         await update.message.reply_text("You are not authorized to use this command.")
         return
@@ -733,20 +713,214 @@ async def admin_delete_product(update: telegram.Update, context: ContextTypes.DE
         return
     
     product_name = products[product_id]['name']
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM products WHERE id = %s", (int(product_id),))
-    conn.commit()
-    cur.close()
-    conn.close()
-    log_admin_action(update.effective_user.id, f"Deleted product ID {product_id}: {product_name}")
+    delete_product(product_id)
+    log_admin_action(update.effective_user.id, "product.delete", f"Deleted product ID {product_id}: {product_name}",
+                     entity=audit_log.product_entity(product_id), before=products[product_id])
     await update.message.reply_text(f"Product ID {product_id} deleted successfully!")
-    end_time = datetime.now()
-    logger.info(f"Deleted product in {(end_time - start_time).total_seconds()} seconds")
 
+@metrics.timed_handler
+@tracing.traced_handler
+async def admin_history(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("Processing /admin_history")
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+    
+    entity = context.args[0].strip() if context.args else None
+    # A bare number is shorthand for a product ID
+    if entity and entity.isdigit():
+        entity = audit_log.product_entity(entity)
+    
+    events = audit_log.history(entity)
+    if not events:
+        await update.message.reply_text(f"No admin history found for {entity}." if entity else "No admin history found.")
+        return
+    
+    history_text = "\n".join(audit_log.format_event(event) for event in events)
+    if len(history_text) > 4000:
+        history_text = history_text[:4000] + "\n..."
+    await update.message.reply_text(f"Admin history{f' for {entity}' if entity else ''}:\n{history_text}")
+
+@metrics.timed_handler
+@tracing.traced_handler
+async def admin_find(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("Processing /admin_find")
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+    
+    if not context.args:
+        await update.message.reply_text("Usage: /admin_find <username or license key prefix>")
+        return
+    term = context.args[0].strip()
+    
+    # Searches every shard, so run it off the event loop
+    matches = await asyncio.to_thread(search_licenses, term)
+    if not matches:
+        await update.message.reply_text(f"No licenses found for {term}.")
+        return
+    
+    lines = [
+        f"{license_key} - {info['username']} - {info['product']} - expires {info['expiry']}"
+        f"{'' if info['active'] else ' (deactivated)'}{' - HWID bound' if info['hwid'] else ''}"
+        for license_key, info in matches
+    ]
+    result_text = "\n".join(lines)
+    if len(result_text) > 4000:
+        result_text = result_text[:4000] + "\n..."
+    await update.message.reply_text(f"Licenses matching {term}:\n{result_text}")
+
+@metrics.timed_handler
+@tracing.traced_handler
+async def admin_seats(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("Processing /admin_seats")
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+    
+    usage = "Usage: /admin_seats <license_key> [release <hwid|all>]"
+    args = context.args or []
+    if len(args) not in (1, 3) or (len(args) == 3 and args[1].lower() != 'release'):
+        await update.message.reply_text(usage)
+        return
+    license_key = args[0].strip()
+    license = get_license(license_key)
+    if license is None:
+        await update.message.reply_text("License key not found.")
+        return
+    
+    seats = list_seats(license_key)
+    if len(args) == 3:
+        hwid = None if args[2].lower() == 'all' else args[2].strip()
+        released = release_seats(license_key, hwid)
+        if not released:
+            await update.message.reply_text(f"No seat of {license_key} is held by {hwid}." if hwid else f"No seats of {license_key} are in use.")
+            return
+        remaining = list_seats(license_key)
+        log_admin_action(update.effective_user.id, "license.seat_release",
+                         f"Released {released} seat(s) of license {license_key}",
+                         entity=audit_log.license_entity(license_key), before={'seats': seats}, after={'seats': remaining})
+        await update.message.reply_text(f"Released {released} seat(s). {len(remaining)} of {license['seats']} in use.")
+        return
+    
+    seat_text = "\n".join(f"{number}. {hwid}" for number, hwid in enumerate(seats, 1)) or "No machine has used this license yet."
+    await update.message.reply_text(f"Seats of {license_key} ({len(seats)} of {license['seats']} in use):\n{seat_text}")
+
+@metrics.timed_handler
+@tracing.traced_handler
+async def admin_export(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("Processing /admin_export")
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+    
+    usage = f"Usage: /admin_export <{'|'.join(sorted(export_data.EXPORTS))}> [csv|ndjson] [since]"
+    args = context.args or []
+    name = args[0].lower() if args else 'licenses'
+    fmt = args[1].lower() if len(args) > 1 else 'csv'
+    if name not in export_data.EXPORTS or fmt not in export_data.FORMATS:
+        await update.message.reply_text(usage)
+        return
+    try:
+        since = datetime.fromisoformat(args[2]) if len(args) > 2 else None
+    except ValueError:
+        await update.message.reply_text(f"Invalid watermark {args[2]!r}. {usage}")
+        return
+    
+    await update.message.reply_text(f"Exporting {name}...")
+    filename = f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}.gz"
+    # The directory goes with whatever the export left in it, even if it failed
+    with tempfile.TemporaryDirectory(prefix='export-') as directory:
+        path = os.path.join(directory, filename)
+        # The export streams from the database in a worker thread so the event loop stays responsive
+        count, watermark = await asyncio.to_thread(export_data.export, database.get_store(), name, path, fmt, since)
+        caption = f"{count} {name} rows" + (f" changed after {since.isoformat()}" if since else "")
+        if watermark is not None:
+            caption += f"\nNext incremental export: /admin_export {name} {fmt} {watermark.isoformat()}"
+        if os.path.getsize(path) > MAX_UPLOAD_BYTES:
+            await update.message.reply_text(f"{caption}\nThe file is too large to send here; run export_data.py on the server instead.")
+        else:
+            with open(path, 'rb') as f:
+                await update.message.reply_document(f, filename=filename, caption=caption)
+        log_admin_action(update.effective_user.id, "data.export", f"Exported {count} {name} rows as {fmt}",
+                         after={'since': since.isoformat() if since else None,
+                                'watermark': watermark.isoformat() if watermark else None})
+
+@metrics.timed_handler
+@tracing.traced_handler
+async def admin_stats(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("Processing /admin_stats")
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+    
+    args = [arg.lower() for arg in context.args or []]
+    chart = 'chart' in args
+    args = [arg for arg in args if arg != 'chart']
+    try:
+        if len(args) > 1:
+            raise ValueError("too many arguments")
+        first, last = analytics.parse_range(args[0] if args else None)
+    except ValueError:
+        await update.message.reply_text(f"Usage: /admin_stats [range] [chart]\nRange: {analytics.RANGE_HELP}")
+        return
+    
+    # Reads the daily rollups (see analytics.py), not the licenses themselves
+    report = await asyncio.to_thread(analytics.report, first, last)
+    stats_text = analytics.format_report(report)
+    if len(stats_text) > 4000:
+        stats_text = stats_text[:4000] + "\n..."
+    await update.message.reply_text(stats_text)
+    if not chart:
+        return
+    
+    filename = f"stats-{report['first']}-{report['last']}.pdf"
+    # The directory goes with whatever the chart left in it, even if it failed
+    with tempfile.TemporaryDirectory(prefix='stats-') as directory:
+        path = os.path.join(directory, filename)
+        # Drawing a long range takes a while, so it happens off the event loop
+        await asyncio.to_thread(analytics.render_chart, report, path)
+        with open(path, 'rb') as f:
+            await update.message.reply_document(f, filename=filename)
+
+@metrics.timed_handler
+@tracing.traced_handler
+async def admin_validations(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("Processing /admin_validations")
+    if update.effective_user.id != ADMIN_USER_ID:
+        await update.message.reply_text("You are not authorized to use this command.")
+        return
+    
+    usage = "Usage: /admin_validations <license_key> [days] or /admin_validations shared [days]"
+    args = context.args or []
+    try:
+        days = float(args[1]) if len(args) > 1 else 7
+    except ValueError:
+        days = 0
+    if len(args) not in (1, 2) or not 0 < days <= validation_log.VALIDATION_LOG_RETENTION_DAYS:
+        await update.message.reply_text(usage)
+        return
+    
+    # Reads the validation log (see validation_log.py) off the event loop
+    if args[0].lower() == 'shared':
+        report_text = await asyncio.to_thread(validation_log.shared_report, days)
+    else:
+        report_text = await asyncio.to_thread(validation_log.license_report, args[0].strip(), days)
+    if len(report_text) > 4000:
+        report_text = report_text[:4000] + "\n..."
+    await update.message.reply_text(report_text)
+
+# Job of the poller leader (see analytics.py)
+async def sweep_expired_licenses(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        await asyncio.to_thread(analytics.sweep_expired)
+    except Exception as e:
+        logger.error("Sweeping expired licenses failed: %s", e)
+
+@metrics.timed_handler
+@tracing.traced_handler
 async def admin_help(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    start_time = datetime.now()
-    logger.info("Processing /admin_help")
+    logger.debug("Processing /admin_help")
     if update.effective_user.id != ADMIN_USER_ID:
         await update.message.reply_text("You are not authorized to use this command.")
         return
@@ -769,158 +943,228 @@ async def admin_help(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE
         "   - Description: Deletes a product by its ID.\n"
         "   - Usage: `/admin_delete_product <product_id>`\n"
         "   - Example: `/admin_delete_product 5`\n\n"
-        "5. **/admin_help**\n"
+        "5. **/admin_history**\n"
+        "   - Description: Shows recent admin actions, optionally for one entity.\n"
+        "   - Usage: `/admin_history [entity]`\n"
+        "   - Example: `/admin_history product:5` or `/admin_history 5`\n\n"
+        "6. **/admin_export**\n"
+        "   - Description: Exports licenses, transactions or payments as a gzipped CSV/NDJSON file.\n"
+        "   - Usage: `/admin_export <licenses|transactions|payments> [csv|ndjson] [since]`\n"
+        "   - Example: `/admin_export licenses csv` or `/admin_export payments ndjson 2025-05-01T00:00:00`\n\n"
+        "7. **/admin_find**\n"
+        "   - Description: Finds licenses by username or license key prefix.\n"
+        "   - Usage: `/admin_find <username or key prefix>`\n"
+        "   - Example: `/admin_find john` or `/admin_find 3f2a`\n\n"
+        "8. **/admin_seats**\n"
+        "   - Description: Lists the machines using a license, or frees seats so other machines can use it.\n"
+        "   - Usage: `/admin_seats <license_key> [release <hwid|all>]`\n"
+        "   - Example: `/admin_seats 3f2a... release all`\n\n"
+        "9. **/admin_stats**\n"
+        "   - Description: Shows sales, revenue, validations and active licenses per product, optionally with a chart.\n"
+        "   - Usage: `/admin_stats [today|7d|30d|month|YYYY-MM|first..last] [chart]`\n"
+        "   - Example: `/admin_stats 30d chart` or `/admin_stats 2025-05`\n\n"
+        "10. **/admin_validations**\n"
+        "   - Description: Shows the recent validations of a license (outcome, address, machine), or the licenses validated from more machines than they have seats.\n"
+        "   - Usage: `/admin_validations <license_key> [days]` or `/admin_validations shared [days]`\n"
+        "   - Example: `/admin_validations 3f2a...` or `/admin_validations shared 30`\n\n"
+        "11. **/admin_help**\n"
         "   - Description: Displays this help message with a list of admin commands.\n"
         "   - Usage: `/admin_help`\n\n"
         "💡 **Tip**: Ensure you are logged in as the admin (user ID: {ADMIN_USER_ID}) to use these commands."
     )
     await update.message.reply_text(help_text)
-    end_time = datetime.now()
-    logger.info(f"Displayed admin help in {(end_time - start_time).total_seconds()} seconds")
 
 # User commands
+@metrics.timed_handler
+@tracing.traced_handler
 async def start(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Starting /start handler")
-    logger.debug(f"Update received: {update.to_dict()}")
+    logger.debug("Starting /start handler")
+    logger.debug("Update received: %s", update)
     context.user_data.clear()
     await update.message.reply_text(
         "Welcome to LicenseBot! Let's get started.\nWhat's your name?"
     )
     context.user_data['state'] = NAME
-    end_time = datetime.now()
-    logger.info(f"Finished /start handler in {(end_time - start_time).total_seconds()} seconds")
     return NAME
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def get_name(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Processing get_name")
+    logger.debug("Processing get_name")
     context.user_data['name'] = update.message.text.strip()
-    products = load_products()
-    product_list = "\n".join([f"{key}. {info['name']}" for key, info in products.items()])
     await update.message.reply_text(
-        f"Hello {context.user_data['name']}! Please select a product:\n{product_list}\n\nType the number of your choice (e.g., 1 or 2 for full versions, 3 or 4 for trials)."
+        f"Hello {context.user_data['name']}! Please select a product:",
+        reply_markup=get_product_menu()
     )
     context.user_data['state'] = PRODUCT
-    end_time = datetime.now()
-    logger.info(f"Processed get_name in {(end_time - start_time).total_seconds()} seconds")
     return PRODUCT
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def select_product(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Processing select_product")
+    logger.debug("Processing select_product")
     product_choice = update.message.text.strip()
-    products = load_products()
+    _, products = get_catalog()
     if product_choice not in products:
-        product_list = "\n".join([f"{key}. {info['name']}" for key, info in products.items()])
         await update.message.reply_text(
-            f"Invalid choice. Please select a product by typing the number:\n{product_list}"
+            "Invalid choice. Please select a product from the menu:",
+            reply_markup=get_product_menu()
         )
         return PRODUCT
     
+    next_state = await choose_product(update, context, product_choice)
+    return next_state
+
+# Inline menu callbacks for the product step: "products_page:<page>" or "product:<product_id>"
+@metrics.timed_handler
+@tracing.traced_handler
+async def select_product_callback(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    logger.debug("Processing select_product_callback")
+    query = update.callback_query
+    await query.answer()
+    action, _, value = query.data.partition(':')
+    _, products = get_catalog()
+    
+    if action == 'products_page' or value not in products:
+        page = int(value) if action == 'products_page' and value.isdigit() else 0
+        menu = get_product_menu(page)
+        if query.message.reply_markup != menu:
+            await query.edit_message_reply_markup(reply_markup=menu)
+        return PRODUCT
+    
+    next_state = await choose_product(update, context, value)
+    return next_state
+
+async def choose_product(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE, product_choice) -> int:
+    _, products = get_catalog()
     context.user_data['product'] = product_choice
     product_info = products[product_choice]
+    query = update.callback_query
     
     if product_info.get('is_trial', False):
-        username = context.user_data['name']
-        expiry = (datetime.now() + timedelta(days=product_info['expiry_days'])).strftime('%Y-%m-%d')
-        license_key = generate_license_key()
-        product_name = product_info['name']
-        product_file = product_info['file']
-        
-        licenses = load_licenses()
-        licenses[license_key] = {
-            'username': username,
-            'hwid': '',
-            'expiry': expiry,
-            'active': True,
-            'tx_hash': 'trial-no-payment',
-            'product': product_name,
-            'is_trial': True
-        }
-        save_licenses(licenses)
-        
-        transactions = load_transactions()
-        transactions[license_key] = {
-            'username': username,
-            'product': product_name,
-            'product_file': product_file,
-            'pdf_file': f"license_{license_key}.pdf",
-            'is_trial': True
-        }
-        save_transactions(transactions)
-        
-        pdf_file = create_pdf_license(license_key, username, expiry, product_name, is_trial=True)
-        
-        await update.message.reply_text(
-            f"Trial License Generated!\n"
-            f"License Key: {license_key}\n"
-            f"Username: {username}\n"
-            f"Product: {product_name}\n"
-            f"Expiry: {expiry}\n"
-            "Please enter this license key in your EA settings.\n"
-            "When you run the EA for the first time, it will automatically detect your machine's Hardware ID (HWID) and register it with your license."
-        )
-        
-        try:
-            with open(pdf_file, 'rb') as f:
-                await update.message.reply_text("Sending License Certificate...")
-                await update.message.reply_document(f, caption="Your License Certificate")
-            
-            with open(product_file, 'rb') as f:
-                await update.message.reply_text(f"Sending {product_name}...")
-                await update.message.reply_document(f, caption=f"Your {product_name}")
-            
-            with open('usage_guide.pdf', 'rb') as f:
-                await update.message.reply_text("Sending Usage Guide...")
-                await update.message.reply_document(f, caption="Usage Guide")
-            
-            await update.message.reply_text(
-                f"Thank you for trying our product! After the trial expires, purchase a full version at {BOT_LINK}."
-            )
-        except Exception as e:
-            await update.message.reply_text(
-                f"An error occurred while sending the files: {str(e)}\n"
-                f"Please use /resend {license_key} to try again."
-            )
-        end_time = datetime.now()
-        logger.info(f"Generated trial license in {(end_time - start_time).total_seconds()} seconds")
+        if query:
+            await query.edit_message_text(f"You selected {product_info['name']}.")
+        await issue_trial_license(update.effective_message, context, product_info, update.effective_user.id)
         return ConversationHandler.END
     
-    pricing_tiers = product_info['pricing_tiers']
-    tier_list = "\n".join([f"{key}. ${info['price_usd']} ({info['expiry_days']} days)" for key, info in pricing_tiers.items()])
-    await update.message.reply_text(
-        f"You selected {product_info['name']}.\n"
-        f"Please select a pricing tier:\n{tier_list}\n\nType the number of your choice (e.g., 1, 2, 3, or 4)."
-    )
+    prompt = f"You selected {product_info['name']}.\nPlease select a pricing tier:"
+    if query:
+        await query.edit_message_text(prompt, reply_markup=get_tier_menu(product_choice))
+    else:
+        await update.message.reply_text(prompt, reply_markup=get_tier_menu(product_choice))
     context.user_data['state'] = PRICING_TIER
-    end_time = datetime.now()
-    logger.info(f"Selected product in {(end_time - start_time).total_seconds()} seconds")
     return PRICING_TIER
 
+# Deliver a product file: as a signed download link when downloads are
+# configured (see file_store.py), otherwise uploaded through the Bot API.
+# `file_name` is a legacy path for products that predate the file store.
+async def send_product_file(message: telegram.Message, product_name, file_name, file_sha256) -> None:
+    name = os.path.basename(file_name)
+    if file_sha256 and file_store.downloads_enabled():
+        minutes = max(1, round(file_store.DOWNLOAD_URL_TTL / 60))
+        await message.reply_text(
+            f"Download {product_name} here. The link is valid for {minutes} minutes; /resend gives you a new one.",
+            reply_markup=InlineKeyboardMarkup([[
+                InlineKeyboardButton(f"Download {name}", url=file_store.download_url(file_sha256, name))
+            ]])
+        )
+        return
+    with open(file_store.resolve(file_name, file_sha256), 'rb') as f:
+        await message.reply_text(f"Sending {product_name}...")
+        await message.reply_document(f, filename=name, caption=f"Your {product_name}")
+
+async def issue_trial_license(message: telegram.Message, context: ContextTypes.DEFAULT_TYPE, product_info, telegram_id) -> None:
+    username = context.user_data['name']
+    product_name = product_info['name']
+    product_file = product_info['file']
+    license_key, expiry = issue_license(username, product_info, 'trial', 'trial-no-payment', telegram_id)
+    pdf_file = create_pdf_license(license_key, username, expiry, product_name, is_trial=True)
+    
+    await message.reply_text(
+        f"Trial License Generated!\n"
+        f"License Key: {license_key}\n"
+        f"Username: {username}\n"
+        f"Product: {product_name}\n"
+        f"Expiry: {expiry}\n"
+        "Please enter this license key in your EA settings.\n"
+        "When you run the EA for the first time, it will automatically detect your machine's Hardware ID (HWID) and register it with your license."
+    )
+    
+    try:
+        with open(pdf_file, 'rb') as f:
+            await message.reply_text("Sending License Certificate...")
+            await message.reply_document(f, caption="Your License Certificate")
+        
+        await send_product_file(message, product_name, product_file, product_info.get('file_sha256'))
+        
+        with open('usage_guide.pdf', 'rb') as f:
+            await message.reply_text("Sending Usage Guide...")
+            await message.reply_document(f, caption="Usage Guide")
+        
+        await message.reply_text(
+            f"Thank you for trying our product! After the trial expires, purchase a full version at {BOT_LINK}."
+        )
+    except Exception as e:
+        await message.reply_text(
+            f"An error occurred while sending the files: {str(e)}\n"
+            f"Please use /resend {license_key} to try again."
+        )
+
+@metrics.timed_handler
+@tracing.traced_handler
 async def select_pricing_tier(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Processing select_pricing_tier")
+    logger.debug("Processing select_pricing_tier")
     tier_choice = update.message.text.strip()
     product_choice = context.user_data['product']
-    products = load_products()
-    product_info = products[product_choice]
-    pricing_tiers = product_info['pricing_tiers']
+    _, products = get_catalog()
     
-    if tier_choice not in pricing_tiers:
-        tier_list = "\n".join([f"{key}. ${info['price_usd']} ({info['expiry_days']} days)" for key, info in pricing_tiers.items()])
+    if product_choice not in products or tier_choice not in products[product_choice]['pricing_tiers']:
         await update.message.reply_text(
-            f"Invalid choice. Please select a pricing tier by typing the number:\n{tier_list}"
+            "Invalid choice. Please select a pricing tier from the menu:",
+            reply_markup=get_tier_menu(product_choice) if product_choice in products else get_product_menu()
+        )
+        return PRICING_TIER if product_choice in products else PRODUCT
+    
+    next_state = await choose_pricing_tier(update, context, tier_choice)
+    return next_state
+
+# Inline menu callbacks for the tier step: "tier:<product_id>:<tier>" or "products_page:<page>" (back)
+@metrics.timed_handler
+@tracing.traced_handler
+async def select_pricing_tier_callback(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    logger.debug("Processing select_pricing_tier_callback")
+    query = update.callback_query
+    await query.answer()
+    action, _, value = query.data.partition(':')
+    product_choice, _, tier_choice = value.partition(':')
+    _, products = get_catalog()
+    
+    if action == 'products_page' or product_choice not in products:
+        context.user_data.pop('product', None)
+        await query.edit_message_text(
+            f"Hello {context.user_data.get('name', '')}! Please select a product:",
+            reply_markup=get_product_menu()
         )
+        context.user_data['state'] = PRODUCT
+        return PRODUCT
+    
+    if tier_choice not in products[product_choice]['pricing_tiers']:
+        await query.edit_message_reply_markup(reply_markup=get_tier_menu(product_choice))
         return PRICING_TIER
     
+    context.user_data['product'] = product_choice
+    next_state = await choose_pricing_tier(update, context, tier_choice)
+    return next_state
+
+async def choose_pricing_tier(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE, tier_choice) -> int:
+    _, products = get_catalog()
     context.user_data['pricing_tier'] = tier_choice
-    tier_info = pricing_tiers[tier_choice]
+    tier_info = products[context.user_data['product']]['pricing_tiers'][tier_choice]
     payment_amount_xlm = tier_info['price_xlm']
     payment_amount_usd = tier_info['price_usd']
     
-    await update.message.reply_text(
-        f"You selected the ${payment_amount_usd} tier ({tier_info['expiry_days']} days).\n"
+    payment_text = (
+        f"You selected the ${payment_amount_usd} tier ({tier_info['expiry_days']} days{tier_seats_text(tier_info)}).\n"
         f"To proceed, please send one of the following to this Stellar address: {STELLAR_PUBLIC_KEY}\n"
         f"- {payment_amount_xlm} XLM\n"
         f"- {payment_amount_usd} USDC (equivalent to ${payment_amount_usd})\n\n"
@@ -928,14 +1172,17 @@ async def select_pricing_tier(update: telegram.Update, context: ContextTypes.DEF
         f"For testing, you can use this address: {TEST_ADDRESS}\n\n"
         "Please type the address manually to avoid copying issues."
     )
+    if update.callback_query:
+        await update.callback_query.edit_message_text(payment_text)
+    else:
+        await update.message.reply_text(payment_text)
     context.user_data['state'] = PAYMENT
-    end_time = datetime.now()
-    logger.info(f"Selected pricing tier in {(end_time - start_time).total_seconds()} seconds")
     return PAYMENT
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def verify_payment(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Processing verify_payment")
+    logger.debug("Processing verify_payment")
     sender_address = update.message.text.strip()
     sender_address = re.sub(r'[^A-Z0-9]', '', sender_address.upper())
     
@@ -954,39 +1201,20 @@ async def verify_payment(update: telegram.Update, context: ContextTypes.DEFAULT_
         context.user_data['tx_hash'] = tx_hash
         product_choice = context.user_data['product']
         tier_choice = context.user_data['pricing_tier']
-        products = load_products()
-        product_info = products[product_choice]
-        tier_info = product_info['pricing_tiers'][tier_choice]
+        _, products = get_catalog(fresh=True)
+        product_info = products.get(product_choice)
+        if product_info is None or tier_choice not in product_info['pricing_tiers']:
+            logger.error("Payment %s verified for %s tier %s, which is no longer for sale", tx_hash, product_choice, tier_choice)
+            await update.message.reply_text(
+                "This product is no longer available. Your payment was received; please contact the admin "
+                f"with this transaction: {tx_hash}"
+            )
+            return ConversationHandler.END
         product_name = product_info['name']
         product_file = product_info['file']
-        
-        license_key = generate_license_key()
         username = context.user_data['name']
-        expiry_days = tier_info['expiry_days']
-        expiry = (datetime.now() + timedelta(days=expiry_days)).strftime('%Y-%m-%d')
-        
-        licenses = load_licenses()
-        licenses[license_key] = {
-            'username': username,
-            'hwid': '',
-            'expiry': expiry,
-            'active': True,
-            'tx_hash': context.user_data['tx_hash'],
-            'product': product_name,
-            'is_trial': False
-        }
-        save_licenses(licenses)
-        
-        transactions = load_transactions()
-        transactions[license_key] = {
-            'username': username,
-            'product': product_name,
-            'product_file': product_file,
-            'pdf_file': f"license_{license_key}.pdf",
-            'is_trial': False
-        }
-        save_transactions(transactions)
-        
+        license_key, expiry = issue_license(username, product_info, tier_choice, context.user_data['tx_hash'],
+                                           update.effective_user.id)
         pdf_file = create_pdf_license(license_key, username, expiry, product_name)
         
         await update.message.reply_text(
@@ -1004,9 +1232,7 @@ async def verify_payment(update: telegram.Update, context: ContextTypes.DEFAULT_
                 await update.message.reply_text("Sending License Certificate...")
                 await update.message.reply_document(f, caption="Your License Certificate")
             
-            with open(product_file, 'rb') as f:
-                await update.message.reply_text(f"Sending {product_name}...")
-                await update.message.reply_document(f, caption=f"Your {product_name}")
+            await send_product_file(update.message, product_name, product_file, product_info.get('file_sha256'))
             
             with open('usage_guide.pdf', 'rb') as f:
                 await update.message.reply_text("Sending Usage Guide...")
@@ -1018,71 +1244,149 @@ async def verify_payment(update: telegram.Update, context: ContextTypes.DEFAULT_
                 f"An error occurred while sending the files: {str(e)}\n"
                 f"Please use /resend {license_key} to try again."
             )
-        end_time = datetime.now()
-        logger.info(f"Verified payment and generated license in {(end_time - start_time).total_seconds()} seconds")
         return ConversationHandler.END
     else:
         await update.message.reply_text(
             "Payment not found. Please ensure you sent the correct amount to the address provided.\n"
             f"Expected address for testing: {TEST_ADDRESS}"
         )
-        end_time = datetime.now()
-        logger.info(f"Failed payment verification in {(end_time - start_time).total_seconds()} seconds")
         return PAYMENT
 
-async def resend_files(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    start_time = datetime.now()
-    logger.info("Processing /resend")
-    if not context.args:
-        await update.message.reply_text("Please provide your license key. Usage: /resend <license_key>")
-        return
-    
-    license_key = context.args[0].strip()
-    transactions = load_transactions()
-    
-    if license_key not in transactions:
-        await update.message.reply_text("License key not found. Please contact support with your transaction details.")
-        return
-    
-    transaction = transactions[license_key]
+# Send the certificate, product file and usage guide of a license again
+async def send_license_files(message: telegram.Message, license_key, transaction) -> None:
     product_name = transaction['product']
     product_file = transaction['product_file']
     pdf_file = transaction['pdf_file']
-    username = transaction['username']
     is_trial = transaction.get('is_trial', False)
     
-    await update.message.reply_text(f"Resending files for license key: {license_key}...")
+    await message.reply_text(f"Resending files for license key: {license_key}...")
     
     try:
         with open(pdf_file, 'rb') as f:
-            await update.message.reply_text("Sending License Certificate...")
-            await update.message.reply_document(f, caption="Your License Certificate")
+            await message.reply_text("Sending License Certificate...")
+            await message.reply_document(f, caption="Your License Certificate")
         
-        with open(product_file, 'rb') as f:
-            await update.message.reply_text(f"Sending {product_name}...")
-            await update.message.reply_document(f, caption=f"Your {product_name}")
+        await send_product_file(message, product_name, product_file, transaction.get('file_sha256'))
         
         with open('usage_guide.pdf', 'rb') as f:
-            await update.message.reply_text("Sending Usage Guide...")
-            await update.message.reply_document(f, caption="Usage Guide")
+            await message.reply_text("Sending Usage Guide...")
+            await message.reply_document(f, caption="Usage Guide")
         
         if is_trial:
-            await update.message.reply_text(
+            await message.reply_text(
                 f"Thank you for trying our product! After the trial expires, purchase a full version at {BOT_LINK}."
             )
         else:
-            await update.message.reply_text("Thank you! Check your files above.")
+            await message.reply_text("Thank you! Check your files above.")
     except Exception as e:
-        await update.message.reply_text(
+        await message.reply_text(
             f"An error occurred while resending the files: {str(e)}\n"
             "Please contact support with your license key and transaction details."
         )
-    end_time = datetime.now()
-    logger.info(f"Resent files in {(end_time - start_time).total_seconds()} seconds")
 
+# /resend <key> looks the transaction up by primary key; /mylicenses finds the
+# key for users who lost it
+@metrics.timed_handler
+@tracing.traced_handler
+async def resend_files(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("Processing /resend")
+    if not context.args:
+        await update.message.reply_text(
+            "Please provide your license key. Usage: /resend <license_key>\n"
+            "Lost your key? /mylicenses lists the licenses you bought."
+        )
+        return
+    
+    license_key = context.args[0].strip()
+    transaction = get_transaction(license_key)
+    
+    if transaction is None:
+        await update.message.reply_text("License key not found. Please contact support with your transaction details.")
+        return
+    
+    await send_license_files(update.message, license_key, transaction)
+
+# One page of the caller's licenses with a resend button each. Pages follow the
+# (expiry, license_key) of the last license shown ("mylicenses:<expiry>:<key>",
+# "mylicenses:" for the first page), so every page is one indexed range read.
+async def my_licenses_page(telegram_id, after=None):
+    # Fans out to every shard, so run it off the event loop
+    licenses = await asyncio.to_thread(licenses_of_user, telegram_id, after, MY_LICENSES_PAGE_SIZE + 1)
+    if not licenses and after is None:
+        return "You have no licenses yet. Use /start to buy one or claim a trial.", None
+    has_next = len(licenses) > MY_LICENSES_PAGE_SIZE
+    licenses = licenses[:MY_LICENSES_PAGE_SIZE]
+    today = datetime.now().strftime('%Y-%m-%d')
+    lines = []
+    keyboard = []
+    for license_key, info in licenses:
+        if not info['active']:
+            status = "deactivated"
+        elif info['expiry'] < today:
+            status = f"expired {info['expiry']}"
+        else:
+            status = f"expires {info['expiry']}"
+        lines.append(f"{license_key}\n{info['product']}{' (trial)' if info['is_trial'] else ''} - {status}")
+        keyboard.append([InlineKeyboardButton(f"Resend {info['product']} ({info['expiry']})",
+                                              callback_data=f"resend:{license_key}")])
+    nav = []
+    if after is not None:
+        nav.append(InlineKeyboardButton("« First", callback_data="mylicenses:"))
+    if has_next:
+        last_key, last = licenses[-1]
+        nav.append(InlineKeyboardButton("Next »", callback_data=f"mylicenses:{last['expiry']}:{last_key}"))
+    if nav:
+        keyboard.append(nav)
+    text = "Your licenses:\n\n" + "\n\n".join(lines) if lines else "No more licenses."
+    return text, InlineKeyboardMarkup(keyboard) if keyboard else None
+
+@metrics.timed_handler
+@tracing.traced_handler
+async def my_licenses(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("Processing /mylicenses")
+    text, markup = await my_licenses_page(update.effective_user.id)
+    await update.message.reply_text(text, reply_markup=markup)
+
+# "mylicenses:..." pages and "resend:<key>" buttons of /mylicenses; a resend is
+# only answered for the user who bought the license
+@metrics.timed_handler
+@tracing.traced_handler
+async def my_licenses_callback(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    logger.debug("Processing my_licenses_callback")
+    query = update.callback_query
+    action, _, value = query.data.partition(':')
+    telegram_id = update.effective_user.id
+    
+    if action == 'mylicenses':
+        await query.answer()
+        expiry, _, license_key = value.partition(':')
+        text, markup = await my_licenses_page(telegram_id, (expiry, license_key) if license_key else None)
+        await query.edit_message_text(text, reply_markup=markup)
+        return
+    
+    transaction = get_transaction(value)
+    if transaction is None or transaction.get('telegram_id') != telegram_id:
+        await query.answer("License not found.", show_alert=True)
+        return
+    await query.answer()
+    await send_license_files(query.message, value, transaction)
+
+# Why `hwid` cannot use the license, or None if it holds or could still claim a
+# seat; /validate in the bot only reports, the EA's first check binds the machine
+def hwid_mismatch_text(license_key, license, hwid):
+    if not license['hwid'] or license['hwid'] == hwid:
+        return None
+    if license['seats'] <= 1:
+        return "HWID mismatch. This license is locked to a different machine."
+    seats = list_seats(license_key) or []
+    if hwid in seats or len(seats) < license['seats']:
+        return None
+    return f"HWID mismatch. All {license['seats']} seats of this license are used by other machines."
+
+@metrics.timed_handler
+@tracing.traced_handler
 async def validate_license(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    start_time = datetime.now()
-    logger.info("Processing /validate")
+    logger.debug("Processing /validate")
     context.user_data.pop('state', None)
     context.user_data.pop('name', None)
     context.user_data.pop('product', None)
@@ -1094,20 +1398,20 @@ async def validate_license(update: telegram.Update, context: ContextTypes.DEFAUL
         return
 
     license_key = context.args[0].strip()
-    licenses = load_licenses()
+    license = get_license(license_key)
 
-    if license_key not in licenses:
+    if license is None:
         await update.message.reply_text("Invalid license key. Please check and try again.")
         return
 
-    license = licenses[license_key]
     expiry_date = datetime.strptime(license['expiry'], '%Y-%m-%d')
     current_date = datetime.now()
 
     if len(context.args) > 1:
         provided_hwid = context.args[1].strip()
-        if license['hwid'] and license['hwid'] != provided_hwid:
-            await update.message.reply_text("HWID mismatch. This license is locked to a different machine.")
+        mismatch = hwid_mismatch_text(license_key, license, provided_hwid)
+        if mismatch:
+            await update.message.reply_text(mismatch)
             return
         if not license['active']:
             await update.message.reply_text("This license is deactivated.")
@@ -1129,12 +1433,11 @@ async def validate_license(update: telegram.Update, context: ContextTypes.DEFAUL
         context.user_data['validate_key'] = license_key
         context.user_data['validate_state'] = 'awaiting_hwid'
         context.user_data['validate_start_time'] = datetime.now()
-    end_time = datetime.now()
-    logger.info(f"Processed /validate in {(end_time - start_time).total_seconds()} seconds")
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def handle_validate_hwid(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    start_time = datetime.now()
-    logger.info("Processing handle_validate_hwid")
+    logger.debug("Processing handle_validate_hwid")
     if 'validate_state' not in context.user_data or context.user_data['validate_state'] != 'awaiting_hwid':
         return
 
@@ -1149,9 +1452,8 @@ async def handle_validate_hwid(update: telegram.Update, context: ContextTypes.DE
         context.user_data.pop('validate_start_time', None)
         return
 
-    licenses = load_licenses()
     license_key = context.user_data['validate_key']
-    license = licenses[license_key]
+    license = get_license(license_key)
     expiry_date = datetime.strptime(license['expiry'], '%Y-%m-%d')
     current_date = datetime.now()
 
@@ -1174,8 +1476,9 @@ async def handle_validate_hwid(update: telegram.Update, context: ContextTypes.DE
             )
     else:
         provided_hwid = hwid_input
-        if license['hwid'] and license['hwid'] != provided_hwid:
-            await update.message.reply_text("HWID mismatch. This license is locked to a different machine.")
+        mismatch = hwid_mismatch_text(license_key, license, provided_hwid)
+        if mismatch:
+            await update.message.reply_text(mismatch)
             context.user_data.pop('validate_state', None)
             context.user_data.pop('validate_key', None)
             context.user_data.pop('validate_start_time', None)
@@ -1199,16 +1502,13 @@ async def handle_validate_hwid(update: telegram.Update, context: ContextTypes.DE
     context.user_data.pop('validate_state', None)
     context.user_data.pop('validate_key', None)
     context.user_data.pop('validate_start_time', None)
-    end_time = datetime.now()
-    logger.info(f"Processed handle_validate_hwid in {(end_time - start_time).total_seconds()} seconds")
 
+@metrics.timed_handler
+@tracing.traced_handler
 async def cancel(update: telegram.Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    start_time = datetime.now()
-    logger.info("Processing /cancel")
+    logger.debug("Processing /cancel")
     await update.message.reply_text("Process cancelled.")
     context.user_data.clear()
-    end_time = datetime.now()
-    logger.info(f"Processed /cancel in {(end_time - start_time).total_seconds()} seconds")
     return ConversationHandler.END
 
 def setup_application():
@@ -1220,8 +1520,14 @@ def setup_application():
         ],
         states={
             NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_name)],
-            PRODUCT: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_product)],
-            PRICING_TIER: [MessageHandler(filters.TEXT & ~filters.COMMAND, select_pricing_tier)],
+            PRODUCT: [
+                CallbackQueryHandler(select_product_callback, pattern=r'^(product|products_page):'),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, select_product)
+            ],
+            PRICING_TIER: [
+                CallbackQueryHandler(select_pricing_tier_callback, pattern=r'^(tier|products_page):'),
+                MessageHandler(filters.TEXT & ~filters.COMMAND, select_pricing_tier)
+            ],
             PAYMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, verify_payment)],
             ADMIN_ADD_PRODUCT: [MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_product_details)],
             ADMIN_ADD_PRODUCT_FILE: [MessageHandler(filters.Document.ALL, admin_add_product_file)],
@@ -1239,8 +1545,16 @@ def setup_application():
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler("validate", validate_license))
     application.add_handler(CommandHandler("resend", resend_files))
+    application.add_handler(CommandHandler("mylicenses", my_licenses))
+    application.add_handler(CallbackQueryHandler(my_licenses_callback, pattern=r'^(mylicenses|resend):'))
     application.add_handler(CommandHandler("admin_list_products", admin_list_products))
     application.add_handler(CommandHandler("admin_delete_product", admin_delete_product))
+    application.add_handler(CommandHandler("admin_history", admin_history))
+    application.add_handler(CommandHandler("admin_find", admin_find))
+    application.add_handler(CommandHandler("admin_seats", admin_seats))
+    application.add_handler(CommandHandler("admin_export", admin_export))
+    application.add_handler(CommandHandler("admin_stats", admin_stats))
+    application.add_handler(CommandHandler("admin_validations", admin_validations))
     application.add_handler(CommandHandler("admin_help", admin_help))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_validate_hwid))
 
@@ -1249,27 +1563,63 @@ def signal_handler(sig, frame):
     application.stop_running()
     sys.exit(0)
 
-# Function to run the Telegram bot polling in a separate thread
-def run_polling():
-    logger.info("Starting bot polling in a separate thread...")
-    asyncio.run(polling_coroutine())
+# The bot's event loop runs in a background thread; polling on it is started and
+# stopped by the leader election, so only one process of the cluster polls
+_bot_loop = None
+
+def run_on_bot_loop(coroutine):
+    return asyncio.run_coroutine_threadsafe(coroutine, _bot_loop).result()
 
-async def polling_coroutine():
+async def start_polling():
+    # Products may have changed while another process was the leader
+    invalidate_catalog()
     await application.initialize()
     await application.start()
-    logger.info("Bot polling started successfully")
     await application.updater.start_polling(allowed_updates=telegram.Update.ALL_TYPES)
-    logger.info("Polling loop is running")
+    # Stopping the application drops its jobs, so every new leader schedules them
+    application.job_queue.run_repeating(sweep_expired_licenses, interval=analytics.STATS_SWEEP_INTERVAL, first=60,
+                                        name='sweep_expired_licenses')
+    logger.info("Bot polling started successfully")
+
+async def stop_polling():
+    if application.updater.running:
+        await application.updater.stop()
+    if application.running:
+        await application.stop()
+    logger.info("Bot polling stopped")
+
+# Initialize the database, set up the bot and join the poller election.
+# Importing this module has no such side effects. Every process that calls this
+# (replicas of `python telegram_bot.py`, or gunicorn workers of
+# 'telegram_bot:create_app()') serves /validate, but only the elected leader
+# polls Telegram and runs the job queue; see leader.py for failover.
+def start_bot():
+    global _bot_loop
+    os.makedirs(file_store.FILE_STORE_DIR, exist_ok=True)
+    init_db()
+    audit_log.start(database.get_store())
+    purchase_queue.start()
+    setup_application()
+    _bot_loop = asyncio.new_event_loop()
+    bot_thread = threading.Thread(target=_bot_loop.run_forever, name="bot-loop", daemon=True)
+    bot_thread.start()
+    leader.start(
+        database.get_store().leader_lock(leader.POLLER_LOCK_ID),
+        on_elected=lambda: run_on_bot_loop(start_polling()),
+        on_demoted=lambda: run_on_bot_loop(stop_polling())
+    )
+    return bot_thread
 
-# Initialize the database, set up the bot, and start polling when the module is loaded (for production with Gunicorn)
-init_db()
-setup_application()
-polling_thread = threading.Thread(target=run_polling, daemon=True)
-polling_thread.start()
+# Application factory for gunicorn workers that also take part in the election
+# (start without --preload, so each worker runs its own elector):
+#   gunicorn -w 4 -b 0.0.0.0:5000 'telegram_bot:create_app()'
+def create_app():
+    start_bot()
+    return app
 
 if __name__ == '__main__':
-    # For local testing only
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    start_bot()
     logger.info("Starting Flask server for /validate endpoint...")
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,236 @@
+import atexit
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Lightweight tracing: one trace per Telegram update or /validate request, with
+# nested spans for DB calls, PDF renders and Bot API requests.
+#
+#   TRACE_EXPORT          where finished traces go: "file:traces.jsonl" (one span per
+#                         line) or "otlp:http://127.0.0.1:4318/v1/traces" (OTLP/HTTP
+#                         JSON). Unset means traces are only used for slow-trace logs.
+#   TRACE_SLOW_THRESHOLD  traces slower than this many seconds are logged with a
+#                         per-stage breakdown (default 2.0)
+TRACE_EXPORT = os.getenv('TRACE_EXPORT', '')
+TRACE_SLOW_THRESHOLD = float(os.getenv('TRACE_SLOW_THRESHOLD', '2.0'))
+TRACE_EXPORT_BATCH_SIZE = 100
+TRACE_EXPORT_INTERVAL = 1.0  # seconds
+TRACE_MAX_PENDING = 10000  # finished traces buffered for the exporter
+SERVICE_NAME = 'telegram-license-system'
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+class Trace:
+    __slots__ = ('trace_id', 'spans')
+
+    def __init__(self):
+        self.trace_id = secrets.token_hex(16)
+        self.spans = []
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes', 'start_ns', 'end_ns', 'error')
+
+    def __init__(self, trace, parent_id, name, attributes):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    @property
+    def duration(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+def current_trace_id():
+    current = _current_span.get()
+    return current.trace.trace_id if current else None
+
+@contextmanager
+def _run_span(new_span, root):
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.error = repr(e)
+        raise
+    finally:
+        new_span.end_ns = time.time_ns()
+        _current_span.reset(token)
+        new_span.trace.spans.append(new_span)
+        if root:
+            _finish_trace(new_span)
+
+# Start a new trace; used at the entry point of each update or HTTP request
+def trace(name, **attributes):
+    return _run_span(Span(Trace(), None, name, attributes), root=True)
+
+# Child span of the current trace; a cheap no-op when no trace is active
+# (e.g. getUpdates long polls or the background audit flusher)
+@contextmanager
+def span(name, **attributes):
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    with _run_span(Span(parent.trace, parent.span_id, name, attributes), root=False) as child:
+        yield child
+
+# Decorator for sync or async functions; root=True starts a new trace per call
+def traced(name=None, root=False):
+    def decorator(func):
+        span_name = name or func.__name__
+        open_span = trace if root else span
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with open_span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with open_span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Decorator for Telegram handlers: one trace per update, tagged with the update and user IDs
+def traced_handler(func):
+    span_name = f"handler.{func.__name__}"
+
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        attributes = {'update_id': getattr(update, 'update_id', None)}
+        user = getattr(update, 'effective_user', None)
+        if user is not None:
+            attributes['user_id'] = user.id
+        with trace(span_name, **attributes):
+            return await func(update, context, *args, **kwargs)
+    return wrapper
+
+def _finish_trace(root_span):
+    if root_span.duration >= TRACE_SLOW_THRESHOLD:
+        stages = sorted(
+            (s for s in root_span.trace.spans if s is not root_span),
+            key=lambda s: s.duration, reverse=True
+        )
+        breakdown = ", ".join(f"{s.name}={s.duration:.3f}s" for s in stages[:10])
+        logger.warning("Slow trace %s %s took %.3fs: %s", root_span.trace.trace_id, root_span.name,
+                       root_span.duration, breakdown or "no child spans")
+    if _exporter is not None:
+        _exporter.submit(root_span.trace)
+
+class _Exporter:
+    def __init__(self, target):
+        self.kind, _, self.destination = target.partition(':')
+        if self.kind not in ('file', 'otlp') or not self.destination:
+            raise ValueError(f"Unsupported TRACE_EXPORT value: {target}")
+        self.queue = queue.Queue(maxsize=TRACE_MAX_PENDING)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="trace-exporter", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, finished_trace):
+        try:
+            self.queue.put_nowait(finished_trace)
+        except queue.Full:
+            pass
+
+    def run(self):
+        while not self.stop_event.wait(TRACE_EXPORT_INTERVAL):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        while True:
+            traces = []
+            try:
+                while len(traces) < TRACE_EXPORT_BATCH_SIZE:
+                    traces.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if not traces:
+                return
+            spans = [s for t in traces for s in t.spans]
+            try:
+                if self.kind == 'file':
+                    self.write_file(spans)
+                else:
+                    self.post_otlp(spans)
+            except Exception as e:
+                logger.error("Failed to export %d spans: %s", len(spans), e)
+
+    def write_file(self, spans):
+        with open(self.destination, 'a') as f:
+            for s in spans:
+                f.write(json.dumps(s.to_dict(), default=str) + "\n")
+
+    def post_otlp(self, spans):
+        payload = {
+            'resourceSpans': [{
+                'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]},
+                'scopeSpans': [{
+                    'scope': {'name': 'tracing'},
+                    'spans': [_otlp_span(s) for s in spans],
+                }],
+            }]
+        }
+        request = urllib.request.Request(
+            self.destination, data=json.dumps(payload).encode(),
+            headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        with urllib.request.urlopen(request, timeout=5) as response:
+            response.read()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout=TRACE_EXPORT_INTERVAL * 5)
+
+def _otlp_span(s):
+    otlp = {
+        'traceId': s.trace.trace_id,
+        'spanId': s.span_id,
+        'name': s.name,
+        'kind': 1,
+        'startTimeUnixNano': str(s.start_ns),
+        'endTimeUnixNano': str(s.end_ns),
+        'attributes': [{'key': key, 'value': {'stringValue': str(value)}} for key, value in s.attributes.items()],
+        'status': {'code': 2, 'message': s.error} if s.error else {'code': 1},
+    }
+    if s.parent_id:
+        otlp['parentSpanId'] = s.parent_id
+    return otlp
+
+_exporter = _Exporter(TRACE_EXPORT) if TRACE_EXPORT else None
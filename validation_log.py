@@ -0,0 +1,192 @@
+import argparse
+import atexit
+import collections
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from dotenv import load_dotenv
+import database
+import license_index
+import logging_config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# A record of every /validate answer, for tracking down "my EA says invalid"
+# tickets and licenses shared between machines: when, license key, a hash of
+# the HWID (license_index.hwid_hash, so machines can be told apart and matched
+# against a known HWID without storing it), client address, outcome and latency.
+#
+# Answering must not wait for it, so record() only appends to an in-process
+# ring buffer of VALIDATION_LOG_BUFFER_SIZE events (when the database falls
+# behind, the oldest are overwritten and counted as dropped). A background
+# thread writes the buffer every VALIDATION_LOG_FLUSH_INTERVAL seconds in
+# batches of up to VALIDATION_LOG_BATCH_SIZE rows: COPY on PostgreSQL, a
+# multi-row INSERT on SQLite.
+#
+# On PostgreSQL validation_events is partitioned by month. Each process creates
+# the partition of a month when its first event of that month is flushed, and
+# once an hour drops the partitions older than VALIDATION_LOG_RETENTION_DAYS,
+# which removes a month of events without a DELETE or vacuum. SQLite deletes
+# the expired rows instead.
+#
+# The client address is the peer of the connection; behind a reverse proxy
+# that is the proxy.
+
+VALIDATION_LOG_BUFFER_SIZE = int(os.getenv('VALIDATION_LOG_BUFFER_SIZE', '100000'))
+VALIDATION_LOG_FLUSH_INTERVAL = float(os.getenv('VALIDATION_LOG_FLUSH_INTERVAL', '0.25'))  # seconds
+VALIDATION_LOG_BATCH_SIZE = int(os.getenv('VALIDATION_LOG_BATCH_SIZE', '5000'))
+VALIDATION_LOG_RETENTION_DAYS = float(os.getenv('VALIDATION_LOG_RETENTION_DAYS', '90'))
+RETENTION_CHECK_INTERVAL = 3600  # seconds
+# Longest wait between flushes while the database keeps failing
+MAX_RETRY_INTERVAL = 30.0  # seconds
+
+# deque.append and popleft are atomic, so producers need no lock
+_buffer = collections.deque(maxlen=VALIDATION_LOG_BUFFER_SIZE)
+_flush_lock = threading.Lock()
+_start_lock = threading.Lock()
+_flusher_pid = None
+# Months whose partition this process has created
+_partitions = set()
+
+# Queue one answer; never blocks on database I/O
+def record(license_key, hwid, ip, outcome, latency):
+    if len(_buffer) == _buffer.maxlen:
+        metrics.VALIDATION_EVENTS.labels('dropped').inc()
+    _buffer.append((datetime.now(), license_key, license_index.hwid_hash(hwid).hex() if hwid else None, ip, outcome,
+                    round(latency * 1000, 3)))
+    if _flusher_pid != os.getpid():
+        _start_flusher()
+
+def _month(timestamp):
+    return date(timestamp.year, timestamp.month, 1)
+
+# Write everything buffered so far; False if the database failed, in which case
+# the batch goes back into the buffer where there is room
+def flush(store=None):
+    store = store or database.get_store()
+    with _flush_lock:
+        while _buffer:
+            events = []
+            try:
+                while len(events) < VALIDATION_LOG_BATCH_SIZE:
+                    events.append(_buffer.popleft())
+            except IndexError:
+                pass
+            try:
+                months = {_month(event[0]) for event in events} - _partitions
+                if months:
+                    store.ensure_validation_partitions(months)
+                    _partitions.update(months)
+                store.insert_validation_events(events)
+            except Exception as e:
+                room = _buffer.maxlen - len(_buffer)
+                kept = events[len(events) - room:] if room < len(events) else events
+                _buffer.extendleft(reversed(kept))
+                metrics.VALIDATION_EVENTS.labels('dropped').inc(len(events) - len(kept))
+                logger.warning("Could not write %d validation events, %d buffered: %s", len(events), len(_buffer), e)
+                return False
+            metrics.VALIDATION_EVENTS.labels('stored').inc(len(events))
+    return True
+
+# Drop the events older than VALIDATION_LOG_RETENTION_DAYS
+def prune(store=None):
+    store = store or database.get_store()
+    store.drop_validation_events(datetime.now() - timedelta(days=VALIDATION_LOG_RETENTION_DAYS))
+
+def _run_flusher():
+    interval = VALIDATION_LOG_FLUSH_INTERVAL
+    next_prune = time.monotonic()
+    while True:
+        time.sleep(interval)
+        try:
+            # Back off while the database is down instead of retrying four times a second
+            interval = VALIDATION_LOG_FLUSH_INTERVAL if flush() else min(interval * 2, MAX_RETRY_INTERVAL)
+            if time.monotonic() >= next_prune:
+                prune()
+                next_prune = time.monotonic() + RETENTION_CHECK_INTERVAL
+        except Exception:
+            logger.exception("Writing validation events failed")
+
+# Started by the first event of each process, so forked workers get their own
+def _start_flusher():
+    global _flusher_pid
+    with _start_lock:
+        if _flusher_pid == os.getpid():
+            return
+        if _flusher_pid is None:
+            atexit.register(flush)
+        _flusher_pid = os.getpid()
+        threading.Thread(target=_run_flusher, name="validation-log-flusher", daemon=True).start()
+
+# --- reading -----------------------------------------------------------------------
+
+def format_event(event, bound_hash=None):
+    machine = event['hwid_hash'][:12] if event['hwid_hash'] else '-'
+    if bound_hash and event['hwid_hash'] == bound_hash:
+        machine += ' (bound)'
+    return (f"{event['created_at']:%Y-%m-%d %H:%M:%S} {event['outcome']} from {event['ip'] or '-'}, "
+            f"machine {machine}, {event['latency_ms']:.1f} ms")
+
+# Text of the recent validations of a license for /admin_validations; the
+# bound HWID is marked so the machine a customer reports can be recognized
+def license_report(license_key, days=7, limit=15):
+    store = database.get_store()
+    license = database.get_license(license_key)
+    summary = store.validation_summary(license_key, datetime.now() - timedelta(days=days))
+    events = store.validation_events(license_key, limit)
+    bound_hash = license_index.hwid_hash(license['hwid']).hex() if license and license['hwid'] else None
+    outcomes = ", ".join(f"{count} {outcome}" for outcome, count in sorted(summary['outcomes'].items())) or "none"
+    lines = [
+        f"Validations of {license_key} in the last {days:g} days: {outcomes}",
+        f"From {summary['hwids']} machine(s) and {summary['ips']} address(es)"
+        + (f"; the license has {license['seats']} seat(s)" if license else "; the key does not exist"),
+    ]
+    if events:
+        lines.append("")
+        lines.extend(format_event(event, bound_hash) for event in events)
+    return "\n".join(lines)
+
+# Licenses validated from more machines than they have seats in the last `days` days
+def shared_report(days=7, limit=20):
+    store = database.get_store()
+    candidates = store.shared_licenses(datetime.now() - timedelta(days=days), limit=limit * 5)
+    licenses = database.get_licenses([row[0] for row in candidates]) if candidates else {}
+    lines = []
+    for license_key, hwids, ips, validations in candidates:
+        license = licenses.get(license_key)
+        if license is None or hwids <= license['seats']:
+            continue
+        lines.append(f"{license_key} ({license['username']}, {license['product']}): {hwids} machines for "
+                     f"{license['seats']} seat(s), {ips} address(es), {validations} validations")
+        if len(lines) == limit:
+            break
+    if not lines:
+        return f"No license was validated from more machines than it has seats in the last {days:g} days."
+    return f"Licenses validated from more machines than seats in the last {days:g} days:\n" + "\n".join(lines)
+
+def main():
+    load_dotenv()
+    logging_config.setup_logging()
+    parser = argparse.ArgumentParser(description="Read and prune the validation event log.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    license_parser = subparsers.add_parser('license', help="recent validations of a license")
+    license_parser.add_argument('license_key')
+    license_parser.add_argument('--days', type=float, default=7)
+    license_parser.add_argument('--limit', type=int, default=50)
+    shared_parser = subparsers.add_parser('shared', help="licenses validated from more machines than they have seats")
+    shared_parser.add_argument('--days', type=float, default=7)
+    subparsers.add_parser('prune', help=f"drop events older than {VALIDATION_LOG_RETENTION_DAYS:g} days")
+    args = parser.parse_args()
+
+    if args.command == 'license':
+        print(license_report(args.license_key, args.days, args.limit))
+    elif args.command == 'shared':
+        print(shared_report(args.days))
+    else:
+        prune()
+
+if __name__ == '__main__':
+    main()
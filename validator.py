@@ -0,0 +1,226 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import urlsplit
+from dotenv import load_dotenv
+from flask import Blueprint, Flask, request
+import analytics
+import circuit_breaker
+import database
+import file_store
+import leases
+import license_index
+import logging_config
+import metrics
+import tracing
+import validation_log
+
+# License validation service: POST /validate and GET /metrics (and the signed
+# product file downloads of file_store.py).
+#
+# This module imports neither python-telegram-bot nor fpdf and does nothing when
+# imported, so validator workers start quickly, stay small and can be scaled
+# independently of the bot, which runs once as `python telegram_bot.py`:
+#
+#   gunicorn -w 8 -b 0.0.0.0:5000 'validator:create_app()'
+#
+# telegram_bot registers the same blueprint, so its Flask app still serves
+# /validate in single-process setups. async_validator.py runs the same checks
+# (check_license, claim_machine) for clients on persistent connections.
+#
+# Every answer is counted for /admin_stats (analytics.py) and recorded in the
+# validation log (validation_log.py), both without waiting on the database.
+#
+# With LICENSE_INDEX_PATH set, machines that are already bound to a valid
+# license are answered from the shared license index (license_index.py) without
+# a database query.
+#
+# While the database is unavailable (a connection error or timeout, or the
+# circuit breaker of database.py is open), /validate answers from the last known good state: the
+# license index, even if its follower has stopped, or the machines this worker
+# last validated on the database. Either may be up to DEGRADED_GRACE_SECONDS
+# old. Such answers carry "X-License-Degraded: 1" ("degraded": true in JSON) and
+# at most the shortest lease; machines neither source knows get a 503.
+#
+# /validate answers in plain text ("valid" or the reason for a refusal), which
+# existing EA builds compare against. Every answer carries X-License-Next-Check
+# (seconds until the client should validate again); answers that grant a
+# validation lease (see leases.py) also carry it in X-License-Lease, refusals
+# do not. Clients that send "Accept: application/json" get all of it as JSON,
+# with "lease_seconds": null on refusals:
+#
+#   {"status": "valid", "outcome": "valid", "message": "valid",
+#    "lease_seconds": 21600, "next_check_seconds": 13017}
+
+logger = logging.getLogger(__name__)
+access_logger = logging.getLogger(logging_config.ACCESS_LOGGER_NAME)
+
+blueprint = Blueprint('validator', __name__)
+
+# Flask endpoint for Prometheus scrapes
+@blueprint.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    body, content_type = metrics.render_metrics()
+    return body, 200, {'Content-Type': content_type}
+
+# (outcome, message, status) of the /validate answers
+VALID = ('valid', "valid", 200)
+MISSING_PARAMS = ('missing_params', "Missing license_key or hwid", 400)
+INVALID_KEY = ('invalid_key', "Invalid license key", 404)
+HWID_MISMATCH = ('hwid_mismatch', "HWID mismatch", 403)
+DEACTIVATED = ('deactivated', "License deactivated", 403)
+EXPIRED = ('expired', "License expired", 403)
+NO_FREE_SEAT = ('no_free_seat', "No free seats", 403)
+# Answers while the database is unavailable; the body stays "valid" for EAs
+VALID_DEGRADED = ('valid_degraded', "valid", 200)
+UNAVAILABLE = ('unavailable', "Service temporarily unavailable", 503)
+DEGRADED_RESULTS = (VALID_DEGRADED, UNAVAILABLE)
+
+DEGRADED_GRACE_SECONDS = float(os.getenv('DEGRADED_GRACE_SECONDS', '21600'))
+# Machines remembered per worker for degraded answers
+DEGRADED_CACHE_SIZE = 20000
+
+# (license_key, hwid) -> (expiry, time.monotonic() of the last valid answer from
+# the database), oldest first
+_last_good = OrderedDict()
+_last_good_lock = threading.Lock()
+
+# Flask endpoint for license validation
+@blueprint.route('/validate', methods=['POST'])
+@tracing.traced('http.validate', root=True)
+def validate():
+    start_time = time.perf_counter()
+    data = request.form
+    license_key = data.get('license_key')
+    hwid = data.get('hwid')
+
+    if not license_key or not hwid:
+        return validate_response(MISSING_PARAMS, license_key, start_time)
+
+    license = license_index.valid_license(license_key, hwid)
+    if license is not None:
+        return validate_response(VALID, license_key, start_time, license)
+    try:
+        license = database.get_license(license_key)
+        result = check_license(license, hwid) or claim_machine(license_key, license, hwid)
+    except Exception as e:
+        if not circuit_breaker.is_outage(e):
+            logger.exception("Validation of license %s failed", license_key)
+            raise
+        result, license = degraded_result(license_key, hwid, e)
+    else:
+        if result is VALID:
+            remember_valid(license_key, hwid, license)
+    return validate_response(result, license_key, start_time, license)
+
+# Checks a looked-up license (None if the key is unknown) without writing
+# anything; None means the machine still has to be bound or take a seat
+def check_license(license, hwid):
+    if license is None:
+        return INVALID_KEY
+    multi_seat = license['seats'] > 1
+    if license['hwid'] and license['hwid'] != hwid and not multi_seat:
+        return HWID_MISMATCH
+    if not license['active']:
+        return DEACTIVATED
+    if datetime.now() > leases.expiry_time(license['expiry']):
+        return EXPIRED
+    if license['hwid'] == hwid:
+        return VALID
+    return None
+
+# Binds the HWID to a license that has none yet, or gives the machine a seat of
+# a multi-seat license
+def claim_machine(license_key, license, hwid):
+    if license['seats'] > 1:
+        # Machines other than the first hold rows of license_seats; a new one
+        # claims a free seat, if there is one
+        if database.has_seat(license_key, hwid):
+            return VALID
+        if not database.claim_seat(license_key, hwid):
+            return NO_FREE_SEAT
+        logger.info("Claimed a seat of license %s", license_key)
+    elif database.bind_hwid(license_key, hwid):
+        logger.info("Bound HWID to license %s", license_key)
+    elif database.get_license(license_key)['hwid'] != hwid:
+        # A concurrent request bound a different machine first
+        return HWID_MISMATCH
+    return VALID
+
+def remember_valid(license_key, hwid, license):
+    with _last_good_lock:
+        _last_good[(license_key, hwid)] = (license['expiry'], time.monotonic())
+        _last_good.move_to_end((license_key, hwid))
+        while len(_last_good) > DEGRADED_CACHE_SIZE:
+            _last_good.popitem(last=False)
+
+# (result, license) from the last known good state, for a validation that the
+# database could not answer because of `error` (circuit_breaker.is_outage)
+def degraded_result(license_key, hwid, error):
+    if not isinstance(error, circuit_breaker.CircuitOpen):
+        logger.warning("Validating license %s on the database failed, answering degraded: %s", license_key, error)
+    license = license_index.valid_license(license_key, hwid, max_age=DEGRADED_GRACE_SECONDS)
+    if license is None:
+        with _last_good_lock:
+            expiry, validated_at = _last_good.get((license_key, hwid), (None, None))
+        if expiry is not None and time.monotonic() - validated_at <= DEGRADED_GRACE_SECONDS \
+                and datetime.now() <= leases.expiry_time(expiry):
+            license = {'expiry': expiry}
+    return (VALID_DEGRADED, license) if license is not None else (UNAVAILABLE, None)
+
+# Adds the lease, records the outcome histogram and one sampled access log line
+# per /validate request
+def validate_response(result, license_key, start_time, license=None):
+    outcome, message, status = result
+    degraded = result in DEGRADED_RESULTS
+    lease, next_check = leases.grant(outcome, license_key, license if status == 200 else None, degraded)
+    body = message
+    if request.accept_mimetypes.best_match(('text/plain', 'application/json')) == 'application/json':
+        body = answer_json(result, lease, next_check)
+    record_answer(outcome, license_key, status, start_time, lease, license, request.form.get('hwid'), request.remote_addr)
+    return body, status, lease_headers(lease, next_check, degraded)
+
+def lease_headers(lease, next_check, degraded=False):
+    headers = {'X-License-Next-Check': str(next_check)}
+    if lease is not None:
+        headers['X-License-Lease'] = str(lease)
+    if degraded:
+        headers['X-License-Degraded'] = '1'
+    return headers
+
+def answer_json(result, lease, next_check):
+    outcome, message, status = result
+    answer = 'valid' if status == 200 else 'unavailable' if result is UNAVAILABLE else 'refused'
+    return {'status': answer, 'outcome': outcome, 'message': message,
+            'lease_seconds': lease, 'next_check_seconds': next_check, 'degraded': result in DEGRADED_RESULTS}
+
+# `license` is what the answer was based on, for the per-product validation
+# counts of analytics.py; hwid and ip go into the validation log
+def record_answer(outcome, license_key, status, start_time, lease, license=None, hwid=None, ip=None):
+    duration = time.perf_counter() - start_time
+    metrics.VALIDATE_LATENCY.labels(outcome).observe(duration)
+    if lease is not None:
+        metrics.VALIDATE_LEASE.observe(lease)
+    validation_log.record(license_key, hwid, ip, outcome, duration)
+    if outcome != MISSING_PARAMS[0]:
+        analytics.count_validation(outcome, license_key, status, license)
+    access_logger.info("validate outcome=%s license_key=%s status=%d duration=%.3fs lease=%s",
+                       outcome, license_key, status, duration, lease)
+
+# Application factory for validator-only processes
+def create_app():
+    load_dotenv()
+    database_url = os.getenv('DATABASE_URL')
+    if database_url:
+        logging_config.register_secret(urlsplit(database_url).password)
+    for url in database.replica_urls() + database.shard_urls():
+        logging_config.register_secret(urlsplit(url).password)
+    logging_config.setup_logging()
+    app = Flask(__name__)
+    app.register_blueprint(blueprint)
+    app.register_blueprint(file_store.blueprint)
+    logger.info("Validator ready: DATABASE_URL set=%s, read replicas=%d", bool(database_url), len(database.replica_urls()))
+    return app